@@ -9,21 +9,35 @@ default parameters.
 For the CEs and SEs already present in the CS, the agent is updating
 if necessary settings which were changed in the BDII recently
 """
-from urllib.parse import urlparse
+import os
 from datetime import datetime, date, timedelta
 from textwrap import dedent
 
-from DIRAC import S_OK
+from DIRAC import S_OK, S_ERROR
 from DIRAC.ConfigurationSystem.Client.CSAPI import CSAPI
 from DIRAC.ConfigurationSystem.Agent.Bdii2CSAgent import Bdii2CSAgent
 from DIRAC.ConfigurationSystem.Client.Helpers.Path import cfgPath
 from DIRAC.FrameworkSystem.Client.NotificationClient import NotificationClient
 from GridPPDIRAC.ConfigurationSystem.private.AutoBDIISEs import update_ses
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.BDIIPool import BDIIPool, split_host
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.CapacityModel import CapacityModel
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.ConfigurationSystem import ConfigurationSystem
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.Deadline import CancelToken, StageCancelled
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.Fingerprints import Fingerprints, fingerprint
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.GOCDBCache import GOCDBCache
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.LastSeenStore import LastSeenStore
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.Metrics import metrics
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.Sharding import Shard
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.SiteMetadata import site_metadata
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.QueueVariants import (ARC_QUEUE_VARIANTS,
+                                                                                      HTCONDOR_QUEUE_VARIANTS,
+                                                                                      load_queue_variants)
 from GridPPDIRAC.ConfigurationSystem.private.AddResourceAPI import (update_ces,
                                                                     remove_old_ces,
                                                                     find_old_ses,
                                                                     find_htcondor_ces,
                                                                     find_arc_ces)
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.StageScheduler import StageScheduler
 
 
 __RCSID__ = "$Id$"
@@ -53,80 +67,264 @@ class AutoBdii2CSAgent(Bdii2CSAgent):
                             default value = None
                             By default uses the DIRAC built in default
                             DIRAC default = 'lcg-bdii.cern.ch:2170'
+        bdii_pool         - The BDIIs queries are raced over, BDIIHosts if set
+                            (else just bdii_host). BDIIRace hosts are queried at
+                            once, BDIIQueryTimeout seconds at most, a failing
+                            host is quarantined for BDIIQuarantineTime seconds
+                            and answers with fewer than BDIIMinResultFraction
+                            of the usual number of entries are not trusted
+        capacity_model    - If DynamicQueueLimits is set, the EWMA capacity model
+                            used to derive Glue2 queue pilot limits from the
+                            advertised share load, persisted in the work directory
+        queue_variants    - Glue2 single/multi-core queue variant tables, any
+                            variants defined in the QueueVariants/ARC and
+                            QueueVariants/HTCondor subsections take precedence
+                            over the built in ones
+        CommitBatchSize   - If non-zero, CS changes are committed in batches
+                            of about this many changes, adapted to how long
+                            the master takes to respond (CommitTargetTime)
+        JournalChanges    - Journal CS change sets in the work directory so an
+                            interrupted commit is replayed on the next cycle
+        LastSeenSyncDays  - If non-zero, LastSeen dates are kept in a store in the
+                            work directory and only written to the CS once they
+                            are this many days behind
+        StageWorkers      - Maximum number of discovery stages run at once,
+                            0 runs them all concurrently
+        CycleTimeout      - Seconds the discovery stages of a cycle may take in
+                            total, stages still running are then cancelled and
+                            their changes dropped (0 for no limit)
+        StageTimeout      - Seconds each discovery stage may take (0 for only the
+                            CycleTimeout)
+        ChangeLog         - Write the committed CS changes, with the stage making
+                            them, to a JSON-lines change log in the work directory
+        ChangeLogSample   - Fraction of the per option records written to the
+                            change log (section summaries are always written)
+        WriteMetrics      - Write Prometheus metrics (metrics.prom) and a JSON
+                            cycle report (cycle_report.json) to the work directory
+        MetricsTextfileDirectory - If set, the Prometheus metrics are written there
+                            instead, e.g. node-exporter's textfile collector directory
+        shard             - If ShardCount is more than 1, the Shard (ShardIndex of
+                            ShardCount) of the GOCDB sites this instance discovers
+                            and reconciles, the others being left to the instances
+                            configured with the other indices
+        SkipUnchanged     - Skip rebuilding and reconciling the resources of a
+                            discovery stage whose BDII results are unchanged since
+                            the last committed cycle, only refreshing LastSeen
+        FingerprintMaxAge - Seconds after which a stage is fully reconciled even
+                            if its BDII results are unchanged
+        GOCDBSiteMetadata - Take the country codes, coordinates and contacts of
+                            sites from their GOCDB site records, cached in the
+                            work directory
+        SiteMetadataTTL   - Seconds the GOCDB site records are used for before
+                            being fetched again
         """
         self.domain = self.am_getOption('Domain', AutoBdii2CSAgent.domain)
         self.country_default = self.am_getOption('CountryCodeDefault', AutoBdii2CSAgent.country_default)
         self.bdii_host = self.am_getOption('BDIIHost', "topbdii.grid.hep.ph.ic.ac.uk:2170")
+        shard_count = self.am_getOption('ShardCount', 1)
+        self.shard = None
+        if shard_count > 1:
+            try:
+                self.shard = Shard(self.am_getOption('ShardIndex', 0), shard_count)
+            except ValueError as err:
+                return S_ERROR(str(err))
+        self.bdii_pool = BDIIPool(self.am_getOption('BDIIHosts', []) or [self.bdii_host],
+                                  race=self.am_getOption('BDIIRace', 2),
+                                  timeout=self.am_getOption('BDIIQueryTimeout', 300),
+                                  quarantine=self.am_getOption('BDIIQuarantineTime', 1800),
+                                  min_fraction=self.am_getOption('BDIIMinResultFraction', 0.5))
         self.removeOldCEs = self.am_getOption('RemoveOldCEs', True)
         self.ce_removal_threshold = self.am_getOption('CERemovalThreshold', 5)
         self.banned_ces = self.am_getOption('BannedCEs', [])
         self.banned_ses = self.am_getOption('BannedSEs', [])
         self.max_processors = self.am_getOption('FixedMaxProcessors', None)
-        return Bdii2CSAgent.initialize(self)
+        self.site_workers = self.am_getOption('SiteWorkers', 8)
+        self.stage_workers = self.am_getOption('StageWorkers', 0)
+        self.cycle_timeout = self.am_getOption('CycleTimeout', 18000)
+        self.stage_timeout = self.am_getOption('StageTimeout', 0)
+        self.write_metrics = self.am_getOption('WriteMetrics', True)
+        self.metrics_directory = self.am_getOption('MetricsTextfileDirectory', '')
+        journal_path = None
+        if self.am_getOption('JournalChanges', True):
+            journal_path = os.path.join(self.am_getWorkDirectory(), 'cs_journal.jsonl')
+        ConfigurationSystem.configure(commit_batch_size=self.am_getOption('CommitBatchSize', 0) or None,
+                                      commit_target_time=self.am_getOption('CommitTargetTime', 10.),
+                                      journal_path=journal_path)
+        last_seen_sync_days = self.am_getOption('LastSeenSyncDays', 3)
+        if last_seen_sync_days and ConfigurationSystem.last_seen_store is None:
+            ConfigurationSystem.configure(last_seen_store=LastSeenStore(self.am_getWorkDirectory()),
+                                          last_seen_sync_days=last_seen_sync_days)
+        if self.am_getOption('ChangeLog', True):
+            ConfigurationSystem.configure(change_log_path=os.path.join(self.am_getWorkDirectory(),
+                                                                       'cs_changes.jsonl'),
+                                          change_log_sample=self.am_getOption('ChangeLogSample', 1.))
+        self.gocdb_site_metadata = self.am_getOption('GOCDBSiteMetadata', True)
+        site_metadata.configure(cache=GOCDBCache(self.am_getWorkDirectory()),
+                                ttl=self.am_getOption('SiteMetadataTTL', 86400))
+        self.capacity_model = None
+        if self.am_getOption('DynamicQueueLimits', False):
+            self.capacity_model = CapacityModel(os.path.join(self.am_getWorkDirectory(), 'capacity.json'),
+                                                alpha=self.am_getOption('CapacitySmoothing', 0.3),
+                                                waiting_fraction=self.am_getOption('CapacityWaitingFraction', 0.1),
+                                                min_waiting=self.am_getOption('MinWaitingJobs', 10),
+                                                max_waiting=self.am_getOption('MaxWaitingJobs', 5000))
+        variants_section = cfgPath(self.am_getModuleParam('section'), 'QueueVariants')
+        self.arc_queue_variants = load_queue_variants(cfgPath(variants_section, 'ARC'),
+                                                      ARC_QUEUE_VARIANTS)
+        self.htcondor_queue_variants = load_queue_variants(cfgPath(variants_section, 'HTCondor'),
+                                                           HTCONDOR_QUEUE_VARIANTS)
+        result = Bdii2CSAgent.initialize(self)
+        # The variant tables are ordered, so they are fingerprinted by repr
+        self.fingerprints = None
+        if self.am_getOption('SkipUnchanged', True):
+            self.fingerprint_inputs = fingerprint(self.voName, self.domain, self.country_default,
+                                                  self.banned_ces, self.banned_ses, self.max_processors,
+                                                  repr(self.arc_queue_variants),
+                                                  repr(self.htcondor_queue_variants), str(self.shard),
+                                                  volatile=None)
+            self.fingerprints = Fingerprints(os.path.join(self.am_getWorkDirectory(), 'fingerprints.json'),
+                                             max_age=self.am_getOption('FingerprintMaxAge', 86400))
+        return result
 
     def execute(self):
-        """General agent execution method."""
-        # Update SEs
+        """Run _execute, exporting its metrics to the work directory."""
+        if self.shard is not None:
+            metrics.start_cycle(agent='AutoBdii2CSAgent', shard=str(self.shard.Index))
+        else:
+            metrics.start_cycle(agent='AutoBdii2CSAgent')
+        try:
+            with metrics.timer('cycle_seconds'):
+                return self._execute()
+        finally:
+            if self.write_metrics:
+                metrics.export(self.am_getWorkDirectory(), self.metrics_directory)
+
+    def _execute(self):
+        """
+        General agent execution method.
+
+        The SE and CE discovery stages run concurrently into one change set on a
+        single ConfigurationSystem, old CEs are then removed from the merged state
+        and everything is committed at once. Stages whose BDII results are
+        unchanged since the last committed cycle only refresh LastSeen. Stages
+        overrunning their deadline are cancelled, the finished ones still commit.
+        """
+        cfg_system = ConfigurationSystem()
+        if self.gocdb_site_metadata:
+            site_metadata.refresh()
+        else:
+            site_metadata.reset()
+        if self.capacity_model is not None:
+            self.capacity_model.discard()
+        if self.fingerprints is not None:
+            self.fingerprints.discard()
+            # New GOCDB site records may change the sites' names, coordinates and contacts
+            self.fingerprints.inputs = fingerprint(self.fingerprint_inputs, site_metadata.hash,
+                                                   volatile=None)
+
+        # Replay any change set left behind by an interrupted commit
         ##############################
-        url = urlparse('//%s' % self.bdii_host)
         try:
-            update_ses(self.voName,
-                       address=(url.hostname, url.port if url.port is not None else 2170),
-                       banned_ses=self.banned_ses)
+            cfg_system.replay_journal()
         except Exception:
-            self.log.exception("Error while running check for new SEs")
+            self.log.exception("Error while replaying the CS change journal")
+
+        scheduler = StageScheduler(cfg_system, workers=self.stage_workers,
+                                   stage_timeout=self.stage_timeout or None,
+                                   token=CancelToken(self.cycle_timeout or None))
+
+        # Update SEs
+        ##############################
+        scheduler.add('update_ses', update_ses, self.voName,
+                      address=split_host(self.bdii_host),
+                      banned_ses=self.banned_ses,
+                      replica=cfg_system.replica(),
+                      fingerprints=self.fingerprints,
+                      bdii_pool=self.bdii_pool,
+                      shard=self.shard)
 
         # Update CEs
         ##############################
         if self.processCEs:
-            self.log.notice("Starting Glue1 CE processing")
-            try:
-                update_ces(voList=self.voName,
-                           host=self.bdii_host,
-                           domain=self.domain,
-                           country_default=self.country_default,
-                           banned_ces=self.banned_ces,
-                           max_processors=self.max_processors)
-            except Exception:
-                self.log.exception("Error while running check for new CEs")
+            scheduler.add('update_ces', update_ces,
+                          voList=self.voName,
+                          host=self.bdii_host,
+                          domain=self.domain,
+                          country_default=self.country_default,
+                          banned_ces=self.banned_ces,
+                          max_processors=self.max_processors,
+                          workers=self.site_workers,
+                          fingerprints=self.fingerprints,
+                          bdii_pool=self.bdii_pool,
+                          shard=self.shard)
 
             # Update HTCondor CEs
             ##############################
-            self.log.notice("Processing HTCondor Glue2 CEs")
-            try:
-                find_htcondor_ces(voList=self.voName,
-                                  bdii_host=self.bdii_host,
-                                  banned_ces=self.banned_ces,
-                                  max_processors=self.max_processors)
-            except Exception:
-                self.log.exception("Error while running check for new HTCondor CEs")
+            scheduler.add('find_htcondor_ces', find_htcondor_ces,
+                          voList=self.voName,
+                          bdii_host=self.bdii_host,
+                          banned_ces=self.banned_ces,
+                          max_processors=self.max_processors,
+                          capacity_model=self.capacity_model,
+                          queue_variants=self.htcondor_queue_variants,
+                          fingerprints=self.fingerprints,
+                          bdii_pool=self.bdii_pool,
+                          shard=self.shard)
 
             # Update ARC CEs
             ##############################
-            self.log.notice("Processing ARC Glue2 CEs")
-            try:
-                find_arc_ces(voList=self.voName,
-                             bdii_host=self.bdii_host,
-                             banned_ces=self.banned_ces,
-                             max_processors=self.max_processors)
-            except Exception:
-                self.log.exception("Error while running check for new ARC CEs")
+            scheduler.add('find_arc_ces', find_arc_ces,
+                          voList=self.voName,
+                          bdii_host=self.bdii_host,
+                          banned_ces=self.banned_ces,
+                          max_processors=self.max_processors,
+                          capacity_model=self.capacity_model,
+                          queue_variants=self.arc_queue_variants,
+                          fingerprints=self.fingerprints,
+                          bdii_pool=self.bdii_pool,
+                          shard=self.shard)
+
+        self.log.notice("Running SE and CE discovery stages")
+        results = scheduler.run()
+        # An overrun stage's thread may yet record a fingerprint for the changes dropped
+        if self.fingerprints is not None and any(isinstance(result.Error, StageCancelled)
+                                                 for result in results):
+            self.fingerprints.discard()
 
         # Remove old CEs with last_seen > threshold
         ##############################
         if self.removeOldCEs:
             try:
-                remove_old_ces(removal_threshold=self.ce_removal_threshold,
-                               domain=self.domain,
-                               banned_ces=self.banned_ces)
+                with ConfigurationSystem.stage('remove_old_ces'), \
+                        metrics.timer('stage_seconds', stage='remove_old_ces'):
+                    remove_old_ces(removal_threshold=self.ce_removal_threshold,
+                                   domain=self.domain,
+                                   banned_ces=self.banned_ces,
+                                   cfg_system=cfg_system,
+                                   shard=self.shard)
             except Exception as err:
                 self.log.error("Error while running removal of old CEs: %s" % err)
 
+        try:
+            cfg_system.commit()
+        except Exception:
+            self.log.exception("Error while committing the discovered resources to the CS")
+            if self.fingerprints is not None:
+                self.fingerprints.discard()
+            if self.capacity_model is not None:
+                self.capacity_model.discard()
+        else:
+            # Only trust the fingerprints and queue limits once what they stand for is in the CS
+            if self.fingerprints is not None:
+                self.fingerprints.save()
+            if self.capacity_model is not None:
+                self.capacity_model.save()
+
         # Email about old SEs with last_seen > threshold
         ##############################
         if self.addressTo and self.addressFrom:
             try:
-                old_ses = find_old_ses(notification_threshold=14)
+                old_ses = find_old_ses(notification_threshold=14, cfg_system=cfg_system, shard=self.shard)
             except Exception as err:
                 self.log.error("Failed to get old SEs: %s" % err)
                 return S_OK()
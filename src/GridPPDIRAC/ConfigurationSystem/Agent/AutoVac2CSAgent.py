@@ -7,21 +7,29 @@ resources for a given or any configured VO. It detects resources not yet
 present in the CS and adds them automatically based of configurable
 default parameters.
 """
-import re
+import os
+from collections import defaultdict
 from datetime import date, datetime, timedelta
-from pprint import pformat
 from DIRAC import S_OK, S_ERROR
 from DIRAC.Core.Base.AgentModule import AgentModule
 from DIRAC.Core.LCG.GOCDBClient import GOCDBClient
 from DIRAC.ConfigurationSystem.Client.Helpers.Path import cfgPath
 from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.ConfigurationSystem import ConfigurationSystem
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.Fingerprints import (Fingerprints, SeenRecorder,
+                                                                                     fingerprint)
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.GOCDBCache import GOCDBCache
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.LastSeenStore import LastSeenStore
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.Metrics import metrics
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.SiteMetadata import (CC_MAPPINGS, CC_REGEX,
+                                                                                     guess_country_code,
+                                                                                     site_metadata)
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.VacModel import MAX_CPUTIME, VacModel
 
 __RCSID__ = "$Id$"
 
-CN_REGEX = re.compile(r'CN=([^/]*)')
-VOKEY_EXTENSION_REGEX = re.compile(r'^PILOT_(SE|DN)_(.*)$')
-HOSTS_BASE = "Registry/Hosts"
-SITES_BASE = "Resources/Sites"
+# GOCDB service type and the CS site type its endpoints are added as, in processing order
+SERVICE_TYPES = (('uk.ac.gridpp.vac', 'VAC'),
+                 ('uk.ac.gridpp.vcycle', 'CLOUD'))
 
 class AutoVac2CSAgent(AgentModule):
     """
@@ -30,12 +38,9 @@ class AutoVac2CSAgent(AgentModule):
     Automatically updates the CS automatically for CEs and SEs.
     """
 
-    max_cputime_map = {'VAC': 400000, 'CLOUD': 24000000}
-    cc_regex = re.compile(r'\.([a-zA-Z]{2})$')
-    cc_mappings = {'.gov': 'us',
-                   '.edu': 'us',
-                   'efda.org': 'uk',
-                   'atlas-swt2.org': 'us'}
+    max_cputime_map = MAX_CPUTIME
+    cc_regex = CC_REGEX
+    cc_mappings = CC_MAPPINGS
 
     def initialize(self, *args, **kwargs):
         """
@@ -44,59 +49,155 @@ class AutoVac2CSAgent(AgentModule):
         Initialise method pulls in some extra configuration options
         These include:
         VOKeys            - List of VO identifiers
+        CommitBatchSize   - If non-zero, CS changes are committed in batches
+                            of about this many changes
+        JournalChanges    - Journal CS change sets in the work directory so an
+                            interrupted commit is replayed on the next cycle
+        LastSeenSyncDays  - If non-zero, LastSeen dates are kept in a store in the
+                            work directory and only written to the CS once they
+                            are this many days behind
+        ChangeLog         - Write the committed CS changes, with the stage making
+                            them, to a JSON-lines change log in the work directory
+        ChangeLogSample   - Fraction of the per option records written to the
+                            change log (section summaries are always written)
+        WriteMetrics      - Write Prometheus metrics (metrics.prom) and a JSON
+                            cycle report (cycle_report.json) to the work directory
+        MetricsTextfileDirectory - If set, the Prometheus metrics are written there
+                            instead, e.g. node-exporter's textfile collector directory
+        GOCDBCacheMaxAge  - GOCDB responses are cached in the work directory, a
+                            cached response is used if GOCDB fails and it is
+                            younger than this many seconds
+        SkipUnchanged     - Skip processing a GOCDB response unchanged since the
+                            last committed cycle, only refreshing LastSeen
+        FingerprintMaxAge - Seconds after which a response is processed even if
+                            unchanged
+        GOCDBSiteMetadata - Take the country codes of new sites from their GOCDB
+                            site records, rather than only their host names
+        SiteMetadataTTL   - Seconds the GOCDB site records are used for before
+                            being fetched again
         """
-        self.vokeys = self.am_getOption('VOKeys', ['GridPP'])
+        self.vokeys = frozenset(self.am_getOption('VOKeys', ['GridPP']))
         self.removal_threshold = self.am_getOption('RemovalThreshold', 5)
+        self.write_metrics = self.am_getOption('WriteMetrics', True)
+        self.metrics_directory = self.am_getOption('MetricsTextfileDirectory', '')
+        journal_path = None
+        if self.am_getOption('JournalChanges', True):
+            journal_path = os.path.join(self.am_getWorkDirectory(), 'cs_journal.jsonl')
+        ConfigurationSystem.configure(commit_batch_size=self.am_getOption('CommitBatchSize', 0) or None,
+                                      commit_target_time=self.am_getOption('CommitTargetTime', 10.),
+                                      journal_path=journal_path)
+        last_seen_sync_days = self.am_getOption('LastSeenSyncDays', 3)
+        if last_seen_sync_days and ConfigurationSystem.last_seen_store is None:
+            ConfigurationSystem.configure(last_seen_store=LastSeenStore(self.am_getWorkDirectory()),
+                                          last_seen_sync_days=last_seen_sync_days)
+        if self.am_getOption('ChangeLog', True):
+            ConfigurationSystem.configure(change_log_path=os.path.join(self.am_getWorkDirectory(),
+                                                                       'cs_changes.jsonl'),
+                                          change_log_sample=self.am_getOption('ChangeLogSample', 1.))
         self.gocdb_client = GOCDBClient()
+        self.gocdb_cache = GOCDBCache(self.am_getWorkDirectory(),
+                                      max_age=self.am_getOption('GOCDBCacheMaxAge', 172800))
+        self.gocdb_site_metadata = self.am_getOption('GOCDBSiteMetadata', True)
+        site_metadata.configure(cache=self.gocdb_cache, ttl=self.am_getOption('SiteMetadataTTL', 86400))
+        self.fingerprints = None
+        if self.am_getOption('SkipUnchanged', True):
+            self.fingerprints = Fingerprints(os.path.join(self.am_getWorkDirectory(), 'fingerprints.json'),
+                                             max_age=self.am_getOption('FingerprintMaxAge', 86400))
         return S_OK()
 
     def execute(self):
+        """Run _execute, exporting its metrics to the work directory."""
+        metrics.start_cycle(agent='AutoVac2CSAgent')
+        try:
+            with metrics.timer('cycle_seconds'):
+                return self._execute()
+        finally:
+            if self.write_metrics:
+                metrics.export(self.am_getWorkDirectory(), self.metrics_directory)
+
+    def _execute(self):
         """General agent execution method."""
         cfg_system = ConfigurationSystem()
         cfg_system.initialize()
-
-        # Get VAC sites.
-        # ##############
-        result = self.gocdb_client.getServiceEndpointInfo('service_type', "uk.ac.gridpp.vac")
-        if not result['OK']:
-            self.log.error("Problem getting GOCDB VAC information")
-            return result
-
         try:
-            self.process_gocdb_results(result['Value'], 'VAC', cfg_system)
-        except:
-            self.log.exception("Problem processing GOCDB VAC information")
-            return S_ERROR("Problem processing GOCDB VAC information")
-
-        # Get CLOUD (vcycle) sites.
-        # #########################
-        result = self.gocdb_client.getServiceEndpointInfo('service_type', "uk.ac.gridpp.vcycle")
-        if not result['OK']:
-            self.log.error("Problem getting GOCDB CLOUD (vcycle) information")
-            return result
-
-        try:
-            self.process_gocdb_results(result['Value'], 'CLOUD', cfg_system)
-        except:
-            self.log.exception("Problem processing GOCDB CLOUD (vcycle) information")
-            return S_ERROR("Problem processing GOCDB CLOUD (vcycle) information")
+            cfg_system.replay_journal()
+        except Exception:
+            self.log.exception("Error while replaying the CS change journal")
+
+        if self.gocdb_site_metadata:
+            site_metadata.refresh()
+        else:
+            site_metadata.reset()
+        if self.fingerprints is not None:
+            # New GOCDB site records may change the sites' names
+            self.fingerprints.inputs = fingerprint(self.vokeys, site_metadata.hash, volatile=None)
+
+        # Get VAC and CLOUD (vcycle) sites.
+        # ##################################
+        results = self.gocdb_cache.fetch_all({service_type: (self.gocdb_client.getServiceEndpointInfo,
+                                                             ('service_type', service_type))
+                                              for service_type, _ in SERVICE_TYPES})
+        if self.fingerprints is not None:
+            self.fingerprints.discard()
+        for service_type, site_type in SERVICE_TYPES:
+            result = results[service_type]
+            if not result['OK']:
+                self.log.error("Problem getting GOCDB %s information" % site_type)
+                return result
+            response = result['Value']
+
+            try:
+                with ConfigurationSystem.stage(site_type), metrics.timer('stage_seconds', stage=site_type):
+                    self.process_gocdb_response(response, site_type, cfg_system)
+            except:
+                self.log.exception("Problem processing GOCDB %s information" % site_type)
+                return S_ERROR("Problem processing GOCDB %s information" % site_type)
 
         cfg_system.commit()
+        if self.fingerprints is not None:
+            self.fingerprints.save()
 
         # Remove old hosts/sites
         # ######################
         try:
-            self.remove_old(self.removal_threshold)
+            with ConfigurationSystem.stage('remove_old'), metrics.timer('stage_seconds', stage='remove_old'):
+                self.remove_old(self.removal_threshold)
         except:
             self.log.exception("Problem removing old hosts/sites.")
             return S_ERROR("Problem processing GOCDB CLOUD (vcycle) information")
 
         return S_OK()
 
+    def process_gocdb_response(self, response, site_path_prefix, cfg_system):
+        """
+        Process a GOCDB response unless it is unchanged since the last committed cycle.
+
+        An unchanged response only has LastSeen refreshed in the sections
+        processing it last set it in.
+
+        Args:
+            response (GOCDBResponse): The GOCDB query response.
+            site_path_prefix (str): The CS path prefix (VAC or CLOUD) for the type of
+                                    service that we are processing.
+            cfg_system (ConfigurationSystem): A ConfigurationSystem instance used to update
+                                              the CS.
+        """
+        if self.fingerprints is None:
+            return self.process_gocdb_results(response.Value, site_path_prefix, cfg_system)
+        if self.fingerprints.replay_seen(site_path_prefix, response.Hash, cfg_system):
+            return S_OK()
+        seen = set()
+        result = self.process_gocdb_results(response.Value, site_path_prefix, SeenRecorder(cfg_system, seen))
+        self.fingerprints.record(site_path_prefix, response.Hash, seen)
+        return result
+
     def process_gocdb_results(self, services, site_path_prefix, cfg_system, country_default='xx'):
         """
         Process GOCDB results.
 
+        The services are first normalised into a VacModel, which is then
+        written to the CS with one add per site and per host.
+
         Args:
             services (list): List of services returned from GOCDB query.
             site_path_prefix (str): The CS path prefix (VAC or CLOUD) for the type of
@@ -104,139 +205,58 @@ class AutoVac2CSAgent(AgentModule):
             cfg_system (ConfigurationSystem): A ConfigurationSystem instance used to update
                                               the CS.
         """
-        for service in services:
-            # Resources
-            sitename = service.get('SITENAME')
-            hostname = service.get('HOSTNAME')
-            nodestatus = service.get('IN_PRODUCTION', 'N')
-            if nodestatus != 'Y':
-                continue
-            # Try to use OS from GOC DB if defined
-            raw_host_os = service.get('HOST_OS', 'EL9')
-            os_match = re.match(r'.*[A-Za-z]([0-9])$', raw_host_os)
-            if os_match:
-              host_os = 'EL%s' % os_match.group(1)
-            else:
-              host_os = 'EL9'
-            country_code = AutoVac2CSAgent.extract_cc(hostname) or country_default
-            if sitename is None or hostname is None:
-                self.log.warn("Missing sitename or hostname for service:\n%s" % pformat(service))
-                continue
-
-            site_path = cfgPath(SITES_BASE, site_path_prefix, "%s.%s.%s"
-                                % (site_path_prefix, sitename, country_code))
-            ce_path = cfgPath(site_path, 'CEs', hostname)
-            queue_path = cfgPath(ce_path, 'Queues', 'default')
-            cfg_system.add(site_path, 'Name', sitename)
-            cfg_system.append_unique(site_path, 'CE', hostname)
-            cfg_system.add(ce_path, 'CEType', "VMCloud")
-            cfg_system.add(ce_path, 'Architecture', 'x86_64')
-            cfg_system.add(ce_path, 'OS', host_os)
-            cfg_system.add(ce_path, 'LastSeen', date.today().strftime('%d/%m/%Y'))
-            cfg_system.add(queue_path, 'maxCPUTime',
-                           AutoVac2CSAgent.max_cputime_map.get(site_path_prefix, 'Unknown'))
-
-            for extension in service.get('EXTENSIONS', []):
-                match = VOKEY_EXTENSION_REGEX.match(extension.get('KEY', ''))
-                if match is None:
-                    continue
-
-                extension_key = match.group()
-                k, vokey = match.groups()
-                if vokey not in self.vokeys:
-                    self.log.warn("Extension KEY %s for %s with vokey %s does not belong "
-                                  "to a valid vokey: %s"
-                                  % (extension_key, sitename, vokey, self.vokeys))
-                    continue
-
-                if k == 'SE':
-                    se = extension.get('VALUE')
-                    if se is None:
-                        self.log.warn("No SE value for extension KEY %s" % extension_key)
-                        continue
-                    cfg_system.append_unique(site_path, 'SE', se)
-
-                # Registry
-                elif k == 'DN':
-                    dn = extension.get('VALUE', '')
-                    if "CN=" not in dn:
-                        self.log.warn("For extension KEY %s, Could not find the CN component "
-                                      "of DN: %s" % (extension_key, dn))
-                        continue
-                    cn = max(CN_REGEX.findall(dn), key=len)
-                    host_path = cfgPath(HOSTS_BASE, cn)
-                    cfg_system.add(host_path, 'DN', dn)
-                    cfg_system.add(host_path, 'LastSeen', date.today().strftime('%d/%m/%Y'))
-                    cfg_system.add(host_path, 'Properties',
-                                   ['GenericPilot', 'LimitedDelegation'])
-
+        model = VacModel(self.vokeys, country_default)
+        with metrics.timer('model_build_seconds', site_type=site_path_prefix):
+            model.add_services(services, site_path_prefix)
+        metrics.set('vac_ces', len(model), site_type=site_path_prefix)
+        model.write(cfg_system, site_path_prefix,
+                    AutoVac2CSAgent.max_cputime_map.get(site_path_prefix, 'Unknown'))
         return S_OK()
 
     def remove_old(self, removal_threshold=5):
         """Remove old hosts/sites."""
         cfg_system = ConfigurationSystem()
-        result = cfg_system.getCurrentCFG()
-        if not result['OK']:
-            self.log.error('Could not get current config from the CS')
-            raise RuntimeError("Error removing old Resources/Registry.")
+        replica = cfg_system.replica()
 
         today = date.today()
-        removal_threshold = timedelta(days=removal_threshold)
+        cutoff = today - timedelta(days=removal_threshold)
 
-        old_ces = set()
         base_path = '/Resources/Sites'
         for site_type in ('VAC', 'CLOUD'):
-            site_type_path = cfgPath(base_path, site_type)
-            for site, site_info in result['Value'].getAsDict(base_path).items():
-                site_path = cfgPath(site_type_path, site)
-                for ce, ce_info in site_info.get('CEs', {}).items():
-                    ce_path = cfgPath(site_path, 'CEs', ce)
-
-                    if 'LastSeen' not in ce_info:
-                        self.log.warn("No LastSeen info for CE: %s at site: %s" % (ce, site))
-                        continue
-
-                    last_seen = datetime.strptime(ce_info['LastSeen'], '%d/%m/%Y').date()
-                    delta = today - last_seen
-                    if delta > removal_threshold:
-                        self.log.warn("Last seen %s:%s %s days ago...removing"
-                                      % (site, ce, delta.days))
-                        cfg_system.remove(section=ce_path)
-                        old_ces.add(ce)
-
-                if old_ces:
-                    cfg_system.remove(section=site_path, option='CE', value=old_ces)
-                    old_ces.clear()
-
-        host_base = '/Registry/Hosts'
-        for host, host_info in result['Value'].getAsDict(host_base).items():
-            host_path = cfgPath(host_base, host)
-            if 'LastSeen' not in host_info:
-                self.log.warn("No LastSeen info for host: %s" % host)
-                continue
-
-            last_seen = datetime.strptime(host_info['LastSeen'], '%d/%m/%Y').date()
-            delta = today - last_seen
-            if delta > removal_threshold:
-                self.log.warn("Last seen host %s %s days ago...removing"
-                              % (host, delta.days))
-                cfg_system.remove(section=host_path)
+            pattern = cfgPath(base_path, site_type, '*', 'CEs', '*')
+            for ce_path in replica.sections_without(pattern, 'LastSeen'):
+                site_path, _, ce = ce_path.rsplit('/', 2)
+                self.log.warn("No LastSeen info for CE: %s at site: %s" % (ce, site_path.rsplit('/', 1)[-1]))
+
+            old_ces = defaultdict(set)
+            for ce_path, last_seen in cfg_system.last_seen_before(pattern, cutoff):
+                site_path, _, ce = ce_path.rsplit('/', 2)
+                self.log.warn("Last seen %s:%s %s days ago...removing"
+                              % (site_path.rsplit('/', 1)[-1], ce,
+                                 (today - datetime.strptime(last_seen, '%d/%m/%Y').date()).days))
+                cfg_system.remove(section=ce_path)
+                old_ces[site_path].add(ce)
+
+            for site_path, ces in sorted(old_ces.items()):
+                cfg_system.remove(section=site_path, option='CE', value=ces)
+
+        pattern = cfgPath('/Registry/Hosts', '*')
+        for host_path in replica.sections_without(pattern, 'LastSeen'):
+            self.log.warn("No LastSeen info for host: %s" % host_path.rsplit('/', 1)[-1])
+
+        for host_path, last_seen in cfg_system.last_seen_before(pattern, cutoff):
+            self.log.warn("Last seen host %s %s days ago...removing"
+                          % (host_path.rsplit('/', 1)[-1],
+                             (today - datetime.strptime(last_seen, '%d/%m/%Y').date()).days))
+            cfg_system.remove(section=host_path)
         cfg_system.commit()
         return S_OK()
 
     @classmethod
     def extract_cc(cls, ce, cc_mappings=None, cc_regex=None):
-        """Extract the 2 character country code from the CE name."""
-        if cc_mappings is None:
-            cc_mappings = cls.cc_mappings
-        if cc_regex is None:
-            cc_regex = cls.cc_regex
-
-        ce = ce.strip().lower()
-        for key, value in cc_mappings.items():
-            if ce.endswith(key):
-                return value
-        cc = cc_regex.search(ce)
-        if cc is not None:
-            cc = cc.groups()[0]
-        return cc
+        """Extract the 2 character country code from the CE name, see SiteMetadata.host_country."""
+        if cc_mappings is None and cc_regex is None:
+            return site_metadata.host_country(ce)
+        return guess_country_code(ce,
+                                  cls.cc_mappings if cc_mappings is None else cc_mappings,
+                                  cls.cc_regex if cc_regex is None else cc_regex)
@@ -4,9 +4,13 @@ UsersAndGroupsAgent
 
 __RCSID__ = "$Id$"
 import os
-from DIRAC import S_OK
+from DIRAC import S_OK, S_ERROR
 from DIRAC.Core.Base.AgentModule import AgentModule
 from GridPPDIRAC.ConfigurationSystem.private.UsersAndGroupsAPI import UsersAndGroupsAPI
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.Deadline import (CancelToken,
+                                                                                 StageCancelled,
+                                                                                 call_with_deadline)
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.Metrics import metrics
 
 
 class UsersAndGroupsAgent(AgentModule):
@@ -18,8 +22,14 @@ class UsersAndGroupsAgent(AgentModule):
     servers
     '''
     def initialize(self):
-        '''Initialisation'''
-        self._uag = UsersAndGroupsAPI()
+        '''
+        Initialisation
+
+        CycleTimeout is the seconds the VOMS update may take before it is
+        abandoned, without committing, and VOMSTimeout the socket timeout of
+        each VOMS SOAP call.
+        '''
+        self._uag = UsersAndGroupsAPI(voms_timeout=self.am_getOption('VOMSTimeout', 120))
         self.am_setOption("PollingTime", 3600 * 6)  # Every 6 hours
         self.proxyLocation = os.path.join(self.am_getWorkDirectory(),
                                           ".volatileId")
@@ -29,7 +39,27 @@ class UsersAndGroupsAgent(AgentModule):
         """
         General agent execution method
         """
-        result = self._uag.update_usersandgroups()
+        metrics.start_cycle(agent='UsersAndGroupsAgent')
+        try:
+            with metrics.timer('cycle_seconds'):
+                return self._execute()
+        finally:
+            if self.am_getOption('WriteMetrics', True):
+                metrics.export(self.am_getWorkDirectory(),
+                               self.am_getOption('MetricsTextfileDirectory', ''))
+
+    def _execute(self):
+        """
+        Update the users and groups from VOMS
+        """
+        token = CancelToken(self.am_getOption('CycleTimeout', 14400) or None)
+        try:
+            with metrics.timer('stage_seconds', stage='update_usersandgroups'):
+                result = call_with_deadline(token, self._uag.update_usersandgroups)
+        except StageCancelled as err:
+            self.log.error("VOMS update abandoned, the CS was not changed: %s" % err)
+            metrics.inc('stage_overruns_total', stage='update_usersandgroups')
+            return S_ERROR(str(err))
         if not result['OK']:
             return result
 
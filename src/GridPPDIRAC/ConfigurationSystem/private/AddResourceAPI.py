@@ -1,18 +1,25 @@
 """API for adding resources to CS."""
-from datetime import date, datetime, timedelta
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
 from urllib.parse import urlparse
 from DIRAC import gLogger
 from DIRAC.ConfigurationSystem.Client.Helpers.Path import cfgPath
 from DIRAC.Core.Utilities.Glue2 import getGlue2CEInfo
 from .AutoResourceTools.utils import get_se_vo_info, get_xrootd_ports
-from .AutoResourceTools.ConfigurationSystem import ConfigurationSystem
+from .AutoResourceTools.ConfigurationSystem import ConfigurationSystem, ChangeList
+from .AutoResourceTools.Metrics import metrics
+from .AutoResourceTools.Fingerprints import SeenRecorder, fingerprint
 from .AutoResourceTools.SETypes import SE
 from .AutoResourceTools.CETypes import Site
 from .AutoResourceTools.Glue2HTCondorAPI import update_htcondor_ces
 from .AutoResourceTools.Glue2ARCAPI import update_arc_ces
+from .AutoResourceTools.QueueVariants import ARC_QUEUE_VARIANTS, HTCONDOR_QUEUE_VARIANTS
 
 def find_arc_ces(voList, bdii_host="topbdii.grid.hep.ph.ic.ac.uk:2170",
-                 banned_ces=None, max_processors=None):
+                 banned_ces=None, max_processors=None, capacity_model=None, queue_variants=None,
+                 cfg_system=None, fingerprints=None, bdii_pool=None, shard=None):
     """
     Find and add all ARC CEs defined using Glue2.
 
@@ -21,6 +28,16 @@ def find_arc_ces(voList, bdii_host="topbdii.grid.hep.ph.ic.ac.uk:2170",
         banned_ces (list): List of banned CEs which will be skipped
         max_processors (str/int): If specified and not None, this overrides the BDII gleaned MaxProcessors
                                   value for a site which is defined for all CEs.
+        capacity_model (CapacityModel): If given, queue pilot limits are derived from the
+                                        advertised share load instead of the static defaults.
+        queue_variants (tuple): QueueVariant table used to expand each queue into its
+                                single/multi-core variants. Defaults to the built in table.
+        cfg_system (ConfigurationSystem): If given the changes are made to it (or recorded
+                                          in a ChangeList) and not committed.
+        fingerprints (Fingerprints): If given and the BDII results fingerprint the same as
+                                     last recorded, only the CEs' LastSeen is updated.
+        bdii_pool (BDIIPool): If given the queries are raced over its hosts instead of bdii_host.
+        shard (Shard): If given only the CEs of its sites are updated.
 
     Raises:
         ValueError: If the BDII host str cannot be split to it's two components (hostname and port).
@@ -37,10 +54,15 @@ def find_arc_ces(voList, bdii_host="topbdii.grid.hep.ph.ic.ac.uk:2170",
         gLogger.error("Could not cast port '%s' to type int" % host[1])
         raise
     update_arc_ces(vo_list=voList, bdii_host=host,
-                   banned_ces=banned_ces, max_processors=max_processors)
+                   banned_ces=banned_ces, max_processors=max_processors,
+                   capacity_model=capacity_model,
+                   queue_variants=queue_variants or ARC_QUEUE_VARIANTS,
+                   cfg_system=cfg_system, fingerprints=fingerprints,
+                   bdii_pool=bdii_pool, shard=shard)
 
 def find_htcondor_ces(voList, bdii_host="topbdii.grid.hep.ph.ic.ac.uk:2170",
-                      banned_ces=None, max_processors=None):
+                      banned_ces=None, max_processors=None, capacity_model=None, queue_variants=None,
+                      cfg_system=None, fingerprints=None, bdii_pool=None, shard=None):
     """
     Find and add all HTCondor CEs defined using Glue2.
 
@@ -49,6 +71,16 @@ def find_htcondor_ces(voList, bdii_host="topbdii.grid.hep.ph.ic.ac.uk:2170",
         banned_ces (list): List of banned CEs which will be skipped
         max_processors (str/int): If specified and not None, this overrides the BDII gleaned MaxProcessors
                                   value for a site which is defined for all CEs.
+        capacity_model (CapacityModel): If given, queue pilot limits are derived from the
+                                        advertised share load instead of the static defaults.
+        queue_variants (tuple): QueueVariant table used to expand each queue into its
+                                single/multi-core variants. Defaults to the built in table.
+        cfg_system (ConfigurationSystem): If given the changes are made to it (or recorded
+                                          in a ChangeList) and not committed.
+        fingerprints (Fingerprints): If given and the BDII results fingerprint the same as
+                                     last recorded, only the CEs' LastSeen is updated.
+        bdii_pool (BDIIPool): If given the queries are raced over its hosts instead of bdii_host.
+        shard (Shard): If given only the CEs of its sites are updated.
 
     Raises:
         ValueError: If the BDII host str cannot be split to it's two components (hostname and port).
@@ -65,46 +97,61 @@ def find_htcondor_ces(voList, bdii_host="topbdii.grid.hep.ph.ic.ac.uk:2170",
         gLogger.error("Could not cast port '%s' to type int" % host[1])
         raise
     update_htcondor_ces(vo_list=voList, bdii_host=host,
-                        banned_ces=banned_ces, max_processors=max_processors)
+                        banned_ces=banned_ces, max_processors=max_processors,
+                        capacity_model=capacity_model,
+                        queue_variants=queue_variants or HTCONDOR_QUEUE_VARIANTS,
+                        cfg_system=cfg_system, fingerprints=fingerprints,
+                        bdii_pool=bdii_pool, shard=shard)
 
 
 
-def find_old_ses(notification_threshold=14):
+def find_old_ses(notification_threshold=14, cfg_system=None, shard=None):
     """
     Find old SEs.
 
     Args:
         notification_threshold (int): Only SEs which were last seen longer ago than
                                       this number of days are returned.
+        cfg_system (ConfigurationSystem): The configuration system to look in, by default a new one.
+        shard (Shard): If given only the SEs of this shard are returned.
     Returns:
         list: A sorter list of two element tuples. These elements are as follows:
               (se name, last seen date). Both elements are strings and the last seen date
               is in the format '%d/%m/%Y'. This should only contain SEs seen longer ago than
               notification_threshold
     """
-    result = ConfigurationSystem().getCurrentCFG()
-    if not result['OK']:
-        gLogger.error('Could not get current config from the CS')
-        raise RuntimeError("Error finding old SEs.")
-
-    old_ses = set()
-    today = date.today()
-    notification_threshold = timedelta(days=notification_threshold)
-    for se, se_info in result['Value'].getAsDict('/Resources/StorageElements').items():
-        if 'LastSeen' not in se_info:
-            gLogger.warn("No LastSeen info for SE: %s" % se)
-            continue
-
-        last_seen_str = se_info['LastSeen']
-        last_seen = datetime.strptime(last_seen_str, '%d/%m/%Y').date()
-        if today - last_seen > notification_threshold:
-            old_ses.add((se, last_seen_str))
+    if cfg_system is None:
+        cfg_system = ConfigurationSystem()
+    replica = cfg_system.replica()
+    pattern = cfgPath('/Resources/StorageElements', '*')
+    for se_path in replica.sections_without(pattern, 'LastSeen'):
+        gLogger.warn("No LastSeen info for SE: %s" % se_path.rsplit('/', 1)[-1])
 
+    cutoff = date.today() - timedelta(days=notification_threshold)
+    old_ses = {(se_path.rsplit('/', 1)[-1], last_seen_str)
+               for se_path, last_seen_str in cfg_system.last_seen_before(pattern, cutoff)}
+    if shard is not None:
+        old_ses = {(se, last_seen) for se, last_seen in old_ses if shard.owns_se(se)}
     return sorted(old_ses)
 
 
+def _build_site_changes(site, site_info_lst, domain, country_default, banned_ces, max_processors):
+    """
+    Build the CS changes for a single site.
+
+    Returns:
+        tuple: (ChangeList, seconds taken)
+    """
+    start = time.time()
+    changes = ChangeList()
+    Site(site, site_info_lst, domain, country_default, banned_ces, max_processors)\
+        .write(changes, cfgPath('/Resources/Sites', domain))
+    return changes, time.time() - start
+
+
 def update_ces(voList, domain='LCG', country_default='xx', host=None,
-               banned_ces=None, max_processors=None):
+               banned_ces=None, max_processors=None, workers=8, slow_site_threshold=30,
+               cfg_system=None, fingerprints=None, bdii_pool=None, shard=None):
     """
     Update the CEs in the Dirac config for certain VO list.
 
@@ -119,13 +166,29 @@ def update_ces(voList, domain='LCG', country_default='xx', host=None,
         banned_ces (list): List of banned CEs which will be skipped
         max_processors (str/int): If specified and not None, this overrides the BDII gleaned MaxProcessors
                                   value for a site which is defined for all CEs.
+        workers (int): Number of threads used to build the site models.
+        slow_site_threshold (float): Sites taking longer than this many seconds to build are
+                                     reported.
+        cfg_system (ConfigurationSystem): If given the changes are made to it (or recorded
+                                          in a ChangeList) and not committed.
+        fingerprints (Fingerprints): If given and the BDII results fingerprint the same as
+                                     last recorded, the site models are not rebuilt and only
+                                     the CEs' LastSeen is updated.
+        bdii_pool (BDIIPool): If given the BDII hosts are failed over in its ranking instead
+                              of only querying host.
+        shard (Shard): If given only the sites of this shard are updated.
     """
     # Get CE info from BDII
     #  We collect across all VOs to prevent "flip-floping" of CE lists.
     ##############################
     site_details = {}
     for vo in voList:
-        result = getGlue2CEInfo(vo, host=host)
+        metrics.inc('bdii_queries_total', query='glue2_ce_info')
+        with metrics.timer('bdii_query_seconds', query='glue2_ce_info'):
+            if bdii_pool is not None:
+                result = bdii_pool.failover(getGlue2CEInfo, vo)
+            else:
+                result = getGlue2CEInfo(vo, host=host)
         if not result['OK']:
             gLogger.error("Failed to call getGlue2CEInfo(vo=%s, host=%s): %s" % (vo, host, result['Message']))
             raise RuntimeError("getGlue2CEInfo failure.")
@@ -134,25 +197,65 @@ def update_ces(voList, domain='LCG', country_default='xx', host=None,
             gLogger.warn("No CEs found in BDII for %s" % vo)
 
         for site_name, site_info in ce_bdii_dict.items():
+            if shard is not None and not shard.owns(site_name):
+                continue
             if site_name in site_details:
                 site_details[site_name].append(site_info)
             else:
                 site_details[site_name] = [site_info]
 
-    # Main update loop
+    commit = cfg_system is None
+    if commit:
+        cfg_system = ConfigurationSystem()
+
+    # Skip rebuilding the site models if nothing changed
     ##############################
-    cfg_system = ConfigurationSystem()
-    for site, site_info_lst in sorted(site_details.items()):
-        try:
-            s = Site(site, site_info_lst, domain, country_default, banned_ces, max_processors)
-        except Exception as err:
-            gLogger.warn("Skipping problematic site: %s with error %s" % (site, err))
-            continue
-        s.write(cfg_system, cfgPath('/Resources/Sites', domain))
-    cfg_system.commit()
-
-
-def remove_old_ces(removal_threshold=5, domain='LCG', banned_ces=None):
+    if fingerprints is not None:
+        fp = fingerprint(site_details, domain, country_default, banned_ces, max_processors, str(shard))
+        if fingerprints.replay_seen('update_ces', fp, cfg_system):
+            if commit:
+                cfg_system.commit()
+            return
+        seen = set()
+        cfg_system = SeenRecorder(cfg_system, seen)
+
+    # Build the site models concurrently, each into its own change list
+    ##############################
+    start = time.time()
+    site_changes = {}
+    site_times = {}
+    with ThreadPoolExecutor(max_workers=max(int(workers), 1)) as pool:
+        futures = {pool.submit(_build_site_changes, site, site_info_lst, domain,
+                               country_default, banned_ces, max_processors): site
+                   for site, site_info_lst in site_details.items()}
+        for future in as_completed(futures):
+            site = futures[future]
+            try:
+                site_changes[site], site_times[site] = future.result()
+            except Exception as err:
+                gLogger.warn("Skipping problematic site: %s with error %s" % (site, err))
+                continue
+            metrics.observe('site_build_seconds', site_times[site])
+            if site_times[site] > slow_site_threshold:
+                gLogger.warn("Site %s took %.1fs to build" % (site, site_times[site]))
+
+    if site_times:
+        slowest = max(site_times, key=site_times.get)
+        gLogger.notice("Built %d of %d sites in %.1fs, slowest: %s (%.1fs)"
+                       % (len(site_changes), len(site_details), time.time() - start,
+                          slowest, site_times[slowest]))
+
+    # Merge in site order and commit once
+    ##############################
+    for site, changes in sorted(site_changes.items()):
+        changes.apply(cfg_system)
+    if commit:
+        cfg_system.commit()
+    if fingerprints is not None:
+        fingerprints.record('update_ces', fp, seen)
+
+
+def remove_old_ces(removal_threshold=5, domain='LCG', banned_ces=None, cfg_system=None, shard=None):
     """
     Remove old CEs.
 
@@ -161,36 +264,37 @@ def remove_old_ces(removal_threshold=5, domain='LCG', banned_ces=None):
                                       this number of days are removed.
         domain (str): The domain/root directory under which to search for sites.
         banned_ces (list): List of banned CEs which will also be removed
+        cfg_system (ConfigurationSystem): If given the CEs are removed from it, including
+                                          any pending changes, and not committed.
+        shard (Shard): If given only the CEs of this shard's sites are removed.
     """
-    cfg_system = ConfigurationSystem()
-    result = cfg_system.getCurrentCFG()
-    if not result['OK']:
-        gLogger.error('Could not get current config from the CS')
-        raise RuntimeError("Error removing old CEs.")
-
-    old_ces = set()
-    today = date.today()
+    commit = cfg_system is None
+    if commit:
+        cfg_system = ConfigurationSystem()
+    replica = cfg_system.replica()
     base_path = cfgPath('/Resources/Sites', domain)
-    removal_threshold = timedelta(days=removal_threshold)
-    for site, site_info in result['Value'].getAsDict(base_path).items():
-        site_path = cfgPath(base_path, site)
-        for ce, ce_info in site_info.get('CEs', {}).items():
-            ce_path = cfgPath(site_path, 'CEs', ce)
-
-            if 'LastSeen' not in ce_info:
-                gLogger.warn("No LastSeen info for CE: %s at site: %s" % (ce, site))
-                continue
+    pattern = cfgPath(base_path, '*', 'CEs', '*')
+    for ce_path in replica.sections_without(pattern, 'LastSeen'):
+        site_path, _, ce = ce_path.rsplit('/', 2)
+        gLogger.warn("No LastSeen info for CE: %s at site: %s" % (ce, site_path.rsplit('/', 1)[-1]))
 
-            last_seen = datetime.strptime(ce_info['LastSeen'], '%d/%m/%Y').date()
-            if today - last_seen > removal_threshold\
-               or (banned_ces is not None and ce in banned_ces):
-                cfg_system.remove(section=ce_path)
-                old_ces.add(ce)
+    cutoff = date.today() - timedelta(days=removal_threshold)
+    old_ces = {ce_path for ce_path, _ in cfg_system.last_seen_before(pattern, cutoff)}
+    if banned_ces is not None:
+        old_ces.update(ce_path for ce_path, _ in replica.options(pattern, 'LastSeen')
+                       if ce_path.rsplit('/', 1)[-1] in banned_ces)
+    if shard is not None:
+        old_ces = {ce_path for ce_path in old_ces if shard.owns_site_path(ce_path)}
 
-        if old_ces:
-            cfg_system.remove(section=site_path, option='CE', value=old_ces)
-            old_ces.clear()
-    cfg_system.commit()
+    site_ces = defaultdict(set)
+    for ce_path in old_ces:
+        site_path, _, ce = ce_path.rsplit('/', 2)
+        cfg_system.remove(section=ce_path)
+        site_ces[site_path].add(ce)
+    for site_path, ces in sorted(site_ces.items()):
+        cfg_system.remove(section=site_path, option='CE', value=ces)
+    if commit:
+        cfg_system.commit()
 
 __all__ = ('update_ses', 'find_old_ses', 'update_ces', 'remove_old_ces')
 
@@ -10,8 +10,10 @@ from urllib.parse import urlparse
 
 from DIRAC import gLogger
 from DIRAC.Core.Base import Script
+from DIRAC.ConfigurationSystem.Client.Helpers.Path import cfgPath
 from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.ConfigurationSystem import ConfigurationSystem
 from .AutoResourceTools.ldaptools import MockLdap as ldap
+from .AutoResourceTools.Fingerprints import SeenRecorder, fingerprint
 
 VO_REGEX = re.compile(r'^VO:\s*(?P<voname>[\w.-]+)')
 
@@ -23,13 +25,20 @@ def ldapsearch_bdii_ses(address=('lcg-bdii.egi.eu', 2170),
                         base='Mds-Vo-name=local,o=grid',
                         scope=ldap.SCOPE_SUBTREE,
                         latency_mapping=None,
-                        cfg_base_path='/Resources/StorageElements'):
-    """Return processes SE information from BDII."""
+                        cfg_base_path='/Resources/StorageElements',
+                        replica=None,
+                        bdii_pool=None):
+    """
+    Return processes SE information from BDII.
+
+    The existing SEs are read from replica, by default that of a new ConfigurationSystem.
+    If a BDIIPool is given the queries are raced over its hosts rather than sent to address.
+    """
     if latency_mapping is None:
         latency_mapping = LATENCY_MAPPING
 
     # Open LDAP connection to BDII
-    ldap_conn = ldap.open(*address)
+    ldap_conn = bdii_pool if bdii_pool is not None else ldap.open(*address)
 
     # Get SA records
     # ##############
@@ -67,20 +76,19 @@ def ldapsearch_bdii_ses(address=('lcg-bdii.egi.eu', 2170),
 
     # Get Existing Config SEs
     # #######################
-    cs = ConfigurationSystem()
-    result = cs.getCurrentCFG()
-    if not result['OK']:
-        gLogger.error('Could not get current config from the CS')
-        raise RuntimeError("Error finding current SEs.")
+    if replica is None:
+        replica = ConfigurationSystem().replica()
+    protocol_indices = {}
+    for ap_path, protocol in replica.options(cfgPath(cfg_base_path, '*', 'AccessProtocol.*'), 'Protocol'):
+        se_path, access_protocol = ap_path.rsplit('/', 1)
+        protocol_indices.setdefault(se_path, {})[protocol] = int(access_protocol.rsplit('.', 1)[-1])
+
     existing_dirac_names = {}
     all_dirac_se_names = set()  # convienience for later
     # tape and disk might share se?
-    for se, se_info in sorted(result['Value'].getAsDict(cfg_base_path).items()):
-        # str is the case for Options, e.g. DefaultProtocols
-        if not isinstance(se_info, dict) or 'Host' not in se_info:
-            continue
+    for se_path, host in replica.options(cfgPath(cfg_base_path, '*'), 'Host'):
+        se = se_path.rsplit('/', 1)[-1]
         all_dirac_se_names.add(se)
-        host = se_info['Host']
         latency = se.rsplit('-', 1)[-1]
         latency_dict = existing_dirac_names.setdefault(host, {})
         if latency in latency_dict:
@@ -89,9 +97,7 @@ def ldapsearch_bdii_ses(address=('lcg-bdii.egi.eu', 2170),
             continue
 
         latency_dict[latency] = {'dirac_name': se}
-        for key, value in se_info.items():
-            if key.startswith('AccessProtocol.') and 'Protocol' in value:
-                latency_dict[latency][value['Protocol']] = int(key.rsplit('.', 1)[-1])
+        latency_dict[latency].update(protocol_indices.get(se_path, {}))
 
     # Get SE records
     # ##############
@@ -107,6 +113,7 @@ def ldapsearch_bdii_ses(address=('lcg-bdii.egi.eu', 2170),
         # attach DIRAC name and VOs
         host = max(se['GlueSEUniqueID'], key=len)
         se['host'] = host
+        se['site'] = bdii_name
         srm_vos = sa_dict.get(host, {}).get('GlueSAAccessControlBaseRule', [])
         latency_dict = sa_dict.get(host, {})
         for latency, sas in latency_dict.items():
@@ -189,18 +196,41 @@ def ldapsearch_bdii_ses(address=('lcg-bdii.egi.eu', 2170),
 
 
 def update_ses(considered_vos=None, cfg_base_path='/Resources/StorageElements',
-               address=('lcg-bdii.egi.eu', 2170), banned_ses=None):
-    """Update the list of Storage Elements in DIRAC config."""
+               address=('lcg-bdii.egi.eu', 2170), banned_ses=None, cfg_system=None, replica=None,
+               fingerprints=None, bdii_pool=None, shard=None):
+    """
+    Update the list of Storage Elements in DIRAC config.
+
+    If cfg_system is given the changes are made to it (e.g. a ChangeList) and
+    left to the caller to commit. replica and bdii_pool are passed on to ldapsearch_bdii_ses.
+    If the BDII results fingerprint the same as last recorded in fingerprints,
+    only the SEs' LastSeen is updated. If a Shard is given only the SEs of its
+    sites are updated.
+    """
     se_dict, _, srm_dict, xrootport_dict, vopaths_dict\
         = ldapsearch_bdii_ses(address=address,
-                              cfg_base_path=cfg_base_path)
+                              cfg_base_path=cfg_base_path,
+                              replica=replica,
+                              bdii_pool=bdii_pool)
 
-    cs = ConfigurationSystem()
+    commit = cfg_system is None
+    cs = ConfigurationSystem() if commit else cfg_system
+    if fingerprints is not None:
+        fp = fingerprint(se_dict, srm_dict, xrootport_dict, vopaths_dict,
+                         considered_vos, cfg_base_path, banned_ses, str(shard))
+        if fingerprints.replay_seen('update_ses', fp, cs):
+            if commit:
+                cs.commit()
+            return
+        seen = set()
+        cs = SeenRecorder(cs, seen)
     for se, se_info in sorted(se_dict.items()):
         host = se_info['host']
         if banned_ses is not None and host in banned_ses:
             gLogger.info("Skipping banned SE: %s" % host)
             continue
+        if shard is not None and not shard.owns(se_info['site']):
+            continue
         site_path = os.path.join(cfg_base_path, se)
         vos = se_info.get('vos', set())
         # only consider certain vos.
@@ -263,7 +293,10 @@ def update_ses(considered_vos=None, cfg_base_path='/Resources/StorageElements',
                 if valid_paths:
                     cs.add(vo_path, vo_name, min(valid_paths, key=len))
 
-    cs.commit()
+    if commit:
+        cs.commit()
+    if fingerprints is not None:
+        fingerprints.record('update_ses', fp, seen)
 
 
 if __name__ == '__main__':
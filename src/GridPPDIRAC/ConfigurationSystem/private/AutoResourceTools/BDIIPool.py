@@ -0,0 +1,228 @@
+"""Race discovery queries over several top BDIIs."""
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+
+from DIRAC import gLogger, S_ERROR
+
+from .Deadline import CancelToken, cancel_scope, current_token
+from .ldaptools import MockLdap
+from .Metrics import metrics
+
+
+def split_host(host, default_port=2170):
+    """Split a '<hostname>:<port>' string into (hostname, port)."""
+    url = urlparse('//%s' % host)
+    return url.hostname, url.port if url.port is not None else default_port
+
+
+class BDIIPool(object):
+    """
+    Pool of top BDIIs answering the same queries.
+
+    search_s races each query against the race best ranked hosts and returns
+    the first complete answer. An answer is complete if it has at least
+    min_fraction of the median number of entries the query returned in the
+    last history answers, guarding against a BDII that is still filling up
+    or has lost part of its sources. A host failing or timing out is
+    quarantined for quarantine seconds, a host giving a partial answer is
+    ranked as if it had timed out, and another host is tried in either case.
+    Once the race is decided the queries still running are killed.
+    Hosts are ranked by a moving average of their latency, quarantined
+    hosts last so a query is still attempted if every host is quarantined.
+
+    The pool has the search_s API of an ldap connection, so it can be used in
+    place of one. Queries not going through ldapsearch (e.g. DIRAC's
+    getGlue2CEInfo) can fail over the ranked hosts with failover.
+
+    Example:
+        >>> pool = BDIIPool(['topbdii.grid.hep.ph.ic.ac.uk:2170', 'lcg-bdii.egi.eu:2170'])
+        >>> pool.search_s(base='o=glue', filterstr='(objectClass=GLUE2ComputingService)')
+        >>> pool.failover(getGlue2CEInfo, 'gridpp')
+    """
+
+    def __init__(self, hosts, race=2, timeout=300, quarantine=1800, min_fraction=0.5, history=5,
+                 smoothing=0.3, connect=MockLdap.open):
+        """
+        Initialise.
+
+        Args:
+            hosts (list): The BDIIs, as '<hostname>:<port>' strings.
+            race (int): Number of hosts queried at once.
+            timeout (float): Seconds after which a query is abandoned.
+            quarantine (float): Seconds a failing host is only used as a last resort.
+            min_fraction (float): Fraction of the recent median entry count a complete
+                                  answer has at least.
+            history (int): Number of recent answers the median is taken over.
+            smoothing (float): Weight of the newest latency in the moving average.
+            connect (callable): connect(hostname, port, timeout=timeout) returning an
+                                object with search_s, by default MockLdap.open.
+        """
+        if not hosts:
+            raise ValueError("No BDII hosts given.")
+        self.hosts = list(hosts)
+        self.race = max(int(race), 1)
+        self.timeout = timeout
+        self.quarantine = quarantine
+        self.min_fraction = min_fraction
+        self.history = history
+        self.smoothing = smoothing
+        self._connect = connect
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._quarantined = {}
+        self._counts = {}
+
+    def ranked(self):
+        """Return the hosts, fastest first and quarantined ones last."""
+        now = time.time()
+        with self._lock:
+            for host, until in list(self._quarantined.items()):
+                if until <= now:
+                    del self._quarantined[host]
+                    metrics.set('bdii_quarantined', 0, host=host)
+            return sorted(self.hosts, key=lambda host: (self._quarantined.get(host, 0),
+                                                        self._latency.get(host, 0.),
+                                                        self.hosts.index(host)))
+
+    def _succeeded(self, host, elapsed):
+        """Fold a latency into the host's moving average."""
+        with self._lock:
+            latency = self._latency.get(host)
+            latency = elapsed if latency is None else \
+                self.smoothing * elapsed + (1 - self.smoothing) * latency
+            self._latency[host] = latency
+        metrics.set('bdii_latency_seconds', latency, host=host)
+
+    def _failed(self, host, err):
+        """Quarantine a host."""
+        gLogger.warn("BDII %s failed, quarantining it for %ds: %s" % (host, self.quarantine, err))
+        with self._lock:
+            self._quarantined[host] = time.time() + self.quarantine
+        metrics.inc('bdii_failures_total', host=host)
+        metrics.set('bdii_quarantined', 1, host=host)
+
+    def _complete(self, key, count):
+        """Return True if count entries is a complete answer to the query key."""
+        with self._lock:
+            counts = sorted(self._counts.get(key, ()))
+        if not counts:
+            return True
+        return count >= self.min_fraction * counts[len(counts) // 2]
+
+    def _accept(self, key, host, count):
+        """Note an accepted answer's size."""
+        with self._lock:
+            self._counts.setdefault(key, deque(maxlen=self.history)).append(count)
+        metrics.inc('bdii_race_wins_total', host=host)
+
+    def _query(self, host, base, filterstr, scope, token):
+        """Run a query on a host under the race's token, recording its latency or quarantining it."""
+        start = time.time()
+        try:
+            with cancel_scope(token):
+                ret = self._connect(*split_host(host), timeout=self.timeout)\
+                          .search_s(base=base, filterstr=filterstr, scope=scope)
+        except Exception as err:
+            if token.cancelled:
+                # Not the host's fault. A loser killed once the race was won is at least as
+                # slow as the time it ran, which ranks it behind the winner.
+                if token.parent is None or not token.parent.cancelled:
+                    self._succeeded(host, time.time() - start)
+                raise
+            self._failed(host, err)
+            raise
+        self._succeeded(host, time.time() - start)
+        return ret
+
+    def search_s(self, base, filterstr, scope=None):
+        """
+        Race a search over the best ranked hosts, see MockLdap.search_s.
+
+        Raises:
+            RuntimeError: If no host answered.
+        """
+        key = (base, filterstr)
+        # The query threads are under the caller's deadline, and a race token of their own
+        # cancelled once the race is decided so the losers' ldapsearch are killed
+        token = current_token()
+        race_token = CancelToken(parent=token)
+        if token is not None:
+            token.on_cancel(race_token.cancel)
+        candidates = iter(self.ranked())
+        partial = []
+        error = None
+        # Not waiting for the losers on shutdown, they are killed with the race token
+        executor = ThreadPoolExecutor(max_workers=len(self.hosts))
+        try:
+            pending = {}
+            for host in candidates:
+                pending[executor.submit(self._query, host, base, filterstr, scope, race_token)] = host
+                if len(pending) >= self.race:
+                    break
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    host = pending.pop(future)
+                    try:
+                        ret = future.result()
+                    except Exception as err:
+                        if token is not None and token.cancelled:
+                            raise
+                        error = err
+                    else:
+                        if self._complete(key, len(ret)):
+                            self._accept(key, host, len(ret))
+                            return ret
+                        gLogger.warn("BDII %s returned only %d entries for %s, trying another host"
+                                     % (host, len(ret), filterstr))
+                        metrics.inc('bdii_partial_results_total', host=host)
+                        self._succeeded(host, self.timeout)
+                        partial.append((len(ret), host, ret))
+                    # Fail over to the next host
+                    for next_host in candidates:
+                        pending[executor.submit(self._query, next_host, base, filterstr, scope,
+                                                race_token)] = next_host
+                        break
+        finally:
+            race_token.cancel()
+            if token is not None:
+                token.remove_callback(race_token.cancel)
+            executor.shutdown(wait=False)
+
+        # Every host answering short is more likely a real change than them all being broken
+        if partial:
+            count, host, ret = max(partial, key=lambda answer: answer[0])
+            gLogger.warn("All BDIIs returned fewer entries than usual for %s, using the %d from %s"
+                         % (filterstr, count, host))
+            self._accept(key, host, count)
+            return ret
+        raise RuntimeError("No BDII answered %s: %s" % (filterstr, error))
+
+    def failover(self, func, *args, **kwargs):
+        """
+        Call func(*args, host='<hostname>:<port>', **kwargs) on each ranked host until one succeeds.
+
+        Args:
+            func (callable): Function returning S_OK/S_ERROR, e.g. getGlue2CEInfo.
+
+        Returns:
+            dict: The first S_OK, or the last S_ERROR.
+        """
+        result = S_ERROR("No BDII hosts")
+        for host in self.ranked():
+            start = time.time()
+            try:
+                result = func(*args, host=host, **kwargs)
+            except Exception as err:
+                result = S_ERROR(str(err))
+            if result['OK']:
+                self._succeeded(host, time.time() - start)
+                metrics.inc('bdii_race_wins_total', host=host)
+                return result
+            self._failed(host, result['Message'])
+        return result
+
+__all__ = ('BDIIPool', 'split_host')
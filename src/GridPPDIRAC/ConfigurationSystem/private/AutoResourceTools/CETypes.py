@@ -1,8 +1,8 @@
 """Dirac multi VO site types."""
-import re
 from datetime import date
 from collections import namedtuple
 from DIRAC import gConfig
+from .SiteMetadata import CC_MAPPINGS, CC_REGEX, guess_country_code, site_metadata
 from .utils import WritableMixin
 
 
@@ -21,25 +21,28 @@ class Site(WritableMixin, namedtuple('Site', ('DiracName',
     """A Dirac Site."""
 
     __slots__ = ()
-    cc_regex = re.compile(r'\.([a-zA-Z]{2})$')
-    cc_mappings = {'.gov': 'us',
-                   '.edu': 'us',
-                   'efda.org': 'uk',
-                   'atlas-swt2.org': 'us'}
+    _field_kinds = {'Name': 'scalar',
+                    'CEs': 'writable_list',
+                    'Description': 'scalar',
+                    'Coordinates': 'scalar',
+                    'Mail': 'scalar',
+                    'CE': 'set',
+                    'SE': 'set'}
+    cc_regex = CC_REGEX
+    cc_mappings = CC_MAPPINGS
 
     def __new__(cls, site, site_info_lst, domain='LCG', country_default='xx', banned_ces=None, max_processors=None):
         """Constructor."""
         ces = []
         ce_list = set()
-        country_code = country_default
+        hosts = []
         # We have to collect CE names across all VOs
         for site_info in site_info_lst:
             for ce, ce_info in sorted(site_info.get('CEs', {}).items()):
                if banned_ces is not None and ce in banned_ces:
                    continue
 
-               if country_code == country_default:
-                   country_code = Site.extract_cc(ce) or country_default
+               hosts.append(ce)
         # We think this causes the extra half configured 'condor' queues to appear
         # TODO (apart from the complete rewrite: make sure we can still ban CEs from the autoconfig
         #       try:
@@ -52,15 +55,17 @@ class Site(WritableMixin, namedtuple('Site', ('DiracName',
                       if se.startswith(site))
         # Work around glue1 to glue2 transition
         site_name = site
-        # TODO: Coordinates and Mail need to be taken from the GOCDB
+        country_code = site_metadata.country_code(site, hosts, domain, country_default)
+        # Coordinates and Mail are taken from the GOCDB where known
         # Description can be dropped completely, but care needs to be taken that nothing else expects it
+        record = site_metadata.site(site)
         return super(Site, cls).__new__(cls,
                                         DiracName='.'.join((domain, site, country_code)),
                                         Name=site_name,
                                         CEs=ces,
                                         Description='LCG site',
-                                        Coordinates='0.0:0.0',
-                                        Mail='contact_info@GOCDB',
+                                        Coordinates=record and record.Coordinates or '0.0:0.0',
+                                        Mail=record and record.Mail or 'contact_info@GOCDB',
                                         CE=ce_list,
                                         SE=se_list)
 
@@ -68,20 +73,12 @@ class Site(WritableMixin, namedtuple('Site', ('DiracName',
 
     @classmethod
     def extract_cc(cls, ce, cc_mappings=None, cc_regex=None):
-        """Extract the 2 character country code from the CE name."""
-        if cc_mappings is None:
-            cc_mappings = cls.cc_mappings
-        if cc_regex is None:
-            cc_regex = cls.cc_regex
-
-        ce = ce.strip().lower()
-        for key, value in cc_mappings.items():
-            if ce.endswith(key):
-                return value
-        cc = cc_regex.search(ce)
-        if cc is not None:
-            cc = cc.groups()[0]
-        return cc
+        """Extract the 2 character country code from the CE name, see SiteMetadata.host_country."""
+        if cc_mappings is None and cc_regex is None:
+            return site_metadata.host_country(ce)
+        return guess_country_code(ce,
+                                  cls.cc_mappings if cc_mappings is None else cc_mappings,
+                                  cls.cc_regex if cc_regex is None else cc_regex)
 
 
 class CE(WritableMixin, namedtuple('CE', ('DiracName',
@@ -98,6 +95,9 @@ class CE(WritableMixin, namedtuple('CE', ('DiracName',
     """A Dirac CE."""
 
     __slots__ = ()
+    _field_kinds = dict.fromkeys(('MaxProcessors', 'LastSeen', 'architecture', 'SI00', 'HostRAM',
+                                  'CEType', 'OS', 'SubmissionMode', 'JobListFile'), 'scalar')
+    _field_kinds['Queues'] = 'writable_list'
 
     def __new__(cls, ce, ce_info, max_processors=None):
         """Constructor."""
@@ -137,6 +137,7 @@ class Queue(WritableMixin, namedtuple('Queue', ('DiracName',
     """A Dirac Queue."""
 
     __slots__ = ()
+    _field_kinds = dict.fromkeys(('VO', 'SI00', 'maxCPUTime', 'MaxTotalJobs', 'MaxWaitingJobs'), 'scalar')
 
     def __new__(cls, queue, queue_info, ce_logical_cpus=0, ce_si00=0):
         """Constructor."""
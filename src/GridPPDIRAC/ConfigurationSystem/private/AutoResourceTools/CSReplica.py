@@ -0,0 +1,141 @@
+"""Local indexed read replica of the CS."""
+import sqlite3
+import threading
+from datetime import datetime
+
+from DIRAC import gLogger
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS sections (path TEXT PRIMARY KEY, parent TEXT, depth INTEGER);
+CREATE TABLE IF NOT EXISTS options (path TEXT PRIMARY KEY, section TEXT, name TEXT, value TEXT, day INTEGER);
+CREATE INDEX IF NOT EXISTS sections_depth ON sections (depth, path);
+CREATE INDEX IF NOT EXISTS options_section ON options (section, name);
+CREATE INDEX IF NOT EXISTS options_name_value ON options (name, value);
+CREATE INDEX IF NOT EXISTS options_name_day ON options (name, day);
+"""
+
+# Options whose dd/mm/YYYY value is also stored as an ordinal day for range queries.
+DATE_OPTIONS = frozenset(('LastSeen',))
+
+
+def _day(value):
+    """Convert a dd/mm/YYYY CS date to an ordinal day, None if it does not parse."""
+    try:
+        return datetime.strptime(value, '%d/%m/%Y').toordinal()
+    except (TypeError, ValueError):
+        return None
+
+
+class CSReplica(object):
+    """
+    SQLite replica of the CS, rebuilt whenever the CS version changes.
+
+    Sections and options are stored in path indexed tables, with the option
+    name/value and (for dates such as LastSeen) the parsed day also indexed, so
+    that the agents' scans become indexed lookups rather than converting large
+    subtrees to dicts. Section patterns are sqlite GLOB patterns in which every
+    '*' stands for exactly one path element.
+
+    Example:
+        >>> replica = ConfigurationSystem().replica()
+        >>> replica.last_seen_before('/Resources/Sites/LCG/*/CEs/*', date(2024, 1, 1))
+        [('/Resources/Sites/LCG/LCG.UKI-Site.uk/CEs/ce.site.ac.uk', '02/10/2023')]
+        >>> replica.find('Host', 'se.site.ac.uk', '/Resources/StorageElements/*')
+        ['/Resources/StorageElements/UKI-Site-disk']
+    """
+
+    def __init__(self, path=':memory:'):
+        """
+        Initialise.
+
+        Args:
+            path (str): The sqlite database file, by default an in memory database.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        self.version = row[0] if row else None
+
+    def refresh(self, version, options, sections):
+        """
+        Rebuild the replica if the CS version has changed.
+
+        Args:
+            version (str): The CS version of options/sections, None if unknown,
+                           which always forces a rebuild.
+            options (dict): Option path to value.
+            sections (iterable): Section paths.
+
+        Returns:
+            bool: True if the replica was rebuilt.
+        """
+        with self._lock:
+            if version is not None and version == self.version:
+                return False
+            with self._conn:
+                self._conn.execute("DELETE FROM sections")
+                self._conn.execute("DELETE FROM options")
+                self._conn.executemany("INSERT INTO sections VALUES (?, ?, ?)",
+                                       ((path, path.rsplit('/', 1)[0], path.count('/'))
+                                        for path in sections))
+                self._conn.executemany("INSERT INTO options VALUES (?, ?, ?, ?, ?)",
+                                       ((path,) + tuple(path.rsplit('/', 1)) +
+                                        (value, _day(value) if path.rsplit('/', 1)[1] in DATE_OPTIONS else None)
+                                        for path, value in options.items()))
+                self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+            self.version = version
+        gLogger.debug("Rebuilt CS replica %s at version %s" % (self.path, version))
+        return True
+
+    def _query(self, sql, *args):
+        """Run a query and return all rows."""
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def sections(self, pattern):
+        """Return the paths of the sections matching pattern, sorted."""
+        return [row[0] for row in self._query("SELECT path FROM sections WHERE depth = ? AND path GLOB ? "
+                                              "ORDER BY path", pattern.count('/'), pattern)]
+
+    def sections_without(self, pattern, name):
+        """Return the paths of the sections matching pattern that lack option name, sorted."""
+        return [row[0] for row in self._query("SELECT s.path FROM sections s WHERE s.depth = ? AND s.path GLOB ? "
+                                              "AND NOT EXISTS (SELECT 1 FROM options o "
+                                              "WHERE o.section = s.path AND o.name = ?) ORDER BY s.path",
+                                              pattern.count('/'), pattern, name)]
+
+    def options(self, pattern, name):
+        """Return (section path, value) of option name in the sections matching pattern, sorted."""
+        return self._query("SELECT o.section, o.value FROM options o JOIN sections s ON s.path = o.section "
+                           "WHERE o.name = ? AND s.depth = ? AND o.section GLOB ? ORDER BY o.section",
+                           name, pattern.count('/'), pattern)
+
+    def last_seen_before(self, pattern, before, name='LastSeen'):
+        """
+        Return the sections matching pattern last seen before a date.
+
+        Args:
+            pattern (str): Section pattern, e.g. '/Resources/Sites/LCG/*/CEs/*'.
+            before (date): Only sections whose date option is earlier are returned.
+            name (str): The date option, one of DATE_OPTIONS.
+
+        Returns:
+            list: (section path, date string) tuples, sorted.
+        """
+        return self._query("SELECT o.section, o.value FROM options o JOIN sections s ON s.path = o.section "
+                           "WHERE o.name = ? AND o.day < ? AND s.depth = ? AND o.section GLOB ? "
+                           "ORDER BY o.section", name, before.toordinal(), pattern.count('/'), pattern)
+
+    def find(self, name, value, pattern='*'):
+        """Return the paths of the sections (matching pattern) where option name equals value."""
+        return [row[0] for row in self._query("SELECT section FROM options WHERE name = ? AND value = ? "
+                                              "AND section GLOB ? ORDER BY section", name, value, pattern)]
+
+    def close(self):
+        """Close the database."""
+        self._conn.close()
+
+__all__ = ('CSReplica', 'DATE_OPTIONS')
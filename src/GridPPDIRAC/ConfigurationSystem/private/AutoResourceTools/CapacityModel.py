@@ -0,0 +1,174 @@
+"""Load aware pilot limits derived from advertised Glue2 share state."""
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from DIRAC import gLogger
+
+
+class ShareState(namedtuple('ShareState', ('Running', 'Waiting', 'Total', 'CPUs', 'Updated'))):
+    """Smoothed state of a single Glue2 computing share."""
+
+    __slots__ = ()
+
+
+class CapacityModel(object):
+    """
+    EWMA smoothed capacity model for CE queues.
+
+    Each cycle the running, waiting and total job counts advertised by a Glue2
+    ComputingShare, together with the CPU count of the ComputingManager, are
+    folded into an exponentially weighted moving average which is persisted
+    between cycles. Pilot limits are then derived from the smoothed state so
+    that busy sites get fewer idle pilots and quiet ones get more. The state is
+    to be saved once the limits derived from it are committed, or discarded.
+
+    Example:
+        >>> model = CapacityModel('/opt/dirac/work/capacity.json')
+        >>> model.update('ce.example.ac.uk/nordugrid-Condor-grid',
+        ...              running=900, waiting=50, total=950, cpus=1000)
+        (1150, 150)
+        >>> model.save()
+    """
+
+    def __init__(self, state_file=None, alpha=0.3, waiting_fraction=0.1,
+                 min_waiting=10, max_waiting=5000, total_factor=1.5, max_age=7):
+        """
+        Initialise.
+
+        Args:
+            state_file (str): Path of the JSON file the smoothed state is persisted to.
+                              If None the state only lives as long as this object.
+            alpha (float): EWMA weight given to the newest observation.
+            waiting_fraction (float): Fraction of a queue's slots always allowed as
+                                      waiting pilots on top of the idle slots.
+            min_waiting (int): Lower bound on MaxWaitingJobs.
+            max_waiting (int): Upper bound on MaxWaitingJobs.
+            total_factor (float): MaxTotalJobs is capped at total_factor * max_waiting.
+            max_age (int): Days after which a share that has not been seen is forgotten.
+        """
+        self.state_file = state_file
+        self.alpha = float(alpha)
+        self.waiting_fraction = float(waiting_fraction)
+        self.min_waiting = int(min_waiting)
+        self.max_waiting = int(max_waiting)
+        self.max_total = int(total_factor * max_waiting)
+        self.max_age = max_age * 86400
+        self._state = {}
+        # The ARC and HTCondor stages may share a model from different threads.
+        self._lock = threading.Lock()
+        if state_file is not None:
+            self._load()
+        self._saved = dict(self._state)
+
+    def _load(self):
+        """Load the persisted state, dropping shares that have not been seen recently."""
+        try:
+            with open(self.state_file) as state:
+                raw = json.load(state)
+        except (IOError, OSError):
+            return
+        except ValueError as err:
+            gLogger.warn("Ignoring corrupt capacity state %s: %s" % (self.state_file, err))
+            return
+
+        oldest = time.time() - self.max_age
+        for key, value in raw.items():
+            try:
+                share = ShareState(**value)
+            except TypeError:
+                continue
+            if share.Updated >= oldest:
+                self._state[key] = share
+
+    def save(self):
+        """Persist the smoothed state atomically."""
+        with self._lock:
+            self._saved = dict(self._state)
+        if self.state_file is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.state_file))
+        state = {key: share._asdict() for key, share in self._saved.items()}
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.capacity')
+        try:
+            with os.fdopen(fd, 'w') as tmp:
+                json.dump(state, tmp, sort_keys=True)
+            os.replace(tmp_path, self.state_file)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def discard(self):
+        """Drop the observations made since the state was last saved, e.g. as their commit failed."""
+        with self._lock:
+            self._state = dict(self._saved)
+
+    def observe(self, key, running=0, waiting=0, total=0, cpus=0):
+        """
+        Fold a new observation into the smoothed state of a share.
+
+        Args:
+            key (str): Unique identifier of the queue, e.g. '<ce>/<queue>'.
+            running (int): Advertised GLUE2ComputingShareRunningJobs.
+            waiting (int): Advertised GLUE2ComputingShareWaitingJobs.
+            total (int): Advertised GLUE2ComputingShareTotalJobs.
+            cpus (int): CPU count advertised by the ComputingManager.
+
+        Returns:
+            ShareState: The new smoothed state.
+        """
+        new = (float(running), float(waiting), float(total), float(cpus))
+        with self._lock:
+            old = self._state.get(key)
+            if old is not None:
+                new = tuple(self.alpha * n + (1 - self.alpha) * o for n, o in zip(new, old[:4]))
+            share = ShareState(*new, Updated=time.time())
+            self._state[key] = share
+        return share
+
+    def limits(self, key):
+        """
+        Derive the pilot limits for a share.
+
+        The waiting limit is the smoothed number of idle slots plus a fixed
+        fraction of the queue's slots, less the backlog already waiting at the
+        site, clamped to [min_waiting, max_waiting]. The total limit is the
+        queue's slots plus the waiting limit, capped at max_total.
+
+        Args:
+            key (str): Unique identifier of the queue.
+
+        Returns:
+            tuple: (MaxTotalJobs, MaxWaitingJobs) or None if nothing is known about
+                   the share's size.
+        """
+        share = self._state.get(key)
+        if share is None:
+            return None
+        slots = share.CPUs or share.Total or share.Running
+        if slots <= 0:
+            return None
+
+        headroom = max(slots - share.Running, 0.)
+        max_waiting = int(headroom + self.waiting_fraction * slots - share.Waiting)
+        max_waiting = min(max(max_waiting, self.min_waiting), self.max_waiting)
+        max_total = min(int(slots) + max_waiting, self.max_total)
+        return max_total, max_waiting
+
+    def update(self, key, running=0, waiting=0, total=0, cpus=0):
+        """Observe a share and return its new limits, see observe and limits."""
+        self.observe(key, running, waiting, total, cpus)
+        return self.limits(key)
+
+
+def int_attr(attrs, name, default=0):
+    """Return the first value of an ldap attribute as an int, or default if unusable."""
+    try:
+        return int(attrs.get(name, [default])[0])
+    except (TypeError, ValueError):
+        return default
+
+__all__ = ('CapacityModel', 'ShareState', 'int_attr')
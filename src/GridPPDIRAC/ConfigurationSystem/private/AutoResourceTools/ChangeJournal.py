@@ -0,0 +1,117 @@
+"""Write-ahead journal for CS change sets."""
+import json
+import os
+import time
+from collections import namedtuple
+
+from DIRAC import gLogger
+
+
+class PendingChanges(namedtuple('PendingChanges', ('Version', 'Ops', 'Time'))):
+    """The uncommitted part of a journalled change set."""
+
+    __slots__ = ()
+
+
+class ChangeJournal(object):
+    """
+    Append only journal of a CS change set.
+
+    The change set computed by ConfigurationSystem.commit is written here before
+    anything is sent to the CS master, followed by a record after each committed
+    batch. The file is removed once the whole change set is committed, so a
+    journal left behind means the agent died or the commit failed part way. Each
+    line is one JSON record:
+
+        {"type": "begin", "version": <CS version>, "time": <epoch>, "ops": [[op, path, old, new], ...]}
+        {"type": "committed", "count": <ops committed so far>, "version": <CS version after>}
+
+    A torn (partially written) last line is ignored when reading back.
+
+    Example:
+        >>> journal = ChangeJournal('/opt/dirac/work/cs_journal.jsonl')
+        >>> pending = journal.pending()
+        >>> if pending is not None and pending.Version != current_version:
+        ...     journal.clear()
+    """
+
+    def __init__(self, path):
+        """
+        Initialise.
+
+        Args:
+            path (str): The journal file.
+        """
+        self.path = path
+
+    def _write(self, record, mode='a'):
+        """Durably write a record to the journal."""
+        with open(self.path, mode) as journal:
+            journal.write(json.dumps(record) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def begin(self, version, ops):
+        """
+        Start journalling a change set, replacing any previous journal.
+
+        Args:
+            version (str): The CS version the change set was computed against.
+            ops (list): (operation, path, old value, new value) tuples in commit order.
+        """
+        self._write({'type': 'begin', 'version': version, 'time': time.time(),
+                     'ops': [list(op) for op in ops]}, mode='w')
+
+    def committed(self, count, version):
+        """
+        Record that the first count ops have been committed.
+
+        Args:
+            count (int): Total number of ops committed so far.
+            version (str): The CS version after the commit.
+        """
+        self._write({'type': 'committed', 'count': count, 'version': version})
+
+    def clear(self):
+        """Remove the journal."""
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def pending(self):
+        """
+        Read back the uncommitted part of the journalled change set.
+
+        Returns:
+            PendingChanges: The CS version the remaining ops apply to and the ops
+                            themselves, or None if there is nothing pending.
+        """
+        try:
+            with open(self.path) as journal:
+                lines = journal.readlines()
+        except FileNotFoundError:
+            return None
+
+        begin = None
+        count = 0
+        version = None
+        for lineno, line in enumerate(lines, 1):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                gLogger.warn("Ignoring unreadable line %d of CS journal %s" % (lineno, self.path))
+                continue
+            if record.get('type') == 'begin':
+                begin, count, version = record, 0, record.get('version')
+            elif record.get('type') == 'committed' and begin is not None:
+                count, version = record['count'], record.get('version')
+
+        if begin is None:
+            return None
+        ops = [tuple(op) for op in begin['ops'][count:]]
+        if not ops:
+            return None
+        return PendingChanges(version, ops, begin.get('time'))
+
+__all__ = ('ChangeJournal', 'PendingChanges')
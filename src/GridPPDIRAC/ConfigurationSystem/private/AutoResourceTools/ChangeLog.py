@@ -0,0 +1,123 @@
+"""Structured log of the changes committed to the CS."""
+import json
+import threading
+import time
+import zlib
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+
+from DIRAC import gLogger
+
+_local = threading.local()
+
+
+@contextmanager
+def change_stage(name):
+    """
+    Attribute the CS changes made by the current thread within the block to a stage.
+
+    Example:
+        >>> with change_stage('update_ses'):
+        ...     update_ses(vo_list)
+    """
+    previous = getattr(_local, 'stage', None)
+    _local.stage = name
+    try:
+        yield
+    finally:
+        _local.stage = previous
+
+
+def current_stage():
+    """Return the stage set by change_stage for the current thread, None if none."""
+    return getattr(_local, 'stage', None)
+
+
+class ChangeRecord(namedtuple('ChangeRecord', ('Op', 'Path', 'Old', 'New', 'Stage'))):
+    """A committed CS change."""
+
+    __slots__ = ()
+
+    @property
+    def Section(self):
+        """The section the change was made to."""
+        return self.Path if self.Op == 'delSection' else self.Path.rsplit('/', 1)[0]
+
+
+class ChangeLog(object):
+    """
+    Buffer of the changes committed to the CS, flushed once per commit.
+
+    Records are only buffered while committing. On flush a single JSON-lines
+    block is appended to path (if set): a commit header, the per option
+    records (or a stable sample of them, the same paths being picked every
+    commit) and a summary line per section. Without a path only the section
+    summaries are logged.
+
+        {"type": "commit", "time": <epoch>, "changes": n, "sampled": m}
+        {"type": "change", "op": op, "path": path, "old": old, "new": new, "stage": stage}
+        {"type": "section", "section": path, "ops": {op: count, ...}, "stages": [stage, ...]}
+
+    Example:
+        >>> log = ChangeLog('/opt/dirac/work/cs_changes.jsonl', sample=0.1)
+        >>> log.record('setOption', '/Registry/DefaultGroup', None, 'dteam_user', None)
+        >>> log.flush()
+    """
+
+    def __init__(self, path=None, sample=1.):
+        """
+        Initialise.
+
+        Args:
+            path (str): The change log file, None to only log the summary.
+            sample (float): Fraction of the per option records written.
+        """
+        self.path = path
+        self.sample = sample
+        self._records = []
+
+    def __len__(self):
+        """Number of buffered records."""
+        return len(self._records)
+
+    def record(self, op, path, old, new, stage):
+        """Buffer a change."""
+        self._records.append(ChangeRecord(op, path, old, new, stage))
+
+    def _sampled(self, path):
+        """Return True if the per option record of path is to be written."""
+        if self.sample >= 1.:
+            return True
+        return zlib.crc32(path.encode()) % 10000 < self.sample * 10000
+
+    def flush(self):
+        """Write out and clear the buffered records."""
+        if not self._records:
+            return
+        records, self._records = self._records, []
+        sections = {}
+        for record in records:
+            ops, stages = sections.setdefault(record.Section, (Counter(), set()))
+            ops[record.Op] += 1
+            stages.add(record.Stage)
+
+        if self.path is None:
+            for section, (ops, _) in sorted(sections.items()):
+                gLogger.notice("Changed %s: %s" % (section, ', '.join('%s %d' % item for item in sorted(ops.items()))))
+            return
+
+        changes = [{'type': 'change', 'op': record.Op, 'path': record.Path,
+                    'old': record.Old, 'new': record.New, 'stage': record.Stage}
+                   for record in records if self._sampled(record.Path)]
+        lines = [{'type': 'commit', 'time': time.time(), 'changes': len(records), 'sampled': len(changes)}]
+        lines.extend(changes)
+        lines.extend({'type': 'section', 'section': section, 'ops': dict(ops),
+                      'stages': sorted(stages, key=str)}
+                     for section, (ops, stages) in sorted(sections.items()))
+        try:
+            with open(self.path, 'a') as change_log:
+                change_log.write(''.join(json.dumps(line) + '\n' for line in lines))
+        except (IOError, OSError) as err:
+            gLogger.warn("Could not write CS change log %s: %s" % (self.path, err))
+
+__all__ = ('ChangeLog', 'ChangeRecord', 'change_stage', 'current_stage')
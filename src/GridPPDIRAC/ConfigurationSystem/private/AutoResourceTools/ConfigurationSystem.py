@@ -1,38 +1,316 @@
 """Dirac multiVO Configuration system."""
+import time
+from datetime import date, datetime, timedelta
+from collections import defaultdict, deque, namedtuple
+from fnmatch import fnmatchcase
 from itertools import chain
-from collections import defaultdict
 from types import GeneratorType
-from DIRAC import gLogger, gConfig
+from DIRAC import gConfig, gLogger
 from DIRAC.ConfigurationSystem.Client.Helpers.Path import cfgPath
 from DIRAC.ConfigurationSystem.Client.CSAPI import CSAPI
+from DIRAC.ConfigurationSystem.Client.ConfigurationClient import ConfigurationClient
+from .ChangeJournal import ChangeJournal
+from .ChangeLog import ChangeLog, change_stage, current_stage
+from .CSReplica import CSReplica
+from .Metrics import metrics
+from .StalenessSweeper import StalenessSweeper
 
 
+class ChangeList(object):
+    """
+    Recorded list of CS changes.
 
-class ConfigDefaultDict(defaultdict):
-    def __missing__(self, key):
-        old_values = (v.strip() for v in gConfig.getValue(key, '').split(',') if v)
-        value = super(ConfigDefaultDict, self).__missing__(key)
-        if isinstance(value, list):
-            value.extend(old_values)
-        elif isinstance(value, set):
-            value.update(old_values)
-        return value
+    Provides the same add/append/append_unique/remove interface as ConfigurationSystem
+    but only records the calls, so that changes can be built independently (e.g. in
+    worker threads) and applied to a ConfigurationSystem later in a chosen order.
+
+    Example:
+        >>> changes = ChangeList()
+        >>> changes.add('/Registry', 'DefaultGroup', 'dteam_user')
+        >>> changes.apply(ConfigurationSystem())
+    """
+
+    __slots__ = ('_calls',)
+
+    def __init__(self):
+        """initialise."""
+        self._calls = []
+
+    def __len__(self):
+        """Number of recorded calls."""
+        return len(self._calls)
+
+    def _record(self, method, *args):
+        """Record a call, materialising any generator argument."""
+        self._calls.append((method, tuple(tuple(arg) if isinstance(arg, GeneratorType) else arg
+                                          for arg in args)))
+
+    def add(self, section, option, new_value):
+        """Record ConfigurationSystem.add."""
+        self._record('add', section, option, new_value)
+
+    def append(self, section, option, new_value):
+        """Record ConfigurationSystem.append."""
+        self._record('append', section, option, new_value)
+
+    def append_unique(self, section, option, new_value):
+        """Record ConfigurationSystem.append_unique."""
+        self._record('append_unique', section, option, new_value)
+
+    def remove(self, section, option=None, value=None):
+        """Record ConfigurationSystem.remove."""
+        self._record('remove', section, option, value)
+
+    def apply(self, cfg_system):
+        """Replay the recorded calls, in order, on cfg_system."""
+        for method, args in self._calls:
+            getattr(cfg_system, method)(*args)
+
+
+_DELETED = object()
+
+
+class CSConflict(namedtuple('CSConflict', ('Path', 'Base', 'Theirs', 'Ours'))):
+    """
+    A pending change dropped because another writer changed the same path.
+
+    Attributes:
+        Path (str): The option or section path.
+        Base (str): The value the change was computed against.
+        Theirs (str): The value the other writer committed.
+        Ours (str): The value we wanted, None for a removal.
+    """
+
+    __slots__ = ()
+
+
+def absolute_path(path):
+    """Return a CS path as the absolute path the snapshot is indexed by, e.g. '/Registry/Hosts'."""
+    return '/' + path.lstrip('/')
+
+
+def flatten_cfg(cfg_dict, root='/'):
+    """
+    Flatten a nested CFG dict (as from CFG.getAsDict) into an index.
+
+    Args:
+        cfg_dict (dict): Nested dict of sections (dicts) and options (str).
+        root (str): Path of cfg_dict.
+
+    Returns:
+        tuple: (dict of option path to value, set of section paths)
+    """
+    options = {}
+    sections = set()
+    stack = [(root, cfg_dict)]
+    while stack:
+        path, section = stack.pop()
+        for name, value in section.items():
+            child = cfgPath(path, name)
+            if isinstance(value, dict):
+                sections.add(child)
+                stack.append((child, value))
+            else:
+                options[child] = value
+    return options, sections
+
+
+# Resource kinds counted as added/changed/removed, deepest first.
+RESOURCE_PATTERNS = (('ce', '/Resources/Sites/*/*/CEs/*'),
+                     ('site', '/Resources/Sites/*/*'),
+                     ('se', '/Resources/StorageElements/*'),
+                     ('host', '/Registry/Hosts/*'))
+
+
+def resource_changes(ops, sections):
+    """
+    Work out which resources a change set adds, changes and removes.
+
+    A change is attributed to the deepest resource (see RESOURCE_PATTERNS)
+    containing its path, e.g. a change to a CE's queue changes the CE, not its
+    site, while every new resource containing the path counts as added.
+
+    Args:
+        ops (list): (operation, path, old value, new value) tuples.
+        sections (set): Section paths existing before the change set.
+
+    Returns:
+        dict: Resource section path to (kind, 'added'|'changed'|'removed').
+    """
+    changes = {}
+    for operation, path, _, _ in ops:
+        parts = path.split('/')
+        deepest = True
+        for kind, pattern in RESOURCE_PATTERNS:
+            depth = pattern.count('/')
+            if len(parts) <= depth:
+                continue
+            resource = '/'.join(parts[:depth + 1])
+            if not fnmatchcase(resource, pattern):
+                continue
+            if operation == 'delSection' and path == resource:
+                changes[resource] = (kind, 'removed')
+            elif resource not in sections:
+                changes[resource] = (kind, 'added')
+            elif deepest:
+                changes.setdefault(resource, (kind, 'changed'))
+            deepest = False
+    return changes
 
 
 class ConfigurationSystem(CSAPI):
-    """Class to smartly wrap the functionality of the CS."""
+    """
+    Class to smartly wrap the functionality of the CS.
+
+    The current CFG is loaded once per session into a flat path index. Calls to
+    add/remove only update a shadow of the desired state, the minimal set of
+    setOption/modifyValue/delOption/delSection operations is worked out by
+    diffing the shadow against the snapshot at commit time.
+
+    If commit_batch_size is set the operations are committed in batches of
+    roughly that many changes, never splitting the changes to one section
+    across batches. The batch size is halved whenever a commit takes longer
+    than commit_target_time and grown again while the master responds quickly.
+    Each batch that succeeds is folded into the snapshot, so if a batch still
+    fails after commit_retries attempts, calling commit again resumes from it.
+
+    If journal_path is set the change set, together with the CS version it was
+    computed against, is written to a ChangeJournal before committing so that
+    it can be replayed with replay_journal if the process dies part way.
+
+    The CS version the snapshot was taken at is recorded and checked against the
+    master before committing, so several agents can write to the CS side by side:
+    if somebody else committed in between, the pending changes are rebased onto
+    the new version and conflicting changes are reported instead of overwriting.
+
+    Section and option paths may be given relative to the root (e.g.
+    'Resources/Sites') or absolute, they are always stored absolute.
+
+    If last_seen_store is set, LastSeen options are recorded there on every add
+    but only written to the CS when the CS value is missing or more than
+    last_seen_sync_days old, so the date moving on no longer rewrites every
+    LastSeen in the CS each day. Sightings are also pushed to a StalenessSweeper
+    shared by all instances, which last_seen_before uses to find what is old.
+
+    Committed changes are not logged one by one but buffered in a ChangeLog,
+    together with the stage (see stage) they were made in, and written out
+    once per commit to change_log_path.
+    """
+
+    VERSION_PATH = '/DIRAC/Configuration/Version'
+
+    commit_batch_size = None
+    commit_max_batch_size = 5000
+    commit_target_time = 10.
+    commit_retries = 3
+    journal_path = None
+    replica_path = ':memory:'
+    last_seen_store = None
+    last_seen_sync_days = 3
+    change_log_path = None
+    change_log_sample = 1.
+    _replicas = {}
+    _sweeper = StalenessSweeper()
+
+    stage = staticmethod(change_stage)
+
+    @classmethod
+    def configure(cls, **options):
+        """
+        Set the defaults used by all ConfigurationSystem instances.
+
+        Example:
+            >>> ConfigurationSystem.configure(commit_batch_size=500)
+
+        Raises:
+            AttributeError: If an option is not a known setting.
+        """
+        for name, value in options.items():
+            if name.startswith('_') or not hasattr(cls, name) or callable(getattr(cls, name)):
+                raise AttributeError("Unknown ConfigurationSystem setting: %s" % name)
+            setattr(cls, name, value)
 
     def __init__(self):
         """initialise."""
         CSAPI.__init__(self)
         self._num_changes = 0
-        self._append_dict = ConfigDefaultDict(list)
-        self._append_unique_dict = ConfigDefaultDict(set)
+        self._stale = False
+        self.conflicts = []
+        self._append_dict = defaultdict(list)
+        self._append_unique_dict = defaultdict(set)
+        self._current = {}
+        self._sections = set()
+        self._desired = {}
+        self._removed_sections = set()
+        self._stages = {}
+        self._change_log = ChangeLog(self.change_log_path, self.change_log_sample)
         result = self.initialize()
         if not result['OK']:
             gLogger.error('Failed to initialise CSAPI object:',
                           result['Message'])
             raise RuntimeError(result['Message'])
+        self._load_snapshot()
+
+    def _load_snapshot(self):
+        """Load the current CFG into the flat snapshot index."""
+        result = self.getCurrentCFG()
+        if not result['OK']:
+            gLogger.error('Failed to get current CFG:', result['Message'])
+            raise RuntimeError(result['Message'])
+        self._current, self._sections = flatten_cfg(result['Value'].getAsDict())
+        self._version = self._current.get(self.VERSION_PATH)
+        self._desired.clear()
+        self._removed_sections.clear()
+        self._stages.clear()
+
+    def _set_stage(self, path):
+        """Note the stage, if any, path is being changed in."""
+        stage = current_stage()
+        if stage is not None:
+            self._stages[path] = stage
+
+    def replica(self):
+        """
+        Return the local read replica of the CS, brought up to the snapshot's version.
+
+        Replicas are shared between instances using the same replica_path.
+
+        Returns:
+            CSReplica: The replica.
+        """
+        replica = ConfigurationSystem._replicas.get(self.replica_path)
+        if replica is None:
+            replica = ConfigurationSystem._replicas[self.replica_path] = CSReplica(self.replica_path)
+        replica.refresh(self._version, self._current, self._sections)
+        return replica
+
+    def _in_removed_section(self, path):
+        """Return True if path lies within a section removed this session."""
+        # Relative paths (e.g. Resources/Sites/...) run out of '/' instead of reaching the root
+        while '/' in path.strip('/'):
+            path = path.rsplit('/', 1)[0]
+            if path in self._removed_sections:
+                return True
+        return False
+
+    def get_value(self, path, default=None):
+        """
+        Get the value of an option as it will be after commit.
+
+        Args:
+            path (str): The full option path
+            default: Returned if the option does not (or will no longer) exist
+
+        Returns:
+            str: The option value
+        """
+        path = absolute_path(path)
+        value = self._desired.get(path)
+        if value is None:
+            if self._in_removed_section(path):
+                return default
+            value = self._current.get(path, default)
+        return default if value is _DELETED else value
 
     def add(self, section, option, new_value):
         """
@@ -49,6 +327,7 @@ class ConfigurationSystem(CSAPI):
             >>> cs = ConfigurationSystem()
             >>> cs.add('/Registry', 'DefaultGroup', 'dteam_user')
         """
+        section = absolute_path(section)
         if isinstance(new_value, dict):
             section = cfgPath(section, option)
             for option, val in new_value.items():
@@ -60,19 +339,130 @@ class ConfigurationSystem(CSAPI):
         else:
             new_value = str(new_value)
 
-        old_value = gConfig.getValue(cfgPath(section, option), None)
-        if old_value == new_value:
+        if option == 'LastSeen' and self.last_seen_store is not None:
+            self.mark_seen(section, new_value)
             return
 
-        if old_value is None:
-            gLogger.notice("Setting %s/%s:   -> %s"
-                           % (section, option, new_value))
-            self.setOption(cfgPath(section, option), new_value)
-        else:
-            gLogger.notice("Modifying %s/%s:   %s -> %s"
-                           % (section, option, old_value, new_value))
-            self.modifyValue(cfgPath(section, option), new_value)
-        self._num_changes += 1
+        path = cfgPath(section, option)
+        if self.get_value(path) != new_value:
+            self._desired[path] = new_value
+            self._set_stage(path)
+
+    @staticmethod
+    def _parse_date(value):
+        """Parse a dd/mm/YYYY CS date, None if it does not parse."""
+        try:
+            return datetime.strptime(value, '%d/%m/%Y').date()
+        except (TypeError, ValueError):
+            return None
+
+    def mark_seen(self, section, seen=None):
+        """
+        Record that the resource at section has been seen.
+
+        The day is always recorded in last_seen_store (if set) while the CS
+        LastSeen option is only updated when it is missing or at least
+        last_seen_sync_days older than the day seen.
+
+        Args:
+            section (str): The resource's section, e.g. a CE's.
+            seen: The date (or dd/mm/YYYY string) seen, today by default.
+        """
+        section = absolute_path(section)
+        if seen is None:
+            seen = date.today()
+        elif not isinstance(seen, date):
+            seen = self._parse_date(seen) or date.today()
+        path = cfgPath(section, 'LastSeen')
+        ConfigurationSystem._sweeper.seen(section, seen)
+        if self.last_seen_store is not None:
+            self.last_seen_store.mark(section, seen)
+            cs_seen = self._parse_date(self.get_value(path))
+            if cs_seen is not None and (seen - cs_seen).days < self.last_seen_sync_days:
+                return
+        new_value = seen.strftime('%d/%m/%Y')
+        if self.get_value(path) != new_value:
+            self._desired[path] = new_value
+            self._set_stage(path)
+
+    def _seed_sweeper(self, pattern):
+        """
+        Seed the shared StalenessSweeper with the sections matching pattern.
+
+        This is done once per pattern, sightings are pushed by mark_seen after.
+        The CS LastSeen never being newer than the one in last_seen_store, the
+        later of the two is used. Sections unknown to the store (e.g. after the
+        store was lost) are entered last_seen_sync_days late, as their CS value
+        may lag by that much.
+        """
+        sweeper = ConfigurationSystem._sweeper
+        store = self.last_seen_store
+        margin = timedelta(days=self.last_seen_sync_days if store is not None else 0)
+        for section, cs_value in self.replica().options(pattern, 'LastSeen'):
+            cs_seen = self._parse_date(cs_value)
+            if cs_seen is None:
+                continue
+            seen = store.get(section) if store is not None else None
+            sweeper.seen(section, max(seen, cs_seen) if seen is not None else cs_seen + margin)
+        sweeper.seeded.add(pattern)
+
+    def last_seen_before(self, pattern, before):
+        """
+        Return the sections matching pattern last seen before a date.
+
+        Only the expired entries of the shared StalenessSweeper are looked at,
+        which is seeded from the CS the first time a pattern is swept. Each of
+        those is checked against the later of its store and CS LastSeen, as the
+        sweeper misses sightings made by other processes; sections seen since
+        are pushed back to the sweeper rather than returned. Sections no longer
+        in the CS are dropped from the sweeper.
+
+        Args:
+            pattern (str): Section pattern, see CSReplica.
+            before (date): Only sections last seen earlier are returned.
+
+        Returns:
+            list: (section path, date string) tuples, sorted.
+        """
+        pattern = absolute_path(pattern)
+        sweeper = ConfigurationSystem._sweeper
+        if pattern not in sweeper.seeded:
+            self._seed_sweeper(pattern)
+        store = self.last_seen_store
+        old = []
+        for section, _ in sweeper.expired(pattern, before):
+            cs_value = self.get_value(cfgPath(section, 'LastSeen'))
+            if cs_value is None:
+                sweeper.forget(section)
+                continue
+            seen = [day for day in (self._parse_date(cs_value), store.get(section) if store is not None else None)
+                    if day is not None]
+            if not seen:
+                sweeper.forget(section)  # an unparsable LastSeen is never old, as in CSReplica
+                continue
+            if max(seen) >= before:
+                sweeper.seen(section, max(seen))
+                continue
+            old.append((section, max(seen).strftime('%d/%m/%Y')))
+        return sorted(old)
+
+    def _merge_appends(self):
+        """
+        Merge the pending appends with the existing option values.
+
+        Each appended path is looked up in the snapshot once and its existing
+        comma separated values parsed once, the merged value is compared with
+        that same lookup rather than going through add again.
+        """
+        for appends, merge in ((self._append_dict, list.__add__),
+                               (self._append_unique_dict, lambda old, new: set(old).union(new))):
+            for path, value in appends.items():
+                old_value = self.get_value(path)
+                old_values = [v.strip() for v in (old_value or '').split(',') if v.strip()]
+                new_value = ', '.join(sorted(map(str, merge(old_values, list(value)))))
+                if old_value != new_value:
+                    self._desired[path] = new_value
+            appends.clear()
 
     def append(self, section, option, new_value):
         """
@@ -87,10 +477,12 @@ class ConfigurationSystem(CSAPI):
             option (str): The option to be modified
             new_value: The value to be appended
         """
+        path = cfgPath(absolute_path(section), option)
         if isinstance(new_value, (tuple, list, set, GeneratorType)):
-            self._append_dict[cfgPath(section, option)].extend(new_value)
+            self._append_dict[path].extend(new_value)
         else:
-            self._append_dict[cfgPath(section, option)].append(new_value)
+            self._append_dict[path].append(new_value)
+        self._set_stage(path)
 
     def append_unique(self, section, option, new_value):
         """
@@ -105,10 +497,12 @@ class ConfigurationSystem(CSAPI):
             new_value: The value to be appended
         """
 
+        path = cfgPath(absolute_path(section), option)
         if isinstance(new_value, (tuple, list, set, GeneratorType)):
-            self._append_unique_dict[cfgPath(section, option)].update(new_value)
+            self._append_unique_dict[path].update(new_value)
         else:
-            self._append_unique_dict[cfgPath(section, option)].add(new_value)
+            self._append_unique_dict[path].add(new_value)
+        self._set_stage(path)
 
     def remove(self, section, option=None, value=None):
         """
@@ -128,42 +522,321 @@ class ConfigurationSystem(CSAPI):
         Example:
             >>> ConfigurationSystem().remove('/Registry', 'DefaultGroup')
         """
+        section = absolute_path(section)
         if option is None:
-            gLogger.notice("Removing section %s" % section)
-            self.delSection(section)
-            self._num_changes += 1
+            prefix = section.rstrip('/') + '/'
+            for path in [path for path in self._desired if path.startswith(prefix)]:
+                del self._desired[path]
+            self._removed_sections.add(section)
+            self._set_stage(section)
+            ConfigurationSystem._sweeper.forget(section)
+            if self.last_seen_store is not None:
+                self.last_seen_store.discard(section, prefix=True)
         elif value is None:
-            gLogger.notice("Removing option %s/%s" % (section, option))
-            self.delOption(cfgPath(section, option))
-            self._num_changes += 1
+            self._desired[cfgPath(section, option)] = _DELETED
+            self._set_stage(cfgPath(section, option))
         else:
             if isinstance(value, str):
                 value = [value]
-            gLogger.notice("Removing value(s) %s from option %s/%s"
-                           % (list(value), section, option))
-            old_values = (v.strip() for v in gConfig.getValue(cfgPath(section, option), '').split(','))
+            old_values = (v.strip() for v in self.get_value(cfgPath(section, option), '').split(','))
             new_values = [v for v in old_values if v and v not in value]
             self.add(section, option, new_values)
 
-    def commit(self):
-        """Commit the changes to the configuration system."""
-        # Perform all the appending operations at the end to only get from current config once.
-        for path, value in chain(self._append_dict.items(),
-                                 self._append_unique_dict.items()):
-            section, option = path.rsplit('/', 1)
-            self.add(section, option, value)
+    def diff(self, paths=None):
+        """
+        Work out the operations turning the snapshot into the desired state.
 
-        result = CSAPI.commit(self)
-        if not result['OK']:
-            gLogger.error("Error while commit to CS", result['Message'])
-            raise RuntimeError("Error while commit to CS")
-        if self._num_changes:
-            gLogger.notice("Successfully committed %d changes to CS\n"
-                           % self._num_changes)
-            self._num_changes = 0
-            self._append_dict.clear()
-            self._append_unique_dict.clear()
+        Deletions come first so that options re-added under a removed section
+        are set afterwards.
+
+        Args:
+            paths (set): If given, only the operations on these paths.
+
+        Returns:
+            list: (operation, path, old value, new value) tuples
+        """
+        if paths is None:
+            removed, desired = self._removed_sections, self._desired.items()
         else:
+            removed = self._removed_sections.intersection(paths)
+            desired = [(path, self._desired[path]) for path in paths if path in self._desired]
+        ops = []
+        for section in sorted(removed):
+            if section in self._sections and not self._in_removed_section(section):
+                ops.append(('delSection', section, None, None))
+        sets = []
+        for path, value in sorted(desired):
+            old_value = None if self._in_removed_section(path) else self._current.get(path)
+            if value is _DELETED:
+                if old_value is not None:
+                    ops.append(('delOption', path, old_value, None))
+            elif old_value is None:
+                sets.append(('setOption', path, None, value))
+            elif old_value != value:
+                sets.append(('modifyValue', path, old_value, value))
+        return ops + sets
+
+    def _apply(self, ops):
+        """Apply diff operations to the CSAPI modificator."""
+        for operation, path, _, new_value in ops:
+            if operation == 'delSection':
+                self.delSection(path)
+            elif operation == 'delOption':
+                self.delOption(path)
+            elif operation == 'setOption':
+                self.setOption(path, new_value)
+            else:
+                self.modifyValue(path, new_value)
+
+    def _fold(self, ops):
+        """Fold committed operations into the snapshot."""
+        # The snapshot no longer corresponds to any version we know of.
+        self._version = None
+        for operation, path, old_value, new_value in ops:
+            self._change_log.record(operation, path, old_value, new_value, self._stages.get(path))
+            metrics.inc('cs_ops_total', op=operation)
+            if operation == 'delSection':
+                prefix = path + '/'
+                for option in [option for option in self._current if option.startswith(prefix)]:
+                    del self._current[option]
+                self._sections = {section for section in self._sections
+                                  if section != path and not section.startswith(prefix)}
+                self._removed_sections.discard(path)
+                continue
+            self._desired.pop(path, None)
+            if operation == 'delOption':
+                self._current.pop(path, None)
+                continue
+            self._current[path] = new_value
+            section = path.rsplit('/', 1)[0]
+            while section and section not in self._sections:
+                self._sections.add(section)
+                section = section.rsplit('/', 1)[0]
+        self._num_changes += len(ops)
+
+    @staticmethod
+    def _section_groups(ops):
+        """Group diff operations by the section they change, keeping their order."""
+        groups = {}
+        for op in ops:
+            operation, path = op[:2]
+            groups.setdefault(path if operation == 'delSection' else path.rsplit('/', 1)[0], []).append(op)
+        return deque(groups.values())
+
+    def _rebase(self, download=True):
+        """
+        Bring the snapshot up to date with the master, rebasing the pending changes.
+
+        If another writer has committed since the snapshot was taken, pending
+        changes to paths the other writer did not touch are kept, changes the
+        other writer already made are dropped and changes to paths the other
+        writer changed differently are reported as conflicts and dropped rather
+        than overwriting the other writer's values.
+
+        Args:
+            download (bool): False to rebase onto the CFG CSAPI already holds, e.g.
+                             as reloaded by CSAPI.commit, without downloading it.
+
+        Returns:
+            str: The CS version rebased onto.
+
+        Raises:
+            RuntimeError: If the master's CFG could not be downloaded.
+        """
+        if download:
+            result = self.downloadCSData()
+            if not result['OK']:
+                gLogger.error("Error downloading CS data", result['Message'])
+                raise RuntimeError("Error while commit to CS")
+            self._stale = False
+        result = self.getCurrentCFG()
+        if not result['OK']:
+            gLogger.error('Failed to get current CFG:', result['Message'])
+            raise RuntimeError(result['Message'])
+        cfg = result['Value']
+        version = cfg.getOption(self.VERSION_PATH, None)
+        if version == self._version:
+            return version
+
+        current, sections = flatten_cfg(cfg.getAsDict())
+        changed = {path for path in chain(self._current, current)
+                   if current.get(path) != self._current.get(path)}
+        conflicts = []
+        for path in sorted(changed.intersection(self._desired)):
+            value = self._desired.pop(path)
+            value = None if value is _DELETED else value
+            if current.get(path) != value:
+                gLogger.warn("CS conflict, not overwriting %s: was %s, now %s, wanted %s"
+                             % (path, self._current.get(path), current.get(path), value))
+                conflicts.append(CSConflict(path, self._current.get(path), current.get(path), value))
+        for section in sorted(self._removed_sections):
+            prefix = section + '/'
+            if any(path.startswith(prefix) for path in changed):
+                gLogger.warn("CS conflict, not removing section %s as it has since been changed" % section)
+                self._removed_sections.discard(section)
+                conflicts.append(CSConflict(section, None, None, None))
+
+        if download or changed != {self.VERSION_PATH}:
+            gLogger.notice("CS changed from version %s to %s since the snapshot was taken, "
+                           "rebased pending changes with %d conflict(s)" % (self._version, version, len(conflicts)))
+        self.conflicts.extend(conflicts)
+        self._current, self._sections, self._version = current, sections, version
+        return version
+
+    def _master_version(self):
+        """
+        Ask the master for its current CS version, without downloading the CS.
+
+        Returns:
+            str: The version, None if the master could not be asked.
+        """
+        result = ConfigurationClient(url=gConfig.getValue('/DIRAC/Configuration/MasterServer', '')).getVersion()
+        if not result['OK']:
+            gLogger.warn("Could not get the master's CS version:", result['Message'])
+            return None
+        return result['Value']
+
+    def _commit_batch(self, batch):
+        """
+        Commit a batch of operations, retrying from a fresh copy of the master's CFG.
+
+        Returns:
+            float: Time in seconds the successful commit took.
+
+        Raises:
+            RuntimeError: If the batch could not be committed.
+        """
+        paths = {op[1] for op in batch}
+        for attempt in range(self.commit_retries + 1):
+            if self._stale or self._master_version() != self._version:
+                # The modificator holds the changes of a failed attempt (e.g. because
+                # another writer got in first) or another writer has committed since,
+                # start again from the master's copy.
+                self._rebase()
+            # Drop what was rebased away since the batch was worked out
+            batch = self.diff(paths)
+            if not batch:
+                return 0.
+            self._apply(batch)
+            start = time.time()
+            result = CSAPI.commit(self)
+            elapsed = time.time() - start
+            metrics.observe('cs_commit_seconds', elapsed)
+            if result['OK']:
+                self._fold(batch)
+                # CSAPI.commit has already reloaded the CFG, catch up with it (and anything
+                # another writer committed before the reload) without downloading it again.
+                self._rebase(download=False)
+                return elapsed
+            self._stale = True
+            gLogger.warn("Commit of %d changes failed (attempt %d/%d): %s"
+                         % (len(batch), attempt + 1, self.commit_retries + 1, result['Message']))
+            if attempt < self.commit_retries:
+                time.sleep(min(2 ** attempt, 60))
+        gLogger.error("Error while commit to CS", result['Message'])
+        raise RuntimeError("Error while commit to CS")
+
+    def commit(self):
+        """
+        Commit the changes to the configuration system.
+
+        If the master has moved on from the snapshot the pending changes are
+        first rebased onto its current CFG, see _rebase. Conflicts found are
+        logged and collected as CSConflict tuples in self.conflicts. The
+        last_seen_store, if set, is flushed.
+        """
+        if self._stale or self._master_version() != self._version:
+            self._rebase()
+        # Perform all the appending operations at the end to only get from current config once.
+        self._merge_appends()
+        self._num_changes = 0
+        if self.last_seen_store is not None:
+            # The sightings are kept whether or not anything is committed
+            self.last_seen_store.flush()
+        groups = self._section_groups(self.diff())
+        if not groups:
             gLogger.notice("No changes to commit")
+            return
+
+        ops = [op for group in groups for op in group]
+        resources = resource_changes(ops, self._sections)
+        journal = None
+        if self.journal_path:
+            journal = ChangeJournal(self.journal_path)
+            journal.begin(self._version, ops)
+
+        batch_size = self.commit_batch_size or sum(len(group) for group in groups)
+        num_batches = 0
+        num_done = 0
+        try:
+            while groups:
+                batch = []
+                while groups and (not batch or len(batch) + len(groups[0]) <= batch_size):
+                    batch.extend(groups.popleft())
+                elapsed = self._commit_batch(batch)
+                num_batches += 1
+                num_done += len(batch)
+                if journal is not None and groups:
+                    # The rest of the changes are now based on the CS as committed
+                    journal.committed(num_done, self._version)
+                if self.commit_batch_size and groups:
+                    if elapsed > self.commit_target_time:
+                        batch_size = max(batch_size // 2, 1)
+                    elif elapsed < self.commit_target_time / 2:
+                        batch_size = min(int(batch_size * 1.5) + 1, self.commit_max_batch_size)
+                    gLogger.notice("Committed batch %d (%d changes) in %.1fs, next batch size %d"
+                                   % (num_batches, len(batch), elapsed, batch_size))
+        finally:
+            # Whatever made it into the CS is logged, even if a later batch failed.
+            self._change_log.flush()
+
+        gLogger.notice("Successfully committed %d changes to CS in %d batch(es)\n"
+                       % (self._num_changes, num_batches))
+        for kind, change in resources.values():
+            metrics.inc('cs_resources_total', kind=kind, change=change)
+        self._desired.clear()
+        self._removed_sections.clear()
+        self._stages.clear()
+        if journal is not None:
+            journal.clear()
+
+    def replay_journal(self):
+        """
+        Replay a change set left in the journal by an interrupted commit.
+
+        The journal is only replayed if the CS is still at the version the
+        remaining changes were computed against, otherwise somebody else has
+        written to the CS since and the journal is dropped. The changes are
+        fed back through add/remove so anything already in place is skipped.
+
+        Returns:
+            int: The number of journalled changes replayed.
+        """
+        if not self.journal_path:
+            return 0
+        journal = ChangeJournal(self.journal_path)
+        pending = journal.pending()
+        if pending is None:
+            journal.clear()
+            return 0
+        if pending.Version != self._version:
+            gLogger.warn("Dropping stale CS journal %s: computed against version %s but CS is at %s"
+                         % (self.journal_path, pending.Version, self._version))
+            journal.clear()
+            return 0
+
+        gLogger.notice("Replaying %d journalled CS changes from %s" % (len(pending.Ops), self.journal_path))
+        for operation, path, _, new_value in pending.Ops:
+            if operation == 'delSection':
+                self.remove(path)
+                continue
+            section, option = path.rsplit('/', 1)
+            if operation == 'delOption':
+                self.remove(section, option)
+            else:
+                self.add(section, option, new_value)
+        self.commit()
+        journal.clear()
+        return len(pending.Ops)
 
-__all__ = ('ConfigurationSystem',)
+__all__ = ('ConfigurationSystem', 'ChangeList', 'CSConflict', 'absolute_path', 'flatten_cfg', 'resource_changes')
@@ -0,0 +1,179 @@
+"""Deadlines and cancellation of agent cycle stages."""
+import threading
+import time
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+class StageCancelled(Exception):
+    """Raised in, or about, a stage cancelled or past its deadline."""
+
+
+class CancelToken(object):
+    """
+    Cancellation state and deadline of a stage.
+
+    A token is cancelled explicitly with cancel, which also runs the
+    registered callbacks (e.g. killing a subprocess), or implicitly once its
+    deadline, or its parent's, has passed. Long running calls bound their own
+    timeouts with remaining and check the token between steps.
+
+    Example:
+        >>> cycle = CancelToken(3600)
+        >>> token = CancelToken(parent=cycle)
+        >>> token.set_timeout(600)
+        >>> with cancel_scope(token):
+        ...     update_ses(vo_list)
+    """
+
+    def __init__(self, timeout=None, parent=None):
+        """
+        Initialise.
+
+        Args:
+            timeout (float): Seconds from now until the deadline, None for no deadline.
+            parent (CancelToken): Token whose deadline and cancellation also apply to this one.
+        """
+        self.parent = parent
+        self.deadline = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.set_timeout(timeout)
+
+    def set_timeout(self, timeout):
+        """Set the deadline to timeout seconds from now, None to only use the parent's."""
+        self.deadline = time.time() + timeout if timeout else None
+
+    def _deadline(self):
+        """Return the earliest of the own and parent deadlines."""
+        deadlines = [token.deadline for token in self._chain() if token.deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    def _chain(self):
+        """Yield this token and its ancestors."""
+        token = self
+        while token is not None:
+            yield token
+            token = token.parent
+
+    def remaining(self):
+        """Return the seconds left until the deadline, None if there is none."""
+        deadline = self._deadline()
+        if deadline is None:
+            return None
+        return max(deadline - time.time(), 0.)
+
+    def timeout(self, default=None):
+        """Return default bounded by the seconds remaining."""
+        remaining = self.remaining()
+        if remaining is None:
+            return default
+        return remaining if default is None else min(default, remaining)
+
+    @property
+    def expired(self):
+        """True if the deadline has passed."""
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    @property
+    def cancelled(self):
+        """True if this token or an ancestor was cancelled or the deadline has passed."""
+        return any(token._event.is_set() for token in self._chain()) or self.expired
+
+    def cancel(self):
+        """Cancel, running the registered callbacks once."""
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def on_cancel(self, callback):
+        """Register a callback run on cancel, or straight away if already cancelled."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        """Unregister a callback."""
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def check(self):
+        """
+        Raise if cancelled.
+
+        Raises:
+            StageCancelled: If this token or an ancestor was cancelled or the deadline has passed.
+        """
+        if self.cancelled:
+            raise StageCancelled("Deadline passed" if self.expired else "Cancelled")
+
+
+@contextmanager
+def cancel_scope(token):
+    """Make token the current thread's token within the block, see current_token."""
+    previous = getattr(_local, 'token', None)
+    _local.token = token
+    try:
+        yield token
+    finally:
+        _local.token = previous
+
+
+def current_token():
+    """Return the current thread's token, None if none."""
+    return getattr(_local, 'token', None)
+
+
+def check_cancelled():
+    """Raise StageCancelled if the current thread's token is cancelled."""
+    token = current_token()
+    if token is not None:
+        token.check()
+
+
+def call_with_deadline(token, func, *args, **kwargs):
+    """
+    Call func in a thread, abandoning it if it is still running at the token's deadline.
+
+    The token is the thread's current token and is cancelled on overrun, so
+    calls checking it stop and their callbacks (e.g. subprocess kills) run.
+
+    Returns:
+        The return value of func.
+
+    Raises:
+        StageCancelled: If func overran the deadline.
+    """
+    outcome = {}
+
+    def run():
+        with cancel_scope(token):
+            try:
+                outcome['value'] = func(*args, **kwargs)
+            except BaseException as err:
+                outcome['error'] = err
+
+    thread = threading.Thread(target=run, name=getattr(func, '__name__', 'stage'))
+    thread.daemon = True
+    thread.start()
+    thread.join(token.remaining())
+    if thread.is_alive():
+        token.cancel()
+        raise StageCancelled("%s overran its deadline" % thread.name)
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['value']
+
+__all__ = ('CancelToken', 'StageCancelled', 'cancel_scope', 'current_token', 'check_cancelled',
+           'call_with_deadline')
@@ -0,0 +1,251 @@
+"""Fingerprints of discovery query results, to skip reconciling unchanged content."""
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from datetime import date
+
+from DIRAC import gLogger
+from DIRAC.ConfigurationSystem.Client.Helpers.Path import cfgPath
+
+from .Deadline import current_token
+
+# Attributes that change between queries without the resource changing.
+TIMESTAMP_ATTRIBUTES = re.compile(r'(CreationTime|Validity)$')
+# Load/usage attributes, only relevant when pilot limits are derived from them.
+LOAD_ATTRIBUTES = re.compile(r'(RunningJobs|WaitingJobs|TotalJobs|StagingJobs|SuspendedJobs|FreeSlots|UsedSlots|'
+                             r'EstimatedAverageWaitingTime|EstimatedWorstWaitingTime|'
+                             r'(Used|Free)(Online|Nearline)Size)$')
+VOLATILE_ATTRIBUTES = re.compile('|'.join((TIMESTAMP_ATTRIBUTES.pattern, LOAD_ATTRIBUTES.pattern)))
+
+
+def normalise(value, volatile=VOLATILE_ATTRIBUTES):
+    """
+    Normalise query results for fingerprinting.
+
+    Dicts become sorted [key, value] lists without the keys matching volatile,
+    and lists, tuples and sets are sorted, as neither ldap nor the BDII
+    guarantee an order.
+
+    Args:
+        value: The results, any nesting of dicts, sequences, sets and scalars.
+        volatile (re.Pattern): Keys to leave out, None to keep everything.
+
+    Returns:
+        The JSON serialisable normalised value.
+    """
+    if isinstance(value, dict):
+        return sorted([str(key), normalise(val, volatile)] for key, val in value.items()
+                      if volatile is None or not volatile.search(str(key)))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sorted((normalise(val, volatile) for val in value),
+                      key=lambda val: json.dumps(val, sort_keys=True, default=str))
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def fingerprint(*parts, **kwargs):
+    """
+    Return a stable hash of parts.
+
+    Args:
+        parts: Values to fingerprint, see normalise.
+        volatile (re.Pattern): Keys left out, by default VOLATILE_ATTRIBUTES.
+
+    Returns:
+        str: Hex sha256 digest.
+    """
+    normalised = normalise(list(parts), kwargs.get('volatile', VOLATILE_ATTRIBUTES))
+    return hashlib.sha256(json.dumps(normalised, default=str).encode()).hexdigest()
+
+
+class FingerprintingLdap(object):
+    """
+    Wrapper of an ldap connection fingerprinting every result set as it is returned.
+
+    Example:
+        >>> ldap_conn = FingerprintingLdap(ldap.open(host, port))
+        >>> results = _search_arc_ces(ldap_conn)
+        >>> ldap_conn.hexdigest()
+    """
+
+    def __init__(self, ldap_conn, volatile=VOLATILE_ATTRIBUTES):
+        """
+        Initialise.
+
+        Args:
+            ldap_conn: The wrapped connection.
+            volatile (re.Pattern): Attributes left out of the fingerprint.
+        """
+        self._ldap_conn = ldap_conn
+        self._volatile = volatile
+        self._hash = hashlib.sha256()
+
+    def search_s(self, base, filterstr, scope=None):
+        """Search, see MockLdap.search_s, adding the results to the fingerprint."""
+        ret = self._ldap_conn.search_s(base=base, filterstr=filterstr, scope=scope)
+        self._hash.update(json.dumps([base, filterstr, normalise(ret, self._volatile)],
+                                     default=str).encode())
+        return ret
+
+    def hexdigest(self):
+        """Return the fingerprint of the results so far."""
+        return self._hash.hexdigest()
+
+
+class SeenRecorder(object):
+    """ConfigurationSystem proxy noting the sections LastSeen is set in."""
+
+    def __init__(self, cfg_system, seen):
+        """
+        Initialise.
+
+        Args:
+            cfg_system: The ConfigurationSystem or ChangeList changes are passed on to.
+            seen (set): Set the sections are added to.
+        """
+        self._cfg_system = cfg_system
+        self._seen = seen
+
+    def add(self, section, option, new_value):
+        """Note LastSeen sections, including those nested in a dict value, then pass on to the wrapped add."""
+        self._note(section, option, new_value)
+        self._cfg_system.add(section, option, new_value)
+
+    def _note(self, section, option, new_value):
+        """Note section if option is LastSeen, recursing into dict values as add does."""
+        if isinstance(new_value, dict):
+            section = cfgPath(section, option)
+            for option, value in new_value.items():
+                self._note(section, option, value)
+        elif option == 'LastSeen':
+            self._seen.add(section)
+
+    def __getattr__(self, name):
+        return getattr(self._cfg_system, name)
+
+
+class Fingerprints(object):
+    """
+    Persisted per stage fingerprints of the discovery query results.
+
+    A stage fingerprints its normalised query results and its arguments.
+    If the fingerprint, and the agent's other inputs, are those recorded
+    after the last successful commit, the stage skips building its model and
+    reconciling it with the CS and only sets LastSeen in the sections it last
+    set it in. A full reconciliation is forced once a fingerprint is older
+    than max_age, so that CS edits made by hand are still corrected.
+
+    Fingerprints recorded during a cycle only replace the persisted ones on
+    save, which is to be called once the cycle's changes are committed.
+
+    Example:
+        >>> fingerprints = Fingerprints('/opt/dirac/work/fingerprints.json', inputs=fingerprint(banned_ces))
+        >>> fp = fingerprint(results, vo_list)
+        >>> if not fingerprints.replay_seen('update_ces', fp, cfg_system):
+        ...     seen = set()
+        ...     reconcile(results, SeenRecorder(cfg_system, seen))
+        ...     fingerprints.record('update_ces', fp, seen)
+        >>> cfg_system.commit()
+        >>> fingerprints.save()
+    """
+
+    def __init__(self, state_file=None, inputs=None, max_age=86400):
+        """
+        Initialise.
+
+        Args:
+            state_file (str): JSON file the fingerprints are persisted to, None to keep them in memory.
+            inputs (str): Fingerprint of any other inputs (e.g. banned lists), any change of which
+                          invalidates all stage fingerprints.
+            max_age (int): Seconds after which a stage is fully reconciled regardless.
+        """
+        self.state_file = state_file
+        self.inputs = inputs
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._state = {}
+        self._pending = {}
+        if state_file is not None:
+            try:
+                with open(state_file) as state:
+                    self._state = json.load(state)
+            except (IOError, OSError):
+                pass
+            except ValueError as err:
+                gLogger.warn("Ignoring corrupt fingerprint state %s: %s" % (state_file, err))
+
+    def unchanged(self, stage, fp):
+        """Return True if stage's fingerprint fp, and the inputs, match the persisted ones."""
+        with self._lock:
+            entry = self._state.get(stage)
+        return (entry is not None and entry.get('fingerprint') == fp
+                and entry.get('inputs') == self.inputs
+                and time.time() - entry.get('time', 0) < self.max_age)
+
+    def replay_seen(self, stage, fp, cfg_system):
+        """
+        If the stage is unchanged set LastSeen to today in the sections it last set it in.
+
+        Args:
+            stage (str): The stage.
+            fp (str): The stage's fingerprint this cycle.
+            cfg_system: ConfigurationSystem or ChangeList.
+
+        Returns:
+            bool: True if the stage was unchanged and its reconciliation can be skipped.
+        """
+        if not self.unchanged(stage, fp):
+            return False
+        with self._lock:
+            entry = self._state[stage]
+            self._pending[stage] = entry
+        today = date.today().strftime('%d/%m/%Y')
+        for section in entry.get('seen', ()):
+            cfg_system.add(section, 'LastSeen', today)
+        gLogger.notice("Stage %s unchanged since last cycle, only updated LastSeen of %d resources"
+                       % (stage, len(entry.get('seen', ()))))
+        return True
+
+    def record(self, stage, fp, seen):
+        """
+        Record a stage's new fingerprint and the sections it set LastSeen in, see save.
+
+        Nothing is recorded by a cancelled stage, as its changes are dropped.
+        """
+        token = current_token()
+        if token is not None and token.cancelled:
+            return
+        with self._lock:
+            self._pending[stage] = {'fingerprint': fp, 'inputs': self.inputs,
+                                    'time': time.time(), 'seen': sorted(seen)}
+
+    def discard(self):
+        """Forget the fingerprints recorded this cycle."""
+        with self._lock:
+            self._pending.clear()
+
+    def save(self):
+        """Persist the fingerprints recorded this cycle."""
+        with self._lock:
+            self._state.update(self._pending)
+            self._pending.clear()
+            state = dict(self._state)
+        if self.state_file is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.state_file))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.fingerprints')
+        try:
+            with os.fdopen(fd, 'w') as tmp:
+                json.dump(state, tmp, sort_keys=True)
+            os.replace(tmp_path, self.state_file)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+__all__ = ('Fingerprints', 'FingerprintingLdap', 'SeenRecorder', 'fingerprint', 'normalise',
+           'TIMESTAMP_ATTRIBUTES', 'LOAD_ATTRIBUTES', 'VOLATILE_ATTRIBUTES')
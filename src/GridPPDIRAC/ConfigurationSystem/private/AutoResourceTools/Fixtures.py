@@ -0,0 +1,197 @@
+"""Recorded BDII and GOCDB answers, for running the discovery stages offline."""
+import json
+import os
+import tempfile
+import threading
+
+from DIRAC import S_ERROR
+
+
+def _encode(value):
+    """JSON encode sets, which the BDII answers are full of, as tagged sorted lists."""
+    if isinstance(value, (set, frozenset)):
+        return {'__set__': sorted(value, key=str)}
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+
+def _decode(obj):
+    """Reverse _encode."""
+    if set(obj) == {'__set__'}:
+        return set(obj['__set__'])
+    return obj
+
+
+def _call_key(func, args, kwargs):
+    """Return the key a BDII function call is recorded under."""
+    return json.dumps([getattr(func, '__name__', str(func)), list(args), kwargs],
+                      sort_keys=True, default=_encode)
+
+
+class Fixture(object):
+    """
+    BDII searches, BDII function calls (e.g. getGlue2CEInfo) and GOCDB responses.
+
+    A fixture is a JSON file of the form:
+        {"searches": [{"base": ..., "filterstr": ..., "entries": [[dn, attrs], ...]}, ...],
+         "calls": [{"key": ..., "result": {"OK": true, "Value": ...}}, ...],
+         "gocdb": {"uk.ac.gridpp.vac": [service endpoint dicts], ...}}
+    Fixtures are recorded with RecordingBDII and replayed with FixtureBDII.
+
+    Example:
+        >>> fixture = Fixture('ses.json')
+        >>> update_ses(['gridpp'], cfg_system=cfg_system, bdii_pool=FixtureBDII(fixture))
+    """
+
+    def __init__(self, path=None):
+        """
+        Initialise, loading path if it exists.
+
+        Args:
+            path (str): The fixture's JSON file.
+        """
+        self.path = path
+        self.searches = {}
+        self.calls = {}
+        self.gocdb = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path) as fixture:
+                content = json.load(fixture, object_hook=_decode)
+            for search in content.get('searches', ()):
+                self.searches[search['base'], search['filterstr']] = \
+                    [tuple(entry) for entry in search['entries']]
+            for call in content.get('calls', ()):
+                self.calls[call['key']] = call['result']
+            self.gocdb.update(content.get('gocdb', {}))
+
+    def __len__(self):
+        """Number of recorded answers."""
+        return len(self.searches) + len(self.calls) + len(self.gocdb)
+
+    def add_search(self, base, filterstr, entries):
+        """Record a BDII search's entries."""
+        with self._lock:
+            self.searches[base, filterstr] = list(entries)
+
+    def add_call(self, func, args, kwargs, result):
+        """Record a BDII function call's S_OK/S_ERROR result."""
+        with self._lock:
+            self.calls[_call_key(func, args, kwargs)] = result
+
+    def add_services(self, service_type, services):
+        """Record the GOCDB service endpoints of a service type."""
+        with self._lock:
+            self.gocdb[service_type] = services
+
+    def save(self, path=None):
+        """Write the fixture, to path or the path it was loaded from, atomically."""
+        path = path or self.path
+        with self._lock:
+            content = {'searches': [{'base': base, 'filterstr': filterstr, 'entries': entries}
+                                    for (base, filterstr), entries in sorted(self.searches.items())],
+                       'calls': [{'key': key, 'result': result}
+                                 for key, result in sorted(self.calls.items())],
+                       'gocdb': self.gocdb}
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.fixture')
+        try:
+            with os.fdopen(fd, 'w') as tmp:
+                json.dump(content, tmp, default=_encode, indent=1, sort_keys=True)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+
+class FixtureBDII(object):
+    """
+    Replays a Fixture through the BDIIPool API (search_s and failover).
+
+    Stages taking a bdii_pool run against it unchanged, without querying
+    any BDII. The recorded GOCDB responses are returned by services.
+    """
+
+    def __init__(self, fixture):
+        """
+        Initialise.
+
+        Args:
+            fixture (Fixture): The recorded answers.
+        """
+        self.fixture = fixture
+
+    def search_s(self, base, filterstr, scope=None):
+        """
+        Return the recorded entries of a search, see MockLdap.search_s.
+
+        Raises:
+            RuntimeError: If the search was not recorded.
+        """
+        try:
+            return list(self.fixture.searches[base, filterstr])
+        except KeyError:
+            raise RuntimeError("No recorded answer for %s" % filterstr)
+
+    def failover(self, func, *args, **kwargs):
+        """Return the recorded result of a function call, see BDIIPool.failover."""
+        result = self.fixture.calls.get(_call_key(func, args, kwargs))
+        if result is None:
+            return S_ERROR("No recorded result for %s%r" % (getattr(func, '__name__', func), args))
+        return result
+
+    def services(self, service_type):
+        """
+        Return the recorded GOCDB service endpoints of a service type.
+
+        Raises:
+            RuntimeError: If the service type was not recorded.
+        """
+        try:
+            return self.fixture.gocdb[service_type]
+        except KeyError:
+            raise RuntimeError("No recorded GOCDB %s service endpoints" % service_type)
+
+
+class RecordingBDII(object):
+    """Passes the queries on to a BDIIPool and GOCDB, recording the answers in a Fixture."""
+
+    def __init__(self, pool, fixture, gocdb_client=None):
+        """
+        Initialise.
+
+        Args:
+            pool (BDIIPool): The live BDIIs.
+            fixture (Fixture): Where the answers are recorded.
+            gocdb_client (GOCDBClient): Queried by services.
+        """
+        self.pool = pool
+        self.fixture = fixture
+        self.gocdb_client = gocdb_client
+
+    def search_s(self, base, filterstr, scope=None):
+        """Search, see BDIIPool.search_s."""
+        entries = self.pool.search_s(base=base, filterstr=filterstr, scope=scope)
+        self.fixture.add_search(base, filterstr, entries)
+        return entries
+
+    def failover(self, func, *args, **kwargs):
+        """Call func, see BDIIPool.failover."""
+        result = self.pool.failover(func, *args, **kwargs)
+        self.fixture.add_call(func, args, kwargs, result)
+        return result
+
+    def services(self, service_type):
+        """
+        Return the GOCDB service endpoints of a service type.
+
+        Raises:
+            RuntimeError: If there is no GOCDB client or the query failed.
+        """
+        if self.gocdb_client is None:
+            raise RuntimeError("No GOCDB client to get the %s service endpoints from" % service_type)
+        result = self.gocdb_client.getServiceEndpointInfo('service_type', service_type)
+        if not result['OK']:
+            raise RuntimeError("GOCDB %s query failed: %s" % (service_type, result['Message']))
+        self.fixture.add_services(service_type, result['Value'])
+        return result['Value']
+
+__all__ = ('Fixture', 'FixtureBDII', 'RecordingBDII')
@@ -0,0 +1,140 @@
+"""On disk cache of GOCDB query responses."""
+import json
+import os
+import re
+import tempfile
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from DIRAC import gLogger, S_OK, S_ERROR
+
+from .Fingerprints import fingerprint
+from .Metrics import metrics
+
+
+class GOCDBResponse(namedtuple('GOCDBResponse', ('Value', 'Hash', 'Time', 'Cached'))):
+    """
+    A GOCDB query response.
+
+    Attributes:
+        Value: The query's S_OK value, e.g. the list of service endpoint dicts.
+        Hash (str): Fingerprint of Value.
+        Time (float): When the response was fetched from GOCDB.
+        Cached (bool): True if GOCDB failed and the response is the cached one.
+    """
+
+    __slots__ = ()
+
+
+class GOCDBCache(object):
+    """
+    GOCDB responses cached on disk, one JSON file per query.
+
+    Every successful response replaces the cached one. If a query fails the
+    cached response is used instead, provided it was fetched less than
+    max_age seconds ago, so a transient GOCDB outage does not stop the cycle
+    while a long one does not keep resources alive indefinitely. The
+    response Hash lets the caller skip processing unchanged responses.
+
+    Example:
+        >>> cache = GOCDBCache('/opt/dirac/work/AutoVac2CSAgent', max_age=172800)
+        >>> results = cache.fetch_all({'uk.ac.gridpp.vac': (client.getServiceEndpointInfo,
+        ...                                                 ('service_type', 'uk.ac.gridpp.vac'))})
+        >>> results['uk.ac.gridpp.vac']['Value'].Hash
+    """
+
+    def __init__(self, directory, max_age=172800):
+        """
+        Initialise.
+
+        Args:
+            directory (str): Directory the responses are cached in.
+            max_age (float): Seconds a cached response may be used for when GOCDB fails.
+        """
+        self.directory = directory
+        self.max_age = max_age
+
+    def _path(self, key):
+        """Return the cache file of a query key."""
+        return os.path.join(self.directory, 'gocdb_%s.json' % re.sub(r'[^\w.-]', '_', key))
+
+    def load(self, key):
+        """Return the cached GOCDBResponse of a query key, None if there is none."""
+        try:
+            with open(self._path(key)) as cached:
+                entry = json.load(cached)
+            return GOCDBResponse(entry['value'], entry['hash'], entry['time'], True)
+        except (IOError, OSError):
+            return None
+        except (ValueError, KeyError) as err:
+            gLogger.warn("Ignoring corrupt GOCDB cache %s: %s" % (self._path(key), err))
+            return None
+
+    def _store(self, key, response):
+        """Write a response to the key's cache file atomically."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.gocdb')
+        try:
+            with os.fdopen(fd, 'w') as tmp:
+                json.dump({'value': response.Value, 'hash': response.Hash, 'time': response.Time},
+                          tmp, default=str)
+            os.replace(tmp_path, self._path(key))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def fetch(self, key, func, *args, **kwargs):
+        """
+        Run a query, caching its response or falling back to the cached one.
+
+        Args:
+            key (str): The query's cache key.
+            func (callable): The query, returning S_OK/S_ERROR.
+
+        Returns:
+            dict: S_OK(GOCDBResponse), or the query's S_ERROR if there is no recent cached response.
+        """
+        metrics.inc('gocdb_queries_total', query=key)
+        with metrics.timer('gocdb_query_seconds', query=key):
+            try:
+                result = func(*args, **kwargs)
+            except Exception as err:
+                result = S_ERROR(str(err))
+
+        if result['OK']:
+            response = GOCDBResponse(result['Value'], fingerprint(result['Value'], volatile=None),
+                                     time.time(), False)
+            try:
+                self._store(key, response)
+            except (IOError, OSError, TypeError) as err:
+                gLogger.warn("Could not cache GOCDB response for %s: %s" % (key, err))
+            return S_OK(response)
+
+        metrics.inc('gocdb_failures_total', query=key)
+        cached = self.load(key)
+        if cached is None or time.time() - cached.Time > self.max_age:
+            return result
+        gLogger.warn("GOCDB query %s failed, using the response cached %ds ago: %s"
+                     % (key, time.time() - cached.Time, result['Message']))
+        metrics.inc('gocdb_cache_fallbacks_total', query=key)
+        return S_OK(cached)
+
+    def fetch_all(self, queries, workers=None):
+        """
+        Run queries concurrently, see fetch.
+
+        Args:
+            queries (dict): Query key to (func, args) tuple.
+            workers (int): Maximum number of queries run at once, by default all of them.
+
+        Returns:
+            dict: Query key to fetch result.
+        """
+        if not queries:
+            return {}
+        with ThreadPoolExecutor(max_workers=workers or len(queries)) as pool:
+            futures = {key: pool.submit(self.fetch, key, func, *args)
+                       for key, (func, args) in queries.items()}
+            return {key: future.result() for key, future in futures.items()}
+
+__all__ = ('GOCDBCache', 'GOCDBResponse')
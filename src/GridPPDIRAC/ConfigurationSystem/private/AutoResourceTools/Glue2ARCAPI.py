@@ -10,192 +10,221 @@ from itertools import islice
 from DIRAC.ConfigurationSystem.Client.Helpers.Path import cfgPath
 from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.ConfigurationSystem import ConfigurationSystem
 from .ldaptools import in_, MockLdap as ldap
+from .CapacityModel import int_attr
+from .Glue2Model import ComputeModel, parse_dn, el_os_label, group_execution_environments, reduce_os_arch
+from .Fingerprints import (FingerprintingLdap, SeenRecorder, fingerprint,
+                           TIMESTAMP_ATTRIBUTES, VOLATILE_ATTRIBUTES)
+from .QueueVariants import ARC_QUEUE_VARIANTS, arc_variant_name, expand_queues
+from .SiteMetadata import site_metadata
 
 
 endpoint_ce_regex = re.compile(r"^(?:ldap|https)://([^:]+):\d+(?:/arex)?$")
 #dn_ce_regex = re.compile(r"^.*GLUE2ServiceID=(urn:ogf:ComputingService:[^,:]+:arex),.*$")
 dn_ce_regex = re.compile(r"^.*GLUE2ServiceID=([^,]+).*$")
-dn_queue_regex = re.compile(r"^.*GLUE2ShareID=([^,]+).*$")  # Can we combine these for just one cc_regex
 dn_ce2_regex = re.compile(r"^.*[,]?GLUE2ServiceID=(?:urn:ogf:ComputingService:)?([^,:_]+)(?:_(?:ES)?ComputingElement|:arex|:\d+)?,.*$")
 dn_site_regex = re.compile(r"^.*GLUE2DomainID=([^,]+),.*$")
-cc_regex = re.compile(r'\.([a-zA-Z]{2})$')
 vo_regex = re.compile(r'^(?:vo:|VO:)?([^:]*)$')
 
+EL7_CES = ("lcg-admin.uw.computecanada.ca", "lcg-ce2.uw.computecanada.ca", "lcg-ce3.uw.computecanada.ca",
+           "hepgrid5.ph.liv.ac.uk")
+EL8_CES = ("grendel2.hec.lancs.ac.uk", "ingrid.cism.ucl.ac.be")
+None_CES = ("arc-ce01.gridpp.rl.ac.uk", "arc-ce02.gridpp.rl.ac.uk", "arc-ce03.gridpp.rl.ac.uk",
+            "arc-ce04.gridpp.rl.ac.uk", "arc-ce05.gridpp.rl.ac.uk")
+OS_OVERRIDES = dict([(ce, "EL7") for ce in EL7_CES] +
+                    [(ce, "EL8") for ce in EL8_CES] +
+                    [(ce, "None") for ce in None_CES])
 
-def _get_os_arch(ldap_conn, config_dict):
-    os_map = {"centos": "EL"}
-    for dn, attrs in ldap_conn.search_s(base="o=glue",
-                                        scope=ldap.SCOPE_SUBTREE,
-                                        filterstr="(&(objectClass=GLUE2ExecutionEnvironment)" +
-                                                  in_(("GLUE2DomainID:dn:",
-                                                       "GLUE2ServiceID:dn:"),
-                                                      config_dict) +
-                                                  "(GLUE2ExecutionEnvironmentOSName=*)"
-                                                  "(GLUE2ExecutionEnvironmentOSVersion=*)"
-                                                  "(GLUE2ExecutionEnvironmentPlatform=*))"):
-
-        os = attrs["GLUE2ExecutionEnvironmentOSName"][0].lower()
-        arch = attrs["GLUE2ExecutionEnvironmentPlatform"][0].lower()
-        #os_version = attrs["GLUE2ExecutionEnvironmentOSVersion"]
-        #os = os_map.get(os, os) + os_version
-        EL7_CES = ["lcg-admin.uw.computecanada.ca", "lcg-ce2.uw.computecanada.ca", "lcg-ce3.uw.computecanada.ca", "hepgrid5.ph.liv.ac.uk"]
-        EL8_CES = ["grendel2.hec.lancs.ac.uk", "ingrid.cism.ucl.ac.be"]
-        None_CES = ["arc-ce01.gridpp.rl.ac.uk", "arc-ce02.gridpp.rl.ac.uk", "arc-ce03.gridpp.rl.ac.uk", "arc-ce04.gridpp.rl.ac.uk", "arc-ce05.gridpp.rl.ac.uk"]
-        site = dn_site_regex.sub(r"\1", dn), dn_ce_regex.sub(r"\1", dn)
-        for ce, info in config_dict[site].items():
-            current_arch = info.get("architecture", '')
-            current_os = info.get("OS", '')
-            if ce in EL7_CES:
-                info["OS"] = "EL7"
-            elif ce in EL8_CES:
-                info["OS"] = "EL8"
-            elif ce in None_CES:
-                info["OS"] = "None"
-            else:
-                info["OS"] = "EL9"
-            info["architecture"] = "x86_64"
-    return config_dict
-
-
-def _get_arc_ces(ldap_conn, max_processors=None):
-    arc_ces = defaultdict(dict)
-    for dn, attrs in ldap_conn.search_s(base="o=glue",
-                                        scope=ldap.SCOPE_SUBTREE,
-                                        filterstr="(&(objectClass=GLUE2ComputingService)"
-                                                  "(GLUE2ServiceType=org.nordugrid.arex))"):
-
-        service_id, nsubs = dn_ce_regex.subn(r"\1", dn)
-        if nsubs != 1:
-            logging.warning("Couldn't scrape service id (CE) from dn: %s", dn)
-            continue
-        if not service_id:
-            logging.warning("Scraped service id (CE) is blank string.")
-            continue
 
-        domain_id, nsubs2 = dn_site_regex.subn(r"\1", dn)
-        if nsubs != 1:
-            logging.warning("Couldn't scrape domain id (site) from dn: %s", dn)
-            continue
-        if not service_id:
-            logging.warning("Scraped domain id (site) is blank string.")
+def _search_os_arch(ldap_conn, services):
+    return ldap_conn.search_s(base="o=glue",
+                              scope=ldap.SCOPE_SUBTREE,
+                              filterstr="(&(objectClass=GLUE2ExecutionEnvironment)" +
+                                        in_(("GLUE2DomainID:dn:",
+                                             "GLUE2ServiceID:dn:"),
+                                            services) +
+                                        "(GLUE2ExecutionEnvironmentOSName=*)"
+                                        "(GLUE2ExecutionEnvironmentOSVersion=*)"
+                                        "(GLUE2ExecutionEnvironmentPlatform=*))")
+
+
+def _get_os_arch(environments, model):
+    envs = group_execution_environments(environments)
+
+    # EL9 is now the default, only a newer advertised OS replaces it. The per CE
+    # overrides win and the architecture is always x86_64.
+    for site, site_envs in envs.items():
+        os, _ = reduce_os_arch(site_envs, default_os="EL9", os_label=el_os_label)
+        for ce in model.ces(*site):
+            ce.options["OS"] = OS_OVERRIDES.get(ce.name, os)
+            ce.options["architecture"] = "x86_64"
+    return model
+
+
+def _service_key(dn):
+    """Return the (domain id, service id) of a ComputingService dn, None if no CE can be scraped from it."""
+    service_id, nsubs = dn_ce_regex.subn(r"\1", dn)
+    if nsubs != 1 or not service_id:
+        return None
+    domain_id, _ = dn_site_regex.subn(r"\1", dn)
+    return domain_id, service_id
+
+
+def _search_arc_ces(ldap_conn):
+    """
+    Run the BDII searches the ARC CEs are built from, see _get_arc_ces.
+
+    Later searches only depend on the services and shares found by earlier
+    ones, which are scraped from the dns, so all the raw results can be
+    fingerprinted before any model is built.
+
+    Returns:
+        dict: Lists of the (dn, attrs) search results by Glue2 object.
+    """
+    results = {"services": ldap_conn.search_s(base="o=glue",
+                                              scope=ldap.SCOPE_SUBTREE,
+                                              filterstr="(&(objectClass=GLUE2ComputingService)"
+                                                        "(GLUE2ServiceType=org.nordugrid.arex))")}
+    services = dict.fromkeys(key for key in (_service_key(dn) for dn, _ in results["services"])
+                             if key is not None)
+    results["managers"] = _search_manager_info(ldap_conn, services)
+    results["shares"] = _search_queues(ldap_conn, services)
+    shares = {}
+    for dn, attrs in results["shares"]:
+        rdns = parse_dn(dn)
+        if (rdns.get("GLUE2DomainID"), rdns.get("GLUE2ServiceID")) in services:
+            shares[rdns.get("GLUE2DomainID"), rdns.get("GLUE2ServiceID"), attrs["GLUE2ShareID"][0]] = None
+    results["policies"] = _search_vos(ldap_conn, shares)
+    results["environments"] = _search_os_arch(ldap_conn, services)
+    return results
+
+
+def _get_arc_ces(results, max_processors=None, capacity_model=None):
+    arc_ces = ComputeModel()
+    for dn, attrs in results["services"]:
+        key = _service_key(dn)
+        if key is None:
+            logging.warning("Couldn't scrape service id (CE) from dn: %s", dn)
             continue
+        domain_id, service_id = key
 
         num_cores = int(max_processors or 64)
-        arc_ces[(domain_id, service_id)][dn_ce2_regex.subn(r"\1", dn)[0]] = {"CEType": "AREX",
-                                                 "SubmissionMode": "Direct",
-                                                 "wnTmpDir": '.',
-                                                 "HostRAM": 4096,
-                                                 "MaxProcessors": num_cores if num_cores > 1 else None,
-                                                 "LastSeen": date.today().strftime('%d/%m/%Y'),
-                                                 "UseLocalSchedd": False,
-                                                 "DaysToKeepLogs": 2,
-                                                 "Queues": {}}
-    arc_ces = _get_queues(ldap_conn, arc_ces)
+        arc_ces.add_ce(domain_id, service_id, dn_ce2_regex.subn(r"\1", dn)[0],
+                       CEType="AREX",
+                       SubmissionMode="Direct",
+                       wnTmpDir='.',
+                       HostRAM=4096,
+                       MaxProcessors=num_cores if num_cores > 1 else None,
+                       LastSeen=date.today().strftime('%d/%m/%Y'),
+                       UseLocalSchedd=False,
+                       DaysToKeepLogs=2)
+    arc_ces = _get_queues(results, arc_ces, capacity_model)
 #    arc_ces = _get_vos(ldap_conn, arc_ces)
-    arc_ces = _get_os_arch(ldap_conn, arc_ces)
+    arc_ces = _get_os_arch(results["environments"], arc_ces)
     return arc_ces
 
 
-def _get_country_code(ce, default='xx', mapping=None):
-    if mapping is None:
-        mapping = {'.gov': 'us',
-                   '.edu': 'us',
-                   'efda.org': 'uk',
-                   'atlas-swt2.org': 'us'}
-    ce = ce.strip().lower()
-    for key, value in mapping.items():
-        if ce.endswith(key):
-            return value
-    match = cc_regex.search(ce)
-    if match is not None:
-        return match.groups()[0]
-    return default
-
-
 def update_arc_ces(vo_list=None, bdii_host=("topbdii.grid.hep.ph.ic.ac.uk", 2170),
-                   banned_ces=None, max_processors=None):
+                   banned_ces=None, max_processors=None, capacity_model=None,
+                   queue_variants=ARC_QUEUE_VARIANTS, cfg_system=None, fingerprints=None,
+                   bdii_pool=None, shard=None):
     """
     Update ARC CEs from BDII.
+
+    If a CapacityModel is given the queue MaxTotalJobs/MaxWaitingJobs are derived
+    from the advertised share state rather than the static defaults. Each queue is
+    expanded into its single/multi-core variants according to queue_variants.
+
+    If cfg_system is given the changes are made to it (e.g. a ChangeList) and
+    left to the caller to commit, saving the capacity model once they are. If the
+    query results fingerprint the same as recorded in fingerprints, the CEs are
+    not built and only their LastSeen is updated. If a BDIIPool is given the
+    queries are raced over its hosts rather than sent to bdii_host. If a Shard is
+    given only the CEs of its sites are updated.
     """
-    ldap_conn = ldap.open(*bdii_host)
+    ldap_conn = bdii_pool if bdii_pool is not None else ldap.open(*bdii_host)
+    if fingerprints is not None:
+        ldap_conn = FingerprintingLdap(ldap_conn, TIMESTAMP_ATTRIBUTES if capacity_model is not None
+                                       else VOLATILE_ATTRIBUTES)
     sites_root = '/Resources/Sites/LCG'
-    cfg_system = ConfigurationSystem()
-    for (site, _), ce_info in sorted(_get_arc_ces(ldap_conn, max_processors).items()):
-        for ce, info in ce_info.items():
-            if banned_ces is not None and ce in banned_ces:
-                continue
-            # Candian Sites
-            # These require an extra JDL string in the pilot to set the default queue time & default memory
-            if ce.endswith('.ca'):
-                # 23 h 58 min as requested
-                info['XRSLExtraString'] = '(wallTime="86280")(memory>="3500")(runtimeenvironment="ENV/PROXY")'
-            # AREX, non-standard port at UCL: We should get this from GLUE2ComputingEndpoint
-            if ce == 'ingrid.cism.ucl.ac.be':
-                info['Port'] = 8443
-            if vo_list is not None:
-                logging.debug("Filtering out unwanted VOs from CE %s", ce)
-                # Filter VOs. first part of if is clever ruse to update in a comprehension (always returns None)
-                info["Queues"] = {key: val for key, val in info["Queues"].items()
-                                  if (val.update(VO=val['VO'].intersection(vo_list)) or val['VO'])}
-            if not info["Queues"]:
-                logging.warning("Skipping CE %s as it has no queues that support our VOs", ce)
-                continue
-            # add an extra element ("Platform") for the RAL-LCG2 queues and their one operating system per queue scheme
-            if ce.endswith('.gridpp.rl.ac.uk'):
-                for key in info["Queues"].keys():
-                    if key.endswith('EL7'):
-                        info["Queues"][key]["Platform"] = "EL7"
-                    elif key.endswith('EL8'):
-                        info["Queues"][key]["Platform"] = "EL8"
-                    else:
-                        info["Queues"][key]["Platform"] = "EL9"
-            if ce.endswith('gla.scotgrid.ac.uk'):
-                for key in info["Queues"].keys():
-                    if key.endswith('condor_arm'):
-                        info["Queues"][key]["Tag"] = "ARM"
-                        info["Queues"][key]["RequiredTag"] = "ARM"
-            # go forth and multiply
-            old_queues = info["Queues"].copy()
-            for queue in old_queues:
-                # because DIRAC puts the queue name in the rsl, everything after the second hyphen needs to be unchanged
-                queue_bits = queue.split('-', 1)
-                multi_queue = "%s-multim%s" % (queue_bits[0], queue_bits[1])
-                info["Queues"][multi_queue] = info["Queues"][queue].copy()
-                info["Queues"][queue]["NumberOfProcessors"] = 1
-                info["Queues"][multi_queue]["NumberOfProcessors"] = 8
-                multi_tag_string = "MultiProcessor"
-                # go out on a limb and assume any queues that contain 'gpu' or 'GPU' are exactly that
-                if "gpu" in queue or "GPU" in queue:
-                    info["Queues"][queue]["Tag"] = "GPU"
-                    info["Queues"][queue]["RequiredTag"] = "GPU"
-                    multi_tag_string = "MultiProcessor, GPU"
-                # Manchester SKA hack
-                if "hep.manchester.ac.uk" in ce and "himem" in queue:
-                    multi_tag_string = "MultiProcessor, skatelescope.eu.hmem"
-                # beware of the ARM queues at Glasgow
-                if "gla.scotgrid.ac.uk" in ce and "condor_arm" in queue:
-                    multi_tag_string = "MultiProcessor, ARM"
-                info["Queues"][multi_queue]["Tag"] = multi_tag_string
-                info["Queues"][multi_queue]["RequiredTag"] = multi_tag_string
-                info["Queues"][multi_queue]["LocalCEType"] = "Pool"
-            site_path = '.'.join(('LCG', site, _get_country_code(ce)))
-            cfg_system.append_unique(cfgPath(sites_root, site_path), "CE", ce)
-            for option, value in info.items():
-                cfg_system.add(cfgPath(sites_root, site_path, "CEs", ce), option, value)
-    cfg_system.commit()
-
-
-def _get_queue_prefix(ldap_conn, config_dict):
+    commit = cfg_system is None
+    if commit:
+        cfg_system = ConfigurationSystem()
+    results = _search_arc_ces(ldap_conn)
+    if fingerprints is not None:
+        fp = fingerprint(ldap_conn.hexdigest(), vo_list, banned_ces, max_processors, str(shard))
+        if fingerprints.replay_seen('update_arc_ces', fp, cfg_system):
+            if commit:
+                cfg_system.commit()
+            return
+        seen = set()
+        cfg_system = SeenRecorder(cfg_system, seen)
+    arc_ces = _get_arc_ces(results, max_processors, capacity_model)
+    for site, compute_ce in arc_ces.iter_ces():
+        if shard is not None and not shard.owns(site):
+            continue
+        ce = compute_ce.name
+        if banned_ces is not None and ce in banned_ces:
+            continue
+        info = compute_ce.as_dict()
+        # Candian Sites
+        # These require an extra JDL string in the pilot to set the default queue time & default memory
+        if ce.endswith('.ca'):
+            # 23 h 58 min as requested
+            info['XRSLExtraString'] = '(wallTime="86280")(memory>="3500")(runtimeenvironment="ENV/PROXY")'
+        # AREX, non-standard port at UCL: We should get this from GLUE2ComputingEndpoint
+        if ce == 'ingrid.cism.ucl.ac.be':
+            info['Port'] = 8443
+        if vo_list is not None:
+            logging.debug("Filtering out unwanted VOs from CE %s", ce)
+            # Filter VOs. first part of if is clever ruse to update in a comprehension (always returns None)
+            info["Queues"] = {key: val for key, val in info["Queues"].items()
+                              if (val.update(VO=val['VO'].intersection(vo_list)) or val['VO'])}
+        if not info["Queues"]:
+            logging.warning("Skipping CE %s as it has no queues that support our VOs", ce)
+            continue
+        # add an extra element ("Platform") for the RAL-LCG2 queues and their one operating system per queue scheme
+        if ce.endswith('.gridpp.rl.ac.uk'):
+            for key in info["Queues"].keys():
+                if key.endswith('EL7'):
+                    info["Queues"][key]["Platform"] = "EL7"
+                elif key.endswith('EL8'):
+                    info["Queues"][key]["Platform"] = "EL8"
+                else:
+                    info["Queues"][key]["Platform"] = "EL9"
+        # go forth and multiply
+        info["Queues"] = {name: record.as_dict()
+                          for name, record in expand_queues(ce, info["Queues"], queue_variants,
+                                                            arc_variant_name).items()}
+        site_path = '.'.join(('LCG', site, site_metadata.country_code(site, (ce,), 'LCG')))
+        cfg_system.append_unique(cfgPath(sites_root, site_path), "CE", ce)
+        for option, value in info.items():
+            cfg_system.add(cfgPath(sites_root, site_path, "CEs", ce), option, value)
+    if commit:
+        cfg_system.commit()
+        if capacity_model is not None:
+            capacity_model.save()
+    if fingerprints is not None:
+        fingerprints.record('update_arc_ces', fp, seen)
+
+
+def _search_manager_info(ldap_conn, services):
+    return ldap_conn.search_s(base="o=glue", scope=ldap.SCOPE_SUBTREE,
+                              filterstr="(&(objectClass=GLUE2ComputingManager)" +
+                                        in_(("GLUE2DomainID:dn:",
+                                             "GLUE2ServiceID:dn:"),
+                                            services) +
+                                        "(GLUE2ManagerProductName=*))")
+
+
+def _get_manager_info(managers):
     queue_prefix = {}
-    for dn, attrs in ldap_conn.search_s(base="o=glue", scope=ldap.SCOPE_SUBTREE,
-                                        filterstr="(&(objectClass=GLUE2ComputingManager)" +
-                                                  in_(("GLUE2DomainID:dn:",
-                                                       "GLUE2ServiceID:dn:"),
-                                                      config_dict) +
-                                                  "(GLUE2ManagerProductName=*))"):
+    manager_cpus = {}
+    for dn, attrs in managers:
         site = dn_site_regex.sub(r"\1", dn), dn_ce_regex.sub(r"\1", dn)
         queue_prefix[site] = '-'.join(("nordugrid", attrs.get("GLUE2ManagerProductName", ["unknown"])[0]))
-    return queue_prefix
+        manager_cpus[site] = int_attr(attrs, "GLUE2ComputingManagerTotalLogicalCPUs") \
+            or int_attr(attrs, "GLUE2ComputingManagerTotalPhysicalCPUs")
+    return queue_prefix, manager_cpus
 
 def _tidy_time(timeval):
     """ Takes a time (usually a queue length) and tries to convert it to minutes.
@@ -208,20 +237,41 @@ def _tidy_time(timeval):
         return int(timeval / 60)
     return timeval
 
-def _get_queues(ldap_conn, config_dict):
+def _search_queues(ldap_conn, services):
+    return ldap_conn.search_s(base="o=glue", scope=ldap.SCOPE_SUBTREE,
+                              filterstr="(&(objectClass=GLUE2ComputingShare)" +
+                              in_(("GLUE2DomainID:dn:",
+                                   "GLUE2ServiceID:dn:"),
+                                    services) +
+                                    "(GLUE2ShareID=*)"+
+                                    "(GLUE2ComputingShareMappingQueue=*))")
 
-    queue_prefix = _get_queue_prefix(ldap_conn, config_dict)
 
-    queues_dict = {}
-    for dn, attrs in ldap_conn.search_s(base="o=glue", scope=ldap.SCOPE_SUBTREE,
-                                        filterstr="(&(objectClass=GLUE2ComputingShare)" +
-                                        in_(("GLUE2DomainID:dn:",
-                                             "GLUE2ServiceID:dn:"),
-                                              config_dict) +
-                                              "(GLUE2ShareID=*)"+
-                                              "(GLUE2ComputingShareMappingQueue=*))"):
-        domain_id, service_id = dn_site_regex.sub(r"\1", dn), dn_ce_regex.sub(r"\1", dn)
-        ce = dn_ce2_regex.sub(r"\1", dn)
+def _apply_capacity_model(queue_load, model, manager_cpus, capacity_model):
+    """Replace the static queue limits with those derived from the capacity model."""
+    for (domain_id, service_id, queue_name), (running, waiting, total) in queue_load.items():
+        for ce in model.ces(domain_id, service_id):
+            limits = capacity_model.update('/'.join((ce.name, queue_name)),
+                                           running=running,
+                                           waiting=waiting,
+                                           total=total,
+                                           cpus=manager_cpus.get((domain_id, service_id), 0))
+            if limits is not None:
+                options = ce.queues[queue_name].options
+                options["MaxTotalJobs"], options["MaxWaitingJobs"] = limits
+    return model
+
+
+def _get_queues(results, model, capacity_model=None):
+
+    queue_prefix, manager_cpus = _get_manager_info(results["managers"])
+
+    # Sites often advertise a share per VO mapped to the same queue, whose load is
+    # summed so that the capacity model sees each queue once per cycle.
+    queue_load = defaultdict(lambda: [0, 0, 0])
+    for dn, attrs in results["shares"]:
+        rdns = parse_dn(dn)
+        domain_id, service_id = rdns.get("GLUE2DomainID"), rdns.get("GLUE2ServiceID")
         maxCPUTime = int(attrs.get("GLUE2ComputingShareMaxCPUTime", [2940])[0])
         maxWaitingJobs = int(attrs.get("GLUE2ComputingShareMaxWaitingJobs", [2000])[0])
         # Some sites specifically advertise 0 for Max jobs
@@ -231,48 +281,50 @@ def _get_queues(ldap_conn, config_dict):
         if not maxWaitingJobs or maxWaitingJobs > 5000:
             maxWaitingJobs = 5000
         maxTotalJobs = int(1.5 * maxWaitingJobs)
-        queue_id = attrs["GLUE2ShareID"][0]
         queue_name = '-'.join((queue_prefix.get((domain_id, service_id), ''),
                                attrs["GLUE2ComputingShareMappingQueue"][0]))
-        queues_dict[domain_id, service_id, queue_id] = queue_name
-        config_dict.get((domain_id, service_id), {})\
-                   .get(ce, {})\
-                   .get('Queues', {})[queue_name] = {"VO": set(),
-                                                     "SI00": 3100,
-                                                     "maxCPUTime": _tidy_time(maxCPUTime),
-                                                     "MaxTotalJobs": maxTotalJobs,
-                                                     "MaxWaitingJobs": maxWaitingJobs}
-    return _get_vos(ldap_conn, queues_dict, config_dict)
+        queues = model.add_queue(domain_id, service_id, queue_name,
+                                 share_id=attrs["GLUE2ShareID"][0],
+                                 SI00=3100,
+                                 maxCPUTime=_tidy_time(maxCPUTime),
+                                 MaxTotalJobs=maxTotalJobs,
+                                 MaxWaitingJobs=maxWaitingJobs)
+        if queues:
+            load = queue_load[domain_id, service_id, queue_name]
+            load[0] += int_attr(attrs, "GLUE2ComputingShareRunningJobs")
+            load[1] += int_attr(attrs, "GLUE2ComputingShareWaitingJobs")
+            load[2] += int_attr(attrs, "GLUE2ComputingShareTotalJobs")
+    if capacity_model is not None:
+        model = _apply_capacity_model(queue_load, model, manager_cpus, capacity_model)
+    return _get_vos(results["policies"], model)
 
 def dict_chunk(dct, size=1000):
     it = dct.items()
     for pos in range(0, len(dct), size):
         yield {i: j for i, j in islice(it, pos, pos + size)}
 
-def _get_vos(ldap_conn, queues_dict, config_dict):
-    for queues_dict_chunk in dict_chunk(queues_dict, 300):
-        for dn, attrs in ldap_conn.search_s(base="o=glue",
-                                            scope=ldap.SCOPE_SUBTREE,
-                                            filterstr="(&(objectClass=GLUE2MappingPolicy)" +
-                                                      in_(("GLUE2DomainID:dn:",
-                                                           "GLUE2ServiceID:dn:",
-                                                           "GLUE2ShareID:dn:"),
-                                                          queues_dict_chunk) +
-                                                      "(GLUE2PolicyRule=*))"):
-            try:
-                site = dn_site_regex.sub(r"\1", dn), dn_ce_regex.sub(r"\1", dn), dn_queue_regex.sub(r"\1", dn)
-                ce = dn_ce2_regex.sub(r"\1", dn)
-                vo = attrs["GLUE2PolicyRule"][0]
-                if vo_regex.match(vo):
-                    config_dict.get((site[0], site[1]), {})\
-                               .get(ce, {})\
-                               .get("Queues", {})[queues_dict[site]]["VO"].add(vo_regex.sub(r"\1", vo))
-            except Exception as err:
-                # Something wrong with this site, skip it
-                logging.warning("Bad entry for %s: %s", dn, str(err))
-                continue
-
-    return config_dict
+def _search_vos(ldap_conn, shares):
+    policies = []
+    for shares_chunk in dict_chunk(shares, 300):
+        policies.extend(ldap_conn.search_s(base="o=glue",
+                                           scope=ldap.SCOPE_SUBTREE,
+                                           filterstr="(&(objectClass=GLUE2MappingPolicy)" +
+                                                     in_(("GLUE2DomainID:dn:",
+                                                          "GLUE2ServiceID:dn:",
+                                                          "GLUE2ShareID:dn:"),
+                                                         shares_chunk) +
+                                                     "(GLUE2PolicyRule=*))"))
+    return policies
+
+
+def _get_vos(policies, model):
+    for dn, attrs in policies:
+        match = vo_regex.match(attrs["GLUE2PolicyRule"][0])
+        if match:
+            model.attach_vos(dn, (match.group(1),))
+
+    model.report_dropped("ARC")
+    return model
 
 
 if __name__ == "__main__":
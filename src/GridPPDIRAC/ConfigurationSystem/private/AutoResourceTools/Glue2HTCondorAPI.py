@@ -10,12 +10,17 @@ from DIRAC.ConfigurationSystem.Client.Helpers.Path import cfgPath
 # from ConfigurationSystem import ConfigurationSystem
 from .ldaptools import in_, MockLdap as ldap
 from .ConfigurationSystem import ConfigurationSystem
+from .CapacityModel import int_attr
+from .Glue2Model import ComputeModel, el_os_label, group_execution_environments, reduce_os_arch
+from .Fingerprints import (FingerprintingLdap, SeenRecorder, fingerprint,
+                           TIMESTAMP_ATTRIBUTES, VOLATILE_ATTRIBUTES)
+from .QueueVariants import HTCONDOR_QUEUE_VARIANTS, htcondor_variant_name, expand_queues
+from .SiteMetadata import site_metadata
 
 
 endpoint_ce_regex = re.compile(r"^(?:condor|https)://([^:]+):\d+/?$")
 dn_ce_regex = re.compile(r"^.*GLUE2ServiceID=([^,]+),.*$")
 dn_site_regex = re.compile(r"^.*GLUE2DomainID=([^,]+),.*$")
-cc_regex = re.compile(r'\.([a-zA-Z]{2})$')
 
 
 def get_endpoints(ldap_conn, domain_id, service_id):
@@ -31,83 +36,143 @@ def get_endpoints(ldap_conn, domain_id, service_id):
     return endpoints
 
 
-def _get_vos(ldap_conn, config_dict):
-    for dn, attrs in ldap_conn.search_s(base="o=glue",
-                                        scope=ldap.SCOPE_SUBTREE,
-                                        filterstr="(&(objectClass=GLUE2MappingPolicy)" +
-                                                  in_(("GLUE2DomainID:dn:",
-                                                       "GLUE2ServiceID:dn:"),
-                                                      config_dict) +
-                                                  "(GLUE2PolicyRule=*))"):
-        site = dn_site_regex.sub(r"\1", dn), dn_ce_regex.sub(r"\1", dn)
-        for ce, info in config_dict[site].items():
-            queue = '-'.join((ce, "condor"))
-            info["Queues"][queue].setdefault("VO", set()).update({vo.lower().replace("vo:", '')
-                                                                  for vo in attrs["GLUE2PolicyRule"]})
-    return config_dict
-
-
-def _get_os_arch(ldap_conn, config_dict):
-    os_map = {"centos": "EL"}
-    for dn, attrs in ldap_conn.search_s(base="o=glue",
-                                        scope=ldap.SCOPE_SUBTREE,
-                                        filterstr="(&(objectClass=GLUE2ExecutionEnvironment)" +
-                                                  in_(("GLUE2DomainID:dn:",
-                                                       "GLUE2ServiceID:dn:"),
-                                                      config_dict) +
-                                                  "(GLUE2ExecutionEnvironmentOSName=*)"
-                                                  "(GLUE2ExecutionEnvironmentOSVersion=*)"
-                                                  "(GLUE2ExecutionEnvironmentPlatform=*))"):
-
-        arch = attrs["GLUE2ExecutionEnvironmentPlatform"][0].lower()
-        os_version = attrs["GLUE2ExecutionEnvironmentOSVersion"][0]
-        os = attrs["GLUE2ExecutionEnvironmentOSName"][0].lower()
-#        os = os_map.get(os, os) + os_version
-
-        site = dn_site_regex.sub(r"\1", dn), dn_ce_regex.sub(r"\1", dn)
-        for ce, info in config_dict[site].items():
-            os = "EL9"  # This is now the default
-            current_arch = info.get("architecture", '')
-            current_os = info.get("OS", '')
-            if os > current_os or arch > current_arch:
-                info["architecture"] = arch
-                info["OS"] = os
-    return config_dict
-
-
-def _get_htcondor_ces(ldap_conn, max_processors=None):
-    htcondor_ces = defaultdict(dict)
-    for dn, attrs in ldap_conn.search_s(base="o=glue",
-                                        scope=ldap.SCOPE_SUBTREE,
-                                        filterstr="(&(objectClass=GLUE2ComputingManager)"
-                                                  "(GLUE2ManagerProductName=HTCondor))"):
+def _search_vos(ldap_conn, services):
+    return ldap_conn.search_s(base="o=glue",
+                              scope=ldap.SCOPE_SUBTREE,
+                              filterstr="(&(objectClass=GLUE2MappingPolicy)" +
+                                        in_(("GLUE2DomainID:dn:",
+                                             "GLUE2ServiceID:dn:"),
+                                            services) +
+                                        "(GLUE2PolicyRule=*))")
 
-        service_id, nsubs = dn_ce_regex.subn(r"\1", dn)
-        if nsubs != 1:
-            logging.warning("Couldn't scrape service id (CE) from dn: %s", dn)
-            continue
-        if not service_id:
-            logging.warning("Scraped service id (CE) is blank string.")
-            continue
 
-        domain_id, nsubs2 = dn_site_regex.subn(r"\1", dn)
-        if nsubs != 1:
-            logging.warning("Couldn't scrape domain id (site) from dn: %s", dn)
-            continue
-        if not service_id:
-            logging.warning("Scraped domain id (site) is blank string.")
+def _get_vos(policies, model):
+    for dn, attrs in policies:
+        model.attach_service_vos(dn, (vo.lower().replace("vo:", '') for vo in attrs["GLUE2PolicyRule"]))
+    model.report_dropped("HTCondor")
+    return model
+
+
+def _search_os_arch(ldap_conn, services):
+    return ldap_conn.search_s(base="o=glue",
+                              scope=ldap.SCOPE_SUBTREE,
+                              filterstr="(&(objectClass=GLUE2ExecutionEnvironment)" +
+                                        in_(("GLUE2DomainID:dn:",
+                                             "GLUE2ServiceID:dn:"),
+                                            services) +
+                                        "(GLUE2ExecutionEnvironmentOSName=*)"
+                                        "(GLUE2ExecutionEnvironmentOSVersion=*)"
+                                        "(GLUE2ExecutionEnvironmentPlatform=*))")
+
+
+def _get_os_arch(environments, model):
+    envs = group_execution_environments(environments)
+
+    for site, site_envs in envs.items():
+        # EL9 is now the default, only a newer advertised OS replaces it
+        os, arch = reduce_os_arch(site_envs, default_os="EL9", os_label=el_os_label)
+        for ce in model.ces(*site):
+            ce.options["architecture"] = arch
+            ce.options["OS"] = os
+    return model
+
+
+def _search_share_load(ldap_conn, services):
+    return ldap_conn.search_s(base="o=glue",
+                              scope=ldap.SCOPE_SUBTREE,
+                              filterstr="(&(objectClass=GLUE2ComputingShare)" +
+                                        in_(("GLUE2DomainID:dn:",
+                                             "GLUE2ServiceID:dn:"),
+                                            services) +
+                                        "(GLUE2ShareID=*))")
+
+
+def _get_share_load(shares):
+    """Sum the advertised running/waiting/total jobs over all shares of each service."""
+    share_load = defaultdict(lambda: [0, 0, 0])
+    for dn, attrs in shares:
+        load = share_load[dn_site_regex.sub(r"\1", dn), dn_ce_regex.sub(r"\1", dn)]
+        load[0] += int_attr(attrs, "GLUE2ComputingShareRunningJobs")
+        load[1] += int_attr(attrs, "GLUE2ComputingShareWaitingJobs")
+        load[2] += int_attr(attrs, "GLUE2ComputingShareTotalJobs")
+    return share_load
+
+
+def _apply_capacity_model(shares, model, manager_cpus, capacity_model):
+    """Replace the static queue limits with those derived from the capacity model."""
+    share_load = _get_share_load(shares)
+    for site, ces in model.services.items():
+        running, waiting, total = share_load.get(site, (0, 0, 0))
+        for ce in ces.values():
+            for queue in ce.queues.values():
+                limits = capacity_model.update('/'.join((ce.name, queue.name)),
+                                               running=running,
+                                               waiting=waiting,
+                                               total=total,
+                                               cpus=manager_cpus.get(site, 0))
+                if limits is not None:
+                    queue.options["MaxTotalJobs"], queue.options["MaxWaitingJobs"] = limits
+    return model
+
+
+def _service_key(dn):
+    """Return the (domain id, service id) of a ComputingManager dn, None if no CE can be scraped from it."""
+    service_id, nsubs = dn_ce_regex.subn(r"\1", dn)
+    if nsubs != 1 or not service_id:
+        return None
+    domain_id, _ = dn_site_regex.subn(r"\1", dn)
+    return domain_id, service_id
+
+
+def _search_htcondor_ces(ldap_conn, capacity_model=None):
+    """
+    Run the BDII searches the HTCondor CEs are built from, see _get_htcondor_ces.
+
+    Later searches only depend on the services found by earlier ones, which
+    are scraped from the dns, so all the raw results can be fingerprinted
+    before any model is built. The shares are only searched for the capacity model.
+
+    Returns:
+        dict: Lists of the (dn, attrs) search results by Glue2 object, and the
+              endpoints of each (domain id, service id).
+    """
+    results = {"managers": ldap_conn.search_s(base="o=glue",
+                                              scope=ldap.SCOPE_SUBTREE,
+                                              filterstr="(&(objectClass=GLUE2ComputingManager)"
+                                                        "(GLUE2ManagerProductName=HTCondor))"),
+               "endpoints": {}}
+    for dn, _ in results["managers"]:
+        key = _service_key(dn)
+        if key is not None and key not in results["endpoints"]:
+            results["endpoints"][key] = get_endpoints(ldap_conn, *key)
+    services = [key for key, endpoints in results["endpoints"].items() if endpoints]
+    results["policies"] = _search_vos(ldap_conn, services)
+    results["environments"] = _search_os_arch(ldap_conn, services)
+    if capacity_model is not None:
+        results["shares"] = _search_share_load(ldap_conn, services)
+    return results
+
+
+def _get_htcondor_ces(results, max_processors=None, capacity_model=None):
+    htcondor_ces = ComputeModel()
+    manager_cpus = {}
+    for dn, attrs in results["managers"]:
+        key = _service_key(dn)
+        if key is None:
+            logging.warning("Couldn't scrape service id (CE) from dn: %s", dn)
             continue
+        domain_id, service_id = key
 
         max_total_jobs = int(attrs.get('GLUE2ComputingManagerTotalPhysicalCPUs',
                                        attrs.get('GLUE2ComputingManagerTotalLogicalCPUs', [0]))[0])
-
+        manager_cpus[(domain_id, service_id)] = max_total_jobs
 
         num_cores = int(max_processors or 64)
         # default time (HTCondor Glue2 does not advertise time)
         maxCPUTime_default = int(2881) # 2 days + 1 min
         # need to check what get_endpoints actually does
         # All HTCondorCEs now get a token tag, so we never lose CERN again
-        for ce in get_endpoints(ldap_conn, domain_id, service_id):
+        for ce in results["endpoints"][key]:
             if ce == "lcgce02.phy.bris.ac.uk":
                 maxCPUTime_site = int(11520) # 8 days
             elif ce.endswith("pp.rl.ac.uk"):
@@ -115,83 +180,98 @@ def _get_htcondor_ces(ldap_conn, max_processors=None):
             else:
                 maxCPUTime_site = maxCPUTime_default
 
-            htcondor_ces[(domain_id, service_id)][ce] = {"CEType": "HTCondorCE",
-                                                         "SubmissionMode": "Direct",
-                                                         "wnTmpDir": '.',
-                                                         "SI00": 3100,
-                                                         "HostRAM": 4096,
-                                                         "MaxProcessors": num_cores if num_cores > 1 else None,
-                                                         "LastSeen": date.today().strftime('%d/%m/%Y'),
-                                                         "UseLocalSchedd": False,
-                                                         "DaysToKeepLogs": 2,
-                                                         "Tag" : "Token",
-                                                         "Queues": {'-'.join((ce, 'condor')): {"VO": set(),
-                                                                                               "SI00": 3100,
-                                                                                               "MaxTotalJobs": 7500,
-                                                                                               "MaxWaitingJobs": 5000,
-                                                                                               "maxCPUTime": maxCPUTime_site}}}
-    htcondor_ces = _get_vos(ldap_conn, htcondor_ces)
-    htcondor_ces = _get_os_arch(ldap_conn, htcondor_ces)
+            htcondor_ces.add_ce(domain_id, service_id, ce,
+                                CEType="HTCondorCE",
+                                SubmissionMode="Direct",
+                                wnTmpDir='.',
+                                SI00=3100,
+                                HostRAM=4096,
+                                MaxProcessors=num_cores if num_cores > 1 else None,
+                                LastSeen=date.today().strftime('%d/%m/%Y'),
+                                UseLocalSchedd=False,
+                                DaysToKeepLogs=2,
+                                Tag="Token").add_queue('-'.join((ce, 'condor')),
+                                                       SI00=3100,
+                                                       MaxTotalJobs=7500,
+                                                       MaxWaitingJobs=5000,
+                                                       maxCPUTime=maxCPUTime_site)
+    htcondor_ces = _get_vos(results["policies"], htcondor_ces)
+    htcondor_ces = _get_os_arch(results["environments"], htcondor_ces)
+    if capacity_model is not None:
+        htcondor_ces = _apply_capacity_model(results["shares"], htcondor_ces, manager_cpus, capacity_model)
     return htcondor_ces
 
 
-def _get_country_code(ce, default='xx', mapping=None):
-    if mapping is None:
-        mapping = {'.gov': 'us',
-                   '.edu': 'us',
-                   'efda.org': 'uk',
-                   'atlas-swt2.org': 'us'}
-    ce = ce.strip().lower()
-    for key, value in mapping.items():
-        if ce.endswith(key):
-            return value
-    match = cc_regex.search(ce)
-    if match is not None:
-        return match.groups()[0]
-    print(f"No country mapping found for CE {ce}")
-    return default
-
-
 def update_htcondor_ces(vo_list=None, bdii_host=("topbdii.grid.hep.ph.ic.ac.uk", 2170),
-                        banned_ces=None, max_processors=None):
+                        banned_ces=None, max_processors=None, capacity_model=None,
+                        queue_variants=HTCONDOR_QUEUE_VARIANTS, cfg_system=None, fingerprints=None,
+                        bdii_pool=None, shard=None):
     """
     Update HTCondor CEs from BDII.
+
+    If a CapacityModel is given the queue MaxTotalJobs/MaxWaitingJobs are derived
+    from the advertised share state rather than the static 7500/5000. Each queue is
+    expanded into its single/multi-core variants according to queue_variants.
+
+    If cfg_system is given the changes are made to it (e.g. a ChangeList) and
+    left to the caller to commit, saving the capacity model once they are. If the
+    query results fingerprint the same as recorded in fingerprints, the CEs are
+    not built and only their LastSeen is updated. If a BDIIPool is given the
+    queries are raced over its hosts rather than sent to bdii_host. If a Shard is
+    given only the CEs of its sites are updated.
     """
-    ldap_conn = ldap.open(*bdii_host)
+    ldap_conn = bdii_pool if bdii_pool is not None else ldap.open(*bdii_host)
+    if fingerprints is not None:
+        ldap_conn = FingerprintingLdap(ldap_conn, TIMESTAMP_ATTRIBUTES if capacity_model is not None
+                                       else VOLATILE_ATTRIBUTES)
     sites_root = '/Resources/Sites/LCG'
-    cfg_system = ConfigurationSystem()
-    for (site, _), ce_info in sorted(_get_htcondor_ces(ldap_conn, max_processors).items()):
+    commit = cfg_system is None
+    if commit:
+        cfg_system = ConfigurationSystem()
+    results = _search_htcondor_ces(ldap_conn, capacity_model)
+    if fingerprints is not None:
+        fp = fingerprint(ldap_conn.hexdigest(), vo_list, banned_ces, max_processors, str(shard))
+        if fingerprints.replay_seen('update_htcondor_ces', fp, cfg_system):
+            if commit:
+                cfg_system.commit()
+            return
+        seen = set()
+        cfg_system = SeenRecorder(cfg_system, seen)
+    htcondor_ces = _get_htcondor_ces(results, max_processors, capacity_model)
+    for site, compute_ce in htcondor_ces.iter_ces():
+        if shard is not None and not shard.owns(site):
+            continue
         # try to omit the special LHCB INFN-T1 Doppelgänger
         if site == "INFN-CNAF-LHCB":
             print("Trying to avoid updating INFN-CNAF-LHCB")
             continue
-        for ce, info in ce_info.items():
-            if banned_ces is not None and ce in banned_ces:
-                continue
-
-            if vo_list is not None:
-                logging.debug("Filtering out unwanted VOs from HTCondor CE %s", ce)
-                # Filter VOs. first part of if is clever ruse to update in a comprehension (always returns None)
-                info["Queues"] = {key: val for key, val in info["Queues"].items()
-                                  if (val.update(VO=val['VO'].intersection(vo_list)) or val['VO'])}
-            if not info["Queues"]:
-                logging.warning("Skipping HTCondor CE %s as it has no queues that support our VOs", ce)
-                continue
-            # duplicate each queue, so we have a single and an 8 core queue
-            old_queues = info["Queues"].copy()
-            for queue in old_queues:
-                multi_queue = "%s-multi" % queue
-                info["Queues"][multi_queue] = info["Queues"][queue].copy()
-                info["Queues"][queue]["NumberOfProcessors"] = 1
-                info["Queues"][multi_queue]["NumberOfProcessors"] = 8
-                info["Queues"][multi_queue]["Tag"] = "MultiProcessor"
-                info["Queues"][multi_queue]["RequiredTag"] = "MultiProcessor"
-                info["Queues"][multi_queue]["LocalCEType"] = "Pool"
-            site_path = '.'.join(('LCG', site, _get_country_code(ce)))
-            cfg_system.append_unique(cfgPath(sites_root, site_path), "CE", ce)
-            for option, value in info.items():
-                cfg_system.add(cfgPath(sites_root, site_path, "CEs", ce), option, value)
-    cfg_system.commit()
+        ce = compute_ce.name
+        if banned_ces is not None and ce in banned_ces:
+            continue
+        info = compute_ce.as_dict()
+
+        if vo_list is not None:
+            logging.debug("Filtering out unwanted VOs from HTCondor CE %s", ce)
+            # Filter VOs. first part of if is clever ruse to update in a comprehension (always returns None)
+            info["Queues"] = {key: val for key, val in info["Queues"].items()
+                              if (val.update(VO=val['VO'].intersection(vo_list)) or val['VO'])}
+        if not info["Queues"]:
+            logging.warning("Skipping HTCondor CE %s as it has no queues that support our VOs", ce)
+            continue
+        # duplicate each queue, so we have a single and an 8 core queue
+        info["Queues"] = {name: record.as_dict()
+                          for name, record in expand_queues(ce, info["Queues"], queue_variants,
+                                                            htcondor_variant_name).items()}
+        site_path = '.'.join(('LCG', site, site_metadata.country_code(site, (ce,), 'LCG')))
+        cfg_system.append_unique(cfgPath(sites_root, site_path), "CE", ce)
+        for option, value in info.items():
+            cfg_system.add(cfgPath(sites_root, site_path, "CEs", ce), option, value)
+    if commit:
+        cfg_system.commit()
+        if capacity_model is not None:
+            capacity_model.save()
+    if fingerprints is not None:
+        fingerprints.record('update_htcondor_ces', fp, seen)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,293 @@
+"""Glue2 compute model (Site -> CE -> Queue) shared by the Glue2 CE modules."""
+import logging
+import re
+from collections import Counter, defaultdict, namedtuple
+
+# Known architectures, most preferred first. Unknown ones rank below these.
+ARCH_PREFERENCE = ('x86_64', 'amd64', 'aarch64', 'ppc64le')
+_ARCH_RANK = {arch: len(ARCH_PREFERENCE) - i for i, arch in enumerate(ARCH_PREFERENCE)}
+_os_version_regex = re.compile(r'^(.*?)(\d+)?$')
+_major_version_regex = re.compile(r'\d+')
+# Lower case Glue2 OSNames of the Red Hat Enterprise Linux rebuilds, labelled EL<major version>
+EL_OS_NAMES = frozenset(('almalinux', 'centos', 'centosstream', 'redhat', 'redhatenterpriseas', 'rhel',
+                         'rocky', 'rockylinux', 'scientificlinux', 'scientificlinuxcern', 'sl', 'slc'))
+
+
+class ExecutionEnvironment(namedtuple('ExecutionEnvironment', ('OSName', 'OSVersion', 'Platform'))):
+    """A Glue2 ExecutionEnvironment row."""
+
+    __slots__ = ()
+
+
+def parse_dn(dn):
+    """
+    Split a Glue2 dn into its attributes.
+
+    Where an attribute appears more than once the outermost (rightmost) value wins, which
+    matches the greedy dn regexes this replaces.
+
+    Args:
+        dn (str): The ldap dn, e.g. 'GLUE2ShareID=x,GLUE2ServiceID=y,GLUE2GroupID=resource,...'
+
+    Returns:
+        dict: attribute name to value.
+    """
+    rdns = {}
+    for rdn in dn.split(','):
+        attr, _, value = rdn.partition('=')
+        rdns[attr.strip()] = value
+    return rdns
+
+
+def group_execution_environments(entries):
+    """
+    Group Glue2 ExecutionEnvironment rows by the service they belong to.
+
+    Args:
+        entries (list): (dn, attrs) tuples as returned from an ldap search.
+
+    Returns:
+        dict: (domain id, service id) to list of ExecutionEnvironment.
+    """
+    groups = defaultdict(list)
+    for dn, attrs in entries:
+        rdns = parse_dn(dn)
+        groups[rdns.get('GLUE2DomainID'), rdns.get('GLUE2ServiceID')].append(
+            ExecutionEnvironment(attrs["GLUE2ExecutionEnvironmentOSName"][0].lower(),
+                                 attrs["GLUE2ExecutionEnvironmentOSVersion"][0],
+                                 attrs["GLUE2ExecutionEnvironmentPlatform"][0].lower()))
+    return groups
+
+
+def os_sort_key(os_label):
+    """Version aware sort key for OS labels, so that e.g. 'EL10' > 'EL9' > 'EL7'."""
+    prefix, version = _os_version_regex.match(os_label or '').groups()
+    return prefix, int(version) if version else -1
+
+
+def arch_sort_key(arch):
+    """Sort key ranking architectures by ARCH_PREFERENCE, then lexically."""
+    return _ARCH_RANK.get(arch, 0), arch or ''
+
+
+def el_os_label(env):
+    """
+    Return the DIRAC OS label of an ExecutionEnvironment, e.g. 'EL9' for AlmaLinux 9.4.
+
+    Returns:
+        str: The label, None if the OS is not an Enterprise Linux or has no version.
+    """
+    version = _major_version_regex.search(env.OSVersion or '')
+    if env.OSName.replace(' ', '') not in EL_OS_NAMES or version is None:
+        return None
+    return 'EL%d' % int(version.group())
+
+
+def reduce_os_arch(envs, default_os='EL9', os_label=None):
+    """
+    Reduce the ExecutionEnvironments of a service to a single OS and architecture.
+
+    The newest OS, by os_sort_key, of default_os and the labels os_label gives
+    the environments wins, so default_os is also the oldest OS reported.
+
+    Args:
+        envs (list): ExecutionEnvironment tuples of one service.
+        default_os (str): OS used if no environment gets a newer label.
+        os_label (callable): Optional function mapping an ExecutionEnvironment to a
+                             DIRAC OS label, e.g. 'EL9', or None if it has none.
+
+    Returns:
+        tuple: (OS, architecture)
+    """
+    arch = max((env.Platform for env in envs), key=arch_sort_key)
+    labels = [default_os]
+    if os_label is not None:
+        labels.extend(label for label in map(os_label, envs) if label)
+    return max(labels, key=os_sort_key), arch
+
+
+class ComputeQueue(object):
+    """A queue (Glue2 ComputingShare) of a CE."""
+
+    __slots__ = ('name', 'share_id', 'vos', 'options')
+
+    def __init__(self, name, share_id=None, **options):
+        """Initialise."""
+        self.name = name
+        self.share_id = share_id
+        self.vos = set()
+        self.options = options
+
+    def as_dict(self):
+        """Return the queue as a dict of CS options."""
+        ret = dict(self.options)
+        ret['VO'] = set(self.vos)
+        return ret
+
+
+class ComputeCE(object):
+    """A CE (Glue2 ComputingService endpoint) of a site."""
+
+    __slots__ = ('name', 'site', 'service_id', 'options', 'queues')
+
+    def __init__(self, name, site, service_id, **options):
+        """Initialise."""
+        self.name = name
+        self.site = site
+        self.service_id = service_id
+        self.options = options
+        self.queues = {}
+
+    def add_queue(self, name, share_id=None, **options):
+        """
+        Add a queue to this CE and return it.
+
+        Several shares (e.g. one per VO) can map to the same queue, in which case
+        the existing queue is returned with the options merged into its own, so
+        that the VOs attached through each share end up on the one queue.
+        """
+        queue = self.queues.get(name)
+        if queue is None:
+            queue = self.queues[name] = ComputeQueue(name, share_id, **options)
+        else:
+            queue.options.update(options)
+        return queue
+
+    def as_dict(self):
+        """Return the CE as a dict of CS options with its queues under 'Queues'."""
+        ret = dict(self.options)
+        ret['Queues'] = {name: queue.as_dict() for name, queue in self.queues.items()}
+        return ret
+
+
+class ComputeSite(object):
+    """A site (Glue2 AdminDomain)."""
+
+    __slots__ = ('name', 'ces')
+
+    def __init__(self, name):
+        """Initialise."""
+        self.name = name
+        self.ces = {}
+
+
+class ComputeModel(object):
+    """
+    Glue2 compute model.
+
+    Holds the discovered sites, CEs and queues together with two indices:
+    one from (domain id, service id) to the CEs of that service and one from
+    (domain id, service id, share id) to the queues built from that share. The
+    indices are filled while ingesting so that later rows (policies, execution
+    environments) attach in O(1) and rows with no matching parent are counted
+    rather than silently lost.
+    """
+
+    __slots__ = ('sites', 'services', 'shares', 'dropped')
+
+    def __init__(self):
+        """Initialise."""
+        self.sites = {}
+        self.services = {}
+        self.shares = {}
+        self.dropped = Counter()
+
+    def add_ce(self, domain_id, service_id, name, **options):
+        """
+        Add a CE belonging to the given service.
+
+        Returns:
+            ComputeCE: The new CE.
+        """
+        site = self.sites.get(domain_id)
+        if site is None:
+            site = self.sites[domain_id] = ComputeSite(domain_id)
+        ce = site.ces[name] = ComputeCE(name, domain_id, service_id, **options)
+        self.services.setdefault((domain_id, service_id), {})[name] = ce
+        return ce
+
+    def ces(self, domain_id, service_id):
+        """Return the CEs of a service (empty if the service is unknown)."""
+        return self.services.get((domain_id, service_id), {}).values()
+
+    def add_queue(self, domain_id, service_id, name, share_id=None, **options):
+        """
+        Add a queue to every CE of the given service, see ComputeCE.add_queue.
+
+        If share_id is given the queues are indexed by (domain_id, service_id, share_id).
+
+        Returns:
+            list: The ComputeQueue objects, empty if the service is unknown.
+        """
+        ces = self.ces(domain_id, service_id)
+        if not ces:
+            self.dropped['share'] += 1
+            return []
+        queues = [ce.add_queue(name, share_id, **options) for ce in ces]
+        if share_id is not None:
+            self.shares.setdefault((domain_id, service_id, share_id), []).extend(queues)
+        return queues
+
+    def queues_for_share(self, domain_id, service_id, share_id):
+        """Return the queues built from a share (empty if unknown)."""
+        return self.shares.get((domain_id, service_id, share_id), ())
+
+    def attach_service_vos(self, dn, vos):
+        """
+        Attach VOs from a MappingPolicy row to every queue of its service.
+
+        Args:
+            dn (str): The dn of the policy row.
+            vos (iterable): VO names to attach.
+
+        Returns:
+            bool: False if the row was dropped as its service is unknown.
+        """
+        rdns = parse_dn(dn)
+        ces = self.ces(rdns.get('GLUE2DomainID'), rdns.get('GLUE2ServiceID'))
+        if not ces:
+            self.dropped['policy'] += 1
+            return False
+        vos = tuple(vos)
+        for ce in ces:
+            for queue in ce.queues.values():
+                queue.vos.update(vos)
+        return True
+
+    def attach_vos(self, dn, vos):
+        """
+        Attach VOs from a MappingPolicy row to the queues of its share.
+
+        Args:
+            dn (str): The dn of the policy row.
+            vos (iterable): VO names to attach.
+
+        Returns:
+            bool: False if the row was dropped as its share is unknown.
+        """
+        rdns = parse_dn(dn)
+        queues = self.queues_for_share(rdns.get('GLUE2DomainID'),
+                                       rdns.get('GLUE2ServiceID'),
+                                       rdns.get('GLUE2ShareID'))
+        if not queues:
+            self.dropped['policy'] += 1
+            return False
+        vos = tuple(vos)
+        for queue in queues:
+            queue.vos.update(vos)
+        return True
+
+    def iter_ces(self):
+        """Yield (site name, ComputeCE) in (site, service) order."""
+        for (site, _), ces in sorted(self.services.items()):
+            for ce in ces.values():
+                yield site, ce
+
+    def report_dropped(self, what):
+        """Log the number of rows dropped while building the model."""
+        for kind, count in sorted(self.dropped.items()):
+            logging.warning("%s: dropped %d %s row(s) with no matching parent", what, count, kind)
+
+__all__ = ('ComputeModel', 'ComputeSite', 'ComputeCE', 'ComputeQueue', 'ExecutionEnvironment',
+           'parse_dn', 'group_execution_environments', 'os_sort_key', 'arch_sort_key', 'el_os_label',
+           'reduce_os_arch', 'EL_OS_NAMES')
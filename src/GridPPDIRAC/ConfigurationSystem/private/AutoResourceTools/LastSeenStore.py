@@ -0,0 +1,225 @@
+"""Compact local store of when CS resources were last seen."""
+import mmap
+import os
+import threading
+from array import array
+from datetime import date, timedelta
+
+_EPOCH = date(1970, 1, 1)
+_ITEM_SIZE = 4  # uint32 days since the epoch, 0 meaning unset
+_MIN_CAPACITY = 1024
+
+
+def epoch_day(day):
+    """Return the number of days since 1970-01-01 of a date."""
+    return (day - _EPOCH).days
+
+
+def from_epoch_day(days):
+    """Return the date of a number of days since 1970-01-01."""
+    return _EPOCH + timedelta(days=days)
+
+
+class LastSeenStore(object):
+    """
+    Memory mapped key -> last seen day store.
+
+    Keys (CS section paths) are kept one per line in an append only '<name>.keys'
+    file, the line number being the key's slot in '<name>.days', a memory mapped
+    array of uint32 days since the epoch. Marking a key seen is therefore a single
+    4 byte write and costs nothing in the CS, only the file grows (by doubling)
+    when new keys are added. A slot of 0 means the key has not been seen or has
+    been discarded.
+
+    Discarded keys are dropped by compact, which rewrites both files. It is run
+    on opening the store and by flush once more than half the keys are
+    discarded, so the files do not grow with every resource ever seen.
+
+    Example:
+        >>> store = LastSeenStore('/opt/dirac/work/AutoBdii2CSAgent')
+        >>> store.mark('/Resources/Sites/LCG/LCG.UKI-Site.uk/CEs/ce.site.ac.uk')
+        >>> store.get('/Resources/Sites/LCG/LCG.UKI-Site.uk/CEs/ce.site.ac.uk')
+        datetime.date(2024, 5, 1)
+    """
+
+    def __init__(self, directory, name='lastseen'):
+        """
+        Initialise.
+
+        Args:
+            directory (str): Directory holding the store files.
+            name (str): Base name of the store files.
+        """
+        self._lock = threading.RLock()
+        self._keys_path = os.path.join(directory, name + '.keys')
+        self._days_path = os.path.join(directory, name + '.days')
+        self._recover()
+        self._open()
+        self.compact()
+
+    def _recover(self):
+        """
+        Finish a compaction interrupted part way, see compact.
+
+        The compacted keys file is written after the compacted days file, so
+        if it exists both are complete and are moved into place.
+        """
+        if os.path.exists(self._keys_path + '.compact'):
+            if os.path.exists(self._days_path + '.compact'):
+                os.replace(self._days_path + '.compact', self._days_path)
+            os.replace(self._keys_path + '.compact', self._keys_path)
+        elif os.path.exists(self._days_path + '.compact'):
+            os.unlink(self._days_path + '.compact')
+
+    def _open(self):
+        """Read the keys and map the days."""
+        self._slots = {}
+        self._keys = []
+        if os.path.exists(self._keys_path):
+            with open(self._keys_path) as keys:
+                for key in keys.read().splitlines():
+                    self._slots[key] = len(self._keys)
+                    self._keys.append(key)
+        self._keys_file = open(self._keys_path, 'a')
+        fd = os.open(self._days_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._days_file = os.fdopen(fd, 'r+b')
+        size = os.fstat(fd).st_size
+        capacity = max(_MIN_CAPACITY, len(self._keys), size // _ITEM_SIZE)
+        self._mmap = None
+        self._days = None
+        self._map(capacity)
+
+    def _map(self, capacity):
+        """(Re)map the days file, growing it to hold capacity entries."""
+        if self._days is not None:
+            self._days.release()
+            self._mmap.close()
+        size = capacity * _ITEM_SIZE
+        if os.fstat(self._days_file.fileno()).st_size < size:
+            self._days_file.truncate(size)
+        self._mmap = mmap.mmap(self._days_file.fileno(), size)
+        self._days = memoryview(self._mmap).cast('I')
+
+    def __len__(self):
+        """Number of keys stored, including discarded ones not compacted yet."""
+        return len(self._keys)
+
+    def __contains__(self, key):
+        """True if key has a last seen day."""
+        return self.get(key) is not None
+
+    def _slot(self, key):
+        """Return the slot of key, allocating one if needed."""
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = len(self._keys)
+            if slot >= len(self._days):
+                self._map(len(self._days) * 2)
+            self._keys_file.write(key + '\n')
+            self._keys_file.flush()
+            self._keys.append(key)
+            self._slots[key] = slot
+        return slot
+
+    def mark(self, key, day=None):
+        """
+        Record that key was seen on day.
+
+        Args:
+            key (str): The key, e.g. a CE's CS section.
+            day (date): The day it was seen, today by default. Earlier days than the
+                        one already stored are ignored.
+        """
+        days = epoch_day(day or date.today())
+        with self._lock:
+            slot = self._slot(key)
+            if self._days[slot] < days:
+                self._days[slot] = days
+
+    def get(self, key):
+        """Return the day key was last seen, None if unknown."""
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None or not self._days[slot]:
+                return None
+            return from_epoch_day(self._days[slot])
+
+    def discard(self, key, prefix=False):
+        """
+        Forget key.
+
+        Args:
+            key (str): The key.
+            prefix (bool): Also forget every key below key, e.g. the CEs of a removed site.
+        """
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is not None:
+                self._days[slot] = 0
+            if prefix:
+                key_prefix = key.rstrip('/') + '/'
+                for other, slot in self._slots.items():
+                    if other.startswith(key_prefix):
+                        self._days[slot] = 0
+
+    def items(self, prefix=''):
+        """Yield (key, last seen date) for the known keys starting with prefix."""
+        with self._lock:
+            entries = [(key, self._days[slot]) for key, slot in self._slots.items()
+                       if key.startswith(prefix) and self._days[slot]]
+        for key, days in entries:
+            yield key, from_epoch_day(days)
+
+    def _discarded(self):
+        """Return the number of discarded keys."""
+        return sum(1 for slot in range(len(self._keys)) if not self._days[slot])
+
+    def compact(self):
+        """
+        Drop the discarded keys, rewriting the store files.
+
+        The compacted days then keys are written next to the store files and
+        moved into place in that order, see _recover.
+
+        Returns:
+            int: The number of keys dropped.
+        """
+        with self._lock:
+            live = [(key, self._days[slot]) for slot, key in enumerate(self._keys) if self._days[slot]]
+            dropped = len(self._keys) - len(live)
+            if not dropped:
+                return 0
+            days = array('I', (day for _, day in live))
+            days.extend([0] * (max(_MIN_CAPACITY, len(live)) - len(live)))
+            for path, content in ((self._days_path, days.tobytes()),
+                                  (self._keys_path, ''.join(key + '\n' for key, _ in live).encode())):
+                with open(path + '.compact', 'wb') as compacted:
+                    compacted.write(content)
+                    compacted.flush()
+                    os.fsync(compacted.fileno())
+            self._close()
+            self._recover()
+            self._open()
+        return dropped
+
+    def flush(self):
+        """Flush the days to disk, compacting first if more than half the keys are discarded."""
+        with self._lock:
+            if self._discarded() * 2 > len(self._keys):
+                self.compact()
+            self._mmap.flush()
+
+    def _close(self):
+        """Flush and close the files."""
+        self._mmap.flush()
+        self._days.release()
+        self._mmap.close()
+        self._days_file.close()
+        self._keys_file.close()
+
+    def close(self):
+        """Flush and close the store."""
+        with self._lock:
+            self._close()
+
+__all__ = ('LastSeenStore', 'epoch_day', 'from_epoch_day')
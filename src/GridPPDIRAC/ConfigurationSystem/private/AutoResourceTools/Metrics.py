@@ -0,0 +1,212 @@
+"""Counters, gauges and timers for the discovery agents."""
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from DIRAC import gLogger
+
+
+def _label_key(labels):
+    """Return a hashable, ordered form of a labels dict."""
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(labels):
+    """Format a label key for the Prometheus text format."""
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, value.replace('\\', r'\\').replace('"', r'\"')
+                                                 .replace('\n', r'\n'))
+                             for name, value in labels)
+
+
+class Metrics(object):
+    """
+    Registry of counters, gauges and timers.
+
+    Counters and timers accumulate over the life of the process, as Prometheus
+    expects, while start_cycle marks the point the JSON cycle report's deltas
+    are taken from. Timers are exported as summaries (_count and _sum) with an
+    extra _max gauge. Every metric name is prefixed with prefix and carries the
+    constant labels.
+
+    Example:
+        >>> metrics.start_cycle(agent='AutoBdii2CSAgent')
+        >>> metrics.inc('ldap_queries_total', host='topbdii.example.org:2170')
+        >>> with metrics.timer('stage_seconds', stage='update_ses'):
+        ...     update_ses(vo_list)
+        >>> metrics.export('/opt/dirac/work/AutoBdii2CSAgent')
+    """
+
+    def __init__(self, prefix='gridppdirac_'):
+        """
+        Initialise.
+
+        Args:
+            prefix (str): Prefix of every exported metric name.
+        """
+        self.prefix = prefix
+        self.labels = {}
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._timers = {}
+        self._cycle_counters = {}
+        self._cycle_timers = {}
+        self._cycle_start = time.time()
+
+    def inc(self, name, value=1, **labels):
+        """Increase a counter."""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set a gauge."""
+        with self._lock:
+            self._gauges[name, _label_key(labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        """Record a timing."""
+        key = (name, _label_key(labels))
+        with self._lock:
+            count, total, longest = self._timers.get(key, (0, 0., 0.))
+            self._timers[key] = (count + 1, total + seconds, max(longest, seconds))
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Time the block, see observe."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def start_cycle(self, **labels):
+        """
+        Start a new agent cycle.
+
+        Gauges and timer maxima are cleared and the counters noted, so that the
+        cycle report only covers this cycle.
+
+        Args:
+            labels: Constant labels added to every exported metric, e.g. agent.
+        """
+        with self._lock:
+            self.labels = labels
+            self._gauges.clear()
+            self._timers = {key: (count, total, 0.) for key, (count, total, _) in self._timers.items()}
+            self._cycle_counters = dict(self._counters)
+            self._cycle_timers = dict(self._timers)
+            self._cycle_start = time.time()
+
+    def textfile(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        const = _label_key(self.labels)
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            timers = sorted(self._timers.items())
+
+        lines = []
+        typed = set()
+
+        def emit(name, kind, labels, value):
+            name = self.prefix + name
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s%s %s' % (name, _format_labels(const + labels), repr(float(value))))
+
+        for (name, labels), value in counters:
+            emit(name, 'counter', labels, value)
+        for (name, labels), value in gauges:
+            emit(name, 'gauge', labels, value)
+        # Keep the lines of each metric family together.
+        for suffix, kind, index in (('_count', 'counter', 0), ('_sum', 'counter', 1), ('_max', 'gauge', 2)):
+            for (name, labels), timing in timers:
+                emit(name + suffix, kind, labels, timing[index])
+        return '\n'.join(lines) + '\n'
+
+    def report(self):
+        """
+        Return the cycle report.
+
+        Returns:
+            dict: Cycle start/duration, constant labels and this cycle's counter
+                  increases, gauges and timings, keyed by 'name{label=value,...}'.
+        """
+        def key_str(name, labels):
+            return name + ('{%s}' % ','.join('%s=%s' % label for label in labels) if labels else '')
+
+        with self._lock:
+            counters = {key_str(*key): value - self._cycle_counters.get(key, 0)
+                        for key, value in sorted(self._counters.items())
+                        if value != self._cycle_counters.get(key, 0)}
+            gauges = {key_str(*key): value for key, value in sorted(self._gauges.items())}
+            timers = {}
+            for key, (count, total, longest) in sorted(self._timers.items()):
+                old_count, old_total, _ = self._cycle_timers.get(key, (0, 0., 0.))
+                if count != old_count:
+                    timers[key_str(*key)] = {'count': count - old_count,
+                                             'sum': round(total - old_total, 3),
+                                             'max': round(longest, 3)}
+        return {'start': self._cycle_start, 'duration': round(time.time() - self._cycle_start, 3),
+                'labels': self.labels, 'counters': counters, 'gauges': gauges, 'timers': timers}
+
+    @staticmethod
+    def _write(path, content):
+        """Write a file atomically, so collectors never read a partial one."""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.metrics')
+        try:
+            with os.fdopen(fd, 'w') as tmp:
+                tmp.write(content)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def write_textfile(self, path):
+        """Write the metrics to a node-exporter textfile collector style .prom file."""
+        try:
+            self._write(path, self.textfile())
+        except (IOError, OSError) as err:
+            gLogger.warn("Could not write metrics file %s: %s" % (path, err))
+
+    def write_report(self, path):
+        """Write the cycle report as a single line of JSON."""
+        try:
+            self._write(path, json.dumps(self.report(), sort_keys=True) + '\n')
+        except (IOError, OSError) as err:
+            gLogger.warn("Could not write cycle report %s: %s" % (path, err))
+
+    def export(self, directory, textfile_directory=None):
+        """
+        Write metrics.prom and cycle_report.json.
+
+        Args:
+            directory (str): Directory the cycle report (and by default the .prom file) is written to.
+            textfile_directory (str): Directory for the .prom file, e.g. that of node-exporter's
+                                      textfile collector, named after the agent (and shard) label
+                                      if set.
+        """
+        if textfile_directory:
+            name = self.labels.get('agent', 'metrics').lower()
+            if 'shard' in self.labels:
+                name += '_shard%s' % self.labels['shard']
+            name += '.prom'
+            self.write_textfile(os.path.join(textfile_directory, name))
+        else:
+            self.write_textfile(os.path.join(directory, 'metrics.prom'))
+        self.write_report(os.path.join(directory, 'cycle_report.json'))
+
+
+# The process wide registry.
+metrics = Metrics()
+
+__all__ = ('Metrics', 'metrics')
@@ -0,0 +1,196 @@
+"""Declarative single/multi-core queue variant expansion for the Glue2 CE modules."""
+import re
+from collections import namedtuple
+from types import MappingProxyType
+
+from DIRAC import gConfig, gLogger
+from DIRAC.ConfigurationSystem.Client.Helpers.Path import cfgPath
+
+
+class QueueVariant(namedtuple('QueueVariant', ('Suffix', 'Processors', 'Tags', 'LocalCEType', 'Match'))):
+    """
+    A queue variant.
+
+    Every discovered queue is expanded into one queue per distinct Suffix in a variant
+    table ('' being the queue itself). Within a Suffix the first variant whose Match
+    predicate accepts the (ce, queue) pair is used.
+
+    Attributes:
+        Suffix (str): Inserted into the queue name by the flavour's namer, '' for the queue itself.
+        Processors (int): NumberOfProcessors of the variant.
+        Tags (tuple): Tag/RequiredTag values, in order. Empty for no tags.
+        LocalCEType (str): LocalCEType of the variant or None.
+        Match (callable): Predicate taking (ce, queue) names.
+    """
+
+    __slots__ = ()
+
+
+class QueueRecord(namedtuple('QueueRecord', ('Name', 'Base', 'NumberOfProcessors', 'Tag', 'LocalCEType'))):
+    """
+    An expanded, immutable queue.
+
+    All variants of a queue share the same read-only Base mapping so only the
+    fields that differ per variant are stored per record.
+    """
+
+    __slots__ = ()
+
+    def as_dict(self):
+        """Return the queue as a dict of CS options."""
+        ret = dict(self.Base)
+        ret['NumberOfProcessors'] = self.NumberOfProcessors
+        if self.Tag:
+            ret['Tag'] = self.Tag
+            ret['RequiredTag'] = self.Tag
+        if self.LocalCEType:
+            ret['LocalCEType'] = self.LocalCEType
+        return ret
+
+
+def _any_queue(ce, queue):
+    return True
+
+
+def _gpu_queue(ce, queue):
+    # go out on a limb and assume any queues that contain 'gpu' or 'GPU' are exactly that
+    return "gpu" in queue or "GPU" in queue
+
+
+def _gla_arm_base_queue(ce, queue):
+    return ce.endswith('gla.scotgrid.ac.uk') and queue.endswith('condor_arm')
+
+
+def _gla_arm_queue(ce, queue):
+    # beware of the ARM queues at Glasgow
+    return "gla.scotgrid.ac.uk" in ce and "condor_arm" in queue
+
+
+def _manchester_himem_queue(ce, queue):
+    # Manchester SKA hack
+    return "hep.manchester.ac.uk" in ce and "himem" in queue
+
+
+ARC_QUEUE_VARIANTS = (QueueVariant('', 1, ('GPU',), None, _gpu_queue),
+                      QueueVariant('', 1, ('ARM',), None, _gla_arm_base_queue),
+                      QueueVariant('', 1, (), None, _any_queue),
+                      QueueVariant('multim', 8, ('MultiProcessor', 'ARM'), 'Pool', _gla_arm_queue),
+                      QueueVariant('multim', 8, ('MultiProcessor', 'skatelescope.eu.hmem'), 'Pool',
+                                   _manchester_himem_queue),
+                      QueueVariant('multim', 8, ('MultiProcessor', 'GPU'), 'Pool', _gpu_queue),
+                      QueueVariant('multim', 8, ('MultiProcessor',), 'Pool', _any_queue))
+
+HTCONDOR_QUEUE_VARIANTS = (QueueVariant('', 1, (), None, _any_queue),
+                           QueueVariant('multi', 8, ('MultiProcessor',), 'Pool', _any_queue))
+
+
+def arc_variant_name(queue, suffix):
+    """
+    Name an ARC queue variant.
+
+    Because DIRAC puts the queue name in the rsl, everything after the first hyphen
+    needs to be unchanged, so the suffix is inserted straight after it.
+    """
+    queue_bits = queue.split('-', 1)
+    if len(queue_bits) != 2:
+        return "%s-%s" % (queue, suffix)
+    return "%s-%s%s" % (queue_bits[0], suffix, queue_bits[1])
+
+
+def htcondor_variant_name(queue, suffix):
+    """Name an HTCondor queue variant."""
+    return "%s-%s" % (queue, suffix)
+
+
+def _freeze(value):
+    """Make a queue option value immutable."""
+    if isinstance(value, (set, frozenset, list)):
+        return tuple(sorted(value))
+    return value
+
+
+def expand_queues(ce, queues, variants, namer):
+    """
+    Expand the queues of a CE according to a variant table.
+
+    Args:
+        ce (str): The CE name, passed to the variant predicates.
+        queues (dict): Queue name to dict of queue options.
+        variants (iterable): QueueVariant table.
+        namer (callable): Function (queue, suffix) -> variant queue name.
+
+    Returns:
+        dict: Queue name to QueueRecord. Variants are grouped by suffix in table order.
+    """
+    by_suffix = {}
+    for variant in variants:
+        by_suffix.setdefault(variant.Suffix, []).append(variant)
+
+    bases = {queue: MappingProxyType({option: _freeze(value) for option, value in options.items()})
+             for queue, options in queues.items()}
+    records = {}
+    for suffix, suffix_variants in by_suffix.items():
+        for queue, base in bases.items():
+            variant = next((v for v in suffix_variants if v.Match(ce, queue)), None)
+            if variant is None:
+                continue
+            name = namer(queue, suffix) if suffix else queue
+            records[name] = QueueRecord(name, base, variant.Processors,
+                                        ', '.join(variant.Tags), variant.LocalCEType)
+    return records
+
+
+def load_queue_variants(section, defaults=()):
+    """
+    Load extra queue variants from the CS.
+
+    Each subsection of section defines one variant, e.g.
+
+        Multi16
+        {
+          Suffix = multi16
+          Processors = 16
+          Tags = MultiProcessor
+          LocalCEType = Pool
+          QueueMatch = .*
+          CEMatch = .*\\.ac\\.uk$
+        }
+
+    QueueMatch and CEMatch are regular expressions searched for in the queue and
+    CE names, both default to matching everything. The loaded variants take
+    precedence over the defaults.
+
+    Args:
+        section (str): The CS section holding the variant definitions.
+        defaults (tuple): Built in variant table appended after the loaded ones.
+
+    Returns:
+        tuple: The combined variant table.
+    """
+    result = gConfig.getSections(section)
+    if not result['OK'] or not result['Value']:
+        return tuple(defaults)
+
+    variants = []
+    for name in result['Value']:
+        options = gConfig.getOptionsDict(cfgPath(section, name))
+        if not options['OK']:
+            gLogger.warn("Could not read queue variant %s: %s" % (name, options['Message']))
+            continue
+        options = options['Value']
+        try:
+            queue_regex = re.compile(options.get('QueueMatch', ''))
+            ce_regex = re.compile(options.get('CEMatch', ''))
+            variants.append(QueueVariant(Suffix=options.get('Suffix', ''),
+                                         Processors=int(options.get('Processors', 1)),
+                                         Tags=tuple(tag.strip() for tag in options.get('Tags', '').split(',')
+                                                    if tag.strip()),
+                                         LocalCEType=options.get('LocalCEType') or None,
+                                         Match=lambda ce, queue, q=queue_regex, c=ce_regex:
+                                         bool(c.search(ce) and q.search(queue))))
+        except (re.error, ValueError) as err:
+            gLogger.warn("Skipping bad queue variant %s: %s" % (name, err))
+    return tuple(variants) + tuple(defaults)
+
+__all__ = ('QueueVariant', 'QueueRecord', 'ARC_QUEUE_VARIANTS', 'HTCONDOR_QUEUE_VARIANTS',
+           'arc_variant_name', 'htcondor_variant_name', 'expand_queues', 'load_queue_variants')
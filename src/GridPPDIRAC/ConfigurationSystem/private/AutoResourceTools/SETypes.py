@@ -27,6 +27,9 @@ class AccessProtocol(WritableMixin, namedtuple('AccessProtocol', ('DiracName',
     """A Dirac Access Protocol."""
 
     __slots__ = ()
+    _field_kinds = dict.fromkeys(('Protocol', 'PluginName', 'Port', 'Access', 'Path',
+                                  'SpaceToken', 'WSUrl', 'Host'), 'scalar')
+    _field_kinds['VOPath'] = 'dict'
 
     def __new__(cls, vo, vo_info, se, port=None, protocol=None,
                 plugin_name=None, ws_url=None, existing_access_protocols=None):
@@ -139,6 +142,9 @@ class SE(WritableMixin, namedtuple('SE', ('DiracName',
     """A Dirac SE."""
 
     __slots__ = ()
+    _field_kinds = dict.fromkeys(('Host', 'BackendType', 'Description', 'VO', 'TotalSize', 'LastSeen'),
+                                 'scalar')
+    _field_kinds['AccessProtocols'] = 'writable_tuple'
     latency_mapping = {'online': 'disk',
                        'nearline': 'tape'}
 
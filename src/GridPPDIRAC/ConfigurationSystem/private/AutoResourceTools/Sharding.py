@@ -0,0 +1,69 @@
+"""Partition of the discovered sites between agent instances."""
+import zlib
+from collections import namedtuple
+
+
+def shard_of(site, count):
+    """
+    Return the shard a GOCDB site name belongs to.
+
+    crc32 is used as, unlike hash, it is the same in every process.
+    """
+    return zlib.crc32(site.encode('utf-8')) % count
+
+
+def gocdb_name(dirac_site):
+    """Return the GOCDB name of a DIRAC site name, e.g. LCG.UKI-LT2-IC-HEP.uk -> UKI-LT2-IC-HEP."""
+    return dirac_site.split('.', 1)[-1].rsplit('.', 1)[0]
+
+
+class Shard(namedtuple('Shard', ('Index', 'Count'))):
+    """
+    One of Count shards of the sites.
+
+    Sites are assigned by a stable hash of their GOCDB name, so every agent
+    instance configured with the same Count agrees on the assignment without
+    talking to the others. Name allocation and the banned lists are not
+    affected, each instance still reads the whole CS.
+
+    Example:
+        >>> shard = Shard(0, 3)
+        >>> shard.owns('UKI-LT2-IC-HEP')
+        >>> shard.owns_site_path('/Resources/Sites/LCG/LCG.UKI-LT2-IC-HEP.uk/CEs/ceprod00.grid.hep.ph.ic.ac.uk')
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, index=0, count=1):
+        """
+        Create.
+
+        Raises:
+            ValueError: If index is not within [0, count).
+        """
+        index, count = int(index), int(count)
+        if count < 1 or not 0 <= index < count:
+            raise ValueError("Shard index %d not within [0, %d)" % (index, count))
+        return super(Shard, cls).__new__(cls, index, count)
+
+    def __str__(self):
+        return '%d/%d' % (self.Index, self.Count)
+
+    def owns(self, site):
+        """Return True if the GOCDB site belongs to this shard."""
+        return self.Count == 1 or shard_of(site, self.Count) == self.Index
+
+    def owns_site_path(self, path):
+        """Return True if the site, of a /Resources/Sites/<domain>/<DIRAC site>[/...] path, belongs to this shard."""
+        return self.owns(gocdb_name(path.split('/')[4]))
+
+    def owns_se(self, se):
+        """
+        Return True if a DIRAC SE name belongs to this shard.
+
+        SEs are named <GOCDB site>[count]-<latency>, the name less its latency
+        is used, so that every SE is assigned to exactly one shard.
+        """
+        return self.owns(se.rsplit('-', 1)[0])
+
+__all__ = ('Shard', 'shard_of', 'gocdb_name')
@@ -0,0 +1,296 @@
+"""Country code, coordinates and contact of the grid sites, from the CS, GOCDB and host names."""
+import re
+import threading
+import time
+import urllib.request
+import xml.etree.ElementTree as ElementTree
+from collections import namedtuple
+
+from DIRAC import gConfig, gLogger, S_OK, S_ERROR
+from DIRAC.ConfigurationSystem.Client.Helpers.Path import cfgPath
+
+from .Fingerprints import fingerprint
+from .Metrics import metrics
+from .Sharding import gocdb_name
+
+GOCDB_SITES_URL = 'https://goc.egi.eu/gocdbpi/public/?method=get_site'
+SITES_BASE = '/Resources/Sites'
+CC_REGEX = re.compile(r'\.([a-zA-Z]{2})$')
+CC_MAPPINGS = {'.gov': 'us',
+               '.edu': 'us',
+               'efda.org': 'uk',
+               'atlas-swt2.org': 'us'}
+# ISO 3166 codes, as GOCDB uses, which differ from the top level domains DIRAC site names use
+ISO_TO_DIRAC = {'gb': 'uk'}
+
+
+def guess_country_code(host, cc_mappings=CC_MAPPINGS, cc_regex=CC_REGEX):
+    """
+    Guess the 2 character country code of a host from its name.
+
+    Args:
+        host (str): The host name.
+        cc_mappings (dict): Host name suffix to country code, checked first.
+        cc_regex (re.Pattern): Regex whose first group is the country code.
+
+    Returns:
+        str: The country code, None if it could not be guessed.
+    """
+    host = host.strip().lower()
+    for key, value in cc_mappings.items():
+        if host.endswith(key):
+            return value
+    cc = cc_regex.search(host)
+    if cc is not None:
+        cc = cc.groups()[0]
+    return cc
+
+
+def fetch_gocdb_sites(url=GOCDB_SITES_URL, timeout=60):
+    """
+    Get every site record from the GOCDB programmatic interface in one call.
+
+    Args:
+        url (str): URL of the get_site method.
+        timeout (float): Socket timeout in seconds.
+
+    Returns:
+        dict: S_OK(list of dict), a dict of element name to text per SITE, nested
+              elements (e.g. DOMAIN/DOMAIN_NAME) flattened.
+    """
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            root = ElementTree.parse(response).getroot()
+    except (IOError, OSError, ElementTree.ParseError) as err:
+        return S_ERROR("Failed to get the GOCDB sites from %s: %s" % (url, err))
+    return S_OK([{element.tag: (element.text or '').strip()
+                  for element in site.iter() if element is not site and not len(element)}
+                 for site in root.iter('SITE')])
+
+
+class SiteRecord(namedtuple('SiteRecord', ('Name', 'Country', 'Coordinates', 'Mail', 'Domain'))):
+    """
+    GOCDB record of a site.
+
+    Attributes:
+        Name (str): The GOCDB site name.
+        Country (str): The DIRAC country code, e.g. 'uk', None if unknown.
+        Coordinates (str): '<longitude>:<latitude>', None if unknown.
+        Mail (str): The site contact email, None if unknown.
+        Domain (str): The DNS domain of the site's hosts, None if unknown.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_gocdb(cls, entry):
+        """Create from a fetch_gocdb_sites dict."""
+        country = entry.get('COUNTRY_CODE', '').lower() or None
+        coordinates = None
+        if entry.get('LONGITUDE') and entry.get('LATITUDE'):
+            coordinates = '%s:%s' % (entry['LONGITUDE'], entry['LATITUDE'])
+        return cls(entry.get('SHORT_NAME'),
+                   ISO_TO_DIRAC.get(country, country),
+                   coordinates,
+                   entry.get('CONTACT_EMAIL') or None,
+                   entry.get('DOMAIN_NAME', '').lower().strip('.') or None)
+
+
+class SiteMetadata(object):
+    """
+    Site metadata shared by the discovery stages.
+
+    The country code of a site is resolved in order from:
+        1. the site's existing DIRAC name in the CS, so sites are never renamed,
+        2. the site's GOCDB record,
+        3. its hosts' names, by the GOCDB domains, then the CC_MAPPINGS
+           suffixes, then their top level domain,
+        4. the default, which an existing DIRAC name with the default code
+           also gives.
+    A code resolved from 1-3 is kept for the site for the rest of the cycle,
+    so the site's CEs all end up in the same DIRAC site.
+
+    The GOCDB site records are fetched in one call, at most every ttl
+    seconds, and looked up by site name or by host domain suffix. They are
+    cached on disk if a GOCDBCache is given, which is used instead of GOCDB
+    while younger than ttl and if GOCDB fails. Without a refresh, only the
+    CS and the host names are used. The CS site names are read once per
+    domain until the next reset.
+
+    Example:
+        >>> site_metadata.configure(cache=GOCDBCache('/opt/dirac/work/AutoBdii2CSAgent'), ttl=86400)
+        >>> site_metadata.refresh()
+        >>> site_metadata.country_code('UKI-LT2-IC-HEP', ['ceprod00.grid.hep.ph.ic.ac.uk'])
+        'uk'
+    """
+
+    def __init__(self, ttl=86400, cache=None, url=GOCDB_SITES_URL, timeout=60):
+        """
+        Initialise.
+
+        Args:
+            ttl (float): Seconds the GOCDB site records are used for before being fetched again.
+            cache (GOCDBCache): If given the GOCDB site records are cached in it.
+            url (str): URL of the GOCDB get_site method.
+            timeout (float): Socket timeout of the GOCDB query.
+        """
+        self.ttl = ttl
+        self.cache = cache
+        self.url = url
+        self.timeout = timeout
+        self.hash = None
+        self._lock = threading.Lock()
+        self._loaded = None
+        self._sites = {}
+        self._domains = {}
+        self._suffixes = {key.lower().strip('.'): value for key, value in CC_MAPPINGS.items()}
+        self._hosts = {}
+        self._names = {}
+        self._indexed = set()
+
+    def configure(self, **kwargs):
+        """Set any of the __init__ arguments."""
+        for name, value in kwargs.items():
+            if name not in ('ttl', 'cache', 'url', 'timeout'):
+                raise TypeError("Unknown SiteMetadata option %s" % name)
+            setattr(self, name, value)
+
+    def reset(self):
+        """Forget the CS site names and the country codes kept this cycle."""
+        with self._lock:
+            self._names.clear()
+            self._indexed.clear()
+
+    def refresh(self, force=False):
+        """
+        Reset and, if older than ttl, fetch the GOCDB site records again.
+
+        Call at the start of every cycle, or call reset to only use the CS and
+        host names. If the GOCDB query fails the records already held, if
+        any, are kept.
+
+        Returns:
+            dict: S_OK, or the GOCDB query's S_ERROR.
+        """
+        self.reset()
+        if not force and self._loaded is not None and time.time() - self._loaded < self.ttl:
+            return S_OK()
+
+        if self.cache is None:
+            with metrics.timer('gocdb_query_seconds', query='sites'):
+                result = fetch_gocdb_sites(self.url, self.timeout)
+            loaded = time.time()
+        else:
+            cached = None if force else self.cache.load('sites')
+            if cached is not None and time.time() - cached.Time < self.ttl:
+                result = S_OK(cached)
+            else:
+                result = self.cache.fetch('sites', fetch_gocdb_sites, self.url, self.timeout)
+            if result['OK']:
+                result, loaded = S_OK(result['Value'].Value), result['Value'].Time
+        if not result['OK']:
+            gLogger.warn("Could not get the GOCDB site records, using the %d already held: %s"
+                         % (len(self._sites), result['Message']))
+            return result
+        self._index(result['Value'])
+        self._loaded = loaded
+        return S_OK()
+
+    def _index(self, entries):
+        """Replace the GOCDB site records and their domain index."""
+        sites = {}
+        domains = {}
+        for entry in entries:
+            record = SiteRecord.from_gocdb(entry)
+            if not record.Name:
+                continue
+            sites[record.Name] = record
+            if record.Domain and record.Country:
+                # Domains shared by sites in different countries say nothing
+                if domains.setdefault(record.Domain, record.Country) != record.Country:
+                    domains[record.Domain] = None
+        with self._lock:
+            self._sites = sites
+            self._domains = domains
+            self._hosts = {}
+            self.hash = fingerprint(sorted(sites.values()), volatile=None)
+        metrics.set('site_metadata_sites', len(sites))
+
+    def site(self, name):
+        """Return the SiteRecord of a GOCDB site name, None if unknown."""
+        return self._sites.get(name)
+
+    def host_country(self, host):
+        """
+        Return the country code of a host by its name, None if unknown.
+
+        The host's domain suffixes, longest first, are looked up in the GOCDB
+        domains then the CC_MAPPINGS suffixes, falling back to the top level
+        domain. Results are memoised until the GOCDB records change.
+        """
+        host = host.strip().lower()
+        try:
+            return self._hosts[host]
+        except KeyError:
+            pass
+        labels = host.split('.')
+        suffixes = ['.'.join(labels[i:]) for i in range(len(labels))]
+        cc = next((self._domains[suffix] for suffix in suffixes if self._domains.get(suffix)), None) \
+            or next((self._suffixes[suffix] for suffix in suffixes if suffix in self._suffixes), None)
+        if cc is None:
+            match = CC_REGEX.search(host)
+            cc = match.groups()[0] if match is not None else None
+        self._hosts[host] = cc
+        return cc
+
+    def _cs_names(self, domain, site):
+        """Return the country codes of the site's existing DIRAC names in the domain."""
+        if domain not in self._indexed:
+            names = {}
+            result = gConfig.getSections(cfgPath(SITES_BASE, domain))
+            for dirac_name in result.get('Value', []) if result['OK'] else []:
+                if dirac_name.startswith(domain + '.') and dirac_name.count('.') >= 2:
+                    names.setdefault((domain, gocdb_name(dirac_name)), set())\
+                         .add(dirac_name.rsplit('.', 1)[1])
+            with self._lock:
+                for key, codes in names.items():
+                    self._names.setdefault(key, set()).update(codes)
+                self._indexed.add(domain)
+        return self._names.get((domain, site), ())
+
+    def country_code(self, site, hosts=(), domain='LCG', default='xx'):
+        """
+        Return the country code of a site's DIRAC name.
+
+        Args:
+            site (str): The GOCDB site name.
+            hosts (list): The site's host names, e.g. its CEs.
+            domain (str): The DIRAC domain the site is named in, e.g. LCG or VAC.
+            default (str): The country code used if no other is found.
+
+        Returns:
+            str: The country code.
+        """
+        codes = sorted(code for code in self._cs_names(domain, site) if code != default)
+        if codes:
+            source, cc = 'cs', codes[0]
+        else:
+            record = self._sites.get(site)
+            if record is not None and record.Country:
+                source, cc = 'gocdb', record.Country
+            else:
+                source, cc = 'host', next((code for code in map(self.host_country, hosts) if code), None)
+        if cc is None:
+            metrics.inc('site_metadata_lookups_total', source='default')
+            return default
+        metrics.inc('site_metadata_lookups_total', source=source)
+        if source != 'cs':
+            with self._lock:
+                self._names.setdefault((domain, site), set()).add(cc)
+        return cc
+
+
+site_metadata = SiteMetadata()
+
+__all__ = ('SiteMetadata', 'SiteRecord', 'site_metadata', 'guess_country_code', 'fetch_gocdb_sites',
+           'CC_MAPPINGS', 'CC_REGEX', 'GOCDB_SITES_URL')
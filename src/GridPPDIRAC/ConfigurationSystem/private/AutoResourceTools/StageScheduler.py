@@ -0,0 +1,156 @@
+"""Run independent CS discovery stages concurrently into one change set."""
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from DIRAC import gLogger
+
+from .ChangeLog import change_stage
+from .ConfigurationSystem import ChangeList
+from .Deadline import CancelToken, StageCancelled, cancel_scope
+from .Metrics import metrics
+
+
+class StageResult(namedtuple('StageResult', ('Name', 'Changes', 'Time', 'Error'))):
+    """
+    Outcome of a stage.
+
+    Attributes:
+        Name (str): The stage name.
+        Changes (int): Number of recorded CS calls applied.
+        Time (float): Seconds the stage took, None if it failed.
+        Error (Exception): The exception the stage raised, None if it succeeded.
+    """
+
+    __slots__ = ()
+
+
+class StageScheduler(object):
+    """
+    Concurrent discovery stage runner.
+
+    Each stage is a function taking a cfg_system keyword argument. Stages run
+    concurrently, each recording its changes in its own ChangeList, which are
+    then applied to the shared ConfigurationSystem in the order the stages were
+    added, so the merged change set does not depend on which stage finished
+    first. A stage that raises is logged and its changes dropped, the others
+    are still applied. Nothing is committed, the caller can run removal stages
+    on the merged state and commit once.
+
+    Each stage runs under its own CancelToken, with a deadline stage_timeout
+    seconds after it starts, bounded by that of the cycle token. A stage
+    still running at its deadline is cancelled (killing its ldapsearch
+    subprocesses), its thread abandoned and its changes dropped, and is
+    counted in the stage_overruns_total metric.
+
+    Example:
+        >>> cfg_system = ConfigurationSystem()
+        >>> scheduler = StageScheduler(cfg_system)
+        >>> scheduler.add('update_ses', update_ses, vo_list)
+        >>> scheduler.add('update_ces', update_ces, vo_list, host=bdii_host)
+        >>> scheduler.run()
+        >>> remove_old_ces(cfg_system=cfg_system)
+        >>> cfg_system.commit()
+    """
+
+    def __init__(self, cfg_system, workers=None, stage_timeout=None, token=None):
+        """
+        Initialise.
+
+        Args:
+            cfg_system (ConfigurationSystem): The configuration system the stages' changes are applied to.
+            workers (int): Maximum number of stages run at once, by default all of them.
+            stage_timeout (float): Seconds a stage may run for, None to only use the cycle deadline.
+            token (CancelToken): The cycle's token, whose deadline bounds every stage's.
+        """
+        self.cfg_system = cfg_system
+        self.workers = workers
+        self.stage_timeout = stage_timeout
+        self.token = token
+        self._stages = []
+
+    def add(self, name, func, *args, **kwargs):
+        """Add a stage calling func(*args, cfg_system=<ChangeList>, **kwargs)."""
+        self._stages.append((name, func, args, kwargs))
+
+    def _run_stage(self, name, func, args, kwargs, token):
+        """Run a stage into a new ChangeList, returning (ChangeList, seconds taken)."""
+        token.set_timeout(self.stage_timeout)
+        token.check()
+        start = time.time()
+        changes = ChangeList()
+        with change_stage(name), cancel_scope(token), metrics.timer('stage_seconds', stage=name):
+            func(*args, cfg_system=changes, **kwargs)
+        return changes, time.time() - start
+
+    def _wait(self, pending):
+        """Wait for a stage to finish or the earliest deadline, returning the overrun stages' futures."""
+        # A stage yet to start has its deadline at least stage_timeout away
+        remaining = [token.remaining() for _, token in pending.values()]
+        remaining = [seconds for seconds in remaining if seconds is not None]
+        if self.stage_timeout:
+            remaining.append(self.stage_timeout)
+        wait(pending, timeout=min(remaining) if remaining else None, return_when=FIRST_COMPLETED)
+        return [future for future, (_, token) in pending.items()
+                if not future.done() and token.cancelled]
+
+    def run(self):
+        """
+        Run the stages and apply their changes.
+
+        Returns:
+            list: StageResult for each stage, in the order added.
+        """
+        if not self._stages:
+            return []
+        start = time.time()
+        # Overrun stages' threads are abandoned rather than waited for
+        pool = ThreadPoolExecutor(max_workers=max(int(self.workers or len(self._stages)), 1))
+        try:
+            futures = []
+            for name, func, args, kwargs in self._stages:
+                token = CancelToken(parent=self.token)
+                futures.append((pool.submit(self._run_stage, name, func, args, kwargs, token), (name, token)))
+
+            overrun = set()
+            pending = dict(futures)
+            while pending:
+                for future in self._wait(pending):
+                    name, token = pending.pop(future)
+                    token.cancel()
+                    future.cancel()
+                    overrun.add(future)
+                    gLogger.error("Stage %s overran its deadline, cancelled it and dropped its changes" % name)
+                    metrics.inc('stage_overruns_total', stage=name)
+                for future in [future for future in pending if future.done()]:
+                    del pending[future]
+        finally:
+            pool.shutdown(wait=False)
+
+        results = []
+        for future, (name, token) in futures:
+            if future in overrun:
+                results.append(StageResult(name, 0, None, StageCancelled("%s overran its deadline" % name)))
+                continue
+            try:
+                changes, elapsed = future.result()
+            except StageCancelled as err:
+                gLogger.error("Stage %s cancelled, dropping its changes: %s" % (name, err))
+                metrics.inc('stage_overruns_total', stage=name)
+                results.append(StageResult(name, 0, None, err))
+                continue
+            except Exception as err:
+                gLogger.exception("Stage %s failed, dropping its changes" % name)
+                metrics.inc('stage_failures_total', stage=name)
+                results.append(StageResult(name, 0, None, err))
+                continue
+            with change_stage(name):
+                changes.apply(self.cfg_system)
+            results.append(StageResult(name, len(changes), elapsed, None))
+            metrics.inc('stage_changes_total', len(changes), stage=name)
+            gLogger.notice("Stage %s recorded %d changes in %.1fs" % (name, len(changes), elapsed))
+
+        gLogger.notice("Ran %d stages in %.1fs" % (len(results), time.time() - start))
+        return results
+
+__all__ = ('StageScheduler', 'StageResult')
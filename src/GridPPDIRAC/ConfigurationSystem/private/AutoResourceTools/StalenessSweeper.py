@@ -0,0 +1,79 @@
+"""Min-heap index of when CS resources were last seen."""
+import heapq
+import threading
+from datetime import date
+from fnmatch import fnmatchcase
+
+
+class StalenessSweeper(object):
+    """
+    Incrementally maintained (last seen day, section) min-heap.
+
+    Resources are pushed as they are seen rather than found by walking the CS, so
+    a sweep only pops the entries older than its cutoff. Entries superseded by a
+    later sighting or forgotten are left in the heap and skipped when popped.
+    Section patterns follow CSReplica, each '*' standing for one path element.
+
+    Example:
+        >>> sweeper = StalenessSweeper()
+        >>> sweeper.seen('/Registry/Hosts/vm1.site.ac.uk', date(2024, 1, 1))
+        >>> sweeper.expired('/Registry/Hosts/*', date(2024, 1, 5))
+        [('/Registry/Hosts/vm1.site.ac.uk', datetime.date(2024, 1, 1))]
+    """
+
+    def __init__(self):
+        """Initialise."""
+        self._lock = threading.Lock()
+        self._heap = []
+        self._days = {}
+        self.seeded = set()
+
+    def __len__(self):
+        """Number of sections tracked."""
+        return len(self._days)
+
+    def seen(self, section, day):
+        """Record that section was seen on day, ignoring days earlier than already recorded."""
+        ordinal = day.toordinal()
+        with self._lock:
+            if self._days.get(section, 0) >= ordinal:
+                return
+            self._days[section] = ordinal
+            heapq.heappush(self._heap, (ordinal, section))
+
+    def forget(self, section):
+        """Stop tracking section."""
+        with self._lock:
+            self._days.pop(section, None)
+
+    def expired(self, pattern, before):
+        """
+        Return the sections matching pattern last seen before a date.
+
+        Only the heap entries older than before are visited. The returned
+        sections stay tracked until seen again or forgotten.
+
+        Args:
+            pattern (str): Section pattern, e.g. '/Resources/Sites/VAC/*/CEs/*'.
+            before (date): Cutoff date.
+
+        Returns:
+            list: (section, date last seen) tuples, oldest first.
+        """
+        depth = pattern.count('/')
+        cutoff = before.toordinal()
+        popped = []
+        expired = []
+        with self._lock:
+            while self._heap and self._heap[0][0] < cutoff:
+                ordinal, section = heapq.heappop(self._heap)
+                if self._days.get(section) != ordinal:
+                    continue  # superseded or forgotten
+                popped.append((ordinal, section))
+                if section.count('/') == depth and fnmatchcase(section, pattern):
+                    expired.append((section, date.fromordinal(ordinal)))
+            for entry in popped:
+                heapq.heappush(self._heap, entry)
+        return expired
+
+__all__ = ('StalenessSweeper',)
@@ -0,0 +1,169 @@
+"""VAC/vcycle site model built from GOCDB service endpoints."""
+import re
+from collections import namedtuple
+from datetime import date
+from pprint import pformat
+
+from DIRAC import gLogger
+from DIRAC.ConfigurationSystem.Client.Helpers.Path import cfgPath
+
+from .SiteMetadata import site_metadata
+
+CN_REGEX = re.compile(r'CN=([^/]*)')
+VOKEY_EXTENSION_REGEX = re.compile(r'^PILOT_(SE|DN)_(.*)$')
+HOST_OS_REGEX = re.compile(r'.*[A-Za-z]([0-9])$')
+HOSTS_BASE = "/Registry/Hosts"
+SITES_BASE = "/Resources/Sites"
+DEFAULT_OS = 'EL9'
+HOST_PROPERTIES = ('GenericPilot', 'LimitedDelegation')
+# maxCPUTime of the default queue of the CEs of each site type
+MAX_CPUTIME = {'VAC': 400000, 'CLOUD': 24000000}
+
+
+class VacSite(namedtuple('VacSite', ('Name', 'CEs', 'SEs'))):
+    """
+    A VAC/vcycle site.
+
+    Attributes:
+        Name (str): The GOCDB site name.
+        CEs (dict): CE hostname to OS, e.g. 'EL9'.
+        SEs (set): The SEs the site's pilots use.
+    """
+
+    __slots__ = ()
+
+
+class VacModel(object):
+    """
+    GOCDB service endpoints of one service type, normalised.
+
+    Sites are keyed by DIRAC site name, CEs by hostname and pilot hosts by
+    CN, so an endpoint listed more than once is only written once. The CS is
+    then updated with one add per site and per host, which the
+    ConfigurationSystem diffs against the CS in one go on commit.
+
+    Example:
+        >>> model = VacModel(frozenset(['GridPP']))
+        >>> model.add_services(services)
+        >>> model.write(cfg_system, 'VAC', max_cputime=400000)
+    """
+
+    def __init__(self, vokeys, country_default='xx', metadata=site_metadata):
+        """
+        Initialise.
+
+        Args:
+            vokeys (frozenset): The VO identifiers of the PILOT_SE_<vokey>/PILOT_DN_<vokey> extensions used.
+            country_default (str): Country code used if the site's is unknown.
+            metadata (SiteMetadata): Resolves the sites' country codes.
+        """
+        self.vokeys = frozenset(vokeys)
+        self.metadata = metadata
+        self.country_default = country_default
+        self.sites = {}
+        self.hosts = {}
+
+    def __len__(self):
+        """Number of CEs."""
+        return sum(len(site.CEs) for site in self.sites.values())
+
+    @staticmethod
+    def host_os(raw_host_os):
+        """Return the DIRAC OS label of a GOCDB HOST_OS, e.g. 'RHEL 9' -> 'EL9'."""
+        match = HOST_OS_REGEX.match(raw_host_os)
+        if match is None:
+            return DEFAULT_OS
+        return 'EL%s' % match.group(1)
+
+    def add_services(self, services, site_type):
+        """
+        Add GOCDB service endpoints.
+
+        Args:
+            services (list): Service endpoint dicts returned from a GOCDB query.
+            site_type (str): The CS site type (VAC or CLOUD), prefixing the DIRAC site names.
+        """
+        for service in services:
+            if service.get('IN_PRODUCTION', 'N') != 'Y':
+                continue
+            sitename = service.get('SITENAME')
+            hostname = service.get('HOSTNAME')
+            if sitename is None or hostname is None:
+                gLogger.warn("Missing sitename or hostname for service:\n%s" % pformat(service))
+                continue
+
+            country_code = self.metadata.country_code(sitename, (hostname,), site_type,
+                                                      self.country_default)
+            dirac_name = "%s.%s.%s" % (site_type, sitename, country_code)
+            site = self.sites.get(dirac_name)
+            if site is None:
+                site = self.sites[dirac_name] = VacSite(sitename, {}, set())
+            site.CEs[hostname] = self.host_os(service.get('HOST_OS', DEFAULT_OS))
+
+            for extension in service.get('EXTENSIONS', []):
+                self._add_extension(site, extension)
+
+    def _add_extension(self, site, extension):
+        """Add a PILOT_SE_<vokey> or PILOT_DN_<vokey> extension of one of site's services."""
+        match = VOKEY_EXTENSION_REGEX.match(extension.get('KEY', ''))
+        if match is None:
+            return
+
+        extension_key = match.group()
+        k, vokey = match.groups()
+        if vokey not in self.vokeys:
+            gLogger.warn("Extension KEY %s for %s with vokey %s does not belong "
+                         "to a valid vokey: %s"
+                         % (extension_key, site.Name, vokey, sorted(self.vokeys)))
+            return
+
+        if k == 'SE':
+            se = extension.get('VALUE')
+            if se is None:
+                gLogger.warn("No SE value for extension KEY %s" % extension_key)
+                return
+            site.SEs.add(se)
+
+        # Registry
+        elif k == 'DN':
+            dn = extension.get('VALUE', '')
+            if "CN=" not in dn:
+                gLogger.warn("For extension KEY %s, Could not find the CN component "
+                             "of DN: %s" % (extension_key, dn))
+                return
+            self.hosts[max(CN_REGEX.findall(dn), key=len)] = dn
+
+    def write(self, cfg_system, site_type, max_cputime=None):
+        """
+        Write the model to the CS.
+
+        Args:
+            cfg_system (ConfigurationSystem): The ConfigurationSystem (or ChangeList) updated.
+            site_type (str): The CS site type (VAC or CLOUD) the sites are written under.
+            max_cputime: The maxCPUTime of the CEs' default queue, by default that in MAX_CPUTIME.
+        """
+        if max_cputime is None:
+            max_cputime = MAX_CPUTIME.get(site_type, 'Unknown')
+        today = date.today().strftime('%d/%m/%Y')
+        sites_path = cfgPath(SITES_BASE, site_type)
+        for dirac_name, site in sorted(self.sites.items()):
+            cfg_system.add(sites_path, dirac_name,
+                           {'Name': site.Name,
+                            'CEs': {ce: {'CEType': 'VMCloud',
+                                         'Architecture': 'x86_64',
+                                         'OS': ce_os,
+                                         'LastSeen': today,
+                                         'Queues': {'default': {'maxCPUTime': max_cputime}}}
+                                    for ce, ce_os in site.CEs.items()}})
+            site_path = cfgPath(sites_path, dirac_name)
+            cfg_system.append_unique(site_path, 'CE', sorted(site.CEs))
+            if site.SEs:
+                cfg_system.append_unique(site_path, 'SE', sorted(site.SEs))
+
+        for cn, dn in sorted(self.hosts.items()):
+            cfg_system.add(HOSTS_BASE, cn, {'DN': dn,
+                                            'LastSeen': today,
+                                            'Properties': list(HOST_PROPERTIES)})
+
+__all__ = ('VacModel', 'VacSite', 'CN_REGEX', 'VOKEY_EXTENSION_REGEX', 'HOST_OS_REGEX',
+           'HOSTS_BASE', 'SITES_BASE', 'MAX_CPUTIME')
@@ -5,6 +5,8 @@ import shlex
 import subprocess
 import warnings
 from collections import defaultdict
+from .Deadline import StageCancelled, current_token
+from .Metrics import metrics
 
 
 __all__ = ("MockLdap", "in_")
@@ -23,13 +25,14 @@ class MockLdap(object):
     option_regex = re.compile(r"(^[^:]+): (.*)$", re.MULTILINE)
     SCOPE_SUBTREE = None
 
-    def __init__(self, hostname, port):
+    def __init__(self, hostname, port, timeout=None):
         self._host = ':'.join((hostname, str(port)))
+        self._timeout = timeout
 
     @classmethod
-    def open(cls, hostname, port):
-        """Open connection mock."""
-        return cls(hostname, port)
+    def open(cls, hostname, port, timeout=None):
+        """Open connection mock, searches being killed after timeout seconds if given."""
+        return cls(hostname, port, timeout)
 
     def search_s(self, base, filterstr, scope=None):
         """
@@ -42,11 +45,39 @@ class MockLdap(object):
 
         Returns:
             list: list of (dn, attib_dict) for items matching the filterstr
+
+        Raises:
+            subprocess.CalledProcessError: If ldapsearch fails.
+            subprocess.TimeoutExpired: If ldapsearch takes longer than the timeout.
+            StageCancelled: If the current thread's CancelToken is cancelled, which kills ldapsearch.
         """
         cmd = "ldapsearch -x -LLL -o ldif-wrap=no -H ldap://{host} -b {base!r} {filterstr!r}"
-        stdout = subprocess.check_output(shlex.split(cmd.format(host=self._host,
-                                                                base=base,
-                                                                filterstr=filterstr)))
+        args = shlex.split(cmd.format(host=self._host, base=base, filterstr=filterstr))
+        token = current_token()
+        if token is not None:
+            token.check()
+        metrics.inc('ldap_queries_total', host=self._host)
+        with metrics.timer('ldap_query_seconds', host=self._host):
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+            if token is not None:
+                token.on_cancel(proc.kill)
+            try:
+                stdout, _ = proc.communicate(timeout=token.timeout(self._timeout) if token is not None
+                                             else self._timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.communicate()
+                metrics.inc('ldap_timeouts_total', host=self._host)
+                if token is not None and token.cancelled:
+                    raise StageCancelled("ldapsearch on %s killed at the deadline" % self._host)
+                raise
+            finally:
+                if token is not None:
+                    token.remove_callback(proc.kill)
+        if token is not None and token.cancelled:
+            raise StageCancelled("ldapsearch on %s killed on cancellation" % self._host)
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, args, stdout)
         ret = []
         # stdout in py3 is bytes and find all doesn't work. Hope I got the decoding correct
         for dn, options in MockLdap.entry_regex.findall(stdout.decode(encoding='utf-8', errors='strict')):
@@ -54,6 +85,8 @@ class MockLdap(object):
             for key, value in MockLdap.option_regex.findall(options):
                 d[key].append(value)
             ret.append((dn, dict(d)))
+        metrics.inc('ldap_bytes_total', len(stdout), host=self._host)
+        metrics.inc('ldap_entries_total', len(ret), host=self._host)
         return ret
 #        return [(dn, dict(MockLdap.option_regex.findall(options)))
 #                for dn, options in MockLdap.entry_regex.findall(stdout)]
@@ -21,15 +21,95 @@ def ldapSEAccessProtocol( se, attr = None, host = None ):
     return S_OK([value["attr"] for value in result['Value']])
 
 
+def _emit_scalar(cfg_system, path, option, value):
+    if value:  # exclude None and empty string
+        cfg_system.add(path, option, value)
+
+
+def _emit_set(cfg_system, path, option, value):
+    cfg_system.append_unique(path, option, sorted(value))
+
+
+def _emit_dict(cfg_system, path, option, value):
+    section = cfgPath(path, option)
+    for key, val in value.items():
+        cfg_system.add(section, key, val)
+
+
+def _emit_writable(cfg_system, path, option, value):
+    value.write(cfg_system, path)
+
+
+def _emit_writable_list(cfg_system, path, option, value):
+    section = cfgPath(path, option)
+    for val in value:
+        val.write(cfg_system, section)
+
+
+def _emit_writable_tuple(cfg_system, path, option, value):
+    for val in value:
+        val.write(cfg_system, path)
+
+
+def _emit_auto(cfg_system, path, option, value):
+    if isinstance(value, list):
+        _emit_writable_list(cfg_system, path, option, value)
+    elif isinstance(value, tuple):
+        _emit_writable_tuple(cfg_system, path, option, value)
+    elif isinstance(value, WritableMixin):
+        _emit_writable(cfg_system, path, option, value)
+    elif isinstance(value, dict):
+        _emit_dict(cfg_system, path, option, value)
+    elif isinstance(value, set):
+        _emit_set(cfg_system, path, option, value)
+    else:
+        _emit_scalar(cfg_system, path, option, value)
+
+
+FIELD_EMITTERS = {'scalar': _emit_scalar,
+                  'set': _emit_set,
+                  'dict': _emit_dict,
+                  'writable': _emit_writable,
+                  'writable_list': _emit_writable_list,
+                  'writable_tuple': _emit_writable_tuple,
+                  'auto': _emit_auto}
+
+
 class WritableMixin(object):
     """
     Mixin class for writing out Dirac config named tuples.
 
+    Each subclass gets a write plan compiled once at class creation: one
+    (index, option, emitter) entry per field other than DiracName. The emitter
+    for a field is chosen from the kind declared for it in _field_kinds:
+
+        scalar          - add(path, option, value) unless the value is empty
+        set             - append_unique(path, option, sorted(value))
+        dict            - add each key/value under path/option
+        writable        - a nested writable written under path
+        writable_list   - nested writables each written under path/option
+        writable_tuple  - nested writables each written under path
+        auto            - pick one of the above from the value's type (the default)
+
     Note: This class is expected to be used as a mix-in class with one already extending
           namedtuple and also expects there to be a property named 'DiracName'.
     """
 
     __slots__ = ()
+    _field_kinds = {}
+    _write_plan = ()
+
+    def __init_subclass__(cls, **kwargs):
+        """Compile the write plan of a subclass."""
+        super(WritableMixin, cls).__init_subclass__(**kwargs)
+        fields = getattr(cls, '_fields', None)
+        if fields is None:
+            return
+        unknown = set(cls._field_kinds).difference(fields)
+        if unknown:
+            raise TypeError("%s declares kinds for unknown fields: %s" % (cls.__name__, sorted(unknown)))
+        cls._write_plan = tuple((index, option, FIELD_EMITTERS[cls._field_kinds.get(option, 'auto')])
+                                for index, option in enumerate(fields) if option != 'DiracName')
 
     def write(self, cfg_system, path_root):
         """
@@ -41,23 +121,8 @@ class WritableMixin(object):
             path_root (str): The path in the DIRAC CS to write options to.
         """
         path = cfgPath(path_root, self.DiracName)
-
-        for option, value in self._replace(DiracName=None)._asdict().items():
-            if isinstance(value, list):
-                for val in value:
-                    val.write(cfg_system, cfgPath(path, option))
-            elif isinstance(value, tuple):
-                for val in value:
-                    val.write(cfg_system, path)
-            elif isinstance(value, WritableMixin):
-                value.write(cfg_system, path)
-            elif isinstance(value, dict):
-                for key, val in value.items():
-                    cfg_system.add(cfgPath(path, option), key, val)
-            elif isinstance(value, set):
-                cfg_system.append_unique(path, option, sorted(value))
-            elif value:  # exclude None and empty string
-                cfg_system.add(path, option, value)
+        for index, option, emit in self._write_plan:
+            emit(cfg_system, path, option, self[index])
 
 
 def splitcommonvopaths(vo_paths):
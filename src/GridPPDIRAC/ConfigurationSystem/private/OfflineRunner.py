@@ -0,0 +1,260 @@
+"""Run the discovery stages offline, against recorded answers and a local CS file."""
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+
+from diraccfg import CFG
+from DIRAC import S_OK, S_ERROR
+
+from .AutoBDIISEs import update_ses
+from .AddResourceAPI import update_ces
+from .AutoResourceTools.ChangeLog import ChangeRecord
+from .AutoResourceTools.ConfigurationSystem import ConfigurationSystem
+from .AutoResourceTools.Glue2ARCAPI import update_arc_ces
+from .AutoResourceTools.Glue2HTCondorAPI import update_htcondor_ces
+from .AutoResourceTools.VacModel import VacModel
+
+
+class OfflineConfigurationSystem(ConfigurationSystem):
+    """
+    ConfigurationSystem whose snapshot is a local CFG file and which never commits.
+
+    The changes the stages make are worked out as usual, plan returns them
+    instead of them being committed to the master.
+
+    Example:
+        >>> cfg_system = OfflineConfigurationSystem('dirac.cfg')
+        >>> with ConfigurationSystem.stage('update_ses'):
+        ...     update_ses(['gridpp'], cfg_system=cfg_system, bdii_pool=FixtureBDII(Fixture('ses.json')))
+        >>> cfg_system.plan()
+    """
+
+    def __init__(self, cfg_path):
+        """
+        Initialise.
+
+        Args:
+            cfg_path (str): The CFG file standing in for the master CS.
+        """
+        self.cfg_path = cfg_path
+        super(OfflineConfigurationSystem, self).__init__()
+
+    def initialize(self):
+        """There is no master to connect to."""
+        return S_OK()
+
+    def getCurrentCFG(self):
+        """Return the CFG file's contents."""
+        cfg = CFG()
+        try:
+            cfg.loadFromFile(self.cfg_path)
+        except Exception as err:
+            return S_ERROR("Failed to load %s: %s" % (self.cfg_path, err))
+        return S_OK(cfg)
+
+    def plan(self):
+        """
+        Return the changes that commit would make.
+
+        Returns:
+            list: ChangeRecord tuples, Stage being the stage making the change.
+        """
+        self._merge_appends()
+        return [ChangeRecord(operation, path, old_value, new_value, self._stages.get(path))
+                for operation, path, old_value, new_value in self.diff()]
+
+    def commit(self):
+        """Never commit, see plan."""
+        raise RuntimeError("An OfflineConfigurationSystem is not committed, see plan")
+
+
+class StageProfile(namedtuple('StageProfile', ('Stage', 'Seconds', 'PeakMemory', 'Changes', 'Error'))):
+    """
+    Timing and memory of an offline stage run.
+
+    Attributes:
+        Stage (str): The stage.
+        Seconds (float): Wall clock time the stage took.
+        PeakMemory (int): Peak bytes allocated by Python while the stage ran.
+        Changes (int): Number of CS changes the stage planned.
+        Error (str): The error the stage failed with, None if it succeeded.
+    """
+
+    __slots__ = ()
+
+
+class RunOptions(namedtuple('RunOptions', ('VOs', 'VOKeys', 'BannedCEs', 'BannedSEs', 'MaxProcessors',
+                                           'Domain', 'CountryDefault'))):
+    """
+    Arguments of the offline stages, as the agents take them from their options.
+
+    Attributes:
+        VOs (list): The VOs whose resources are discovered.
+        VOKeys (list): The VO identifiers of the VAC/vcycle GOCDB extensions used.
+        BannedCEs (list): CEs skipped.
+        BannedSEs (list): SEs skipped.
+        MaxProcessors (int): If not None, overrides the BDII MaxProcessors of every CE.
+        Domain (str): The DIRAC domain of the discovered sites.
+        CountryDefault (str): Country code of sites for which none is found.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, vos, vokeys=('GridPP',), banned_ces=(), banned_ses=(), max_processors=None,
+                domain='LCG', country_default='xx'):
+        """Create."""
+        return super(RunOptions, cls).__new__(cls, vos, vokeys, banned_ces, banned_ses, max_processors,
+                                              domain, country_default)
+
+
+def _vac_stage(service_type, site_type):
+    """Return a stage processing the GOCDB endpoints of a VAC/vcycle service type."""
+    def run(cfg_system, bdii, options):
+        model = VacModel(options.VOKeys, options.CountryDefault)
+        model.add_services(bdii.services(service_type), site_type)
+        model.write(cfg_system, site_type)
+    return run
+
+
+# Stage name to stage(cfg_system, bdii, options), in the order they are run
+STAGES = (('update_ses',
+           lambda cfg_system, bdii, options: update_ses(options.VOs, banned_ses=options.BannedSEs,
+                                                        cfg_system=cfg_system, replica=cfg_system.replica(),
+                                                        bdii_pool=bdii)),
+          ('update_ces',
+           lambda cfg_system, bdii, options: update_ces(options.VOs, domain=options.Domain,
+                                                        country_default=options.CountryDefault,
+                                                        banned_ces=options.BannedCEs,
+                                                        max_processors=options.MaxProcessors,
+                                                        cfg_system=cfg_system, bdii_pool=bdii)),
+          ('update_htcondor_ces',
+           lambda cfg_system, bdii, options: update_htcondor_ces(options.VOs, banned_ces=options.BannedCEs,
+                                                                 max_processors=options.MaxProcessors,
+                                                                 cfg_system=cfg_system, bdii_pool=bdii)),
+          ('update_arc_ces',
+           lambda cfg_system, bdii, options: update_arc_ces(options.VOs, banned_ces=options.BannedCEs,
+                                                            max_processors=options.MaxProcessors,
+                                                            cfg_system=cfg_system, bdii_pool=bdii)),
+          ('vac', _vac_stage('uk.ac.gridpp.vac', 'VAC')),
+          ('vcycle', _vac_stage('uk.ac.gridpp.vcycle', 'CLOUD')))
+
+
+def profile_stage(name, stage, *args, **kwargs):
+    """
+    Run a stage, timing it and tracing its peak memory.
+
+    The stage's CS changes are attributed to name. An exception raised by
+    the stage is caught and returned as the Error.
+
+    Returns:
+        StageProfile: The profile, Changes left at 0.
+    """
+    error = None
+    tracemalloc.start()
+    start = time.time()
+    try:
+        with ConfigurationSystem.stage(name):
+            stage(*args, **kwargs)
+    except Exception as err:
+        error = '%s: %s' % (type(err).__name__, err)
+    finally:
+        seconds = time.time() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return StageProfile(name, seconds, peak, 0, error)
+
+
+def run_stages(cfg_system, bdii, options, stages=None):
+    """
+    Run discovery stages one after the other into an OfflineConfigurationSystem.
+
+    The stages are run one at a time, rather than concurrently as in the
+    agent, so that each one's time and memory are its own.
+
+    Args:
+        cfg_system (OfflineConfigurationSystem): The CS the stages plan their changes in.
+        bdii (FixtureBDII): The BDII (and GOCDB) answers, or a RecordingBDII.
+        options (RunOptions): The stages' arguments.
+        stages (list): Names of the stages to run, all of STAGES by default.
+
+    Returns:
+        tuple: (list of StageProfile, list of ChangeRecord)
+
+    Raises:
+        ValueError: If a stage is unknown.
+    """
+    known = dict(STAGES)
+    if stages is None:
+        stages = [name for name, _ in STAGES]
+    unknown = set(stages).difference(known)
+    if unknown:
+        raise ValueError("Unknown stage(s) %s, choose from %s"
+                         % (', '.join(sorted(unknown)), ', '.join(name for name, _ in STAGES)))
+
+    profiles = [profile_stage(name, known[name], cfg_system, bdii, options) for name in stages]
+    plan = cfg_system.plan()
+    changes = {}
+    for record in plan:
+        changes[record.Stage] = changes.get(record.Stage, 0) + 1
+    return [profile._replace(Changes=changes.get(profile.Stage, 0)) for profile in profiles], plan
+
+
+def load_baseline(path):
+    """Return the stage name to StageProfile baseline written by save_baseline."""
+    with open(path) as baseline:
+        return {name: StageProfile(name, entry['seconds'], entry['peak_memory'], entry['changes'], None)
+                for name, entry in json.load(baseline).get('stages', {}).items()}
+
+
+def save_baseline(path, profiles):
+    """Write the profiles of the successful stages as a baseline, atomically."""
+    content = {'time': time.time(),
+               'stages': {profile.Stage: {'seconds': profile.Seconds,
+                                          'peak_memory': profile.PeakMemory,
+                                          'changes': profile.Changes}
+                          for profile in profiles if profile.Error is None}}
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.baseline')
+    try:
+        with os.fdopen(fd, 'w') as tmp:
+            json.dump(content, tmp, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def regressions(profiles, baseline, tolerance=0.2, min_seconds=0.1, min_memory=1 << 20):
+    """
+    Compare stage profiles with a baseline.
+
+    A stage regresses if its time or peak memory exceeds the baseline's by
+    more than the fraction tolerance and, so that noise on small stages is
+    ignored, by more than min_seconds or min_memory bytes.
+
+    Args:
+        profiles (list): StageProfile tuples of this run.
+        baseline (dict): Stage name to StageProfile, see load_baseline.
+        tolerance (float): Allowed fractional increase.
+        min_seconds (float): Increase in seconds always allowed.
+        min_memory (int): Increase in bytes always allowed.
+
+    Returns:
+        list: Descriptions of the regressions, empty if there are none.
+    """
+    found = []
+    for profile in profiles:
+        base = baseline.get(profile.Stage)
+        if base is None or profile.Error is not None:
+            continue
+        if profile.Seconds > max(base.Seconds * (1 + tolerance), base.Seconds + min_seconds):
+            found.append("%s took %.2fs, baseline %.2fs" % (profile.Stage, profile.Seconds, base.Seconds))
+        if profile.PeakMemory > max(base.PeakMemory * (1 + tolerance), base.PeakMemory + min_memory):
+            found.append("%s peaked at %.1fMiB, baseline %.1fMiB"
+                         % (profile.Stage, profile.PeakMemory / 2. ** 20, base.PeakMemory / 2. ** 20))
+    return found
+
+__all__ = ('OfflineConfigurationSystem', 'StageProfile', 'RunOptions', 'STAGES', 'profile_stage',
+           'run_stages', 'load_baseline', 'save_baseline', 'regressions')
@@ -8,6 +8,8 @@ import re
 from DIRAC import gConfig, gLogger, S_OK
 from DIRAC.ConfigurationSystem.Client.CSAPI import CSAPI
 from GridPPDIRAC.Core.Security.MultiVOMSService import MultiVOMSService
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.Deadline import check_cancelled
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.Metrics import metrics
 cn_sanitiser = re.compile('[^a-z._ ]')
 cn_regex = re.compile('/CN=(?P<cn>[^/]*)')
 cn_multispace = re.compile(' +')
@@ -72,12 +74,18 @@ class UsersAndGroupsAPI(object):
 
     Maintains VOMS locations and update DIRAC CS from VOMS
     '''
-    def __init__(self):
-        '''Initialise'''
-        self._vomsSrv = MultiVOMSService()
+    def __init__(self, voms_timeout=None):
+        '''Initialise, voms_timeout being the VOMS SOAP calls' socket timeout'''
+        self._vomsSrv = MultiVOMSService(timeout=voms_timeout)
 
     def update_usersandgroups(self):
-        '''Updates the DIRAC CS from VOMS'''
+        '''
+        Updates the DIRAC CS from VOMS
+
+        If run under a cancelled CancelToken (see call_with_deadline) the
+        update stops before the next VOMS call or before committing, so a
+        partial view of VOMS is never committed.
+        '''
         result = gConfig.getOptionsDict('/Registry/VOMS/Mapping')
         if not result['OK']:
             gLogger.fatal('No DIRAC group to VOMS role mapping available')
@@ -93,10 +101,13 @@ class UsersAndGroupsAPI(object):
         dead_VO_groups = set()
         #groupsInVOMS = set()
         for vo in self._vomsSrv.vos:
+            check_cancelled()
             gLogger.info('Processing information for %s VO...' % vo)
             ## Get the VO name from VOMS
+            metrics.inc('voms_queries_total', call='admGetVOName')
             result = self._vomsSrv.admGetVOName(vo)
             if not result['OK']:
+                metrics.inc('voms_failures_total', vo=vo)
                 gLogger.warn('Could not retrieve VOMS VO name for vo %s, '
                              'skipping...' % vo)
                 dead_VO_groups.update(v for k, v in vomsMapping.items() if k.startswith('/%s' % vo))
@@ -114,12 +125,15 @@ class UsersAndGroupsAPI(object):
 
             ## Users
             ################################################################
+            metrics.inc('voms_queries_total', 2, call='admListMembers')
             suspended_members = self._vomsSrv.getSuspendedMembers(vo)
             result = self._vomsSrv.admListMembers(vo)
             if not result['OK']:
+                metrics.inc('voms_failures_total', vo=vo)
                 gLogger.warn('Could not retrieve registered user entries in '
                              'VOMS for VO %s, skipping...' % vo)
                 continue
+            metrics.inc('voms_entries_total', len(result['Value']), call='admListMembers')
             for user in result['Value']:
                 ## New user check
                 if not usersInVOMS.get(user['DN']):
@@ -145,8 +159,10 @@ class UsersAndGroupsAPI(object):
 
             ## Groups
             ################################################################
+            metrics.inc('voms_queries_total', call='admListRoles')
             result = self._vomsSrv.admListRoles(vo)
             if not result['OK']:
+                metrics.inc('voms_failures_total', vo=vo)
                 gLogger.warn('Could not retrieve registered roles in VOMS '
                              'for vo' % vo)
                 gLogger.warn('Will proceed to add users to any default '
@@ -162,6 +178,8 @@ class UsersAndGroupsAPI(object):
                                   % role)
                     continue
 
+                check_cancelled()
+                metrics.inc('voms_queries_total', call='admListUsersWithRole')
                 result = self._vomsSrv.admListUsersWithRole(vo,
                                                             voNameInVOMS,
                                                             role)
@@ -181,6 +199,7 @@ class UsersAndGroupsAPI(object):
 
         ## Updating CS
         ###################################################################
+        metrics.set('voms_users', len(usersInVOMS))
         gLogger.info("Updating CS with changes/new entries...")
         csapi = CSAPI()
         ret = csapi.downloadCSData()
@@ -242,14 +261,20 @@ class UsersAndGroupsAPI(object):
             if not result['OK']:
                 gLogger.error("Cannot modify user %s, DN: %s, skipping"
                               % (user_nick, user.get('DN')))
+                metrics.inc('cs_user_failures_total')
                 continue
+            metrics.inc('cs_users_written_total')
 
         ## Removing obsolete users, commented out for now
         if obsoleteUsers:
             gLogger.info("Deleting obsolete users: %s" % obsoleteUsers)
             csapi.deleteUsers(obsoleteUsers)
 
-        result = csapi.commitChanges()
+        metrics.set('cs_users_obsolete', len(obsoleteUsers))
+        metrics.set('cs_groups_managed', len(managed_groups))
+        check_cancelled()
+        with metrics.timer('cs_commit_seconds'):
+            result = csapi.commitChanges()
         if not result['OK']:
             gLogger.error("Could not commit configuration changes",
                           result['Message'])
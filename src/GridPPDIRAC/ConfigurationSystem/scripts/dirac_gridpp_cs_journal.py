@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Show, replay or drop the CS change journal left behind by an interrupted agent commit.
+
+The journal is only replayed if the CS is still at the version the pending
+changes were computed against, otherwise it is dropped as stale.
+
+Example:
+  $ dirac-gridpp-cs-journal --show /opt/dirac/work/Configuration/AutoBdii2CSAgent/cs_journal.jsonl
+"""
+from DIRAC import exit as DIRACExit, gLogger
+from DIRAC.Core.Base.Script import Script
+
+
+@Script()
+def main():
+    """Entry point."""
+    Script.registerSwitch("s", "show", "Only list the pending changes")
+    Script.registerSwitch("d", "drop", "Drop the journal without replaying it")
+    Script.registerArgument("journal: path of the journal file")
+    Script.parseCommandLine(ignoreErrors=False)
+    switches = {switch.lstrip('-') for switch, _ in Script.getUnprocessedSwitches()}
+    journal_path = Script.getPositionalArgs()[0]
+
+    from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.ChangeJournal import ChangeJournal
+    from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.ConfigurationSystem import ConfigurationSystem
+
+    journal = ChangeJournal(journal_path)
+    pending = journal.pending()
+    if pending is None:
+        gLogger.notice("No pending changes in %s" % journal_path)
+        DIRACExit(0)
+
+    if switches & {'s', 'show'}:
+        gLogger.notice("%d pending changes against CS version %s:" % (len(pending.Ops), pending.Version))
+        for operation, path, old_value, new_value in pending.Ops:
+            gLogger.notice("  %s %s: %s -> %s" % (operation, path, old_value, new_value))
+        DIRACExit(0)
+
+    if switches & {'d', 'drop'}:
+        journal.clear()
+        gLogger.notice("Dropped %d pending changes" % len(pending.Ops))
+        DIRACExit(0)
+
+    ConfigurationSystem.configure(journal_path=journal_path)
+    try:
+        replayed = ConfigurationSystem().replay_journal()
+    except RuntimeError as err:
+        gLogger.error("Failed to replay CS journal:", str(err))
+        DIRACExit(1)
+    gLogger.notice("Replayed %d journalled changes" % replayed)
+    DIRACExit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Run discovery stages offline, against a recorded BDII/GOCDB fixture and a local CS file.
+
+The CS changes the stages would make are printed, followed by each stage's
+time, peak memory and number of changes. Nothing is committed. With
+--record the stages query the given BDIIs (and GOCDB) instead and their
+answers are saved to the fixture, for later offline runs.
+
+Exit status is 1 if a stage failed and 2 if a stage's time or peak memory
+regressed past the --baseline by more than --tolerance. Times include the
+overhead of tracing memory, so only compare with baselines written by this
+command.
+
+Example:
+  $ dirac-gridpp-discovery-run --cfg cs.cfg --fixture bdii.json --record topbdii.grid.hep.ph.ic.ac.uk:2170
+  $ dirac-gridpp-discovery-run --cfg cs.cfg --fixture bdii.json --save-baseline baseline.json
+  $ dirac-gridpp-discovery-run --cfg cs.cfg --fixture bdii.json --stages update_arc_ces --baseline baseline.json
+"""
+from DIRAC import exit as DIRACExit, gConfig, gLogger
+from DIRAC.Core.Base.Script import Script
+
+
+@Script()
+def main():
+    """Entry point."""
+    Script.registerSwitch("c:", "cfg=", "CFG file standing in for the CS (required)")
+    Script.registerSwitch("f:", "fixture=", "JSON fixture of recorded BDII/GOCDB answers (required)")
+    Script.registerSwitch("S:", "stages=", "Comma separated stages to run (default all)")
+    Script.registerSwitch("V:", "vo=", "Comma separated VOs (default those in the CFG's /Registry/VO)")
+    Script.registerSwitch("K:", "vokeys=", "Comma separated VAC/vcycle GOCDB VO keys (default GridPP)")
+    Script.registerSwitch("r:", "record=", "Comma separated BDIIs ('<hostname>:<port>') to record the fixture from")
+    Script.registerSwitch("b:", "baseline=", "Baseline to compare stage times and peak memory with")
+    Script.registerSwitch("w:", "save-baseline=", "Write this run's stage times and peak memory as a baseline")
+    Script.registerSwitch("t:", "tolerance=", "Fractional increase over the baseline allowed (default 0.2)")
+    Script.registerSwitch("s", "summary", "Only print the per stage summary, not the change plan")
+    Script.disableCS()
+    Script.parseCommandLine(ignoreErrors=False)
+    switches = {}
+    for switch, value in Script.getUnprocessedSwitches():
+        switches[switch.lstrip('-')] = value
+
+    def option(short, long, default=None):
+        return switches.get(short, switches.get(long, default))
+
+    cfg_path, fixture_path = option('c', 'cfg'), option('f', 'fixture')
+    if not cfg_path or not fixture_path:
+        gLogger.error("Both --cfg and --fixture are required")
+        DIRACExit(1)
+
+    from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.BDIIPool import BDIIPool
+    from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.Fixtures import (Fixture, FixtureBDII,
+                                                                                     RecordingBDII)
+    from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.SiteMetadata import site_metadata
+    from GridPPDIRAC.ConfigurationSystem.private.OfflineRunner import (OfflineConfigurationSystem, RunOptions,
+                                                                       load_baseline, regressions,
+                                                                       run_stages, save_baseline)
+
+    # Code reading gConfig directly sees the CFG file too
+    result = gConfig.loadFile(cfg_path)
+    if not result['OK']:
+        gLogger.error("Failed to load %s:" % cfg_path, result['Message'])
+        DIRACExit(1)
+    site_metadata.reset()
+
+    def split(value):
+        return [item.strip() for item in value.split(',') if item.strip()]
+
+    vos = split(option('V', 'vo', '')) or gConfig.getSections('/Registry/VO').get('Value', [])
+    options = RunOptions(vos, vokeys=split(option('K', 'vokeys', '')) or ['GridPP'])
+    stages = split(option('S', 'stages', '')) or None
+
+    fixture = Fixture(fixture_path)
+    record = split(option('r', 'record', ''))
+    if record:
+        from DIRAC.Core.LCG.GOCDBClient import GOCDBClient
+        bdii = RecordingBDII(BDIIPool(record), fixture, GOCDBClient())
+    else:
+        bdii = FixtureBDII(fixture)
+
+    try:
+        cfg_system = OfflineConfigurationSystem(cfg_path)
+        profiles, plan = run_stages(cfg_system, bdii, options, stages)
+    except (RuntimeError, ValueError) as err:
+        gLogger.error(str(err))
+        DIRACExit(1)
+    if record:
+        fixture.save()
+        gLogger.notice("Recorded %d answers to %s" % (len(fixture), fixture_path))
+
+    if not switches.keys() & {'s', 'summary'}:
+        for change in plan:
+            gLogger.notice("[%s] %s %s: %s -> %s" % (change.Stage, change.Op, change.Path, change.Old, change.New))
+    gLogger.notice("%-20s %10s %12s %8s" % ('Stage', 'Seconds', 'Peak MiB', 'Changes'))
+    for profile in profiles:
+        gLogger.notice("%-20s %10.2f %12.1f %8d%s"
+                       % (profile.Stage, profile.Seconds, profile.PeakMemory / 2. ** 20, profile.Changes,
+                          '  FAILED: %s' % profile.Error if profile.Error else ''))
+
+    if option('w', 'save-baseline'):
+        save_baseline(option('w', 'save-baseline'), profiles)
+    if any(profile.Error for profile in profiles):
+        DIRACExit(1)
+    if option('b', 'baseline'):
+        found = regressions(profiles, load_baseline(option('b', 'baseline')),
+                            tolerance=float(option('t', 'tolerance', 0.2)))
+        for regression in found:
+            gLogger.error("Regression:", regression)
+        if found:
+            DIRACExit(2)
+    DIRACExit(0)
+
+
+if __name__ == "__main__":
+    main()
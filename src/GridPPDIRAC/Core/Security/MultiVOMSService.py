@@ -34,8 +34,8 @@ class MultiVOMSService(object):
     '''
     Multiple VO VOMS Service
     '''
-    def __init__(self, adminUrls=None):
-        '''initialise'''
+    def __init__(self, adminUrls=None, timeout=None):
+        '''initialise, timeout being the SOAP calls' socket timeout (suds default if None)'''
         adminUrls = adminUrls or {}
         self.__soapClients = {}
 
@@ -71,12 +71,16 @@ class MultiVOMSService(object):
                     adminClient = Client(admin + '?wsdl',
                                          transport=httpstransport)
                     adminClient.set_options(headers={"X-VOMS-CSRF-GUARD": "1"})
+                    if timeout is not None:
+                        adminClient.set_options(timeout=timeout)
                     compatClient = Client(os.path.join(os.path.dirname(admin),
                                                        'VOMSCompatibility?wsdl'),
                                           transport=HTTPSClientCertTransport(hostCert,
                                                                              hostKey,
                                                                              getCAsLocation()))
                     compatClient.set_options(headers={"X-VOMS-CSRF-GUARD": "1"})
+                    if timeout is not None:
+                        compatClient.set_options(timeout=timeout)
                     self.__soapClients[vo] = {'Admin': adminClient, 'Compat': compatClient}
                     break
                 except Exception:
@@ -0,0 +1,157 @@
+"""Shared fixtures: an in memory master CS behind ConfigurationSystem."""
+import pytest
+
+from DIRAC import S_OK, S_ERROR
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools import ConfigurationSystem as cs_module
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.ConfigurationSystem import ConfigurationSystem
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.StalenessSweeper import StalenessSweeper
+
+VERSION_PATH = ConfigurationSystem.VERSION_PATH
+
+
+class FakeCFG(object):
+    """The parts of diraccfg.CFG ConfigurationSystem uses, over a flat option dict."""
+
+    def __init__(self, options, sections=()):
+        self.options = dict(options)
+        self.sections = set(sections)
+
+    def getAsDict(self):
+        root = {}
+        for section in self.sections:
+            node = root
+            for name in section.strip('/').split('/'):
+                node = node.setdefault(name, {})
+        for path, value in self.options.items():
+            node = root
+            names = path.strip('/').split('/')
+            for name in names[:-1]:
+                node = node.setdefault(name, {})
+            node[names[-1]] = value
+        return root
+
+    def getOption(self, path, default=None):
+        return self.options.get(path, default)
+
+
+class FakeMaster(object):
+    """
+    The master CS: absolute option paths to values, plus explicitly empty sections.
+
+    Every commit bumps the version. A commit made from a copy older than the
+    master's version is refused, as the real master does.
+    """
+
+    def __init__(self, options=None, sections=()):
+        self.options = dict(options or {})
+        self.sections = set(sections)
+        self.version = 1
+        self.options[VERSION_PATH] = '1'
+        self.downloads = 0
+        self.commits = []
+        self.fail_commits = 0
+
+    def copy(self):
+        self.downloads += 1
+        return dict(self.options), set(self.sections)
+
+    def write(self, path, value=None):
+        """Commit as another writer would, value None deleting the option."""
+        if value is None:
+            self.options.pop(path, None)
+        else:
+            self.options[path] = value
+        self._bump()
+
+    def _bump(self):
+        self.version += 1
+        self.options[VERSION_PATH] = str(self.version)
+
+    def commit(self, version, ops):
+        if self.fail_commits:
+            self.fail_commits -= 1
+            return S_ERROR("Injected commit failure")
+        if version != self.options[VERSION_PATH]:
+            return S_ERROR("Data was modified since the copy was downloaded")
+        for operation, path, value in ops:
+            if operation == 'delSection':
+                prefix = path + '/'
+                self.options = {option: val for option, val in self.options.items()
+                                if not option.startswith(prefix)}
+                self.sections = {section for section in self.sections
+                                 if section != path and not section.startswith(prefix)}
+            elif operation == 'delOption':
+                self.options.pop(path, None)
+            else:
+                self.options[path] = value
+        self.commits.append(list(ops))
+        self._bump()
+        return S_OK()
+
+
+class FakeCS(ConfigurationSystem):
+    """ConfigurationSystem talking to a FakeMaster instead of the configuration server."""
+
+    master = None
+    _copy = None
+
+    def initialize(self):
+        # As CSAPI.initialize, which CSAPI.__init__ already calls, only the first call downloads
+        if self._copy is not None:
+            return S_OK()
+        self._pending = []
+        self._copy = self.master.copy()
+        return S_OK()
+
+    def downloadCSData(self):
+        self._pending = []
+        self._copy = self.master.copy()
+        return S_OK()
+
+    def getCurrentCFG(self):
+        options, sections = self._copy
+        return S_OK(FakeCFG(options, sections))
+
+    def _master_version(self):
+        return self.master.options[VERSION_PATH]
+
+    def setOption(self, path, value):
+        self._pending.append(('setOption', path, value))
+        return S_OK()
+
+    def modifyValue(self, path, value):
+        self._pending.append(('modifyValue', path, value))
+        return S_OK()
+
+    def delOption(self, path):
+        self._pending.append(('delOption', path, None))
+        return S_OK()
+
+    def delSection(self, path):
+        self._pending.append(('delSection', path, None))
+        return S_OK()
+
+
+def _csapi_commit(self):
+    """Stands in for CSAPI.commit: send the pending operations to the master."""
+    result = self.master.commit(self._copy[0][VERSION_PATH], self._pending)
+    self._pending = []
+    if result['OK']:
+        # CSAPI.commit downloads the committed CFG
+        self._copy = self.master.copy()
+    return result
+
+
+@pytest.fixture
+def master(monkeypatch):
+    """A FakeMaster, with ConfigurationSystem's shared state and settings reset around the test."""
+    master = FakeMaster()
+    monkeypatch.setattr(FakeCS, 'master', master)
+    monkeypatch.setattr(cs_module.CSAPI, 'commit', _csapi_commit)
+    monkeypatch.setattr(cs_module.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(ConfigurationSystem, '_sweeper', StalenessSweeper())
+    monkeypatch.setattr(ConfigurationSystem, '_replicas', {})
+    for name in ('commit_batch_size', 'commit_max_batch_size', 'commit_target_time', 'commit_retries',
+                 'journal_path', 'last_seen_store', 'last_seen_sync_days', 'change_log_path'):
+        monkeypatch.setattr(ConfigurationSystem, name, getattr(ConfigurationSystem, name))
+    return master
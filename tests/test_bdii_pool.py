@@ -0,0 +1,215 @@
+"""Tests of the BDIIPool against local fake BDIIs queried through ldapsearch."""
+import os
+import select
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+
+import pytest
+
+from DIRAC import S_ERROR, S_OK
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.BDIIPool import BDIIPool, split_host
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.Deadline import (
+    CancelToken, StageCancelled, cancel_scope)
+
+FILTER = '(objectClass=GLUE2ComputingService)'
+
+# Stands in for ldapsearch: sends the filter to the -H server and prints its LDIF answer.
+LDAPSEARCH = '''#!%s
+import socket, sys
+host, port = sys.argv[sys.argv.index('-H') + 1][len('ldap://'):].rsplit(':', 1)
+try:
+    conn = socket.create_connection((host, int(port)))
+except OSError as err:
+    sys.stderr.write('ldap_sasl_bind(SIMPLE): Can\\'t contact LDAP server (-1): %%s\\n' %% err)
+    sys.exit(255)
+conn.sendall((sys.argv[-1] + '\\n').encode())
+answer = b''.join(iter(lambda: conn.recv(65536), b''))
+sys.stdout.buffer.write(answer)
+'''
+
+
+class FakeBDII(socketserver.ThreadingTCPServer):
+    """A local BDII answering every query with num_entries entries after delay seconds."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, delay=0., num_entries=3):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), FakeBDIIHandler)
+        self.delay = delay
+        self.num_entries = num_entries
+        self.queries = []
+        self.hung_up = []
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def host(self):
+        return '127.0.0.1:%d' % self.server_address[1]
+
+
+class FakeBDIIHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.server.queries.append((time.time(), self.rfile.readline().decode().strip()))
+        # ldapsearch sends nothing more, the connection only turns readable if it is killed
+        if select.select([self.connection], [], [], self.server.delay)[0]:
+            self.server.hung_up.append(time.time())
+            return
+        ldif = ''.join('dn: GLUE2ServiceID=svc%d,o=glue\nGLUE2ServiceType: org.nordugrid.arex\n\n' % i
+                       for i in range(self.server.num_entries))
+        try:
+            self.wfile.write(ldif.encode())
+        except OSError:
+            pass  # the ldapsearch was killed
+
+
+@pytest.fixture
+def bdiis(tmp_path, monkeypatch):
+    """Start fake BDIIs with the given delays and entry counts, ldapsearch talking to them."""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    script = bin_dir / 'ldapsearch'
+    script.write_text(LDAPSEARCH % sys.executable)
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep + os.environ['PATH'])
+    servers = []
+
+    def start(*specs):
+        for delay, num_entries in specs:
+            servers.append(FakeBDII(delay, num_entries))
+        return servers[-len(specs):]
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def _closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return '127.0.0.1:%d' % port
+
+
+def test_split_host():
+    """The port defaults to the BDII's 2170."""
+    assert split_host('topbdii.grid.hep.ph.ic.ac.uk') == ('topbdii.grid.hep.ph.ic.ac.uk', 2170)
+    assert split_host('lcg-bdii.egi.eu:2180') == ('lcg-bdii.egi.eu', 2180)
+
+
+def test_queries_fan_out_concurrently(bdiis):
+    """The raced hosts are queried at once and the fastest answer is returned."""
+    slow, fast = bdiis((1.5, 3), (0.1, 3))
+    pool = BDIIPool([slow.host, fast.host], race=2, timeout=10)
+    start = time.time()
+    ret = pool.search_s(base='o=glue', filterstr=FILTER)
+    assert time.time() - start < 1.2
+    assert [dn for dn, _ in ret] == ['GLUE2ServiceID=svc%d,o=glue' % i for i in range(3)]
+    assert ret[0][1] == {'GLUE2ServiceType': ['org.nordugrid.arex']}
+    assert slow.queries and fast.queries
+    assert abs(slow.queries[0][0] - fast.queries[0][0]) < 0.5
+    assert slow.queries[0][1] == FILTER
+
+
+def test_losers_are_killed_once_the_race_is_won(bdiis):
+    """The queries still running once an answer is accepted are killed without blaming their hosts."""
+    slow, fast, spare = bdiis((30, 3), (0.1, 3), (0., 3))
+    pool = BDIIPool([slow.host, fast.host, spare.host], race=2, timeout=60)
+    assert len(pool.search_s(base='o=glue', filterstr=FILTER)) == 3
+    deadline = time.time() + 5
+    while not slow.hung_up and time.time() < deadline:
+        time.sleep(0.05)
+    assert slow.hung_up
+    assert not pool._quarantined
+    # The loser ran for at least as long as the winner, so the untried host now goes first
+    assert pool.ranked()[0] == spare.host
+    assert not spare.queries
+
+
+def test_timed_out_host_is_killed_and_quarantined(bdiis):
+    """A host not answering within the per host timeout fails over to the next one."""
+    stuck, ok = bdiis((30, 3), (0.1, 3))
+    pool = BDIIPool([stuck.host, ok.host], race=1, timeout=0.5)
+    start = time.time()
+    assert len(pool.search_s(base='o=glue', filterstr=FILTER)) == 3
+    assert time.time() - start < 5
+    assert ok.queries
+    assert pool.ranked() == [ok.host, stuck.host]
+
+
+def test_cancellation_stops_the_race(bdiis):
+    """Cancelling the caller's token kills the queries without blaming the hosts."""
+    slow1, slow2 = bdiis((30, 3), (30, 3))
+    pool = BDIIPool([slow1.host, slow2.host], race=2, timeout=60)
+    token = CancelToken()
+    threading.Timer(0.5, token.cancel).start()
+    start = time.time()
+    with cancel_scope(token), pytest.raises(StageCancelled):
+        pool.search_s(base='o=glue', filterstr=FILTER)
+    assert time.time() - start < 5
+    assert not pool._quarantined
+
+
+def test_deadline_bounds_the_host_timeout(bdiis):
+    """A stage deadline shorter than the pool timeout cancels the queries at the deadline."""
+    slow, = bdiis((30, 3))
+    pool = BDIIPool([slow.host], timeout=60)
+    start = time.time()
+    with cancel_scope(CancelToken(0.5)), pytest.raises(StageCancelled):
+        pool.search_s(base='o=glue', filterstr=FILTER)
+    assert time.time() - start < 5
+
+
+def test_fallback_order(bdiis):
+    """Failed hosts are tried last, in ranked order, and only if the others fail."""
+    first, second = bdiis((0.3, 3), (0., 3))
+    down = _closed_port()
+    pool = BDIIPool([down, first.host, second.host], race=1, timeout=10)
+    assert pool.ranked() == [down, first.host, second.host]
+    assert len(pool.search_s(base='o=glue', filterstr=FILTER)) == 3
+    assert down in pool._quarantined
+    assert first.queries and not second.queries
+    # The quarantined host goes last, untried hosts before those known to be slower
+    assert pool.ranked() == [second.host, first.host, down]
+    pool.search_s(base='o=glue', filterstr='(objectClass=GLUE2ComputingShare)')
+    assert len(first.queries) == 1 and second.queries
+    assert pool.ranked() == [second.host, first.host, down]
+
+
+def test_every_host_down():
+    """The last error is reported if no host answers."""
+    pool = BDIIPool([_closed_port(), _closed_port()], race=2, timeout=10)
+    with pytest.raises(RuntimeError):
+        pool.search_s(base='o=glue', filterstr=FILTER)
+
+
+def test_partial_answer_fails_over(bdiis):
+    """An answer well short of the usual count is only used if every host answers short."""
+    full, partial = bdiis((0.3, 10), (0., 10))
+    pool = BDIIPool([partial.host, full.host], race=1, timeout=10)
+    assert len(pool.search_s(base='o=glue', filterstr=FILTER)) == 10
+    partial.num_entries = 2
+    assert len(pool.search_s(base='o=glue', filterstr=FILTER)) == 10
+    assert full.queries
+    full.num_entries = 3
+    assert len(pool.search_s(base='o=glue', filterstr=FILTER)) == 3
+
+
+def test_failover():
+    """failover calls each ranked host until one returns S_OK."""
+    pool = BDIIPool(['a:2170', 'b:2170', 'c:2170'])
+    calls = []
+
+    def get_info(vo, host):
+        calls.append(host)
+        return S_OK(vo) if host == 'b:2170' else S_ERROR('down')
+    assert pool.failover(get_info, 'lz')['Value'] == 'lz'
+    assert calls == ['a:2170', 'b:2170']
+    assert pool.ranked() == ['c:2170', 'b:2170', 'a:2170']
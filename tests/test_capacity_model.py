@@ -0,0 +1,107 @@
+"""Tests of the EWMA capacity model."""
+import json
+import time
+
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools import Glue2ARCAPI
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.CapacityModel import CapacityModel, int_attr
+
+ARC_SERVICE = ('GLUE2ServiceID=urn:ogf:ComputingService:arc.a.ac.uk:arex,GLUE2GroupID=resource,'
+               'GLUE2DomainID=SITE-A,GLUE2GroupID=grid,o=glue')
+
+
+def _arc_share(vo, running, waiting):
+    return ('GLUE2ShareID=grid_%s,' % vo + ARC_SERVICE,
+            {'GLUE2ShareID': ['grid_%s' % vo], 'GLUE2ComputingShareMappingQueue': ['grid'],
+             'GLUE2ComputingShareRunningJobs': [str(running)], 'GLUE2ComputingShareWaitingJobs': [str(waiting)],
+             'GLUE2ComputingShareTotalJobs': [str(running + waiting)]})
+
+
+def test_observe_smooths_with_alpha():
+    """The newest observation is weighted by alpha."""
+    model = CapacityModel(alpha=0.5)
+    model.observe('ce/q', running=100, waiting=0, total=100, cpus=200)
+    share = model.observe('ce/q', running=200, waiting=20, total=220, cpus=200)
+    assert (share.Running, share.Waiting, share.Total, share.CPUs) == (150., 10., 160., 200.)
+
+
+def test_limits():
+    """Idle slots plus the waiting fraction, less the backlog, clamped."""
+    model = CapacityModel(waiting_fraction=0.1, min_waiting=10, max_waiting=5000)
+    assert model.limits('ce/q') is None
+    # 100 idle + 100 fraction - 50 waiting
+    assert model.update('ce/q', running=900, waiting=50, total=950, cpus=1000) == (1150, 150)
+    # A full queue with a large backlog still gets min_waiting
+    assert model.update('ce/full', running=1000, waiting=5000, cpus=1000) == (1010, 10)
+    # Nothing known about the size
+    assert model.update('ce/empty') is None
+
+
+def test_max_total_is_capped():
+    """MaxTotalJobs never exceeds total_factor * max_waiting."""
+    model = CapacityModel(max_waiting=100, total_factor=1.5)
+    assert model.update('ce/q', running=0, cpus=10000) == (150, 100)
+
+
+def test_save_and_load(tmp_path):
+    """The state survives a restart, shares older than max_age are dropped."""
+    state_file = str(tmp_path / 'capacity.json')
+    model = CapacityModel(state_file)
+    model.observe('ce/q', running=10, waiting=1, total=11, cpus=20)
+    model.save()
+
+    with open(state_file) as state:
+        raw = json.load(state)
+    raw['ce/old'] = dict(raw['ce/q'], Updated=time.time() - 8 * 86400)
+    with open(state_file, 'w') as state:
+        json.dump(raw, state)
+
+    reloaded = CapacityModel(state_file, max_age=7)
+    assert reloaded.limits('ce/q') == model.limits('ce/q')
+    assert reloaded.limits('ce/old') is None
+
+
+def test_corrupt_state_is_ignored(tmp_path):
+    """A corrupt state file starts the model afresh."""
+    state_file = tmp_path / 'capacity.json'
+    state_file.write_text('{not json')
+    assert CapacityModel(str(state_file)).limits('ce/q') is None
+
+
+def test_int_attr():
+    """The first ldap value as an int, else the default."""
+    assert int_attr({'GLUE2ComputingShareRunningJobs': ['12']}, 'GLUE2ComputingShareRunningJobs') == 12
+    assert int_attr({'GLUE2ComputingShareRunningJobs': ['n/a']}, 'GLUE2ComputingShareRunningJobs', 3) == 3
+    assert int_attr({}, 'GLUE2ComputingShareRunningJobs') == 0
+
+
+def test_discard_drops_unsaved_observations(tmp_path):
+    """Observations are only kept once saved, as after a successful commit."""
+    model = CapacityModel(str(tmp_path / 'capacity.json'), alpha=0.5)
+    model.observe('ce/q', running=100, cpus=200)
+    model.save()
+    model.observe('ce/q', running=200, cpus=200)
+    model.discard()
+    assert model.observe('ce/q', running=200, cpus=200).Running == 150.
+    assert CapacityModel(str(tmp_path / 'capacity.json')).limits('ce/q') == (320, 120)
+
+
+def test_arc_shares_of_a_queue_are_observed_once(tmp_path):
+    """The load of the shares mapped to one ARC queue is summed and observed once per cycle."""
+    results = {'services': [(ARC_SERVICE, {})],
+               'managers': [('GLUE2ManagerID=m,' + ARC_SERVICE,
+                             {'GLUE2ManagerProductName': ['condor'],
+                              'GLUE2ComputingManagerTotalLogicalCPUs': ['1000']})],
+               'shares': [_arc_share('atlas', 600, 20), _arc_share('lhcb', 300, 30)],
+               'policies': [('GLUE2PolicyID=p,GLUE2ShareID=grid_%s,' % vo + ARC_SERVICE,
+                             {'GLUE2PolicyRule': ['VO:%s' % vo]}) for vo in ('atlas', 'lhcb')],
+               'environments': []}
+    model = CapacityModel(str(tmp_path / 'capacity.json'), alpha=0.5)
+    queues = Glue2ARCAPI._get_arc_ces(results, capacity_model=model).sites['SITE-A'].ces['arc.a.ac.uk'].queues
+    queue = queues['nordugrid-condor-grid'].as_dict()
+    assert queue['VO'] == {'atlas', 'lhcb'}
+    # 100 idle + 100 fraction - 50 waiting, as if a single share
+    assert (queue['MaxTotalJobs'], queue['MaxWaitingJobs']) == (1150, 150)
+    state = model._state['arc.a.ac.uk/nordugrid-condor-grid']
+    assert (state.Running, state.Waiting, state.Total) == (900., 50., 950.)
+    # Nothing is persisted until the caller saves the model after committing
+    assert not (tmp_path / 'capacity.json').exists()
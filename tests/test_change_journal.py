@@ -0,0 +1,86 @@
+"""Tests of the CS change set journal and its replay."""
+import pytest
+
+from DIRAC import S_ERROR
+
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.ChangeJournal import ChangeJournal
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.ConfigurationSystem import ConfigurationSystem
+
+from conftest import FakeCS
+
+OPS = [('delSection', '/Registry/Hosts/old', None, None),
+       ('setOption', '/Registry/Hosts/new/DN', None, '/CN=new'),
+       ('modifyValue', '/Registry/Hosts/vm/DN', '/CN=a', '/CN=b')]
+
+
+def test_pending(tmp_path):
+    """The ops after the last committed record are pending, at that record's version."""
+    journal = ChangeJournal(str(tmp_path / 'journal.jsonl'))
+    assert journal.pending() is None
+    journal.begin('10', OPS)
+    assert journal.pending().Version == '10'
+    assert journal.pending().Ops == OPS
+    journal.committed(1, '11')
+    assert journal.pending()[:2] == ('11', OPS[1:])
+    journal.committed(3, '12')
+    assert journal.pending() is None
+    journal.clear()
+    journal.clear()
+
+
+def test_torn_line_is_ignored(tmp_path):
+    """A partially written last record does not lose the change set."""
+    path = tmp_path / 'journal.jsonl'
+    journal = ChangeJournal(str(path))
+    journal.begin('10', OPS)
+    journal.committed(1, '11')
+    with open(str(path), 'a') as torn:
+        torn.write('{"type": "committed", "cou')
+    assert journal.pending()[:2] == ('11', OPS[1:])
+
+
+def test_begin_replaces_the_previous_change_set(tmp_path):
+    """Only the latest change set is pending."""
+    journal = ChangeJournal(str(tmp_path / 'journal.jsonl'))
+    journal.begin('10', OPS)
+    journal.begin('20', OPS[:1])
+    assert journal.pending()[:2] == ('20', OPS[:1])
+
+
+def _add_hosts(cfg_system, num_hosts):
+    for i in range(num_hosts):
+        cfg_system.add('/Registry/Hosts/vm%d' % i, 'DN', '/CN=vm%d' % i)
+
+
+def test_interrupted_commit_is_replayed(master, tmp_path):
+    """The batches left after a failed one are committed by replay_journal."""
+    ConfigurationSystem.configure(journal_path=str(tmp_path / 'journal.jsonl'), commit_batch_size=1,
+                                  commit_max_batch_size=1, commit_retries=0)
+    cfg_system = FakeCS()
+    _add_hosts(cfg_system, 4)
+    commit = master.commit
+    calls = []
+
+    def fail_third(version, ops):
+        calls.append(ops)
+        if len(calls) == 3:
+            return S_ERROR('Injected commit failure')
+        return commit(version, ops)
+    master.commit = fail_third
+    with pytest.raises(RuntimeError):
+        cfg_system.commit()
+    master.commit = commit
+    assert len(master.commits) == 2
+
+    assert FakeCS().replay_journal() == 2
+    assert all(master.options['/Registry/Hosts/vm%d/DN' % i] == '/CN=vm%d' % i for i in range(4))
+    assert ChangeJournal(ConfigurationSystem.journal_path).pending() is None
+
+
+def test_stale_journal_is_dropped(master, tmp_path):
+    """A journal computed against an older CS version is not replayed."""
+    ConfigurationSystem.configure(journal_path=str(tmp_path / 'journal.jsonl'))
+    ChangeJournal(ConfigurationSystem.journal_path).begin('0', [('setOption', '/Registry/Hosts/vm/DN', None, 'x')])
+    assert FakeCS().replay_journal() == 0
+    assert '/Registry/Hosts/vm/DN' not in master.options
+    assert ChangeJournal(ConfigurationSystem.journal_path).pending() is None
@@ -0,0 +1,91 @@
+"""Tests of the structured CS change log."""
+import json
+import threading
+
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.ChangeLog import (
+    ChangeLog, ChangeRecord, change_stage, current_stage)
+
+SITE = '/Resources/Sites/LCG/LCG.UKI-A.uk'
+
+
+def _lines(path):
+    with open(path) as change_log:
+        return [json.loads(line) for line in change_log]
+
+
+def test_section():
+    """A deleted section is its own section, an option's its parent."""
+    assert ChangeRecord('delSection', SITE, None, None, None).Section == SITE
+    assert ChangeRecord('setOption', SITE + '/CE', 'a', 'b', None).Section == SITE
+
+
+def test_flush_writes_one_block(tmp_path):
+    """A commit header, the records and a summary per section are appended once."""
+    path = str(tmp_path / 'cs_changes.jsonl')
+    log = ChangeLog(path)
+    log.flush()
+    assert not (tmp_path / 'cs_changes.jsonl').exists()
+
+    log.record('setOption', SITE + '/CE', 'ce1', 'ce1, ce2', 'update_htcondor_ces')
+    log.record('createSection', SITE + '/CEs/ce2', None, None, 'update_htcondor_ces')
+    log.record('setOption', SITE + '/Name', None, 'UKI-A', None)
+    assert len(log) == 3
+    log.flush()
+    assert len(log) == 0
+    lines = _lines(path)
+    assert lines[0]['type'] == 'commit' and lines[0]['changes'] == lines[0]['sampled'] == 3
+    assert [line['path'] for line in lines[1:4]] == [SITE + '/CE', SITE + '/CEs/ce2', SITE + '/Name']
+    assert lines[1]['old'] == 'ce1' and lines[1]['stage'] == 'update_htcondor_ces'
+    assert lines[4:] == [{'type': 'section', 'section': SITE, 'ops': {'setOption': 2},
+                          'stages': [None, 'update_htcondor_ces']},
+                         {'type': 'section', 'section': SITE + '/CEs', 'ops': {'createSection': 1},
+                          'stages': ['update_htcondor_ces']}]
+
+    log.record('removeOption', SITE + '/Name', 'UKI-A', None, None)
+    log.flush()
+    assert len(_lines(path)) == 9
+
+
+def test_sample_is_stable(tmp_path):
+    """The same paths are sampled every commit, the summary still covering them all."""
+    path = str(tmp_path / 'cs_changes.jsonl')
+    log = ChangeLog(path, sample=0.3)
+    paths = ['%s/CEs/ce%d/LastSeen' % (SITE, index) for index in range(200)]
+    sampled = []
+    for _ in range(2):
+        for option in paths:
+            log.record('setOption', option, None, '01/05/2024', 'vac')
+        log.flush()
+    lines = _lines(path)
+    commits = [index for index, line in enumerate(lines) if line['type'] == 'commit']
+    for start in commits:
+        assert lines[start]['changes'] == 200
+        sampled.append([line['path'] for line in lines[start + 1:start + 1 + lines[start]['sampled']]])
+    assert sampled[0] == sampled[1] and 20 < len(sampled[0]) < 100
+    assert sum(line['type'] == 'section' for line in lines) == 400
+
+
+def test_without_path(tmp_path):
+    """Without a path nothing is written and the buffer is still cleared."""
+    log = ChangeLog()
+    log.record('setOption', SITE + '/CE', None, 'ce1', None)
+    log.flush()
+    assert len(log) == 0
+    log = ChangeLog(str(tmp_path / 'missing' / 'cs_changes.jsonl'))
+    log.record('setOption', SITE + '/CE', None, 'ce1', None)
+    log.flush()
+    assert len(log) == 0
+
+
+def test_change_stage_is_per_thread():
+    """The stage is that of the innermost block, in this thread only."""
+    seen = []
+    assert current_stage() is None
+    with change_stage('update_ses'):
+        with change_stage('vac'):
+            thread = threading.Thread(target=lambda: seen.append(current_stage()))
+            thread.start()
+            thread.join()
+            assert current_stage() == 'vac'
+        assert current_stage() == 'update_ses'
+    assert current_stage() is None and seen == [None]
@@ -0,0 +1,282 @@
+"""Tests of the snapshot diffing ConfigurationSystem."""
+import pytest
+
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools import ConfigurationSystem as cs_module
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.ConfigurationSystem import (
+    ChangeList, ConfigurationSystem, absolute_path, flatten_cfg, resource_changes)
+
+from conftest import FakeCS, _csapi_commit
+
+SITE = '/Resources/Sites/VAC/VAC.UKI-A.uk'
+CE = SITE + '/CEs/vac.a.ac.uk'
+
+
+def _ops(cfg_system):
+    return [op[:2] for op in cfg_system.diff()]
+
+
+def test_flatten_cfg():
+    """Nested sections become absolute option and section paths."""
+    options, sections = flatten_cfg({'Registry': {'Hosts': {'vm': {'DN': '/CN=vm'}}, 'DefaultGroup': 'user'}})
+    assert options == {'/Registry/Hosts/vm/DN': '/CN=vm', '/Registry/DefaultGroup': 'user'}
+    assert sections == {'/Registry', '/Registry/Hosts', '/Registry/Hosts/vm'}
+
+
+def test_absolute_path():
+    """Relative and absolute paths index the same."""
+    assert absolute_path('Resources/Sites') == absolute_path('/Resources/Sites') == '/Resources/Sites'
+
+
+def test_diff_only_has_real_changes(master):
+    """Unchanged values are not set again, changed and new ones are."""
+    master.options.update({CE + '/CEType': 'Vac', CE + '/OS': 'EL8'})
+    cfg_system = FakeCS()
+    cfg_system.add(CE, 'CEType', 'Vac')
+    cfg_system.add(CE, 'OS', 'EL9')
+    cfg_system.add(CE, 'Queues', {'default': {'maxCPUTime': 400000}})
+    assert cfg_system.diff() == [('modifyValue', CE + '/OS', 'EL8', 'EL9'),
+                                 ('setOption', CE + '/Queues/default/maxCPUTime', None, '400000')]
+
+
+def test_relative_paths_match_the_snapshot(master):
+    """Options added under relative paths diff against the absolute snapshot."""
+    master.options.update({SITE + '/CE': 'old.a.ac.uk, vac.a.ac.uk', CE + '/OS': 'EL9'})
+    cfg_system = FakeCS()
+    relative_ce = CE.lstrip('/')
+    assert cfg_system.get_value(relative_ce + '/OS') == 'EL9'
+    cfg_system.add(relative_ce, 'OS', 'EL9')
+    cfg_system.append_unique(SITE.lstrip('/'), 'CE', 'vac.a.ac.uk')
+    cfg_system._merge_appends()
+    assert cfg_system.diff() == []
+
+    cfg_system.append_unique(SITE.lstrip('/'), 'CE', 'new.a.ac.uk')
+    cfg_system._merge_appends()
+    assert cfg_system.diff() == [('modifyValue', SITE + '/CE', 'old.a.ac.uk, vac.a.ac.uk',
+                                  'new.a.ac.uk, old.a.ac.uk, vac.a.ac.uk')]
+
+
+def test_append_keeps_duplicates_and_order(master):
+    """append adds onto the existing values, append_unique merges them."""
+    master.options.update({SITE + '/SE': 'SE-B, SE-A'})
+    cfg_system = FakeCS()
+    cfg_system.append(SITE, 'SE', 'SE-A')
+    cfg_system.append_unique(SITE, 'Other', ['x', 'x', 'y'])
+    cfg_system._merge_appends()
+    assert cfg_system.get_value(SITE + '/SE') == 'SE-A, SE-A, SE-B'
+    assert cfg_system.get_value(SITE + '/Other') == 'x, y'
+
+
+def test_remove(master):
+    """Option, value and section removals, deletions coming first."""
+    master.options.update({SITE + '/CE': 'a, b', SITE + '/Name': 'A', CE + '/OS': 'EL9',
+                           '/Registry/Hosts/vm/DN': '/CN=vm'})
+    cfg_system = FakeCS()
+    cfg_system.remove(SITE, 'CE', 'a')
+    cfg_system.remove(SITE, 'Name')
+    cfg_system.remove('Registry/Hosts/vm')
+    cfg_system.add('/Registry/Hosts/vm', 'DN', '/CN=vm2')
+    assert cfg_system.get_value(SITE + '/Name') is None
+    assert _ops(cfg_system) == [('delSection', '/Registry/Hosts/vm'),
+                                ('delOption', SITE + '/Name'),
+                                ('setOption', '/Registry/Hosts/vm/DN'),
+                                ('modifyValue', SITE + '/CE')]
+
+
+def test_options_in_removed_sections_are_gone(master):
+    """Nothing under a removed section is read back or diffed."""
+    master.options.update({CE + '/OS': 'EL9'})
+    cfg_system = FakeCS()
+    cfg_system.add(CE, 'CEType', 'Vac')
+    cfg_system.remove(SITE)
+    assert cfg_system.get_value(CE + '/OS') is None
+    assert _ops(cfg_system) == [('delSection', SITE)]
+
+
+def test_commit(master):
+    """The diff is committed to the master, an unchanged second session commits nothing."""
+    master.options.update({CE + '/OS': 'EL8'})
+    cfg_system = FakeCS()
+    cfg_system.add(CE.lstrip('/'), 'OS', 'EL9')
+    cfg_system.add(CE, 'CEType', 'Vac')
+    cfg_system.commit()
+    assert master.options[CE + '/OS'] == 'EL9'
+    assert master.options[CE + '/CEType'] == 'Vac'
+
+    cfg_system = FakeCS()
+    cfg_system.add(CE.lstrip('/'), 'OS', 'EL9')
+    cfg_system.add(CE, 'CEType', 'Vac')
+    num_commits = len(master.commits)
+    cfg_system.commit()
+    assert len(master.commits) == num_commits
+
+
+def test_change_list_replays_in_order(master):
+    """A ChangeList applies its recorded calls in order."""
+    changes = ChangeList()
+    changes.add(CE, 'OS', 'EL9')
+    changes.remove(CE, 'OS')
+    changes.append_unique(SITE, 'CE', (ce for ce in ['vac.a.ac.uk']))
+    cfg_system = FakeCS()
+    changes.apply(cfg_system)
+    cfg_system._merge_appends()
+    assert _ops(cfg_system) == [('setOption', SITE + '/CE')]
+
+
+def test_resource_changes():
+    """Changes are attributed to the deepest resource, new ones counting as added."""
+    ops = [('setOption', CE + '/Queues/q/VO', None, 'lz'),
+           ('modifyValue', SITE + '/Name', 'a', 'b'),
+           ('delSection', '/Registry/Hosts/vm', None, None),
+           ('setOption', '/Resources/StorageElements/SE-A/Host', None, 'se')]
+    assert resource_changes(ops, {SITE, CE, '/Registry/Hosts/vm'}) == {
+        CE: ('ce', 'changed'),
+        SITE: ('site', 'changed'),
+        '/Registry/Hosts/vm': ('host', 'removed'),
+        '/Resources/StorageElements/SE-A': ('se', 'added')}
+
+
+def _many_ces(cfg_system, num_ces, num_options=3):
+    for i in range(num_ces):
+        for j in range(num_options):
+            cfg_system.add('%s/CEs/ce%02d' % (SITE, i), 'Option%d' % j, i * j)
+
+
+def test_batches_keep_sections_whole(master):
+    """Batches hold about commit_batch_size changes, never splitting a section."""
+    ConfigurationSystem.configure(commit_batch_size=5, commit_max_batch_size=5)
+    cfg_system = FakeCS()
+    _many_ces(cfg_system, 6)
+    cfg_system.commit()
+    assert [len(batch) for batch in master.commits] == [3, 3, 3, 3, 3, 3]
+    for batch in master.commits:
+        assert len({path.rsplit('/', 1)[0] for _, path, _ in batch}) == 1
+    assert sum(1 for path in master.options if path.startswith(SITE)) == 18
+
+
+def test_batch_size_adapts_to_commit_time(master, monkeypatch):
+    """Slow commits halve the batch size, fast ones grow it."""
+    ConfigurationSystem.configure(commit_batch_size=4, commit_target_time=10.)
+    cfg_system = FakeCS()
+    _many_ces(cfg_system, 8, num_options=2)
+    clock = [0.]
+    durations = iter([30., 30., 1., 1., 1., 1.])
+    commit = master.commit
+
+    def slow_commit(version, ops):
+        clock[0] += next(durations)
+        return commit(version, ops)
+    monkeypatch.setattr(cs_module.time, 'time', lambda: clock[0])
+    monkeypatch.setattr(master, 'commit', slow_commit)
+    cfg_system.commit()
+    # 4 -> 2 -> 1, a batch always holds at least one whole CE, then 1 -> 2 -> 4 -> 7
+    assert [len(batch) for batch in master.commits] == [4, 2, 2, 2, 4, 2]
+
+
+def test_failed_batch_resumes(master):
+    """A batch failing every retry stops the commit, committing again resumes from it."""
+    ConfigurationSystem.configure(commit_batch_size=3, commit_max_batch_size=3, commit_retries=1)
+    cfg_system = FakeCS()
+    _many_ces(cfg_system, 3)
+    master.fail_commits = 1
+    cfg_system.commit()
+    assert len(master.commits) == 3
+
+    cfg_system = FakeCS()
+    _many_ces(cfg_system, 3, num_options=4)
+    master.fail_commits = 100
+    with pytest.raises(RuntimeError):
+        cfg_system.commit()
+    master.fail_commits = 0
+    cfg_system.commit()
+    assert all(master.options.get('%s/CEs/ce%02d/Option3' % (SITE, i)) == str(i * 3) for i in range(3))
+
+
+def test_commit_rebases_onto_concurrent_changes(master):
+    """Changes another writer made since the snapshot are kept, conflicts reported."""
+    master.options.update({'/Registry/Hosts/vm1/DN': '/CN=a', '/Registry/Hosts/vm2/DN': '/CN=a'})
+    cfg_system = FakeCS()
+    cfg_system.add('/Registry/Hosts/vm1', 'DN', '/CN=ours')
+    cfg_system.add('/Registry/Hosts/vm2', 'DN', '/CN=same')
+    cfg_system.add('/Registry/Hosts/vm3', 'DN', '/CN=new')
+    master.write('/Registry/Hosts/vm1/DN', '/CN=theirs')
+    master.write('/Registry/Hosts/vm2/DN', '/CN=same')
+    cfg_system.commit()
+    assert master.options['/Registry/Hosts/vm1/DN'] == '/CN=theirs'
+    assert master.options['/Registry/Hosts/vm3/DN'] == '/CN=new'
+    assert [conflict.Path for conflict in cfg_system.conflicts] == ['/Registry/Hosts/vm1/DN']
+
+
+def test_removed_section_changed_by_another_writer_is_kept(master):
+    """A section is not removed if another writer changed it since the snapshot."""
+    master.options.update({'/Registry/Hosts/vm1/DN': '/CN=a'})
+    cfg_system = FakeCS()
+    cfg_system.remove('/Registry/Hosts/vm1')
+    master.write('/Registry/Hosts/vm1/Properties', 'GenericPilot')
+    cfg_system.commit()
+    assert master.options['/Registry/Hosts/vm1/DN'] == '/CN=a'
+    assert cfg_system.conflicts[0].Path == '/Registry/Hosts/vm1'
+
+
+@pytest.mark.parametrize('journal', [False, True])
+def test_concurrent_change_between_batches_is_not_overwritten(master, tmp_path, journal):
+    """A batch is rebased onto changes made after the previous batch was committed."""
+    ConfigurationSystem.configure(commit_batch_size=1, commit_max_batch_size=1,
+                                  journal_path=str(tmp_path / 'journal.jsonl') if journal else None)
+    master.options.update({'/Registry/Hosts/vm1/DN': '/CN=a'})
+    cfg_system = FakeCS()
+    cfg_system.add('/Registry/Hosts/vm0', 'DN', '/CN=vm0')
+    cfg_system.add('/Registry/Hosts/vm1', 'DN', '/CN=ours')
+    commit = master.commit
+
+    def commit_then_write(version, ops):
+        result = commit(version, ops)
+        if len(master.commits) == 1:
+            master.write('/Registry/Hosts/vm1/DN', '/CN=theirs')
+        return result
+    master.commit = commit_then_write
+    cfg_system.commit()
+    assert master.options['/Registry/Hosts/vm0/DN'] == '/CN=vm0'
+    assert master.options['/Registry/Hosts/vm1/DN'] == '/CN=theirs'
+    assert [conflict.Path for conflict in cfg_system.conflicts] == ['/Registry/Hosts/vm1/DN']
+
+
+def test_uncontended_commit_does_not_download_again(master):
+    """The CS is only downloaded again on commit, besides CSAPI.commit's reload, if the master moved on."""
+    cfg_system = FakeCS()
+    cfg_system.add('/Registry/Hosts/vm1', 'DN', '/CN=vm1')
+    cfg_system.commit()
+    assert master.downloads == 2
+    assert master.options['/Registry/Hosts/vm1/DN'] == '/CN=vm1'
+
+    cfg_system = FakeCS()
+    cfg_system.add('/Registry/Hosts/vm2', 'DN', '/CN=vm2')
+    master.write('/Registry/Hosts/vm3/DN', '/CN=vm3')
+    cfg_system.commit()
+    assert master.downloads == 5
+    assert master.options['/Registry/Hosts/vm2/DN'] == '/CN=vm2'
+
+
+def test_batches_only_download_when_the_master_moved_on(master, monkeypatch):
+    """Each batch is based on the CFG CSAPI.commit reloads, unless another writer got in since."""
+    ConfigurationSystem.configure(commit_batch_size=1, commit_max_batch_size=1)
+    cfg_system = FakeCS()
+    for i in range(4):
+        cfg_system.add('/Registry/Hosts/vm%d' % i, 'DN', '/CN=vm%d' % i)
+    cfg_system.commit()
+    assert len(master.commits) == 4
+    assert master.downloads == 1 + 4
+
+    cfg_system = FakeCS()
+    for i in range(3):
+        cfg_system.add('/Registry/Hosts/vm%d' % i, 'DN', '/CN=new%d' % i)
+
+    def commit_then_write(self):
+        result = _csapi_commit(self)
+        master.write('/Registry/Hosts/other/DN', '/CN=other')
+        return result
+    monkeypatch.setattr(cs_module.CSAPI, 'commit', commit_then_write)
+    master.downloads = 0
+    cfg_system.commit()
+    # Each reload is already behind the master, so the following batches are rebased first
+    assert master.downloads == 3 + 2
+    assert all(master.options['/Registry/Hosts/vm%d/DN' % i] == '/CN=new%d' % i for i in range(3))
@@ -0,0 +1,75 @@
+"""Tests of the local indexed CS replica."""
+from datetime import date
+
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.CSReplica import CSReplica
+
+SITES = '/Resources/Sites/LCG'
+OPTIONS = {SITES + '/LCG.A.uk/CE': 'ce1.a.ac.uk, ce2.a.ac.uk',
+           SITES + '/LCG.A.uk/CEs/ce1.a.ac.uk/LastSeen': '01/01/2024',
+           SITES + '/LCG.A.uk/CEs/ce1.a.ac.uk/Queues/q/LastSeen': '01/01/2020',
+           SITES + '/LCG.A.uk/CEs/ce2.a.ac.uk/LastSeen': 'garbage',
+           SITES + '/LCG.B.uk/CEs/ce.b.ac.uk/LastSeen': '05/03/2024',
+           '/Resources/StorageElements/SE-A/Host': 'se.a.ac.uk'}
+SECTIONS = {SITES, SITES + '/LCG.A.uk', SITES + '/LCG.A.uk/CEs', SITES + '/LCG.A.uk/CEs/ce1.a.ac.uk',
+            SITES + '/LCG.A.uk/CEs/ce1.a.ac.uk/Queues', SITES + '/LCG.A.uk/CEs/ce1.a.ac.uk/Queues/q',
+            SITES + '/LCG.A.uk/CEs/ce2.a.ac.uk', SITES + '/LCG.A.uk/CEs/ce3.a.ac.uk',
+            SITES + '/LCG.B.uk', SITES + '/LCG.B.uk/CEs', SITES + '/LCG.B.uk/CEs/ce.b.ac.uk',
+            '/Resources/StorageElements', '/Resources/StorageElements/SE-A'}
+CES = SITES + '/*/CEs/*'
+
+
+def _replica():
+    replica = CSReplica()
+    assert replica.refresh('1', OPTIONS, SECTIONS)
+    return replica
+
+
+def test_refresh_only_on_new_versions():
+    """The replica is rebuilt for a new or unknown version only."""
+    replica = _replica()
+    assert not replica.refresh('1', {}, ())
+    assert replica.sections(CES)
+    assert replica.refresh(None, {}, ())
+    assert replica.sections(CES) == []
+
+
+def test_each_star_is_one_element():
+    """A '*' never matches across a '/'."""
+    replica = _replica()
+    assert replica.sections(CES) == [SITES + '/LCG.A.uk/CEs/ce1.a.ac.uk', SITES + '/LCG.A.uk/CEs/ce2.a.ac.uk',
+                                     SITES + '/LCG.A.uk/CEs/ce3.a.ac.uk', SITES + '/LCG.B.uk/CEs/ce.b.ac.uk']
+    assert [section for section, _ in replica.options(CES, 'LastSeen')] == [
+        SITES + '/LCG.A.uk/CEs/ce1.a.ac.uk', SITES + '/LCG.A.uk/CEs/ce2.a.ac.uk',
+        SITES + '/LCG.B.uk/CEs/ce.b.ac.uk']
+
+
+def test_sections_without():
+    """Sections lacking an option."""
+    assert _replica().sections_without(CES, 'LastSeen') == [SITES + '/LCG.A.uk/CEs/ce3.a.ac.uk']
+
+
+def test_last_seen_before():
+    """Dates are compared as days, unparsable ones are never old."""
+    replica = _replica()
+    assert replica.last_seen_before(CES, date(2024, 3, 5)) == [(SITES + '/LCG.A.uk/CEs/ce1.a.ac.uk',
+                                                                '01/01/2024')]
+    assert len(replica.last_seen_before(CES, date(2024, 3, 6))) == 2
+
+
+def test_find():
+    """Sections by option value."""
+    replica = _replica()
+    assert replica.find('Host', 'se.a.ac.uk', '/Resources/StorageElements/*') == ['/Resources/StorageElements/SE-A']
+    assert replica.find('Host', 'se.b.ac.uk') == []
+
+
+def test_persists_with_its_version(tmp_path):
+    """A file replica is not rebuilt at the same version after a restart."""
+    path = str(tmp_path / 'replica.sqlite')
+    replica = CSReplica(path)
+    replica.refresh('7', OPTIONS, SECTIONS)
+    replica.close()
+    replica = CSReplica(path)
+    assert replica.version == '7'
+    assert not replica.refresh('7', {}, ())
+    assert replica.find('Host', 'se.a.ac.uk') == ['/Resources/StorageElements/SE-A']
@@ -0,0 +1,147 @@
+"""Tests of the discovery fingerprints and their use by the Glue2 CE updates."""
+import copy
+import re
+import time
+from datetime import date
+
+import pytest
+
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools import Glue2ARCAPI, Glue2HTCondorAPI
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.ConfigurationSystem import ChangeList
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.Fingerprints import (
+    Fingerprints, FingerprintingLdap, SeenRecorder, fingerprint, normalise)
+
+HTCONDOR_SERVICE = 'GLUE2ServiceID=svc1,GLUE2GroupID=resource,GLUE2DomainID=SITE-A,GLUE2GroupID=grid,o=glue'
+ARC_SERVICE = ('GLUE2ServiceID=urn:ogf:ComputingService:arc.a.ac.uk:arex,GLUE2GroupID=resource,'
+               'GLUE2DomainID=SITE-A,GLUE2GroupID=grid,o=glue')
+ENVIRONMENT = {'GLUE2ExecutionEnvironmentOSName': ['CentOS'], 'GLUE2ExecutionEnvironmentOSVersion': ['9'],
+               'GLUE2ExecutionEnvironmentPlatform': ['x86_64']}
+HTCONDOR_BDII = {
+    'GLUE2ComputingManager': [('GLUE2ManagerID=m,' + HTCONDOR_SERVICE,
+                               {'GLUE2ComputingManagerTotalLogicalCPUs': ['100'],
+                                'GLUE2EntityCreationTime': ['2024-05-01T00:00:00Z']})],
+    'GLUE2ComputingEndpoint': [('GLUE2EndpointID=e,' + HTCONDOR_SERVICE,
+                                {'GLUE2EndpointURL': ['condor://ce1.a.ac.uk:9619']})],
+    'GLUE2MappingPolicy': [('GLUE2PolicyID=p,' + HTCONDOR_SERVICE, {'GLUE2PolicyRule': ['VO:lz']})],
+    'GLUE2ExecutionEnvironment': [('GLUE2ResourceID=r,' + HTCONDOR_SERVICE, ENVIRONMENT)]}
+ARC_BDII = {
+    'GLUE2ComputingService': [(ARC_SERVICE, {'GLUE2EntityCreationTime': ['2024-05-01T00:00:00Z']})],
+    'GLUE2ComputingManager': [('GLUE2ManagerID=m,' + ARC_SERVICE, {'GLUE2ManagerProductName': ['condor']})],
+    'GLUE2ComputingShare': [('GLUE2ShareID=s1,' + ARC_SERVICE,
+                             {'GLUE2ShareID': ['s1'], 'GLUE2ComputingShareMappingQueue': ['grid'],
+                              'GLUE2ComputingShareRunningJobs': ['10']})],
+    'GLUE2MappingPolicy': [('GLUE2PolicyID=p,GLUE2ShareID=s1,' + ARC_SERVICE, {'GLUE2PolicyRule': ['VO:lz']})],
+    'GLUE2ExecutionEnvironment': [('GLUE2ResourceID=r,' + ARC_SERVICE, ENVIRONMENT)]}
+
+
+class FakeBDII(object):
+    """Answers searches with the rows of the filter's objectClass."""
+
+    object_class_regex = re.compile(r'objectClass=(\w+)')
+
+    def __init__(self, rows):
+        self.rows = copy.deepcopy(rows)
+        self.searches = 0
+
+    def search_s(self, base, filterstr, scope=None):
+        self.searches += 1
+        return list(self.rows.get(self.object_class_regex.search(filterstr).group(1), ()))
+
+
+def test_normalise_ignores_order_and_volatile_attributes():
+    """Result order and timestamps do not change the fingerprint, values do."""
+    rows = [('dn1', {'GLUE2EntityCreationTime': ['t1'], 'A': ['1', '2']}), ('dn2', {'B': ['3']})]
+    same = [('dn2', {'B': ['3']}), ('dn1', {'A': ['2', '1'], 'GLUE2EntityCreationTime': ['t2']})]
+    assert normalise(rows) == normalise(same)
+    assert fingerprint(rows, ['lz']) == fingerprint(same, ['lz'])
+    assert fingerprint(rows, ['lz']) != fingerprint(rows, ['lz', 'dune'])
+    assert fingerprint(rows, volatile=None) != fingerprint(same, volatile=None)
+
+
+def test_fingerprinting_ldap():
+    """The digest covers every search made, in order."""
+    bdii = FakeBDII(HTCONDOR_BDII)
+    first, second = FingerprintingLdap(bdii), FingerprintingLdap(bdii)
+    first.search_s('o=glue', '(objectClass=GLUE2ComputingManager)')
+    second.search_s('o=glue', '(objectClass=GLUE2ComputingManager)')
+    assert first.hexdigest() == second.hexdigest()
+    second.search_s('o=glue', '(objectClass=GLUE2MappingPolicy)')
+    assert first.hexdigest() != second.hexdigest()
+
+
+def test_replay_seen(tmp_path):
+    """An unchanged stage only sets LastSeen where it last did, once saved."""
+    state_file = str(tmp_path / 'fingerprints.json')
+    fingerprints = Fingerprints(state_file, inputs='a')
+    changes = ChangeList()
+    seen = set()
+    SeenRecorder(changes, seen).add('/Resources/Sites/LCG/X/CEs/ce', 'Queues', {'q': {'LastSeen': 'x'}})
+    SeenRecorder(changes, seen).add('/Resources/Sites/LCG/X/CEs/ce', 'LastSeen', 'x')
+    assert seen == {'/Resources/Sites/LCG/X/CEs/ce', '/Resources/Sites/LCG/X/CEs/ce/Queues/q'}
+    fingerprints.record('stage', 'fp', seen)
+    assert not fingerprints.replay_seen('stage', 'fp', ChangeList())
+    fingerprints.save()
+
+    changes = ChangeList()
+    assert Fingerprints(state_file, inputs='a').replay_seen('stage', 'fp', changes)
+    assert len(changes) == 2
+    assert not Fingerprints(state_file, inputs='a').replay_seen('stage', 'other', ChangeList())
+    assert not Fingerprints(state_file, inputs='b').replay_seen('stage', 'fp', ChangeList())
+    assert not Fingerprints(state_file, inputs='a', max_age=0).replay_seen('stage', 'fp', ChangeList())
+
+
+def test_corrupt_state_is_ignored(tmp_path):
+    """A corrupt state file means a full reconciliation."""
+    state_file = tmp_path / 'fingerprints.json'
+    state_file.write_text('{"stage": ')
+    assert not Fingerprints(str(state_file)).unchanged('stage', 'fp')
+
+
+def _calls(changes):
+    return [(method, args[:2]) for method, args in changes._calls]
+
+
+@pytest.mark.parametrize('update, build, rows', [
+    (Glue2HTCondorAPI.update_htcondor_ces, '_get_htcondor_ces', HTCONDOR_BDII),
+    (Glue2ARCAPI.update_arc_ces, '_get_arc_ces', ARC_BDII)])
+def test_unchanged_bdii_skips_the_model(monkeypatch, update, build, rows):
+    """The raw results are fingerprinted first, an unchanged BDII builds no model."""
+    module = Glue2HTCondorAPI if update is Glue2HTCondorAPI.update_htcondor_ces else Glue2ARCAPI
+    monkeypatch.setattr(module.site_metadata, 'country_code', lambda site, hosts=(), domain='LCG': 'uk')
+    fingerprints = Fingerprints()
+    changes = ChangeList()
+    bdii = FakeBDII(rows)
+    update(vo_list=['lz'], cfg_system=changes, fingerprints=fingerprints, bdii_pool=bdii)
+    built = _calls(changes)
+    assert ('append_unique', ('/Resources/Sites/LCG/LCG.SITE-A.uk', 'CE')) in built
+    fingerprints.save()
+
+    def no_build(*args, **kwargs):
+        raise AssertionError("The model was built for unchanged results")
+    bdii.rows['GLUE2ComputingManager'][0][1]['GLUE2EntityCreationTime'] = ['2024-05-02T00:00:00Z']
+    with monkeypatch.context() as patch:
+        patch.setattr(module, build, no_build)
+        changes = ChangeList()
+        searches = bdii.searches
+        update(vo_list=['lz'], cfg_system=changes, fingerprints=fingerprints, bdii_pool=bdii)
+    assert bdii.searches == 2 * searches
+    ce_sections = {args[0] for method, args in changes._calls}
+    assert changes._calls and all(method == 'add' and args[1:] == ('LastSeen', date.today().strftime('%d/%m/%Y'))
+                                  for method, args in changes._calls)
+    assert any(section.endswith('/CEs/ce1.a.ac.uk') or section.endswith('/CEs/arc.a.ac.uk')
+               for section in ce_sections)
+
+    bdii.rows['GLUE2MappingPolicy'][0][1]['GLUE2PolicyRule'] = ['VO:dune']
+    changes = ChangeList()
+    update(vo_list=['lz', 'dune'], cfg_system=changes, fingerprints=fingerprints, bdii_pool=bdii)
+    assert _calls(changes) == built
+
+
+def test_recorded_fingerprints_expire():
+    """A fingerprint older than max_age forces a full reconciliation."""
+    fingerprints = Fingerprints(max_age=60)
+    fingerprints.record('stage', 'fp', ())
+    fingerprints.save()
+    assert fingerprints.unchanged('stage', 'fp')
+    fingerprints._state['stage']['time'] = time.time() - 61
+    assert not fingerprints.unchanged('stage', 'fp')
@@ -0,0 +1,106 @@
+"""Tests of the Glue2 Site/CE/Queue model."""
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.Glue2Model import (
+    ComputeModel, ExecutionEnvironment, arch_sort_key, el_os_label, group_execution_environments, os_sort_key,
+    parse_dn, reduce_os_arch)
+
+SERVICE_DN = 'GLUE2ServiceID=svc1,GLUE2GroupID=resource,GLUE2DomainID=SITE-A,GLUE2GroupID=grid,o=glue'
+SHARE_DN = 'GLUE2PolicyID=p1,GLUE2ShareID=share1,' + SERVICE_DN
+
+
+def _model():
+    model = ComputeModel()
+    model.add_ce('SITE-A', 'svc1', 'ce1.a.ac.uk', CEType='AREX')
+    model.add_ce('SITE-A', 'svc1', 'ce2.a.ac.uk', CEType='AREX')
+    model.add_ce('SITE-B', 'svc2', 'ce.b.ac.uk', CEType='HTCondorCE')
+    return model
+
+
+def test_parse_dn():
+    """The outermost value of a repeated attribute wins."""
+    rdns = parse_dn(SHARE_DN)
+    assert rdns['GLUE2ShareID'] == 'share1'
+    assert rdns['GLUE2DomainID'] == 'SITE-A'
+    assert rdns['GLUE2GroupID'] == 'grid'
+
+
+def test_queues_are_added_to_every_ce_of_the_service():
+    """A share becomes a queue of each CE of its service, indexed by share."""
+    model = _model()
+    queues = model.add_queue('SITE-A', 'svc1', 'nordugrid-Condor-grid', share_id='share1', SI00=3100)
+    assert len(queues) == 2
+    assert model.queues_for_share('SITE-A', 'svc1', 'share1') == queues
+    for ce in model.ces('SITE-A', 'svc1'):
+        assert ce.as_dict()['Queues'] == {'nordugrid-Condor-grid': {'SI00': 3100, 'VO': set()}}
+
+
+def test_shares_of_one_queue_share_it():
+    """Shares mapping to the same queue build one queue, holding the VOs of them all."""
+    model = _model()
+    atlas = model.add_queue('SITE-A', 'svc1', 'q1', share_id='grid_atlas', MaxWaitingJobs=10, SI00=3100)
+    lhcb = model.add_queue('SITE-A', 'svc1', 'q1', share_id='grid_lhcb', MaxWaitingJobs=20)
+    assert [queue is other for queue, other in zip(atlas, lhcb)] == [True, True]
+    assert model.attach_vos('GLUE2PolicyID=p1,GLUE2ShareID=grid_atlas,' + SERVICE_DN, ['atlas'])
+    assert model.attach_vos('GLUE2PolicyID=p2,GLUE2ShareID=grid_lhcb,' + SERVICE_DN, ['lhcb'])
+    for ce in model.ces('SITE-A', 'svc1'):
+        assert ce.as_dict()['Queues'] == {'q1': {'MaxWaitingJobs': 20, 'SI00': 3100, 'VO': {'atlas', 'lhcb'}}}
+
+
+def test_vos_attach_by_share_and_by_service():
+    """Policies attach to the queues of their share, or of their whole service."""
+    model = _model()
+    model.add_queue('SITE-A', 'svc1', 'q1', share_id='share1')
+    model.add_queue('SITE-A', 'svc1', 'q2', share_id='share2')
+    assert model.attach_vos(SHARE_DN, ['gridpp'])
+    assert model.attach_service_vos(SERVICE_DN, ['lz'])
+    ce = next(iter(model.ces('SITE-A', 'svc1')))
+    assert ce.queues['q1'].vos == {'gridpp', 'lz'}
+    assert ce.queues['q2'].vos == {'lz'}
+
+
+def test_orphans_are_counted():
+    """Rows whose parent is unknown are dropped and counted."""
+    model = _model()
+    assert model.add_queue('SITE-X', 'svc9', 'q') == []
+    assert not model.attach_vos(SHARE_DN, ['gridpp'])
+    assert not model.attach_service_vos(SERVICE_DN.replace('svc1', 'svc9'), ['gridpp'])
+    assert model.dropped == {'share': 1, 'policy': 2}
+
+
+def test_iter_ces_is_ordered():
+    """CEs come out in (site, service) order."""
+    assert [(site, ce.name) for site, ce in _model().iter_ces()] == [('SITE-A', 'ce1.a.ac.uk'),
+                                                                    ('SITE-A', 'ce2.a.ac.uk'),
+                                                                    ('SITE-B', 'ce.b.ac.uk')]
+
+
+def test_group_execution_environments():
+    """Environments are grouped by service, names lower cased."""
+    attrs = {'GLUE2ExecutionEnvironmentOSName': ['AlmaLinux'],
+             'GLUE2ExecutionEnvironmentOSVersion': ['9.4'],
+             'GLUE2ExecutionEnvironmentPlatform': ['X86_64']}
+    groups = group_execution_environments([('GLUE2ResourceID=wn1,' + SERVICE_DN, attrs),
+                                           ('GLUE2ResourceID=wn2,' + SERVICE_DN, attrs)])
+    assert groups == {('SITE-A', 'svc1'): [ExecutionEnvironment('almalinux', '9.4', 'x86_64')] * 2}
+
+
+def test_os_and_arch_orderings_are_explicit():
+    """EL10 is newer than EL9, known architectures rank above unknown ones."""
+    assert sorted(['EL9', 'EL10', 'EL7'], key=os_sort_key) == ['EL7', 'EL9', 'EL10']
+    assert max(['aarch64', 'x86_64', 'sparc'], key=arch_sort_key) == 'x86_64'
+
+
+def test_el_os_label():
+    """Enterprise Linux rebuilds are labelled by major version."""
+    assert el_os_label(ExecutionEnvironment('centos', '7.9.2009', 'x86_64')) == 'EL7'
+    assert el_os_label(ExecutionEnvironment('scientific linux', '6', 'x86_64')) == 'EL6'
+    assert el_os_label(ExecutionEnvironment('ubuntu', '22.04', 'x86_64')) is None
+    assert el_os_label(ExecutionEnvironment('rocky', 'unknown', 'x86_64')) is None
+
+
+def test_reduce_os_arch():
+    """The newest labelled OS wins, but never one older than the default."""
+    envs = [ExecutionEnvironment('almalinux', '10.0', 'aarch64'),
+            ExecutionEnvironment('centos', '7.9', 'x86_64')]
+    assert reduce_os_arch(envs, default_os='EL9', os_label=el_os_label) == ('EL10', 'x86_64')
+    assert reduce_os_arch(envs[1:], default_os='EL9', os_label=el_os_label) == ('EL9', 'x86_64')
+    assert reduce_os_arch(envs, default_os='EL9') == ('EL9', 'x86_64')
@@ -0,0 +1,155 @@
+"""Tests of the GOCDB response cache against a local HTTP stand-in for GOCDB."""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import URLError
+from urllib.parse import parse_qs, urlparse
+from urllib.request import urlopen
+
+import pytest
+
+from DIRAC import S_OK, S_ERROR
+
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.GOCDBCache import GOCDBCache
+
+VAC = [{'HOSTNAME': 'vac01.a.ac.uk', 'SITENAME': 'UKI-A', 'SERVICE_TYPE': 'uk.ac.gridpp.vac'}]
+
+
+class FakeGOCDB(ThreadingHTTPServer):
+    """Serves the service endpoints of ?service_type=, or fails with HTTP 500 when down."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), FakeGOCDBHandler)
+        self.endpoints = {'uk.ac.gridpp.vac': VAC}
+        self.down = False
+        self.delay = 0.
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get_service_endpoints(self, service_type):
+        """Query as GOCDBClient.getServiceEndpointInfo does, returning S_OK/S_ERROR."""
+        url = 'http://127.0.0.1:%d/gocdbpi/public/?method=get_service_endpoint&service_type=%s' \
+              % (self.server_address[1], service_type)
+        try:
+            with urlopen(url, timeout=10) as response:
+                return S_OK(json.loads(response.read().decode()))
+        except URLError as err:
+            return S_ERROR(str(err))
+
+
+class FakeGOCDBHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.requests.append(time.time())
+        time.sleep(self.server.delay)
+        if self.server.down:
+            self.send_error(500)
+            return
+        service_type = parse_qs(urlparse(self.path).query)['service_type'][0]
+        body = json.dumps(self.server.endpoints.get(service_type, [])).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def gocdb():
+    server = FakeGOCDB()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_responses_are_cached(gocdb, tmp_path):
+    """A successful response is returned, hashed and written to the cache."""
+    cache = GOCDBCache(str(tmp_path))
+    result = cache.fetch('uk.ac.gridpp.vac', gocdb.get_service_endpoints, 'uk.ac.gridpp.vac')
+    assert result['OK'] and result['Value'].Value == VAC and not result['Value'].Cached
+    cached = cache.load('uk.ac.gridpp.vac')
+    assert cached.Value == VAC and cached.Hash == result['Value'].Hash and cached.Cached
+    assert [path.name for path in tmp_path.iterdir()] == ['gocdb_uk.ac.gridpp.vac.json']
+
+    # The hash only changes with the content
+    again = cache.fetch('uk.ac.gridpp.vac', gocdb.get_service_endpoints, 'uk.ac.gridpp.vac')
+    assert again['Value'].Hash == result['Value'].Hash
+    gocdb.endpoints['uk.ac.gridpp.vac'] = VAC + [dict(VAC[0], HOSTNAME='vac02.a.ac.uk')]
+    changed = cache.fetch('uk.ac.gridpp.vac', gocdb.get_service_endpoints, 'uk.ac.gridpp.vac')
+    assert changed['Value'].Hash != result['Value'].Hash
+    assert len(cache.load('uk.ac.gridpp.vac').Value) == 2
+
+
+def test_outage_falls_back_within_max_age(gocdb, tmp_path):
+    """The cached response is used while GOCDB is down, until it is max_age old."""
+    cache = GOCDBCache(str(tmp_path), max_age=60)
+    fetched = cache.fetch('vac', gocdb.get_service_endpoints, 'uk.ac.gridpp.vac')['Value']
+    gocdb.down = True
+    result = cache.fetch('vac', gocdb.get_service_endpoints, 'uk.ac.gridpp.vac')
+    assert result['OK'] and result['Value'].Cached
+    assert result['Value'].Value == VAC and result['Value'].Hash == fetched.Hash
+
+    cache.max_age = 0.1
+    time.sleep(0.2)
+    result = cache.fetch('vac', gocdb.get_service_endpoints, 'uk.ac.gridpp.vac')
+    assert not result['OK'] and '500' in result['Message']
+    # The stale response is kept for when max_age is raised again
+    assert cache.load('vac').Value == VAC
+
+
+def test_outage_without_cache(gocdb, tmp_path):
+    """With nothing cached the query's error is returned, as is a raised exception's."""
+    gocdb.down = True
+    cache = GOCDBCache(str(tmp_path))
+    assert not cache.fetch('vac', gocdb.get_service_endpoints, 'uk.ac.gridpp.vac')['OK']
+
+    def broken():
+        raise ValueError("bad response")
+    result = cache.fetch('broken', broken)
+    assert not result['OK'] and 'bad response' in result['Message']
+
+
+def test_corrupt_cache_is_ignored(gocdb, tmp_path):
+    """A corrupt cache file is no fallback, and is replaced by the next response."""
+    cache = GOCDBCache(str(tmp_path))
+    (tmp_path / 'gocdb_vac.json').write_text('{"value": [')
+    assert cache.load('vac') is None
+    (tmp_path / 'gocdb_vac.json').write_text('{"value": []}')
+    assert cache.load('vac') is None
+    gocdb.down = True
+    assert not cache.fetch('vac', gocdb.get_service_endpoints, 'uk.ac.gridpp.vac')['OK']
+    gocdb.down = False
+    assert cache.fetch('vac', gocdb.get_service_endpoints, 'uk.ac.gridpp.vac')['OK']
+    assert cache.load('vac').Value == VAC
+
+
+def test_fetch_all_is_concurrent(gocdb, tmp_path):
+    """The queries are sent at once, each falling back independently."""
+    gocdb.delay = 0.5
+    gocdb.endpoints['uk.ac.gridpp.vcycle'] = []
+    cache = GOCDBCache(str(tmp_path))
+    queries = {key: (gocdb.get_service_endpoints, (key,))
+               for key in ('uk.ac.gridpp.vac', 'uk.ac.gridpp.vcycle', 'other')}
+    start = time.time()
+    results = cache.fetch_all(queries)
+    assert time.time() - start < 1.2
+    assert max(gocdb.requests) - min(gocdb.requests) < 0.4
+    assert results['uk.ac.gridpp.vac']['Value'].Value == VAC
+    assert results['uk.ac.gridpp.vcycle']['Value'].Value == []
+    assert len(list(tmp_path.iterdir())) == 3
+
+    gocdb.delay = 0.
+    gocdb.down = True
+    (tmp_path / 'gocdb_other.json').unlink()
+    results = cache.fetch_all(queries, workers=1)
+    assert results['uk.ac.gridpp.vac']['Value'].Cached
+    assert not results['other']['OK']
+    assert cache.fetch_all({}) == {}
@@ -0,0 +1,127 @@
+"""Tests of the local LastSeen store and the lazy CS LastSeen sync."""
+import os
+from datetime import date, timedelta
+
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.ConfigurationSystem import ConfigurationSystem
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.LastSeenStore import LastSeenStore
+
+from conftest import FakeCS
+
+CE = '/Resources/Sites/LCG/LCG.A.uk/CEs/ce.a.ac.uk'
+DAY = date(2024, 5, 1)
+
+
+def test_mark_and_get(tmp_path):
+    """Only later days replace the stored one."""
+    store = LastSeenStore(str(tmp_path))
+    assert store.get(CE) is None
+    store.mark(CE, DAY)
+    store.mark(CE, DAY - timedelta(days=3))
+    assert store.get(CE) == DAY
+    assert CE in store
+    store.mark(CE)
+    assert store.get(CE) == date.today()
+
+
+def test_discard(tmp_path):
+    """Discarding a section with prefix also discards the keys below it."""
+    store = LastSeenStore(str(tmp_path))
+    site = CE.rsplit('/CEs/', 1)[0]
+    store.mark(CE, DAY)
+    store.mark(site, DAY)
+    store.mark(site + '2', DAY)
+    store.discard(site, prefix=True)
+    assert store.get(CE) is None and store.get(site) is None
+    assert dict(store.items('/Resources')) == {site + '2': DAY}
+
+
+def test_persists_and_grows(tmp_path):
+    """More keys than the initial capacity survive a reopen."""
+    store = LastSeenStore(str(tmp_path))
+    for i in range(3000):
+        store.mark('/Registry/Hosts/vm%d' % i, DAY + timedelta(days=i % 7))
+    store.close()
+    store = LastSeenStore(str(tmp_path))
+    assert len(store) == 3000
+    assert store.get('/Registry/Hosts/vm2999') == DAY + timedelta(days=2999 % 7)
+
+
+def test_discarded_keys_are_compacted_on_open(tmp_path):
+    """Reopening drops the discarded keys from both files."""
+    store = LastSeenStore(str(tmp_path))
+    for i in range(10):
+        store.mark('/Registry/Hosts/vm%d' % i, DAY + timedelta(days=i))
+    for i in range(0, 10, 2):
+        store.discard('/Registry/Hosts/vm%d' % i)
+    store.close()
+
+    store = LastSeenStore(str(tmp_path))
+    assert len(store) == 5
+    assert dict(store.items()) == {'/Registry/Hosts/vm%d' % i: DAY + timedelta(days=i) for i in range(1, 10, 2)}
+    with open(str(tmp_path / 'lastseen.keys')) as keys:
+        assert len(keys.read().splitlines()) == 5
+    store.mark('/Registry/Hosts/new', DAY)
+    store.close()
+    assert LastSeenStore(str(tmp_path)).get('/Registry/Hosts/new') == DAY
+
+
+def test_flush_compacts_once_half_are_discarded(tmp_path):
+    """A long running store does not grow with every key ever seen."""
+    store = LastSeenStore(str(tmp_path))
+    for i in range(100):
+        store.mark('/Registry/Hosts/vm%d' % i, DAY)
+        store.discard('/Registry/Hosts/vm%d' % (i - 1))
+        store.flush()
+        assert len(store) <= 3
+    assert dict(store.items()) == {'/Registry/Hosts/vm99': DAY}
+
+
+def test_interrupted_compaction_is_finished(tmp_path):
+    """Compacted files left by a crash are moved into place on open."""
+    store = LastSeenStore(str(tmp_path))
+    store.mark('/Registry/Hosts/a', DAY)
+    store.mark('/Registry/Hosts/b', DAY + timedelta(days=1))
+    store.close()
+    # As if the process died after writing the compacted files, dropping 'a'
+    with open(str(tmp_path / 'lastseen.keys')) as keys:
+        assert keys.read() == '/Registry/Hosts/a\n/Registry/Hosts/b\n'
+    days = (tmp_path / 'lastseen.days').read_bytes()
+    (tmp_path / 'lastseen.days.compact').write_bytes(days[4:8] + bytes(4))
+    (tmp_path / 'lastseen.keys.compact').write_text('/Registry/Hosts/b\n')
+
+    store = LastSeenStore(str(tmp_path))
+    assert dict(store.items()) == {'/Registry/Hosts/b': DAY + timedelta(days=1)}
+    assert not os.path.exists(str(tmp_path / 'lastseen.keys.compact'))
+
+    # A compacted days file on its own is incomplete and dropped
+    store.close()
+    (tmp_path / 'lastseen.days.compact').write_bytes(bytes(8))
+    assert dict(LastSeenStore(str(tmp_path)).items()) == {'/Registry/Hosts/b': DAY + timedelta(days=1)}
+    assert not os.path.exists(str(tmp_path / 'lastseen.days.compact'))
+
+
+def test_cs_last_seen_is_synced_lazily(master, tmp_path):
+    """LastSeen goes to the store, the CS only once it lags by last_seen_sync_days."""
+    today = date.today()
+    store = LastSeenStore(str(tmp_path))
+    ConfigurationSystem.configure(last_seen_store=store, last_seen_sync_days=3)
+    master.options[CE + '/LastSeen'] = (today - timedelta(days=2)).strftime('%d/%m/%Y')
+    master.options[CE.replace('ce.a', 'ce.b') + '/LastSeen'] = (today - timedelta(days=3)).strftime('%d/%m/%Y')
+    cfg_system = FakeCS()
+    cfg_system.add(CE, 'LastSeen', today.strftime('%d/%m/%Y'))
+    cfg_system.add(CE.replace('ce.a', 'ce.b').lstrip('/'), 'LastSeen', today.strftime('%d/%m/%Y'))
+    cfg_system.add(CE.replace('ce.a', 'ce.c'), 'LastSeen', today.strftime('%d/%m/%Y'))
+    assert [op[1] for op in cfg_system.diff()] == [CE.replace('ce.a', 'ce.b') + '/LastSeen',
+                                                   CE.replace('ce.a', 'ce.c') + '/LastSeen']
+    assert store.get(CE) == today
+    assert store.get(CE.replace('ce.a', 'ce.b')) == today
+
+
+def test_commit_flushes_the_store(master, tmp_path, monkeypatch):
+    """The store is flushed by commit even when there is nothing to commit."""
+    store = LastSeenStore(str(tmp_path))
+    ConfigurationSystem.configure(last_seen_store=store)
+    flushed = []
+    monkeypatch.setattr(store, 'flush', lambda: flushed.append(True))
+    FakeCS().commit()
+    assert flushed
@@ -0,0 +1,64 @@
+"""Tests of the agent metrics and the cycle report."""
+import json
+import os
+
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.Metrics import Metrics
+
+
+def test_textfile():
+    """Counters, gauges and timer summaries carry the prefix and constant labels."""
+    metrics = Metrics()
+    metrics.start_cycle(agent='AutoBdii2CSAgent')
+    metrics.inc('ldap_queries_total', host='bdii:2170')
+    metrics.inc('ldap_queries_total', 2, host='bdii:2170')
+    metrics.set('cs_changes', 5)
+    metrics.observe('stage_seconds', 1.5, stage='vac')
+    metrics.observe('stage_seconds', 0.5, stage='vac')
+    metrics.set('note', 1, text='a "quoted"\nline')
+    lines = metrics.textfile().splitlines()
+    assert lines[:2] == ['# TYPE gridppdirac_ldap_queries_total counter',
+                         'gridppdirac_ldap_queries_total{agent="AutoBdii2CSAgent",host="bdii:2170"} 3.0']
+    assert 'gridppdirac_cs_changes{agent="AutoBdii2CSAgent"} 5.0' in lines
+    assert 'gridppdirac_note{agent="AutoBdii2CSAgent",text="a \\"quoted\\"\\nline"} 1.0' in lines
+    assert 'gridppdirac_stage_seconds_count{agent="AutoBdii2CSAgent",stage="vac"} 2.0' in lines
+    assert 'gridppdirac_stage_seconds_sum{agent="AutoBdii2CSAgent",stage="vac"} 2.0' in lines
+    assert 'gridppdirac_stage_seconds_max{agent="AutoBdii2CSAgent",stage="vac"} 1.5' in lines
+    assert sum(line.startswith('# TYPE') for line in lines) == 6
+
+
+def test_report_covers_the_cycle():
+    """Counters and timers keep accumulating, the report holding this cycle's increases."""
+    metrics = Metrics()
+    metrics.inc('queries_total', 4)
+    with metrics.timer('stage_seconds', stage='vac'):
+        pass
+    metrics.set('cs_changes', 5)
+    metrics.start_cycle(agent='AutoBdii2CSAgent')
+    metrics.inc('queries_total')
+    metrics.inc('unchanged_total', 0)
+    metrics.observe('stage_seconds', 0.25, stage='vac')
+    report = metrics.report()
+    assert report['labels'] == {'agent': 'AutoBdii2CSAgent'}
+    assert report['counters'] == {'queries_total': 1}
+    assert report['gauges'] == {}
+    assert report['timers'] == {'stage_seconds{stage=vac}': {'count': 1, 'sum': 0.25, 'max': 0.25}}
+    assert 'gridppdirac_queries_total{agent="AutoBdii2CSAgent"} 5.0' in metrics.textfile()
+
+
+def test_export(tmp_path):
+    """The .prom file is named after the agent and shard in the textfile directory."""
+    metrics = Metrics(prefix='test_')
+    metrics.start_cycle(agent='AutoBdii2CSAgent', shard=1)
+    metrics.inc('queries_total')
+    textfile_dir = tmp_path / 'textfile'
+    textfile_dir.mkdir()
+    metrics.export(str(tmp_path), str(textfile_dir))
+    assert os.listdir(str(textfile_dir)) == ['autobdii2csagent_shard1.prom']
+    assert 'test_queries_total' in (textfile_dir / 'autobdii2csagent_shard1.prom').read_text()
+    report = json.loads((tmp_path / 'cycle_report.json').read_text())
+    assert report['counters'] == {'queries_total': 1}
+
+    metrics.export(str(tmp_path))
+    assert sorted(os.listdir(str(tmp_path))) == ['cycle_report.json', 'metrics.prom', 'textfile']
+    # An unwritable directory is only logged
+    metrics.export(str(tmp_path / 'missing'))
@@ -0,0 +1,165 @@
+"""Tests of the recorded fixtures and the offline stage runner."""
+import re
+
+import pytest
+
+from DIRAC import S_OK, S_ERROR
+
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools import SiteMetadata as metadata_module
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.Fixtures import (
+    Fixture, FixtureBDII, RecordingBDII)
+from GridPPDIRAC.ConfigurationSystem.private.OfflineRunner import (
+    OfflineConfigurationSystem, RunOptions, StageProfile, load_baseline, regressions, run_stages,
+    save_baseline)
+
+CFG = '''DIRAC
+{
+  Configuration
+  {
+    Version = 2024-05-01 00:00:00.000000
+  }
+}
+Resources
+{
+  Sites
+  {
+    VAC
+    {
+      VAC.UKI-A.uk
+      {
+        Name = UKI-A
+        CE = vac01.a.ac.uk
+        CEs
+        {
+          vac01.a.ac.uk
+          {
+            CEType = VMCloud
+            OS = EL9
+          }
+        }
+      }
+    }
+  }
+}
+'''
+VAC = [{'HOSTNAME': 'vac01.a.ac.uk', 'SITENAME': 'UKI-A', 'HOST_OS': 'RHEL 9', 'IN_PRODUCTION': 'Y'},
+       {'HOSTNAME': 'vac02.a.ac.uk', 'SITENAME': 'UKI-A', 'HOST_OS': 'RHEL 9', 'IN_PRODUCTION': 'Y'}]
+SERVICE = 'GLUE2ServiceID=svc1,GLUE2GroupID=resource,GLUE2DomainID=SITE-A,GLUE2GroupID=grid,o=glue'
+BDII = {'GLUE2ComputingManager': [('GLUE2ManagerID=m,' + SERVICE, {'GLUE2ComputingManagerTotalLogicalCPUs': ['8']})],
+        'GLUE2ComputingEndpoint': [('GLUE2EndpointID=e,' + SERVICE,
+                                    {'GLUE2EndpointURL': ['condor://ce1.a.ac.uk:9619']})],
+        'GLUE2MappingPolicy': [('GLUE2PolicyID=p,' + SERVICE, {'GLUE2PolicyRule': ['VO:lz']})],
+        'GLUE2ExecutionEnvironment': []}
+
+
+class LivePool(object):
+    """Stands in for the live BDIIPool and GOCDB."""
+
+    object_class_regex = re.compile(r'objectClass=(\w+)')
+
+    def search_s(self, base, filterstr, scope=None):
+        return list(BDII.get(self.object_class_regex.search(filterstr).group(1), ()))
+
+    def failover(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def getServiceEndpointInfo(self, query, service_type):
+        return S_OK(VAC) if service_type == 'uk.ac.gridpp.vac' else S_ERROR('GOCDB down')
+
+
+class FakeGConfig(object):
+
+    def getSections(self, path):
+        return S_OK([])
+
+
+@pytest.fixture
+def cfg_path(tmp_path, master, monkeypatch):
+    """A local CS file, with the shared ConfigurationSystem and site metadata state reset."""
+    monkeypatch.setattr(metadata_module, 'gConfig', FakeGConfig())
+    metadata_module.site_metadata.reset()
+    path = tmp_path / 'dirac.cfg'
+    path.write_text(CFG)
+    return str(path)
+
+
+def _record(tmp_path):
+    """Record the live answers to a fixture file."""
+    fixture = Fixture(str(tmp_path / 'fixture.json'))
+    live = LivePool()
+    recording = RecordingBDII(live, fixture, gocdb_client=live)
+    recording.search_s('o=glue', '(objectClass=GLUE2MappingPolicy)')
+    assert recording.failover(lambda vo, host=None: S_OK({'vo': vo, 'CEs': {'a', 'b'}}), 'lz')['OK']
+    assert recording.services('uk.ac.gridpp.vac') == VAC
+    with pytest.raises(RuntimeError):
+        recording.services('uk.ac.gridpp.vcycle')
+    fixture.save()
+    return fixture
+
+
+def test_fixture_round_trip(tmp_path):
+    """Recorded answers, sets included, are replayed as recorded."""
+    fixture = _record(tmp_path)
+    loaded = Fixture(fixture.path)
+    assert len(loaded) == len(fixture) == 3
+    bdii = FixtureBDII(loaded)
+    assert bdii.search_s('o=glue', '(objectClass=GLUE2MappingPolicy)') == BDII['GLUE2MappingPolicy']
+    assert bdii.failover(lambda vo, host=None: None, 'lz')['Value'] == {'vo': 'lz', 'CEs': {'a', 'b'}}
+    assert bdii.services('uk.ac.gridpp.vac') == VAC
+
+
+def test_unrecorded_answers(tmp_path):
+    """What was not recorded fails rather than being queried."""
+    bdii = FixtureBDII(Fixture(str(tmp_path / 'missing.json')))
+    with pytest.raises(RuntimeError):
+        bdii.search_s('o=glue', '(objectClass=GLUE2ComputingService)')
+    with pytest.raises(RuntimeError):
+        bdii.services('uk.ac.gridpp.vac')
+    assert not bdii.failover(lambda vo, host=None: S_OK(), 'lz')['OK']
+    with pytest.raises(RuntimeError):
+        RecordingBDII(LivePool(), Fixture()).services('uk.ac.gridpp.vac')
+
+
+def test_offline_plan(cfg_path, tmp_path):
+    """The planned changes are attributed to their stages, nothing is committed."""
+    fixture = Fixture()
+    recording = RecordingBDII(LivePool(), fixture, gocdb_client=LivePool())
+    cfg_system = OfflineConfigurationSystem(cfg_path)
+    profiles, _ = run_stages(cfg_system, recording, RunOptions(['lz']), ['vac', 'update_htcondor_ces'])
+    fixture.save(str(tmp_path / 'fixture.json'))
+
+    cfg_system = OfflineConfigurationSystem(cfg_path)
+    profiles, plan = run_stages(cfg_system, FixtureBDII(Fixture(str(tmp_path / 'fixture.json'))),
+                                RunOptions(['lz']), ['vac', 'update_htcondor_ces', 'vcycle'])
+    assert [(profile.Stage, profile.Error is None) for profile in profiles] == [
+        ('vac', True), ('update_htcondor_ces', True), ('vcycle', False)]
+    assert 'uk.ac.gridpp.vcycle' in profiles[2].Error
+    changes = {record.Path: record for record in plan}
+    assert changes['/Resources/Sites/VAC/VAC.UKI-A.uk/CE'].New == 'vac01.a.ac.uk, vac02.a.ac.uk'
+    assert changes['/Resources/Sites/VAC/VAC.UKI-A.uk/CE'].Stage == 'vac'
+    assert '/Resources/Sites/VAC/VAC.UKI-A.uk/CEs/vac01.a.ac.uk/OS' not in changes
+    assert changes['/Resources/Sites/LCG/LCG.SITE-A.uk/CE'].Stage == 'update_htcondor_ces'
+    assert profiles[0].Changes == sum(1 for record in plan if record.Stage == 'vac')
+    assert profiles[0].Seconds >= 0 and profiles[0].PeakMemory > 0
+    with pytest.raises(RuntimeError):
+        cfg_system.commit()
+    with pytest.raises(ValueError):
+        run_stages(cfg_system, FixtureBDII(Fixture()), RunOptions(['lz']), ['update_everything'])
+
+
+def test_missing_cfg(tmp_path):
+    """A CS file that cannot be loaded fails straight away."""
+    with pytest.raises(RuntimeError):
+        OfflineConfigurationSystem(str(tmp_path / 'missing.cfg'))
+
+
+def test_baseline_regressions(tmp_path):
+    """Only the increases beyond both the tolerance and the minimum are regressions."""
+    path = str(tmp_path / 'baseline.json')
+    save_baseline(path, [StageProfile('a', 1., 10 << 20, 5, None), StageProfile('b', 1., 1 << 20, 0, 'failed')])
+    baseline = load_baseline(path)
+    assert list(baseline) == ['a'] and baseline['a'].Changes == 5
+    assert regressions([StageProfile('a', 1.1, 11 << 20, 5, None)], baseline) == []
+    found = regressions([StageProfile('a', 2., 20 << 20, 5, None), StageProfile('new', 9., 0, 0, None)], baseline)
+    assert len(found) == 2 and found[0].startswith('a took 2.00s')
+    assert regressions([StageProfile('a', 9., 0, 0, 'failed')], baseline) == []
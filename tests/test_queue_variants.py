@@ -0,0 +1,70 @@
+"""Tests of the declarative queue variant expansion."""
+import pytest
+
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools import QueueVariants
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.QueueVariants import (
+    ARC_QUEUE_VARIANTS, HTCONDOR_QUEUE_VARIANTS, arc_variant_name, expand_queues, htcondor_variant_name,
+    load_queue_variants)
+
+
+def _expanded(ce, queues, variants, namer):
+    return {name: record.as_dict() for name, record in expand_queues(ce, queues, variants, namer).items()}
+
+
+def test_htcondor_single_and_multi_core():
+    """Every HTCondor queue gets an 8 core variant."""
+    queues = _expanded('ce.a.ac.uk', {'ce.a.ac.uk-condor': {'SI00': 3100, 'VO': {'lz', 'gridpp'}}},
+                       HTCONDOR_QUEUE_VARIANTS, htcondor_variant_name)
+    assert queues == {'ce.a.ac.uk-condor': {'SI00': 3100, 'VO': ('gridpp', 'lz'), 'NumberOfProcessors': 1},
+                      'ce.a.ac.uk-condor-multi': {'SI00': 3100, 'VO': ('gridpp', 'lz'), 'NumberOfProcessors': 8,
+                                                  'Tag': 'MultiProcessor', 'RequiredTag': 'MultiProcessor',
+                                                  'LocalCEType': 'Pool'}}
+
+
+def test_arc_first_matching_variant_wins():
+    """Within a suffix the first matching variant is used, ARC names keep the rsl part."""
+    queues = _expanded('ce.a.ac.uk', {'nordugrid-Condor-gpu': {}, 'nordugrid-Condor-grid': {}},
+                       ARC_QUEUE_VARIANTS, arc_variant_name)
+    assert queues['nordugrid-Condor-gpu']['Tag'] == 'GPU'
+    assert queues['nordugrid-multimCondor-gpu']['Tag'] == 'MultiProcessor, GPU'
+    assert 'Tag' not in queues['nordugrid-Condor-grid']
+    assert queues['nordugrid-multimCondor-grid']['Tag'] == 'MultiProcessor'
+
+
+def test_site_specific_variants():
+    """The Glasgow ARM queues are tagged."""
+    queues = _expanded('ce1.gla.scotgrid.ac.uk', {'nordugrid-Condor-condor_arm': {}},
+                       ARC_QUEUE_VARIANTS, arc_variant_name)
+    assert queues['nordugrid-Condor-condor_arm']['Tag'] == 'ARM'
+    assert queues['nordugrid-multimCondor-condor_arm']['Tag'] == 'MultiProcessor, ARM'
+
+
+def test_variants_share_the_base_options():
+    """All variants of a queue share one read only base mapping."""
+    records = expand_queues('ce', {'ce-condor': {'SI00': 3100}}, HTCONDOR_QUEUE_VARIANTS, htcondor_variant_name)
+    assert records['ce-condor'].Base is records['ce-condor-multi'].Base
+    with pytest.raises(TypeError):
+        records['ce-condor'].Base['SI00'] = 1
+
+
+def test_load_queue_variants(monkeypatch):
+    """CS variants come before the defaults, bad ones are skipped."""
+    class FakeConfig(object):
+        sections = {'Multi16': {'Suffix': 'multi16', 'Processors': '16', 'Tags': 'MultiProcessor, BigMem',
+                                'LocalCEType': 'Pool', 'CEMatch': r'\.ac\.uk$'},
+                    'Bad': {'Suffix': 'bad', 'QueueMatch': '('}}
+
+        def getSections(self, section):
+            return {'OK': True, 'Value': sorted(self.sections)}
+
+        def getOptionsDict(self, path):
+            return {'OK': True, 'Value': self.sections[path.rsplit('/', 1)[1]]}
+
+    monkeypatch.setattr(QueueVariants, 'gConfig', FakeConfig())
+    variants = load_queue_variants('/Systems/Configuration/QueueVariants', HTCONDOR_QUEUE_VARIANTS)
+    assert variants[1:] == HTCONDOR_QUEUE_VARIANTS
+    assert (variants[0].Suffix, variants[0].Processors, variants[0].Tags) == ('multi16', 16,
+                                                                               ('MultiProcessor', 'BigMem'))
+    assert variants[0].Match('ce.a.ac.uk', 'any')
+    assert not variants[0].Match('ce.cern.ch', 'any')
+    assert set(expand_queues('ce.cern.ch', {'q': {}}, variants, htcondor_variant_name)) == {'q', 'q-multi'}
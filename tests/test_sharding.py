@@ -0,0 +1,39 @@
+"""Tests of the partition of the sites between agent instances."""
+import pytest
+
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.Sharding import Shard, gocdb_name, shard_of
+
+SITES = ['UKI-LT2-IC-HEP', 'UKI-NORTHGRID-MAN-HEP', 'UKI-SCOTGRID-GLASGOW', 'RAL-LCG2', 'CERN-PROD'] + \
+        ['SITE-%d' % index for index in range(50)]
+
+
+def test_gocdb_name():
+    assert gocdb_name('LCG.UKI-LT2-IC-HEP.uk') == 'UKI-LT2-IC-HEP'
+    assert gocdb_name('VAC.UKI.NORTH.uk') == 'UKI.NORTH'
+
+
+def test_every_site_has_one_shard():
+    """Each site is owned by exactly one of the shards, all of them used."""
+    shards = [Shard(index, 3) for index in range(3)]
+    owners = {site: [shard.Index for shard in shards if shard.owns(site)] for site in SITES}
+    assert all(len(owner) == 1 for owner in owners.values())
+    assert {owner[0] for owner in owners.values()} == {0, 1, 2}
+    assert all(owners[site] == [shard_of(site, 3)] for site in SITES)
+    assert all(Shard().owns(site) for site in SITES)
+
+
+def test_paths_and_ses_follow_the_site():
+    """CS paths and SE names are owned by the shard of their GOCDB site."""
+    for site in SITES:
+        shard = Shard(shard_of(site, 4), 4)
+        assert shard.owns_site_path('/Resources/Sites/LCG/LCG.%s.uk' % site)
+        assert shard.owns_site_path('/Resources/Sites/LCG/LCG.%s.uk/CEs/ce01.example.org/Queues' % site)
+        assert shard.owns_se('%s-disk' % site)
+        assert not Shard((shard.Index + 1) % 4, 4).owns_se('%s-disk' % site)
+
+
+def test_invalid_shards():
+    assert str(Shard('1', '2')) == '1/2'
+    for index, count in ((2, 2), (-1, 2), (0, 0)):
+        with pytest.raises(ValueError):
+            Shard(index, count)
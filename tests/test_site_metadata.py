@@ -0,0 +1,135 @@
+"""Tests of the site country code resolution from the CS, GOCDB and host names."""
+import pytest
+
+from DIRAC import S_OK
+
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools import SiteMetadata as metadata_module
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.GOCDBCache import GOCDBCache
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.SiteMetadata import (
+    SiteMetadata, fetch_gocdb_sites, guess_country_code)
+
+GOCDB_SITES = '''<?xml version="1.0" encoding="UTF-8"?>
+<results>
+  <SITE ID="1" PRIMARY_KEY="1G0" NAME="UKI-LT2-IC-HEP">
+    <SHORT_NAME>UKI-LT2-IC-HEP</SHORT_NAME>
+    <COUNTRY_CODE>GB</COUNTRY_CODE>
+    <LONGITUDE>-0.17</LONGITUDE>
+    <LATITUDE>51.49</LATITUDE>
+    <CONTACT_EMAIL>lcg-site-admin@imperial.ac.uk</CONTACT_EMAIL>
+    <DOMAIN><DOMAIN_NAME>.hep.ph.ic.ac.uk</DOMAIN_NAME></DOMAIN>
+  </SITE>
+  <SITE ID="2" PRIMARY_KEY="2G0" NAME="CERN-PROD">
+    <SHORT_NAME>CERN-PROD</SHORT_NAME>
+    <COUNTRY_CODE>CH</COUNTRY_CODE>
+    <DOMAIN><DOMAIN_NAME>cern.ch</DOMAIN_NAME></DOMAIN>
+  </SITE>
+  <SITE ID="3" PRIMARY_KEY="3G0" NAME="NO-COUNTRY">
+    <SHORT_NAME>NO-COUNTRY</SHORT_NAME>
+    <DOMAIN><DOMAIN_NAME>nowhere.org</DOMAIN_NAME></DOMAIN>
+  </SITE>
+</results>
+'''
+
+
+class FakeGConfig(object):
+    """The CS site sections by path, counting the lookups."""
+
+    def __init__(self, sections):
+        self.sections = sections
+        self.lookups = 0
+
+    def getSections(self, path):
+        self.lookups += 1
+        return S_OK(self.sections.get(path, []))
+
+
+@pytest.fixture
+def gconfig(monkeypatch):
+    gconfig = FakeGConfig({'/Resources/Sites/LCG': ['LCG.UKI-LT2-IC-HEP.uk', 'LCG.Renamed.fr', 'LCG.Renamed.xx',
+                                                    'LCG.Default.xx', 'Not.A.Site.Name.Here', 'LCG']})
+    monkeypatch.setattr(metadata_module, 'gConfig', gconfig)
+    return gconfig
+
+
+@pytest.fixture
+def gocdb_url(tmp_path):
+    sites = tmp_path / 'get_site.xml'
+    sites.write_text(GOCDB_SITES)
+    return sites.as_uri()
+
+
+def test_guess_country_code():
+    """Known suffixes first, then the top level domain."""
+    assert guess_country_code('ce.hep.ph.ic.ac.uk') == 'uk'
+    assert guess_country_code(' CE.FNAL.GOV ') == 'us'
+    assert guess_country_code('ce.efda.org') == 'uk'
+    assert guess_country_code('ce.example.com') is None
+
+
+def test_fetch_gocdb_sites(gocdb_url, tmp_path):
+    """Each SITE becomes a flat dict, a bad response an S_ERROR."""
+    result = fetch_gocdb_sites(gocdb_url)
+    assert result['OK'] and len(result['Value']) == 3
+    assert result['Value'][0]['SHORT_NAME'] == 'UKI-LT2-IC-HEP'
+    assert result['Value'][0]['DOMAIN_NAME'] == '.hep.ph.ic.ac.uk'
+    (tmp_path / 'bad.xml').write_text('<results><SITE>')
+    assert not fetch_gocdb_sites((tmp_path / 'bad.xml').as_uri())['OK']
+    assert not fetch_gocdb_sites((tmp_path / 'missing.xml').as_uri())['OK']
+
+
+def test_resolution_order(gconfig, gocdb_url):
+    """CS name, then GOCDB record, then host names, then the default."""
+    metadata = SiteMetadata(url=gocdb_url)
+    assert metadata.refresh()['OK']
+    # The existing CS name wins over GOCDB, a default code only if there is no other
+    assert metadata.country_code('Renamed', ['ce.cern.ch']) == 'fr'
+    assert metadata.country_code('Default', ['ce.cern.ch']) == 'ch'
+    # GOCDB records, with ISO codes mapped to DIRAC's
+    assert metadata.country_code('UKI-LT2-IC-HEP') == 'uk'
+    assert metadata.site('UKI-LT2-IC-HEP').Coordinates == '-0.17:51.49'
+    assert metadata.country_code('CERN-PROD', ['ce.cern.fr']) == 'ch'
+    # The GOCDB domains, then CC_MAPPINGS, then the top level domain of the hosts
+    assert metadata.host_country('ce01.hep.ph.ic.ac.uk') == 'uk'
+    assert metadata.country_code('NO-COUNTRY', ['ce.example.com', 'ce.cern.ch']) == 'ch'
+    assert metadata.country_code('Lab', ['ce.fnal.gov']) == 'us'
+    assert metadata.country_code('Unknown', ['ce.example.com'], default='zz') == 'zz'
+    assert gconfig.lookups == 1
+
+
+def test_codes_are_kept_for_the_cycle(gconfig):
+    """A site keeps the code of its first CE until reset."""
+    metadata = SiteMetadata()
+    assert metadata.country_code('NEW', ['ce.a.fr']) == 'fr'
+    assert metadata.country_code('NEW', ['ce.b.de']) == 'fr'
+    assert metadata.country_code('NEW', ['ce.b.de'], domain='VAC') == 'de'
+    metadata.reset()
+    assert metadata.country_code('NEW', ['ce.b.de']) == 'de'
+    assert gconfig.lookups == 3
+
+
+def test_refresh_ttl_and_failure(gconfig, gocdb_url, tmp_path):
+    """GOCDB is queried at most every ttl, a failure keeping the records held."""
+    metadata = SiteMetadata(ttl=3600, url=gocdb_url)
+    assert metadata.refresh()['OK']
+    sites_hash = metadata.hash
+    (tmp_path / 'get_site.xml').write_text('broken')
+    assert metadata.refresh()['OK']
+    assert not metadata.refresh(force=True)['OK']
+    assert metadata.site('CERN-PROD') is not None and metadata.hash == sites_hash
+
+
+def test_refresh_through_the_cache(gconfig, gocdb_url, tmp_path):
+    """The cached records are used while younger than ttl and when GOCDB fails."""
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+    metadata = SiteMetadata(cache=GOCDBCache(str(cache_dir)), url=gocdb_url)
+    assert metadata.refresh()['OK']
+    (tmp_path / 'get_site.xml').write_text('broken')
+
+    restarted = SiteMetadata(cache=GOCDBCache(str(cache_dir)), url=gocdb_url)
+    assert restarted.refresh()['OK']
+    assert restarted.country_code('CERN-PROD') == 'ch'
+    assert restarted.refresh(force=True)['OK']
+    assert restarted.hash == metadata.hash
+    with pytest.raises(TypeError):
+        restarted.configure(retries=3)
@@ -0,0 +1,154 @@
+"""Tests of stage deadlines, cancellation and the concurrent StageScheduler."""
+import threading
+import time
+
+import pytest
+
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.ConfigurationSystem import ChangeList
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.Deadline import (
+    CancelToken, StageCancelled, call_with_deadline, cancel_scope, check_cancelled, current_token)
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.Fingerprints import Fingerprints
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.StageScheduler import StageScheduler
+
+
+def test_deadline_is_the_earliest_in_the_chain():
+    """A token's deadline is bounded by its parent's."""
+    cycle = CancelToken(10)
+    stage = CancelToken(100, parent=cycle)
+    assert 9 < stage.remaining() <= 10
+    assert stage.timeout(5) == 5
+    assert CancelToken().timeout(5) == 5
+    assert CancelToken().remaining() is None
+    expiring = CancelToken(parent=CancelToken(0.01))
+    assert not expiring.cancelled
+    time.sleep(0.02)
+    assert expiring.cancelled and expiring.expired and expiring.remaining() == 0
+
+
+def test_cancel_runs_callbacks_once():
+    """Callbacks run on cancel, or straight away if already cancelled, never twice."""
+    calls = []
+    cycle = CancelToken()
+    token = CancelToken(parent=cycle)
+    token.on_cancel(lambda: calls.append('a'))
+    token.on_cancel(lambda: calls.append('removed'))
+    token.remove_callback(token._callbacks[-1])
+    cycle.cancel()
+    assert token.cancelled and calls == []
+    token.cancel()
+    token.cancel()
+    assert calls == ['a']
+    token.on_cancel(lambda: calls.append('late'))
+    assert calls == ['a', 'late']
+    with pytest.raises(StageCancelled):
+        token.check()
+
+
+def test_cancel_scope_is_per_thread():
+    """The current token is that of the enclosing cancel_scope, in this thread only."""
+    token = CancelToken()
+    seen = []
+    with cancel_scope(token):
+        assert current_token() is token
+        thread = threading.Thread(target=lambda: seen.append(current_token()))
+        thread.start()
+        thread.join()
+        token.cancel()
+        with pytest.raises(StageCancelled):
+            check_cancelled()
+    assert current_token() is None and seen == [None]
+    check_cancelled()
+
+
+def test_call_with_deadline():
+    """A call overrunning the deadline is abandoned and its token cancelled."""
+    assert call_with_deadline(CancelToken(5), lambda x: x + 1, 1) == 2
+    with pytest.raises(ValueError):
+        call_with_deadline(CancelToken(5), int, 'x')
+    token = CancelToken(0.2)
+    start = time.time()
+    with pytest.raises(StageCancelled):
+        call_with_deadline(token, time.sleep, 30)
+    assert time.time() - start < 2
+    assert token.cancelled
+
+
+def _stage(delay, *changes, **kwargs):
+    """A stage sleeping delay seconds, or until cancelled, then recording changes."""
+    cfg_system = kwargs['cfg_system']
+    current_token()._event.wait(delay)
+    check_cancelled()
+    for section in changes:
+        cfg_system.add(section, 'LastSeen', '01/05/2024')
+
+
+def _failing_stage(cfg_system):
+    cfg_system.add('/Registry/Hosts/failed', 'LastSeen', '01/05/2024')
+    raise ValueError("BDII down")
+
+
+def _sections(changes):
+    return [args[0] for _, args in changes._calls]
+
+
+def test_changes_are_applied_in_stage_order():
+    """Stages run at once and are applied in the order added, not the order they finished."""
+    cfg_system = ChangeList()
+    scheduler = StageScheduler(cfg_system)
+    scheduler.add('slow', _stage, 0.3, '/a1', '/a2')
+    scheduler.add('fast', _stage, 0., '/b1')
+    start = time.time()
+    results = scheduler.run()
+    assert time.time() - start < 0.6
+    assert _sections(cfg_system) == ['/a1', '/a2', '/b1']
+    assert [(result.Name, result.Changes, result.Error) for result in results] == [('slow', 2, None),
+                                                                                  ('fast', 1, None)]
+
+
+def test_failed_stage_changes_are_dropped():
+    """A failing stage is reported and the other stages still applied."""
+    cfg_system = ChangeList()
+    scheduler = StageScheduler(cfg_system, workers=1)
+    scheduler.add('failing', _failing_stage)
+    scheduler.add('ok', _stage, 0., '/b1')
+    results = scheduler.run()
+    assert _sections(cfg_system) == ['/b1']
+    assert isinstance(results[0].Error, ValueError) and results[0].Time is None
+
+
+def test_overrun_stage_is_cancelled():
+    """A stage past stage_timeout is cancelled and dropped without holding up the others."""
+    cfg_system = ChangeList()
+    scheduler = StageScheduler(cfg_system, stage_timeout=0.3)
+    scheduler.add('hung', _stage, 30, '/hung')
+    scheduler.add('ok', _stage, 0.1, '/ok')
+    start = time.time()
+    results = scheduler.run()
+    assert time.time() - start < 2
+    assert _sections(cfg_system) == ['/ok']
+    assert isinstance(results[0].Error, StageCancelled)
+    assert results[1].Error is None
+
+
+def test_cycle_deadline_bounds_every_stage():
+    """Stages, including those waiting for a worker, stop at the cycle deadline."""
+    cfg_system = ChangeList()
+    scheduler = StageScheduler(cfg_system, workers=1, stage_timeout=60, token=CancelToken(0.3))
+    scheduler.add('first', _stage, 30, '/first')
+    scheduler.add('queued', _stage, 0., '/queued')
+    start = time.time()
+    results = scheduler.run()
+    assert time.time() - start < 2
+    assert len(cfg_system) == 0
+    assert all(isinstance(result.Error, StageCancelled) for result in results)
+
+
+def test_cancelled_stage_records_no_fingerprint():
+    """A cancelled stage's fingerprint is not recorded, as its changes are dropped."""
+    fingerprints = Fingerprints()
+    token = CancelToken()
+    token.cancel()
+    with cancel_scope(token):
+        fingerprints.record('stage', 'fp', ())
+    fingerprints.save()
+    assert not fingerprints.unchanged('stage', 'fp')
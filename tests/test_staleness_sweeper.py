@@ -0,0 +1,88 @@
+"""Tests of the StalenessSweeper and ConfigurationSystem.last_seen_before."""
+from datetime import date, timedelta
+
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.ConfigurationSystem import ConfigurationSystem
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.LastSeenStore import LastSeenStore
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.StalenessSweeper import StalenessSweeper
+
+from conftest import FakeCS
+
+DAY = date(2024, 5, 1)
+HOSTS = '/Registry/Hosts/*'
+CES = '/Resources/Sites/VAC/*/CEs/*'
+CE = '/Resources/Sites/VAC/VAC.UKI-A.uk/CEs/vac.a.ac.uk'
+
+
+def _date(day):
+    return day.strftime('%d/%m/%Y')
+
+
+def test_expired_oldest_first():
+    """Only entries before the cutoff and matching the pattern are returned."""
+    sweeper = StalenessSweeper()
+    sweeper.seen('/Registry/Hosts/b', DAY)
+    sweeper.seen('/Registry/Hosts/a', DAY - timedelta(days=2))
+    sweeper.seen('/Registry/Hosts/c', DAY + timedelta(days=1))
+    sweeper.seen('/Registry/Hosts/a/Sub', DAY - timedelta(days=5))
+    assert sweeper.expired(HOSTS, DAY + timedelta(days=1)) == [('/Registry/Hosts/a', DAY - timedelta(days=2)),
+                                                               ('/Registry/Hosts/b', DAY)]
+    # Returned entries stay tracked
+    assert len(sweeper.expired(HOSTS, DAY + timedelta(days=1))) == 2
+    assert len(sweeper) == 4
+
+
+def test_seen_later_and_forget():
+    """A later sighting supersedes an entry, an earlier one is ignored."""
+    sweeper = StalenessSweeper()
+    sweeper.seen('/Registry/Hosts/a', DAY)
+    sweeper.seen('/Registry/Hosts/a', DAY - timedelta(days=10))
+    sweeper.seen('/Registry/Hosts/b', DAY)
+    sweeper.seen('/Registry/Hosts/b', DAY + timedelta(days=10))
+    assert sweeper.expired(HOSTS, DAY + timedelta(days=1)) == [('/Registry/Hosts/a', DAY)]
+    sweeper.forget('/Registry/Hosts/a')
+    assert sweeper.expired(HOSTS, DAY + timedelta(days=1)) == []
+    assert len(sweeper) == 1
+
+
+def test_last_seen_before(master):
+    """Old sections are found from the CS, removed ones dropped."""
+    master.options.update({'/Registry/Hosts/old/LastSeen': _date(DAY - timedelta(days=30)),
+                           '/Registry/Hosts/new/LastSeen': _date(DAY),
+                           '/Registry/Hosts/bad/LastSeen': 'garbage'})
+    assert FakeCS().last_seen_before(HOSTS, DAY) == [('/Registry/Hosts/old', _date(DAY - timedelta(days=30)))]
+    master.write('/Registry/Hosts/old/LastSeen')
+    assert FakeCS().last_seen_before(HOSTS, DAY) == []
+    assert len(ConfigurationSystem._sweeper) == 1
+
+
+def test_sections_seen_elsewhere_are_not_returned(master):
+    """A LastSeen updated in the CS by another process since seeding is honoured."""
+    master.options.update({'/Registry/Hosts/vm/LastSeen': _date(DAY - timedelta(days=30))})
+    assert FakeCS().last_seen_before(HOSTS, DAY) == [('/Registry/Hosts/vm', _date(DAY - timedelta(days=30)))]
+    master.write('/Registry/Hosts/vm/LastSeen', _date(DAY))
+    cfg_system = FakeCS()
+    assert cfg_system.last_seen_before(HOSTS, DAY) == []
+    assert cfg_system.last_seen_before(HOSTS, DAY + timedelta(days=1)) == [('/Registry/Hosts/vm', _date(DAY))]
+
+
+def test_store_day_is_used(master, tmp_path):
+    """A sighting only in the store, the CS lagging behind, keeps a section."""
+    store = LastSeenStore(str(tmp_path))
+    ConfigurationSystem.configure(last_seen_store=store)
+    master.options.update({CE + '/LastSeen': _date(DAY - timedelta(days=30))})
+    cfg_system = FakeCS()
+    assert cfg_system.last_seen_before(CES, DAY) == [(CE, _date(DAY - timedelta(days=30)))]
+    store.mark(CE, DAY - timedelta(days=2))
+    assert cfg_system.last_seen_before(CES, DAY - timedelta(days=5)) == []
+    assert cfg_system.last_seen_before(CES, DAY) == [(CE, _date(DAY - timedelta(days=2)))]
+
+
+def test_relative_mark_seen_refreshes_seeded_entries(master):
+    """Sections marked seen under relative paths are the ones the sweep tracks."""
+    master.options.update({CE + '/LastSeen': _date(DAY - timedelta(days=30))})
+    cfg_system = FakeCS()
+    assert cfg_system.last_seen_before(CES.lstrip('/'), DAY) == [(CE, _date(DAY - timedelta(days=30)))]
+    cfg_system.mark_seen(CE.lstrip('/'), DAY)
+    assert cfg_system.last_seen_before(CES, DAY) == []
+    assert cfg_system.last_seen_before(CES.lstrip('/'), DAY) == []
+    assert len(ConfigurationSystem._sweeper) == 1
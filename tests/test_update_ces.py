@@ -0,0 +1,84 @@
+"""Tests of the concurrent Glue1 site model building of update_ces."""
+import time
+
+from DIRAC import S_OK
+from GridPPDIRAC.ConfigurationSystem.private import AddResourceAPI
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools import CETypes
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.ConfigurationSystem import ChangeList
+
+SITES = ['UKI-A', 'UKI-B', 'UKI-BAD', 'UKI-C', 'UKI-D', 'UKI-E']
+
+
+class FakeMetadata(object):
+    """Resolves every site to the uk, later sites faster, failing UKI-BAD."""
+
+    def country_code(self, site, hosts=(), domain='LCG', default='xx'):
+        # Finish the sites in reverse order
+        time.sleep(0.02 * (len(SITES) - SITES.index(site)))
+        if site == 'UKI-BAD':
+            raise ValueError("Broken site")
+        return 'uk'
+
+    def site(self, name):
+        return None
+
+
+class FakeConfig(object):
+
+    def getSections(self, path):
+        return S_OK(['%s-disk' % site for site in SITES])
+
+
+class FakeLogger(object):
+    """Records the warnings."""
+
+    def __init__(self):
+        self.warnings = []
+
+    def warn(self, msg):
+        self.warnings.append(msg)
+
+    def notice(self, msg):
+        pass
+
+    error = notice
+
+
+def _ce_info(vo, host=None):
+    return S_OK({site: {'CEs': {'ce-%s.%s.ac.uk' % (vo, site.lower()): {}}} for site in SITES})
+
+
+def _update(monkeypatch, workers):
+    logger = FakeLogger()
+    monkeypatch.setattr(AddResourceAPI, 'getGlue2CEInfo', _ce_info)
+    monkeypatch.setattr(AddResourceAPI, 'gLogger', logger)
+    monkeypatch.setattr(CETypes, 'site_metadata', FakeMetadata())
+    monkeypatch.setattr(CETypes, 'gConfig', FakeConfig())
+    changes = ChangeList()
+    AddResourceAPI.update_ces(['gridpp', 'lz'], workers=workers, cfg_system=changes)
+    return changes, logger.warnings
+
+
+def test_sites_are_merged_in_order(monkeypatch):
+    """The sites built concurrently are merged sorted by site, as when built one at a time."""
+    changes, warnings = _update(monkeypatch, workers=4)
+    sites = []
+    for _, args in changes._calls:
+        site = args[0].split('/')[4]
+        if not sites or sites[-1] != site:
+            sites.append(site)
+    assert sites == ['LCG.%s.uk' % site for site in SITES if site != 'UKI-BAD']
+    assert ('add', ('/Resources/Sites/LCG/LCG.UKI-E.uk', 'Name', 'UKI-E')) in changes._calls
+    assert ('append_unique', ('/Resources/Sites/LCG/LCG.UKI-A.uk', 'SE', ['UKI-A-disk'])) in changes._calls
+
+    serial, serial_warnings = _update(monkeypatch, workers=1)
+    assert changes._calls == serial._calls
+    assert warnings == serial_warnings
+
+
+def test_failing_site_is_reported(monkeypatch):
+    """A site failing to build is reported and skipped, the others still written."""
+    changes, warnings = _update(monkeypatch, workers=4)
+    assert warnings == ["Skipping problematic site: UKI-BAD with error Broken site"]
+    assert not any('UKI-BAD' in args[0] for _, args in changes._calls)
+    assert len({args[0] for _, args in changes._calls}) == len(SITES) - 1
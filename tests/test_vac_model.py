@@ -0,0 +1,92 @@
+"""Tests of the VAC/vcycle site model built from GOCDB service endpoints."""
+from datetime import date
+
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.VacModel import VacModel
+
+from conftest import FakeCS
+
+SITE = '/Resources/Sites/VAC/VAC.UKI-A.uk'
+DN = '/C=UK/O=eScience/OU=A/L=Physics/CN=vac01.a.ac.uk/CN=pilot'
+
+
+class FakeMetadata(object):
+    """Resolves every site to the uk."""
+
+    def country_code(self, site, hosts=(), domain='LCG', default='xx'):
+        return 'uk'
+
+
+def _service(hostname, sitename='UKI-A', host_os='RHEL 9', production='Y', extensions=()):
+    return {'HOSTNAME': hostname, 'SITENAME': sitename, 'HOST_OS': host_os, 'IN_PRODUCTION': production,
+            'EXTENSIONS': [{'KEY': key, 'VALUE': value} for key, value in extensions]}
+
+
+SERVICES = [_service('vac01.a.ac.uk', extensions=[('PILOT_SE_GridPP', 'UKI-A-disk'),
+                                                  ('PILOT_DN_GridPP', DN),
+                                                  ('PILOT_SE_Other', 'UKI-A-other')]),
+            _service('vac01.a.ac.uk', extensions=[('PILOT_DN_GridPP', DN)]),
+            _service('vac02.a.ac.uk', host_os='CentOS7'),
+            _service('vac03.a.ac.uk', host_os='unknown'),
+            _service('vac04.a.ac.uk', production='N'),
+            {'HOSTNAME': 'nosite.ac.uk', 'IN_PRODUCTION': 'Y'}]
+
+
+def _model():
+    model = VacModel(['GridPP'], metadata=FakeMetadata())
+    model.add_services(SERVICES, 'VAC')
+    return model
+
+
+def test_host_os():
+    """GOCDB HOST_OS values become EL labels, EL9 if unknown."""
+    assert VacModel.host_os('RHEL 9') == 'EL9'
+    assert VacModel.host_os('CentOS7') == 'EL7'
+    assert VacModel.host_os('') == 'EL9'
+
+
+def test_services_are_normalised():
+    """Repeated endpoints are merged, those not in production or lacking a site skipped."""
+    model = _model()
+    assert list(model.sites) == ['VAC.UKI-A.uk']
+    site = model.sites['VAC.UKI-A.uk']
+    assert site.CEs == {'vac01.a.ac.uk': 'EL9', 'vac02.a.ac.uk': 'EL7', 'vac03.a.ac.uk': 'EL9'}
+    assert site.SEs == {'UKI-A-disk'}
+    assert model.hosts == {'vac01.a.ac.uk': DN}
+    assert len(model) == 3
+
+
+def test_write_uses_absolute_paths(master):
+    """The model is written under the absolute CS paths, diffing against the snapshot."""
+    today = date.today().strftime('%d/%m/%Y')
+    master.options.update({SITE + '/CE': 'vac01.a.ac.uk', SITE + '/CEs/vac01.a.ac.uk/OS': 'EL9',
+                           '/Registry/Hosts/vac01.a.ac.uk/DN': DN})
+    cfg_system = FakeCS()
+    _model().write(cfg_system, 'VAC')
+    cfg_system._merge_appends()
+    ops = {op[1]: op for op in cfg_system.diff()}
+    assert all(path.startswith(('/Resources/Sites/VAC/', '/Registry/Hosts/')) for path in ops)
+    assert SITE + '/CEs/vac01.a.ac.uk/OS' not in ops
+    assert '/Registry/Hosts/vac01.a.ac.uk/DN' not in ops
+    assert ops[SITE + '/CE'][3] == 'vac01.a.ac.uk, vac02.a.ac.uk, vac03.a.ac.uk'
+    assert ops[SITE + '/CEs/vac02.a.ac.uk/Queues/default/maxCPUTime'][3] == '400000'
+    assert ops['/Registry/Hosts/vac01.a.ac.uk/Properties'][3] == 'GenericPilot, LimitedDelegation'
+    assert ops['/Registry/Hosts/vac01.a.ac.uk/LastSeen'][3] == today
+
+    cfg_system.commit()
+    cfg_system = FakeCS()
+    _model().write(cfg_system, 'VAC')
+    cfg_system._merge_appends()
+    assert cfg_system.diff() == []
+
+
+def test_written_sections_are_not_swept(master):
+    """The LastSeen written by the model refreshes the sweep of the VAC CEs and hosts."""
+    old = '01/01/2020'
+    master.options.update({SITE + '/CEs/vac01.a.ac.uk/LastSeen': old, '/Registry/Hosts/vac01.a.ac.uk/LastSeen': old,
+                           SITE + '/CEs/gone.a.ac.uk/LastSeen': old})
+    cfg_system = FakeCS()
+    assert len(cfg_system.last_seen_before('/Resources/Sites/VAC/*/CEs/*', date.today())) == 2
+    _model().write(cfg_system, 'VAC')
+    assert cfg_system.last_seen_before('/Resources/Sites/VAC/*/CEs/*', date.today()) == [
+        (SITE + '/CEs/gone.a.ac.uk', old)]
+    assert cfg_system.last_seen_before('/Registry/Hosts/*', date.today()) == []
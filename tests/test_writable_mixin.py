@@ -0,0 +1,96 @@
+"""Tests of the WritableMixin write plans compiled for the CS types."""
+from collections import namedtuple
+
+import pytest
+
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.CETypes import CE, Queue, Site
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.SETypes import SE, AccessProtocol
+from GridPPDIRAC.ConfigurationSystem.private.AutoResourceTools.utils import FIELD_EMITTERS, WritableMixin
+
+from conftest import FakeCS
+
+SITE = '/Resources/Sites/LCG/LCG.UKI-A.uk'
+CE_PATH = SITE + '/CEs/ce1.a.ac.uk'
+SE_PATH = '/Resources/StorageElements/UKI-A-disk'
+
+
+def _site():
+    # _make skips the BDII parsing constructors
+    queue = Queue._make(('q1', {'lhcb', 'atlas'}, '2000', '2880', 10, None))
+    ce = CE._make(('ce1.a.ac.uk', [queue], 8, '01/01/2026', 'x86_64', '', '', 'HTCondorCE', 'EL9', None, None))
+    return Site._make(('LCG.UKI-A.uk', 'UKI-A', [ce], 'LCG site', '0.0:0.0', 'a@b', {'ce1.a.ac.uk'}, {'UKI-A-tape'}))
+
+
+def _se():
+    protocol = AccessProtocol._make(('AccessProtocol.1', {'lhcb': '/dpm/lhcb'}, 'srm', 'GFAL2_SRM2', 8446,
+                                     'remote', '/dpm', None, '/srm/managerv2?SFN=', 'se.a.ac.uk'))
+    return SE._make(('UKI-A-disk', (protocol,), 'se.a.ac.uk', 'DPM', None, {'lhcb'}, 100, '01/01/2026'))
+
+
+def _ops(objects):
+    cfg_system = FakeCS()
+    for obj, path_root in objects:
+        obj.write(cfg_system, path_root)
+    cfg_system._merge_appends()
+    return cfg_system.diff()
+
+
+def test_site_and_se_operations(master):
+    """A Site and SE write the expected CS operations, sets appended to what is there."""
+    master.options[SITE + '/SE'] = 'UKI-A-disk'
+    ops = _ops([(_site(), '/Resources/Sites/LCG'), (_se(), '/Resources/StorageElements')])
+    assert ops == [
+        ('setOption', SITE + '/CE', None, 'ce1.a.ac.uk'),
+        ('setOption', CE_PATH + '/CEType', None, 'HTCondorCE'),
+        ('setOption', CE_PATH + '/LastSeen', None, '01/01/2026'),
+        ('setOption', CE_PATH + '/MaxProcessors', None, '8'),
+        ('setOption', CE_PATH + '/OS', None, 'EL9'),
+        ('setOption', CE_PATH + '/Queues/q1/MaxTotalJobs', None, '10'),
+        ('setOption', CE_PATH + '/Queues/q1/SI00', None, '2000'),
+        ('setOption', CE_PATH + '/Queues/q1/VO', None, 'atlas, lhcb'),
+        ('setOption', CE_PATH + '/Queues/q1/maxCPUTime', None, '2880'),
+        ('setOption', CE_PATH + '/architecture', None, 'x86_64'),
+        ('setOption', SITE + '/Coordinates', None, '0.0:0.0'),
+        ('setOption', SITE + '/Description', None, 'LCG site'),
+        ('setOption', SITE + '/Mail', None, 'a@b'),
+        ('setOption', SITE + '/Name', None, 'UKI-A'),
+        ('modifyValue', SITE + '/SE', 'UKI-A-disk', 'UKI-A-disk, UKI-A-tape'),
+        ('setOption', SE_PATH + '/AccessProtocol.1/Access', None, 'remote'),
+        ('setOption', SE_PATH + '/AccessProtocol.1/Host', None, 'se.a.ac.uk'),
+        ('setOption', SE_PATH + '/AccessProtocol.1/Path', None, '/dpm'),
+        ('setOption', SE_PATH + '/AccessProtocol.1/PluginName', None, 'GFAL2_SRM2'),
+        ('setOption', SE_PATH + '/AccessProtocol.1/Port', None, '8446'),
+        ('setOption', SE_PATH + '/AccessProtocol.1/Protocol', None, 'srm'),
+        ('setOption', SE_PATH + '/AccessProtocol.1/VOPath/lhcb', None, '/dpm/lhcb'),
+        ('setOption', SE_PATH + '/AccessProtocol.1/WSUrl', None, '/srm/managerv2?SFN='),
+        ('setOption', SE_PATH + '/BackendType', None, 'DPM'),
+        ('setOption', SE_PATH + '/Host', None, 'se.a.ac.uk'),
+        ('setOption', SE_PATH + '/LastSeen', None, '01/01/2026'),
+        ('setOption', SE_PATH + '/TotalSize', None, '100'),
+        ('setOption', SE_PATH + '/VO', None, 'lhcb')]
+
+
+def test_compiled_plans_match_auto(master, monkeypatch):
+    """The declared field kinds write what picking the emitter from each value's type did."""
+    objects = [(_site(), '/Resources/Sites/LCG'), (_se(), '/Resources/StorageElements')]
+    expected = _ops(objects)
+    for cls in (Site, CE, Queue, SE, AccessProtocol):
+        monkeypatch.setattr(cls, '_write_plan', tuple((index, option, FIELD_EMITTERS['auto'])
+                                                      for index, option, _ in cls._write_plan))
+    assert _ops(objects) == expected
+
+
+def test_write_plan_layout():
+    """Every field but DiracName gets one entry, in field order."""
+    assert [option for _, option, _ in Site._write_plan] == list(Site._fields[1:])
+    assert [index for index, _, _ in SE._write_plan] == list(range(1, len(SE._fields)))
+    assert SE._write_plan[0][2] is FIELD_EMITTERS['writable_tuple']
+    assert dict((option, emit) for _, option, emit in Site._write_plan)['CE'] is FIELD_EMITTERS['set']
+
+
+def test_unknown_field_kind():
+    """Declaring a kind for a field the type does not have fails at class creation."""
+    with pytest.raises(TypeError):
+        class Broken(WritableMixin, namedtuple('Broken', ('DiracName', 'Name'))):
+            __slots__ = ()
+            _field_kinds = {'Nmae': 'scalar'}